@@ -0,0 +1,76 @@
+"""
+================================================
+benchmarks.__main__ -- Benchmark suite runner
+================================================
+
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import sys
+
+from benchmarks import endtoend, micro, startup
+from benchmarks.harness import (compare, environment, format_comparison,
+                                load_results, write_results)
+from pikachewie.bench import broker_from_url
+
+SUITES = ('micro', 'endtoend', 'startup')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Run PikaChewie benchmarks.')
+    parser.add_argument('-s', '--suite', dest='suites', action='append',
+                        choices=SUITES, help='suite to run; may be repeated '
+                        '(default: all suites)')
+    parser.add_argument('--url', help='AMQP URL of a RabbitMQ node to '
+                        'benchmark against (default: in-process fake broker)')
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='iterations per microbenchmark (default: 10000)')
+    parser.add_argument('-c', '--count', type=int, default=10000,
+                        help='messages per end-to-end benchmark '
+                        '(default: 10000)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--save-baseline', metavar='PATH',
+                        help='also write results to PATH for later '
+                        'comparison')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed fractional throughput drop before a '
+                        'benchmark counts as regressed (default: 0.10)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    suites = args.suites or SUITES
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('pikachewie').setLevel(logging.ERROR)
+
+    results = {'environment': environment(), 'benchmarks': {},
+               'broker': args.url or 'fake'}
+    if 'micro' in suites:
+        results['benchmarks'].update(micro.run(args.number))
+    if 'endtoend' in suites:
+        broker = broker_from_url(args.url)
+        results['benchmarks'].update(endtoend.run(broker, args.count))
+    if 'startup' in suites:
+        results['benchmarks'].update(startup.run())
+
+    write_results(results, args.output)
+    if args.save_baseline:
+        write_results(results, args.save_baseline)
+
+    if args.baseline:
+        comparison = compare(results, load_results(args.baseline),
+                             args.tolerance)
+        print(format_comparison(comparison), file=sys.stderr)
+        if any(regressed for _, _, _, _, regressed in comparison):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
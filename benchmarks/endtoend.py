@@ -0,0 +1,102 @@
+"""
+===================================================================
+benchmarks.endtoend -- Publisher and consumer throughput benchmarks
+===================================================================
+
+"""
+import time
+from timeit import default_timer
+
+from benchmarks.harness import summarize_latencies
+from benchmarks.micro import make_body
+from pikachewie.agent import ConsumerAgent
+from pikachewie.bench import EXCHANGE, QUEUE, SENT_AT_HEADER, declare
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.publisher import BlockingPublisher
+
+ROUTING_KEY = 'bench.message'
+
+CONFIG = {
+    'exchanges': {EXCHANGE: {'exchange_type': 'topic', 'durable': False,
+                             'auto_delete': False}},
+    'queues': {QUEUE: {'durable': False, 'auto_delete': False}},
+}
+BINDINGS = [{'queue': QUEUE, 'exchange': EXCHANGE,
+             'routing_key': ROUTING_KEY}]
+
+
+def publish(broker, count, size, content_type='application/json'):
+    """Publish `count` messages with confirms, timing each publish.
+
+    :returns: ``(elapsed seconds, list of per-publish latencies)``
+
+    """
+    publisher = BlockingPublisher(broker)
+    body = make_body(size, content_type)
+    properties = Properties()
+    properties.content_type = content_type
+    latencies = []
+    start = default_timer()
+    for _ in range(count):
+        properties.headers = {SENT_AT_HEADER: int(time.time() * 1e6)}
+        sent = default_timer()
+        publisher.publish(EXCHANGE, ROUTING_KEY, body, properties)
+        latencies.append(default_timer() - sent)
+    publisher.process_data_events()
+    return default_timer() - start, latencies
+
+
+class TimingConsumer(Consumer):
+    """Records end-to-end latency and stops the IOLoop after `count`."""
+
+    def __init__(self, count, stop):
+        self.count = count
+        self.stop = stop
+        self.latencies = []
+
+    def process_message(self):
+        self.message.payload
+        sent_at = self.message.headers.get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self.latencies.append(time.time() - sent_at / 1e6)
+        if len(self.latencies) >= self.count:
+            self.stop()
+
+
+def consume(broker, count, prefetch_count=100):
+    """Consume `count` messages from the benchmark queue.
+
+    :returns: ``(elapsed seconds, list of end-to-end latencies)``
+
+    """
+    consumer = TimingConsumer(count, lambda: agent.connection.ioloop.stop())
+    agent = ConsumerAgent(consumer, broker, BINDINGS, config=CONFIG,
+                          prefetch_count=prefetch_count)
+    start = default_timer()
+    agent.run()
+    elapsed = default_timer() - start
+    agent.disconnect()
+    return elapsed, consumer.latencies
+
+
+def run(broker, count=10000, sizes=(128, 16 * 1024)):
+    """Run the publisher and consumer benchmarks against `broker`.
+
+    :returns: dict of benchmark name to result
+    :rtype: dict
+
+    """
+    results = {}
+    for size in sizes:
+        declare(broker, CONFIG, BINDINGS)
+        elapsed, latencies = publish(broker, count, size)
+        result = {'ops_per_sec': round(count / elapsed, 3), 'number': count}
+        result.update(summarize_latencies(latencies))
+        results['publish.confirmed[%d]' % size] = result
+
+        elapsed, latencies = consume(broker, count)
+        result = {'ops_per_sec': round(count / elapsed, 3), 'number': count}
+        result.update(summarize_latencies(latencies))
+        results['consume.end_to_end[%d]' % size] = result
+    return results
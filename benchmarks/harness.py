@@ -0,0 +1,115 @@
+"""
+=====================================================
+benchmarks.harness -- Timing and reporting utilities
+=====================================================
+
+"""
+import json
+import platform
+import sys
+import time
+from timeit import default_timer
+
+import pika
+
+from pikachewie.utils import percentile
+
+# results are compared on this metric (higher is better)
+METRIC = 'ops_per_sec'
+
+
+def summarize_latencies(latencies):
+    """Return a dict of latency percentiles (in microseconds)."""
+    samples = sorted(latencies)
+    return {
+        'p50_us': _micros(percentile(samples, 0.50)),
+        'p99_us': _micros(percentile(samples, 0.99)),
+        'p999_us': _micros(percentile(samples, 0.999)),
+        'max_us': _micros(samples[-1] if samples else None),
+    }
+
+
+def _micros(seconds):
+    return None if seconds is None else round(seconds * 1e6, 3)
+
+
+def timeit(func, number, repeat=3):
+    """Time `number` calls of `func`, keeping the best of `repeat` runs.
+
+    :returns: benchmark result dict
+    :rtype: dict
+
+    """
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        METRIC: round(number / best, 3) if best else None,
+        'mean_us': _micros(best / number),
+        'number': number,
+    }
+
+
+def environment():
+    """Describe the environment the benchmarks ran in."""
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'pika': pika.__version__,
+        'time': int(time.time()),
+    }
+
+
+def write_results(results, path):
+    """Write `results` as JSON to `path` (or stdout if `path` is ``-``)."""
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if path == '-':
+        sys.stdout.write(document + '\n')
+    else:
+        with open(path, 'w') as f:
+            f.write(document + '\n')
+
+
+def load_results(path):
+    """Load previously written benchmark results from `path`."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=0.10):
+    """Compare `results` against `baseline`.
+
+    A benchmark regresses when its throughput falls more than `tolerance`
+    (a fraction) below its baseline throughput.
+
+    :returns: list of ``(name, baseline, current, ratio, regressed)`` tuples
+    :rtype: list
+
+    """
+    comparison = []
+    current = results['benchmarks']
+    for name, expected in sorted(baseline['benchmarks'].items()):
+        if name not in current:
+            continue
+        before, after = expected.get(METRIC), current[name].get(METRIC)
+        if not before or after is None:
+            continue
+        ratio = after / before
+        comparison.append((name, before, after, ratio,
+                           ratio < 1 - tolerance))
+    return comparison
+
+
+def format_comparison(comparison):
+    """Format the output of :func:`compare` as a text table."""
+    lines = ['%-50s %14s %14s %8s' % ('benchmark', 'baseline', 'current',
+                                      'ratio')]
+    for name, before, after, ratio, regressed in comparison:
+        lines.append('%-50s %14.1f %14.1f %7.2fx%s' % (
+            name, before, after, ratio, '  REGRESSED' if regressed else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,156 @@
+"""
+=========================================================
+benchmarks.micro -- Message build and decode benchmarks
+=========================================================
+
+"""
+import bz2
+import zlib
+
+import simplejson
+from pika import spec
+from pika.spec import BasicProperties
+
+from benchmarks.harness import timeit
+from pikachewie.agent import ConsumerAgent
+from pikachewie.bench import make_payload
+from pikachewie.columnar import decode_columns
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.message import Message
+from pikachewie.publisher import BlockingPublisher
+
+BODY_SIZES = (128, 16 * 1024, 1024 * 1024)
+CODECS = {
+    None: lambda body: body,
+    'gzip': zlib.compress,
+    'bzip2': bz2.compress,
+}
+CONTENT_TYPES = ('application/json', 'text/plain')
+
+
+def make_body(size, content_type, codec=None):
+    """Return an encoded message body of about `size` bytes."""
+    if content_type == 'application/json':
+        body = simplejson.dumps(make_payload(size)).encode('utf-8')
+    else:
+        body = (b'Chewie, we are home. ' * (size // 21 + 1))[:size]
+    return CODECS[codec](body)
+
+
+def make_header(content_type='application/json', codec=None, headers=None):
+    return BasicProperties(app_id='bench', content_type=content_type,
+                           content_encoding=codec, delivery_mode=2,
+                           message_id='0123456789abcdef', timestamp=1,
+                           headers=headers or {'x-bench': 1})
+
+
+def make_method(delivery_tag=1):
+    return spec.Basic.Deliver('ctag1.1', delivery_tag, False, 'bench',
+                              'bench.key')
+
+
+class NullChannel(object):
+    """A channel that ignores acknowledgements."""
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        pass
+
+
+class NullConsumer(Consumer):
+    """A consumer that does nothing with its messages."""
+
+    def process_message(self):
+        pass
+
+
+def bench_message_build(number):
+    method, header = make_method(), make_header()
+    body = make_body(BODY_SIZES[0], 'application/json')
+    yield 'message.build', timeit(
+        lambda: Message(None, method, header, body), number)
+
+
+def bench_message_decode(number):
+    method = make_method()
+    for size in BODY_SIZES:
+        count = max(1, number * BODY_SIZES[0] // size)
+        for content_type in CONTENT_TYPES:
+            for codec in sorted(CODECS, key=str):
+                body = make_body(size, content_type, codec)
+                header = make_header(content_type, codec)
+                name = 'message.decode[%s,%s,%d]' % (
+                    content_type.split('/')[1], codec or 'identity', size)
+                yield name, timeit(
+                    lambda: Message(None, method, header, body).payload,
+                    count)
+
+
+def bench_columnar_decode(number):
+    method, header = make_method(), make_header()
+    records = make_payload(BODY_SIZES[0] * 100)['records']
+    bodies = [simplejson.dumps(dict(record, id=index)).encode('utf-8')
+              for index, record in enumerate(records)]
+    fields = [('id', 'q'), ('score', 'd'), 'name']
+    count = max(1, number // len(bodies))
+
+    def per_message():
+        messages = [Message(None, method, header, body) for body in bodies]
+        return [[message.payload[name] for message in messages]
+                for name in ('id', 'score', 'name')]
+
+    def batch():
+        messages = [Message(None, method, header, body) for body in bodies]
+        return decode_columns(messages, fields, use_numpy=False)
+
+    yield 'columnar.per_message[%d]' % len(bodies), timeit(per_message,
+                                                           count)
+    yield 'columnar.batch[%d]' % len(bodies), timeit(batch, count)
+
+
+def bench_properties_copy(number):
+    header = make_header(headers={'a': 1, 'b': [1, 2, 3], 'c': {'d': 'e'}})
+    yield 'properties.copy', timeit(lambda: Properties(header), number)
+
+
+def bench_build_basic_properties(number):
+    publisher = BlockingPublisher(None)
+    properties = Properties(make_header())
+    yield 'publisher.build_basic_properties', timeit(
+        lambda: publisher._build_basic_properties(properties), number)
+
+
+def bench_agent_process(number):
+    agent = ConsumerAgent(NullConsumer(), None, [])
+    agent.channel = channel = NullChannel()
+    method, header = make_method(), make_header()
+    body = make_body(BODY_SIZES[0], 'application/json')
+    yield 'agent.process_and_ack', timeit(
+        lambda: agent.process(channel, method, header, body), number)
+
+
+BENCHMARKS = (
+    bench_message_build,
+    bench_message_decode,
+    bench_columnar_decode,
+    bench_properties_copy,
+    bench_build_basic_properties,
+    bench_agent_process,
+)
+
+
+def run(number=10000):
+    """Run the microbenchmarks.
+
+    :returns: dict of benchmark name to result
+    :rtype: dict
+
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        for name, result in benchmark(number):
+            results[name] = result
+    return results
@@ -0,0 +1,78 @@
+"""
+=========================================================
+benchmarks.startup -- Import time and memory benchmarks
+=========================================================
+
+Each import is measured in a fresh interpreter, so that nothing is already
+cached in :data:`sys.modules`.  Memory is measured in a separate run, since
+tracing allocations slows imports down.
+
+"""
+import json
+import subprocess
+import sys
+
+IMPORTS = (
+    ('package', 'import pikachewie'),
+    ('publisher', 'from pikachewie import BlockingPublisher'),
+    ('agent', 'from pikachewie import ConsumerAgent'),
+)
+
+SCRIPT = '''
+import json, sys
+from timeit import default_timer
+tracemalloc = None
+if sys.argv[1:] == ['--memory']:
+    try:
+        import tracemalloc
+        tracemalloc.start()
+    except ImportError:
+        pass
+before = set(sys.modules)
+start = default_timer()
+%s
+seconds = default_timer() - start
+print(json.dumps({
+    'seconds': seconds,
+    'allocated_kb': tracemalloc.get_traced_memory()[1] / 1024.0
+    if tracemalloc else None,
+    'modules': len(set(sys.modules) - before),
+    'tornado': 'tornado' in sys.modules,
+}))
+'''
+
+
+def measure(statement, repeat=5):
+    """Time `statement` in `repeat` fresh interpreters, keeping the best.
+
+    :returns: benchmark result dict
+    :rtype: dict
+
+    """
+    def sample(*args):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT % statement] + list(args))
+        return json.loads(output.decode('utf-8'))
+
+    best = min((sample() for _ in range(repeat)),
+               key=lambda result: result['seconds'])
+    memory = sample('--memory')
+    return {
+        'ops_per_sec': round(1 / best['seconds'], 3),
+        'import_ms': round(best['seconds'] * 1000, 3),
+        'allocated_kb': None if memory['allocated_kb'] is None
+        else round(memory['allocated_kb'], 1),
+        'modules': best['modules'],
+        'tornado': best['tornado'],
+    }
+
+
+def run(repeat=5):
+    """Run the startup benchmarks.
+
+    :returns: dict of benchmark name to result
+    :rtype: dict
+
+    """
+    return dict(('startup.%s' % name, measure(statement, repeat))
+                for name, statement in IMPORTS)
@@ -3,18 +3,62 @@
 PikaChewie - A pika-based RabbitMQ publisher-consumer framework
 ===============================================================
 
+The names below are imported from their submodules on first use, so that
+``import pikachewie`` stays cheap: a process that only publishes never
+imports the agent (or Tornado, which only non-blocking connections need).
+
 """
-from pikachewie.agent import ConsumerAgent
-from pikachewie.broker import Broker
-from pikachewie.consumer import Consumer
-from pikachewie.helpers import consumer_agent_from_config
-from pikachewie.publisher import BlockingPublisher, BlockingJSONPublisher
+import sys
+from types import ModuleType
 
 __all__ = [
     'BlockingJSONPublisher',
     'BlockingPublisher',
+    'BlockingRpcClient',
     'Broker',
     'Consumer',
     'ConsumerAgent',
-    'consumer_agent_from_config'
+    'ConsumerHost',
+    'RoutedConsumer',
+    'consumer_agent_from_config',
+    'consumer_host_from_config',
 ]
+
+# maps each public name to the submodule that defines it
+_LAZY_ATTRIBUTES = {
+    'BlockingJSONPublisher': 'pikachewie.publisher',
+    'BlockingPublisher': 'pikachewie.publisher',
+    'BlockingRpcClient': 'pikachewie.rpc',
+    'Broker': 'pikachewie.broker',
+    'Consumer': 'pikachewie.consumer',
+    'ConsumerAgent': 'pikachewie.agent',
+    'ConsumerHost': 'pikachewie.host',
+    'RoutedConsumer': 'pikachewie.routing',
+    'consumer_agent_from_config': 'pikachewie.helpers',
+    'consumer_host_from_config': 'pikachewie.helpers',
+}
+
+
+class _LazyModule(ModuleType):
+    """A module that imports its public names on first access."""
+
+    def __getattr__(self, name):
+        module_name = _LAZY_ATTRIBUTES.get(name)
+        if module_name is None:
+            raise AttributeError('module %r has no attribute %r'
+                                 % (self.__name__, name))
+        module = __import__(module_name, fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(__all__))
+
+
+# replace this module with a lazy one (rather than defining a module-level
+# __getattr__, which requires Python 3.7)
+_module = _LazyModule(__name__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original_module = sys.modules[__name__]  # keep our globals alive
+sys.modules[__name__] = _module
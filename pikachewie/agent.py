@@ -5,15 +5,28 @@ pikachewie.agent -- PikaChewie agent classes
 
 """
 import logging
+import signal
 import sys
 import time
 import traceback
 from functools import partial
+from timeit import default_timer
 
 import pika
 
 from pikachewie import exceptions
+from pikachewie.autoscale import ConcurrencyController
+from pikachewie.capture import CaptureWriter
+from pikachewie.dedup import Deduplicator
+from pikachewie.flow import FlowController
 from pikachewie.message import Message
+from pikachewie.metrics import AgentMetrics, MetricsServer
+from pikachewie.monitor import QueueMonitor
+from pikachewie.outbox import Outbox
+from pikachewie.profiling import AgentProfiler
+from pikachewie.retry import RetryPolicy
+from pikachewie.scheduling import DeliveryScheduler
+from pikachewie.workers import WorkerPool
 
 log = logging.getLogger(__name__)
 
@@ -24,20 +37,202 @@ class ConsumerAgent(object):
 
     """
     _RECONNECT_DELAY = 5  # seconds
+    _DRAIN_POLL_INTERVAL = 0.1  # seconds
+    _DROP_EXPIRED_ACTIONS = ('ack', 'reject')
+    _PAUSE_METHODS = ('cancel', 'qos')
+
+    def __init__(self, consumer, broker, bindings, no_ack=False, config=None,
+                 drop_expired=False, hooks=(), metrics_port=None,
+                 profile_dir=None, queue_poll_interval=None, concurrency=1,
+                 prefetch_count=None, autoscale=None, capture=None,
+                 drain_timeout=None, retry=None, deduplicate=None,
+                 schedule=True, backpressure=None, pause_method='cancel'):
+        """
+        If `drop_expired` is set, messages whose ``expiration`` has passed by
+        the time they are delivered are not passed to the consumer.  Instead,
+        they are acknowledged (``'ack'`` or ``True``) or rejected without
+        requeue (``'reject'``), so that they are dead-lettered if the queue
+        has a dead-letter exchange.  Dropped messages are counted in
+        :attr:`expired_count`.
+
+        `hooks` are :class:`pikachewie.metrics.AgentHooks` that are called as
+        each message is received, processed, and acknowledged or rejected.
+        If `metrics_port` is set, an :class:`~pikachewie.metrics.AgentMetrics`
+        hook is added, and its metrics are served in the Prometheus text
+        format at ``/metrics`` on that port while the agent runs.
+
+        If `profile_dir` is set, the agent can be profiled while it runs (see
+        :class:`pikachewie.profiling.AgentProfiler`): sending the process
+        ``SIGUSR2``, or requesting ``/profile?seconds=N`` from the metrics
+        port, writes a CPU and memory profile to `profile_dir`.
+
+        If `queue_poll_interval` is set, the depth of each of the agent's
+        queues is polled every `queue_poll_interval` seconds by a
+        :class:`pikachewie.monitor.QueueMonitor` (see :attr:`queue_monitor`).
+
+        If `concurrency` is greater than one, messages are processed by a
+        :class:`pikachewie.workers.WorkerPool` of that many threads (see
+        :attr:`workers`), and are acknowledged or rejected as each finishes.
+        `prefetch_count` sets the channel's QoS prefetch count, which should
+        be at least `concurrency` to keep every worker busy.  If `schedule`
+        is set (the default), prefetched messages waiting for a worker are
+        processed in order of priority, deadline, and routing key by a
+        :class:`pikachewie.scheduling.DeliveryScheduler`, rather than in
+        order of arrival.
+
+        If `autoscale` is set, a
+        :class:`pikachewie.autoscale.ConcurrencyController` adjusts the
+        concurrency and prefetch count to the backlog and load.  `autoscale`
+        is a dict of keyword arguments for the controller (or `True` for the
+        defaults); queue depths are polled every 5 seconds unless
+        `queue_poll_interval` says otherwise.
+
+        If `capture` is set, a sample of the delivered messages is recorded
+        to a capture file by a :class:`pikachewie.capture.CaptureWriter`, for
+        later replay with :func:`pikachewie.capture.replay`.  `capture` is
+        the path of the capture file, or a dict of keyword arguments for the
+        writer (e.g., ``path``, ``sample_rate``, and ``max_bytes``).
+
+        If `drain_timeout` is set, the agent drains (see :meth:`drain`)
+        rather than exits when the process receives ``SIGTERM``, allowing
+        in-flight messages up to `drain_timeout` seconds to finish.
+
+        If `retry` is set, messages whose processing raises a
+        :class:`~pikachewie.exceptions.ConsumerException` are retried after
+        an exponentially increasing delay, and eventually parked, instead of
+        being requeued immediately (see :mod:`pikachewie.retry`).  `retry`
+        is a dict of keyword arguments for a
+        :class:`pikachewie.retry.RetryPolicy` (or `True` for the defaults).
+
+        If `deduplicate` is set, a :class:`pikachewie.dedup.Deduplicator`
+        remembers the messages that have been processed, and later copies of
+        them are acknowledged without being passed to the consumer.
+        `deduplicate` is a dict of keyword arguments for the deduplicator
+        (e.g., ``key``, ``ttl``, and ``path``), or `True` for the defaults.
+
+        If `backpressure` is set, a :class:`pikachewie.flow.FlowController`
+        pauses consumption while the messages held by the agent exceed a
+        byte budget.  `backpressure` is a dict of keyword arguments for the
+        controller (e.g., ``max_bytes`` and ``resume_bytes``), or `True` for
+        the defaults.  `pause_method` is how the agent pauses (see
+        :meth:`pause`): ``'cancel'`` or ``'qos'``.
+
+        :param drop_expired: what to do with expired messages
+        :type drop_expired: :class:`bool` or :class:`str`
+        :param hooks: lifecycle hooks
+        :type hooks: sequence of :class:`pikachewie.metrics.AgentHooks`
+        :param int metrics_port: port on which to serve metrics
+        :param str profile_dir: directory to write on-demand profiles to
+        :param float queue_poll_interval: seconds between queue depth polls
+        :param int concurrency: number of messages to process at once
+        :param int prefetch_count: maximum number of unacknowledged messages
+        :param bool schedule: whether to schedule messages waiting for a
+            worker
+        :param autoscale: concurrency controller options
+        :type autoscale: :class:`dict` or :class:`bool`
+        :param capture: capture file path or capture options
+        :type capture: :class:`str` or :class:`dict`
+        :param float drain_timeout: seconds to drain for on ``SIGTERM``
+        :param retry: retry policy options
+        :type retry: :class:`dict` or :class:`bool`
+        :param deduplicate: deduplicator options
+        :type deduplicate: :class:`dict` or :class:`bool`
+        :param backpressure: flow controller options
+        :type backpressure: :class:`dict` or :class:`bool`
+        :param str pause_method: how to pause consumption
+
+        """
+        if drop_expired is True:
+            drop_expired = 'ack'
+        if drop_expired and drop_expired not in self._DROP_EXPIRED_ACTIONS:
+            raise ValueError('Invalid drop_expired action: %r' % drop_expired)
+        if pause_method not in self._PAUSE_METHODS:
+            raise ValueError('Invalid pause method: %r' % pause_method)
 
-    def __init__(self, consumer, broker, bindings, no_ack=False, config=None):
         self.consumer = consumer
         self.broker = broker
         self.bindings = bindings
         self._ack = not no_ack
         self.config = config or {}
+        self.host = None
         self.connection = None
+        self.pause_method = pause_method
+        self._pause_reasons = set()
+        self._pause_timeouts = {}
         self._reinitialize()
+        self._drop_expired = drop_expired
+        self.expired_count = 0
+        self.hooks = list(hooks)
+        self.metrics = None
+        self._metrics_server = None
+        if metrics_port is not None:
+            self.metrics = AgentMetrics()
+            self.hooks.append(self.metrics)
+            self._metrics_server = MetricsServer(self.metrics.registry,
+                                                 metrics_port)
+        self.profiler = None
+        if profile_dir is not None:
+            self.profiler = AgentProfiler(profile_dir)
+            if self._metrics_server:
+                self._metrics_server.routes['/profile'] = \
+                    self.profiler.handle_request
+        self.concurrency = max(1, int(concurrency))
+        self.prefetch_count = prefetch_count
+        self.schedule = schedule
+        self.workers = None
+        if autoscale and not queue_poll_interval:
+            queue_poll_interval = ConcurrencyController.default_poll_interval
+        self.queue_monitor = None
+        if queue_poll_interval:
+            self.queue_monitor = QueueMonitor(self, queue_poll_interval)
+            self.hooks.append(self.queue_monitor)
+        self.autoscaler = None
+        if autoscale:
+            options = autoscale if isinstance(autoscale, dict) else {}
+            self.autoscaler = ConcurrencyController(self, **options)
+            self.hooks.append(self.autoscaler)
+            self.queue_monitor.add_callback(self.autoscaler.on_queue_stats)
+        self.capture = None
+        if capture:
+            options = capture if isinstance(capture, dict) \
+                else {'path': capture}
+            self.capture = CaptureWriter(**options)
+            self.hooks.append(self.capture)
+        self.retry = None
+        if retry:
+            options = retry if isinstance(retry, dict) else {}
+            self.retry = RetryPolicy(**options)
+        self.deduplicator = None
+        if deduplicate:
+            options = deduplicate if isinstance(deduplicate, dict) else {}
+            self.deduplicator = Deduplicator(**options)
+            self.hooks.append(self.deduplicator)
+        self.flow = None
+        if backpressure:
+            options = backpressure if isinstance(backpressure, dict) else {}
+            self.flow = FlowController(self, **options)
+            self.hooks.append(self.flow)
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.drained = False
+        self._drain_callback = None
+        self._drain_timeout = None
+        self._drain_poll = None
+        self._pending_cancels = 0
 
     def _reinitialize(self):
         """Reinitialize the state of this ConsumerAgent."""
         self.channel = None
+        self.outbox = None
         self._consumer_tags = {}
+        self._paused_queues = set()
+        # queues of consumers cancelled by a pause, by consumer tag, until
+        # their Basic.CancelOk has arrived and their deliveries are settled
+        self._cancelled_tags = {}
+        self._cancels_confirmed = set()
+        self._unsettled = {}    # delivery tag -> consumer tag
+        self._unsettled_counts = {}     # consumer tag -> deliveries
+        self._in_flight = {}
 
     def connect(self):
         """Open a connection to RabbitMQ.
@@ -73,6 +268,32 @@ class ConsumerAgent(object):
         log.info('Connection opened to %s', self.connection)
         self.add_on_connection_close_callback()
         self.open_channel()
+        if self.queue_monitor:
+            self.queue_monitor.start(connection)
+
+    def attach(self, host, connection):
+        """Start consuming over a connection shared by a ConsumerHost.
+
+        The `host` owns the connection: it reconnects when the connection is
+        lost, and :meth:`reconnect` and :meth:`stop` defer to it.
+
+        :param host: the host that opened the connection
+        :type host: :class:`pikachewie.host.ConsumerHost`
+
+        """
+        self.host = host
+        self.connection = connection
+        self.open_channel()
+        if self.queue_monitor:
+            self.queue_monitor.start(connection)
+
+    def detach(self):
+        """Forget this agent's channel, e.g., when its connection is lost."""
+        if self.queue_monitor:
+            self.queue_monitor.stop()
+        if self.outbox is not None:
+            self.outbox.close()
+        self._reinitialize()
 
     def add_on_connection_close_callback(self):
         """Add an on-connection-close callback.
@@ -96,9 +317,21 @@ class ConsumerAgent(object):
         self.reconnect()
 
     def reconnect(self):
-        """Reconnect to RabbitMQ."""
+        """Reconnect to RabbitMQ.
+
+        A hosted agent (see :meth:`attach`) reopens only its own channel.
+        A draining agent does not reconnect.
+
+        """
+        if self.draining:
+            if not self.drained:
+                self._abandon_drain()
+            return
+        if self.host is not None:
+            self.host.recover(self)
+            return
         log.info('Reinitializing...')
-        self._reinitialize()
+        self.detach()
         log.info('Reconnecting in %i seconds', self._RECONNECT_DELAY)
         self.connection.add_timeout(self._RECONNECT_DELAY, self.connect)
 
@@ -122,6 +355,12 @@ class ConsumerAgent(object):
         log.info('Channel opened')
         self.channel = channel
         self.add_on_channel_close_callback()
+        if self.flow is not None:
+            self.flow.reset()
+        if self.paused and self._pauses_by_qos:
+            self.channel.basic_qos(prefetch_count=1)
+        elif self.prefetch_count:
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.create_bindings()
 
     def add_on_channel_close_callback(self):
@@ -146,7 +385,13 @@ class ConsumerAgent(object):
 
         """
         log.warning('Server closed channel: (%s) %s', reply_code, reply_text)
-        self.stop()
+        if self.draining:
+            if not self.drained and channel is self.channel:
+                self._abandon_drain()
+        elif self.host is not None:
+            self.host.on_agent_channel_close(self, channel)
+        else:
+            self.stop()
 
     def create_bindings(self):
         """Create a queue binding for each of the Agent's declared bindings."""
@@ -197,24 +442,63 @@ class ConsumerAgent(object):
         """
         log.info("Binding queue %s to exchange %s via routing key '%s'",
                  queue, exchange, routing_key)
-        on_queue_bind_ok = partial(self.ensure_consuming, queue)
+        if self.retry:
+            on_queue_bind_ok = partial(self.declare_retry_topology, queue)
+        else:
+            on_queue_bind_ok = partial(self.ensure_consuming, queue)
         self.channel.queue_bind(on_queue_bind_ok, queue, exchange, routing_key)
 
+    def declare_retry_topology(self, queue, method_frame):
+        """Declare the exchanges and queues for retrying `queue`'s messages.
+
+        Then ensure that this agent is consuming from `queue`.
+
+        """
+        log.info('Declaring retry queues for queue %s', queue)
+        durable = self.config.get('queues', {}).get(queue, {}).get(
+            'durable', False)
+        declarations = self.retry.topology(queue, durable)
+        for index, (method, kwargs) in enumerate(declarations):
+            callback = None
+            if index == len(declarations) - 1:
+                callback = partial(self.ensure_consuming, queue)
+            getattr(self.channel, method)(callback=callback, **kwargs)
+
     def ensure_consuming(self, queue, method_frame):
         """Ensure that this agent is consuming from the given `queue`."""
         if not self.is_consuming_from(queue):
             self.start_consuming(queue)
 
+    def queue_for(self, consumer_tag):
+        """Return the name of the queue consumed with the given consumer tag.
+
+        :rtype: :class:`str` or `NoneType`
+
+        """
+        for queue, tag in self._consumer_tags.items():
+            if tag == consumer_tag:
+                return queue
+        return self._cancelled_tags.get(consumer_tag)
+
     def is_consuming_from(self, queue):
         """Whether this agent is currently consuming from the given queue.
 
         :rtype: `bool`
 
         """
-        return queue in self._consumer_tags
+        return queue in self._consumer_tags or queue in self._paused_queues
 
     def start_consuming(self, queue):
-        """Start consuming messages on the given queue."""
+        """Start consuming messages on the given queue.
+
+        If consumption is paused (see :meth:`pause`), the queue is consumed
+        from once it resumes.
+
+        """
+        if self.paused and not self._pauses_by_qos:
+            log.info('Deferring basic_consume on paused queue %s', queue)
+            self._paused_queues.add(queue)
+            return
         self.add_on_cancel_callback()
         log.info('Issuing basic_consume on queue %s', queue)
         self._consumer_tags[queue] = self.channel.basic_consume(
@@ -253,42 +537,477 @@ class ConsumerAgent(object):
         """
         message = Message(channel, method, header, body)
         log.debug('Received message #%s', message.delivery_tag)
-        log.debug('Message body: %s', message.body)
-        if self._process(message):
+        if self.paused and self._pauses_by_qos and self._consumer_tags:
+            # the lowered prefetch count let a delivery through
+            log.info('Received message #%s while paused; cancelling '
+                     'consumers', message.delivery_tag)
+            self._cancel_consumers()
+        self._hold(message)
+        if self.hooks:
+            message.received_at = default_timer()
+            for hook in self.hooks:
+                hook.message_received(self, message)
+        if self._drop_expired and self._has_expired(message):
+            self.drop_expired(message)
+            return
+        if self.deduplicator is not None and \
+                self.deduplicator.is_duplicate(message):
+            self.drop_duplicate(message)
+            return
+        if self.draining and self._ack:
+            log.debug('Requeueing message #%s received while draining',
+                      message.delivery_tag)
+            self.reject(message.delivery_tag)
+            return
+        if message.claim_check is None:
+            log.debug('Message body: %s', message.body)
+        else:
+            log.debug('Message body claim-checked as %s',
+                      message.claim_check)
+        if self.workers is not None or self.concurrency > 1:
+            self._submit(message)
+        elif self._process(message):
+            self._complete(message)
+
+    def _submit(self, message):
+        """Pass the given message to a worker thread for processing."""
+        if self.workers is None:
+            queue = DeliveryScheduler() if self.schedule else None
+            self.workers = WorkerPool(self.consumer, self.connection.ioloop,
+                                      self.concurrency, queue, self.profiler)
+        self._in_flight[message.delivery_tag] = message
+        self.workers.submit(message, self._on_worker_done)
+
+    def _on_worker_done(self, message, exc, seconds):
+        """Callback invoked on the IOLoop when a worker finishes a message.
+
+        :param exception exc: the exception raised by the consumer, if any
+        :param float seconds: time spent processing the message
+
+        """
+        start = default_timer() - seconds if self.hooks else None
+        if message.channel is not self.channel:
+            # the channel was closed while the message was being processed,
+            # so the broker has already requeued it
+            log.warning('Discarding result of message #%s from a closed '
+                        'channel', message.delivery_tag)
+            self._processed(message, 'error', start)
+            return
+        if self._in_flight.pop(message.delivery_tag, None) is None and \
+                self.draining:
+            # the drain deadline passed, and the message was requeued
+            log.warning('Discarding result of requeued message #%s',
+                        message.delivery_tag)
+            self._processed(message, 'error', start)
+            return
+        if exc is not None:
+            self._process_failed(message, exc, start)
+            return
+        self._processed(message, 'ok', start)
+        self._complete(message)
+
+    def _complete(self, message):
+        """Publish the outputs of the given processed message, and ack it.
+
+        If the consumer published any messages while processing it (see
+        :meth:`pikachewie.consumer.Consumer.publish`), the message is
+        acknowledged once they have been confirmed by the broker, or
+        requeued if they cannot be.
+
+        """
+        if not message.outputs:
             if self._ack:
                 self.acknowledge(message)
+            return
+        self._publish_outputs(message, message.outputs)
+
+    def _publish_outputs(self, message, outputs):
+        """Publish `outputs` with confirms, then ack the given message.
+
+        The message is requeued if any output cannot be published.
+
+        """
+        if self.outbox is None:
+            self.outbox = Outbox(self.connection)
+        if self._ack:
+            self.outbox.publish(outputs,
+                                partial(self._on_outputs_confirmed, message),
+                                partial(self._on_outputs_failed, message))
+        else:
+            self.outbox.publish(outputs)
+
+    def _on_outputs_confirmed(self, message):
+        if self._is_settleable(message):
+            self.acknowledge(message)
+
+    def _on_outputs_failed(self, message):
+        log.warning('Could not publish the outputs of message #%s',
+                    message.delivery_tag)
+        if self._is_settleable(message):
+            self.reject(message.delivery_tag)
+
+    def _is_settleable(self, message):
+        """Whether the given message can still be acked or rejected."""
+        if message.channel is self.channel and self.channel.is_open:
+            return True
+        log.warning('Discarding result of message #%s from a closed '
+                    'channel', message.delivery_tag)
+        return False
+
+    def drain(self, timeout=None, callback=None):
+        """Stop consuming, finish in-flight messages, and then stop.
+
+        Every consumer is cancelled with ``Basic.Cancel``, so the broker
+        stops delivering messages; any delivered before the cancellation
+        takes effect are requeued unprocessed.  Messages already being
+        processed by the agent's workers are allowed `timeout` seconds (or
+        as long as they need, if `timeout` is `None`) to finish and be
+        acknowledged; any still unfinished are then rejected with requeue.
+        Finally, the agent stops (or `callback` is called with the agent),
+        closing the connection after the acknowledgements.
+
+        Unlike :meth:`stop`, draining does not cause messages that are
+        already being processed to be redelivered and processed again.
+
+        :param float timeout: seconds to wait for in-flight messages
+        :param callback: called with this agent once drained, instead of
+            stopping it
+        :type callback: callable
+
+        """
+        if self.draining:
+            return
+        log.info('Draining %d in-flight message%s (timeout: %s)',
+                 len(self._in_flight), '' if len(self._in_flight) == 1
+                 else 's', timeout)
+        self.draining = True
+        self._drain_callback = callback
+        if self.queue_monitor:
+            self.queue_monitor.stop()
+        if self.channel is not None and self.channel.is_open:
+            for queue, consumer_tag in self._consumer_tags.items():
+                log.info('Cancelling consumer on queue %s', queue)
+                self._pending_cancels += 1
+                self.channel.basic_cancel(self._on_drain_cancel_ok,
+                                          consumer_tag=consumer_tag)
+        if timeout is not None and self.connection is not None:
+            self._drain_timeout = self.connection.add_timeout(
+                timeout, self._on_drain_timeout)
+        self._check_drained()
+
+    def _on_drain_cancel_ok(self, method_frame):
+        self._pending_cancels -= 1
+
+    def _check_drained(self):
+        """Finish draining if no work remains, or check again later."""
+        self._drain_poll = None
+        if not self.draining or self.drained:
+            return
+        if self._in_flight or self._pending_cancels > 0 or \
+                (self.outbox is not None and self.outbox.pending):
+            self._drain_poll = self.connection.add_timeout(
+                self._DRAIN_POLL_INTERVAL, self._check_drained)
+            return
+        self._drained()
+
+    def _on_drain_timeout(self):
+        self._drain_timeout = None
+        if not self.draining or self.drained:
+            return
+        log.warning('Requeueing %d message%s still in flight after drain '
+                    'timeout', len(self._in_flight),
+                    '' if len(self._in_flight) == 1 else 's')
+        if self.channel is not None and self.channel.is_open:
+            for delivery_tag in sorted(self._in_flight):
+                self.reject(delivery_tag)
+        self._in_flight.clear()
+        self._drained()
+
+    def _abandon_drain(self):
+        """Finish draining after losing the channel.
+
+        The broker requeues the in-flight messages itself.
+
+        """
+        log.warning('Channel lost while draining; %d in-flight message%s '
+                    'will be redelivered', len(self._in_flight),
+                    '' if len(self._in_flight) == 1 else 's')
+        self._in_flight.clear()
+        self._pending_cancels = 0
+        self._drained()
+
+    def _drained(self):
+        for timeout in (self._drain_timeout, self._drain_poll):
+            if timeout is not None:
+                self.connection.remove_timeout(timeout)
+        self._drain_timeout = self._drain_poll = None
+        self.drained = True
+        log.info('Drained')
+        if self._drain_callback is not None:
+            self._drain_callback(self)
+        elif self.host is not None:
+            self.host.on_agent_drained(self)
+        else:
+            self.stop()
+
+    @property
+    def paused(self):
+        """Whether consumption is paused."""
+        return bool(self._pause_reasons)
+
+    @property
+    def _pauses_by_qos(self):
+        # the prefetch count does not limit deliveries without acks
+        return self.pause_method == 'qos' and self._ack
+
+    def pause(self, reason='consumer', seconds=None):
+        """Stop receiving messages until :meth:`resume` is called.
+
+        Consumption resumes once every `reason` to pause has been resumed.
+        With the ``'cancel'`` pause method, the agent's consumers are
+        cancelled, and consume again when resumed; messages already received
+        are still processed.  With the ``'qos'`` pause method, the channel's
+        prefetch count is lowered to 1, and restored when resumed.  That only
+        throttles consumption: no more messages are delivered until those
+        held are settled, but then the broker delivers another one.  So if a
+        message is delivered while paused, the consumers are cancelled as
+        with the ``'cancel'`` method, and at most one message per consumer
+        is received during a pause.
+
+        :param str reason: why consumption is paused
+        :param float seconds: resume automatically after this many seconds
+
+        """
+        timeout = self._pause_timeouts.pop(reason, None)
+        if timeout is not None:
+            self.connection.remove_timeout(timeout)
+        if seconds is not None and self.connection is not None:
+            self._pause_timeouts[reason] = self.connection.add_timeout(
+                seconds, partial(self._on_pause_timeout, reason))
+        if reason in self._pause_reasons:
+            return
+        self._pause_reasons.add(reason)
+        if len(self._pause_reasons) > 1:
+            return
+        log.info('Pausing consumption (%s)', reason)
+        if self.channel is None or not self.channel.is_open:
+            return
+        if self._pauses_by_qos:
+            self.channel.basic_qos(prefetch_count=1)
+        else:
+            self._cancel_consumers()
+
+    def _cancel_consumers(self):
+        """Cancel every consumer, to consume again when resumed."""
+        for queue, consumer_tag in list(self._consumer_tags.items()):
+            log.info('Cancelling consumer on paused queue %s', queue)
+            self.channel.basic_cancel(self._on_pause_cancel_ok,
+                                      consumer_tag=consumer_tag)
+            self._cancelled_tags[consumer_tag] = queue
+            self._paused_queues.add(queue)
+        self._consumer_tags.clear()
+
+    def resume(self, reason='consumer'):
+        """Lift a pause (see :meth:`pause`).
+
+        :param str reason: the reason given to :meth:`pause`
+
+        """
+        timeout = self._pause_timeouts.pop(reason, None)
+        if timeout is not None:
+            self.connection.remove_timeout(timeout)
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if self._pause_reasons:
+            return
+        log.info('Resuming consumption (%s)', reason)
+        if self.channel is None or not self.channel.is_open or \
+                self.draining:
+            return
+        if self._pauses_by_qos:
+            self.channel.basic_qos(prefetch_count=self.prefetch_count or 0)
+        queues, self._paused_queues = self._paused_queues, set()
+        for queue in sorted(queues):
+            self.start_consuming(queue)
+
+    def _on_pause_timeout(self, reason):
+        self._pause_timeouts.pop(reason, None)
+        self.resume(reason)
+
+    def _on_pause_cancel_ok(self, method_frame):
+        log.debug('Consumer cancelled: %r', method_frame)
+        consumer_tag = method_frame.method.consumer_tag
+        if consumer_tag not in self._cancelled_tags:
+            return
+        # no more deliveries will arrive for the consumer
+        self._cancels_confirmed.add(consumer_tag)
+        self._forget_cancelled(consumer_tag)
+
+    def _hold(self, message):
+        """Note that the given message refers to its consumer tag until it
+        is settled.
+
+        """
+        consumer_tag = message.consumer_tag
+        self._unsettled[message.delivery_tag] = consumer_tag
+        self._unsettled_counts[consumer_tag] = \
+            self._unsettled_counts.get(consumer_tag, 0) + 1
+
+    def _settled(self, delivery_tag):
+        """Note that the message with the given delivery tag is settled."""
+        consumer_tag = self._unsettled.pop(delivery_tag, None)
+        if consumer_tag is None:
+            return
+        count = self._unsettled_counts[consumer_tag] - 1
+        if count:
+            self._unsettled_counts[consumer_tag] = count
+            return
+        del self._unsettled_counts[consumer_tag]
+        self._forget_cancelled(consumer_tag)
+
+    def _forget_cancelled(self, consumer_tag):
+        """Forget a cancelled consumer once nothing refers to it."""
+        if consumer_tag in self._cancels_confirmed and \
+                consumer_tag not in self._unsettled_counts:
+            self._cancels_confirmed.discard(consumer_tag)
+            self._cancelled_tags.pop(consumer_tag, None)
+
+    def set_concurrency(self, concurrency):
+        """Change the number of messages this agent processes at once."""
+        concurrency = max(1, int(concurrency))
+        if concurrency != self.concurrency:
+            log.info('Changing concurrency from %d to %d', self.concurrency,
+                     concurrency)
+        self.concurrency = concurrency
+        if self.workers is not None:
+            self.workers.resize(concurrency)
+
+    def set_prefetch_count(self, prefetch_count):
+        """Change the QoS prefetch count of this agent's channel."""
+        self.prefetch_count = prefetch_count
+        if self.paused and self._pauses_by_qos:
+            return  # applied when resumed
+        if self.channel is not None:
+            log.info('Setting prefetch count to %s', prefetch_count)
+            self.channel.basic_qos(prefetch_count=prefetch_count or 0)
+
+    def _has_expired(self, message):
+        """Whether the given message expired before it could be processed.
+
+        :rtype: `bool`
+
+        """
+        remaining = message.time_remaining()
+        return remaining is not None and remaining <= 0
+
+    def drop_expired(self, message):
+        """Discard the given expired message without processing it.
+
+        :param message: the expired message
+        :type message: :class:`pikachewie.message.Message`
+
+        """
+        log.info('Dropping expired message #%s', message.delivery_tag)
+        self.expired_count += 1
+        for hook in self.hooks:
+            hook.message_dropped(self, message, 'expired')
+        if not self._ack:
+            self._settled(message.delivery_tag)
+            return
+        if self._drop_expired == 'reject':
+            self.reject(message.delivery_tag, requeue=False)
+        else:
+            self.acknowledge(message)
+
+    def drop_duplicate(self, message):
+        """Acknowledge the given duplicate message without processing it.
+
+        :param message: the duplicate message
+        :type message: :class:`pikachewie.message.Message`
+
+        """
+        log.info('Dropping duplicate message #%s', message.delivery_tag)
+        for hook in self.hooks:
+            hook.message_dropped(self, message, 'duplicate')
+        if self._ack:
+            self.acknowledge(message)
+        else:
+            self._settled(message.delivery_tag)
 
     def _process(self, message):
         """Pass the given message to this agent's consumer for processing."""
+        start = default_timer() if self.hooks else None
+        if self.profiler is not None:
+            self.profiler.begin(message)
         try:
             self.consumer.process(message)
 
-        except exceptions.ConsumerException as exc:
-            self._record_exception(exc)
-            self.reject(message.delivery_tag)
+        except (exceptions.ConsumerException, exceptions.MessageException,
+                pika.exceptions.ChannelClosed,
+                pika.exceptions.ConnectionClosed, KeyboardInterrupt) as exc:
+            self._process_failed(message, exc, start)
             return False
 
-        except exceptions.MessageException as exc:
+        finally:
+            if self.profiler is not None:
+                self.profiler.end(message)
+
+        self._processed(message, 'ok', start)
+        return True
+
+    def _process_failed(self, message, exc, start):
+        """Handle an exception raised while processing the given message."""
+        if isinstance(exc, exceptions.ConsumerException):
+            self._record_exception(exc)
+            queue = self.queue_for(message.consumer_tag)
+            if self.retry is not None and queue is not None:
+                # acknowledged once the broker confirms the republished copy
+                outcome, output = self.retry.output_for(queue, message)
+                self._processed(message, outcome, start)
+                self._publish_outputs(message, [output])
+            else:
+                self.reject(message.delivery_tag)
+                self._processed(message, 'requeued', start)
+
+        elif isinstance(exc, exceptions.MessageException):
             self._record_exception(exc)
             self.reject(message.delivery_tag, requeue=False)
-            return False
+            self._processed(message, 'rejected', start)
 
-        except pika.exceptions.ChannelClosed as exc:
+        elif isinstance(exc, pika.exceptions.ChannelClosed):
             log.critical('RabbitMQ closed the channel: %r', exc)
+            self._processed(message, 'error', start)
             self.reconnect()
-            return False
 
-        except pika.exceptions.ConnectionClosed as exc:
+        elif isinstance(exc, pika.exceptions.ConnectionClosed):
             log.critical('RabbitMQ closed the connection: %r', exc)
+            self._processed(message, 'error', start)
             self.reconnect()
-            return False
 
-        except KeyboardInterrupt:
+        elif isinstance(exc, KeyboardInterrupt):
             self.reject(message.delivery_tag)
+            self._processed(message, 'requeued', start)
             self.stop()
-            return False
 
-        return True
+        else:
+            self._processed(message, 'error', start)
+            raise exc
+
+    def _processed(self, message, outcome, start):
+        """Notify hooks that the given message has been processed."""
+        request = message.flow_request
+        if request is not None:
+            if request[0] == 'pause':
+                self.pause(seconds=request[1])
+            elif request[0] == 'resume':
+                self.resume()
+        if start is not None:
+            seconds = default_timer() - start
+            for hook in self.hooks:
+                hook.message_processed(self, message, outcome, seconds)
+        if not self._ack:
+            self._settled(message.delivery_tag)
 
     def acknowledge(self, message):
         """Acknowledge delivery of the given message.
@@ -301,6 +1020,12 @@ class ConsumerAgent(object):
         """
         log.debug('Acknowledging message #%s', message.delivery_tag)
         self.channel.basic_ack(message.delivery_tag)
+        if self.hooks:
+            seconds = default_timer() - getattr(message, 'received_at',
+                                                default_timer())
+            for hook in self.hooks:
+                hook.message_acknowledged(self, message, seconds)
+        self._settled(message.delivery_tag)
 
     def run(self):
         """Connect to RabbitMQ and start the connection's IOLoop.
@@ -310,8 +1035,40 @@ class ConsumerAgent(object):
 
         """
         self.connect()
+        self.start_services()
         self.connection.ioloop.start()
 
+    def start_services(self):
+        """Start serving metrics and profiles, if enabled."""
+        if self._metrics_server:
+            self._metrics_server.start()
+        if self.profiler:
+            self._install_profile_signal_handler()
+        if self.drain_timeout is not None and self.host is None:
+            self._install_drain_signal_handler()
+
+    def _install_drain_signal_handler(self):
+        """Drain when this process receives SIGTERM."""
+        try:
+            signal.signal(signal.SIGTERM, self._on_drain_signal)
+        except ValueError as exc:
+            # not running in the main thread
+            log.warning('Cannot install drain signal handler: %s', exc)
+
+    def _on_drain_signal(self, signum, frame):
+        ioloop = self.connection.ioloop
+        add_callback = getattr(ioloop, 'add_callback_from_signal',
+                               ioloop.add_callback)
+        add_callback(self.drain, self.drain_timeout)
+
+    def _install_profile_signal_handler(self):
+        """Start a profile when this process receives SIGUSR2."""
+        try:
+            self.profiler.install_signal_handler(self.connection.ioloop)
+        except (AttributeError, ValueError) as exc:
+            # no SIGUSR2 on this platform, or not running in the main thread
+            log.warning('Cannot install profiling signal handler: %s', exc)
+
     def reject(self, delivery_tag, requeue=True):
         """Reject the message on the broker and log it.
 
@@ -322,13 +1079,40 @@ class ConsumerAgent(object):
         log.warning('Rejecting message %s %s requeue', delivery_tag,
                     'with' if requeue else 'without')
         self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        for hook in self.hooks:
+            hook.message_rejected(self, delivery_tag, requeue)
+        self._settled(delivery_tag)
 
     def stop(self):
-        """Cleanly shutdown the connection to RabbitMQ."""
+        """Cleanly shutdown the connection to RabbitMQ.
+
+        A hosted agent (see :meth:`attach`) stops its whole host.
+
+        """
+        if self.host is not None:
+            self.host.stop()
+            return
         log.info('Stopping...')
+        self.release()
         self.disconnect()
         log.info('Exiting...')
 
+    def release(self):
+        """Stop this agent's workers and metrics server, and close its
+        capture file, deduplicator, and outbox.
+
+        """
+        if self.workers is not None:
+            self.workers.stop()
+        if self._metrics_server:
+            self._metrics_server.stop()
+        if self.capture is not None:
+            self.capture.close()
+        if self.deduplicator is not None:
+            self.deduplicator.close()
+        if self.outbox is not None:
+            self.outbox.close()
+
     def disconnect(self):
         """Close the connection to RabbitMQ."""
         if self.connection and self.connection.is_open:
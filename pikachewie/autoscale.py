@@ -0,0 +1,222 @@
+"""
+================================================================
+pikachewie.autoscale -- Autoscaling of ConsumerAgent concurrency
+================================================================
+
+:class:`ConcurrencyController` resizes a
+:class:`~pikachewie.agent.ConsumerAgent`'s worker pool, and its channel's
+prefetch count along with it, each time the agent's
+:class:`~pikachewie.monitor.QueueMonitor` polls its queues.  Each evaluation
+looks at:
+
+* the backlog: how many messages are waiting, and how long the queues will
+  take to drain at the current rate;
+* the latency: the age of the oldest waiting message;
+* the utilization: the fraction of the workers' time spent processing
+  messages since the previous evaluation.
+
+The agent scales up when its workers are saturated and it is falling behind
+(the backlog will not drain within `target_drain_seconds`, or messages wait
+longer than `max_message_age`), and scales down when its workers are mostly
+idle and it is keeping up.  To avoid flapping, a change is made only after
+the same signal has been seen in several consecutive evaluations, and not
+within `cooldown` seconds of the previous change.
+
+Each change is logged and recorded in :attr:`ConcurrencyController.decisions`
+and, if the agent has metrics enabled, exported as the
+``pikachewie_workers``, ``pikachewie_worker_utilization``, and
+``pikachewie_scaling_decisions_total`` metrics.
+
+"""
+import logging
+from collections import deque, namedtuple
+from timeit import default_timer
+
+from pikachewie.metrics import AgentHooks
+
+__all__ = ['ConcurrencyController', 'ScalingDecision']
+
+log = logging.getLogger(__name__)
+
+ScalingDecision = namedtuple('ScalingDecision', [
+    'old_size',             # workers before the change
+    'new_size',             # workers after the change
+    'reason',               # why the change was made
+    'utilization',          # worker utilization, from 0 to 1
+    'backlog',              # messages waiting in the agent's queues
+    'drain_seconds',        # estimated seconds to drain the backlog
+    'oldest_message_age',   # age of the oldest waiting message (or None)
+])
+
+
+class ConcurrencyController(AgentHooks):
+    """Scales an agent's concurrency between `min_workers` and `max_workers`.
+
+    :param agent: the agent to scale
+    :type agent: :class:`pikachewie.agent.ConsumerAgent`
+    :param int min_workers: lower bound on concurrency
+    :param int max_workers: upper bound on concurrency
+    :param int step: workers to add or remove per change
+    :param int prefetch_per_worker: prefetch count per worker, or `None` to
+        leave the prefetch count alone
+    :param float high_utilization: utilization above which to scale up
+    :param float low_utilization: utilization below which to scale down
+    :param float target_drain_seconds: acceptable time to drain the backlog
+    :param float max_message_age: acceptable age of the oldest waiting
+        message, or `None` to ignore message age
+    :param int scale_up_after: consecutive evaluations needed to scale up
+    :param int scale_down_after: consecutive evaluations needed to scale down
+    :param float cooldown: minimum seconds between changes
+
+    """
+    default_poll_interval = 5  # seconds
+
+    def __init__(self, agent, min_workers=1, max_workers=8, step=1,
+                 prefetch_per_worker=2, high_utilization=0.8,
+                 low_utilization=0.3, target_drain_seconds=30.0,
+                 max_message_age=None, scale_up_after=2, scale_down_after=3,
+                 cooldown=30.0, time_func=default_timer):
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError('Invalid worker bounds: %r to %r'
+                             % (min_workers, max_workers))
+        if not 0 <= low_utilization < high_utilization <= 1:
+            raise ValueError('Invalid utilization watermarks: %r to %r'
+                             % (low_utilization, high_utilization))
+        self.agent = agent
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.step = step
+        self.prefetch_per_worker = prefetch_per_worker
+        self.high_utilization = high_utilization
+        self.low_utilization = low_utilization
+        self.target_drain_seconds = target_drain_seconds
+        self.max_message_age = max_message_age
+        self.scale_up_after = scale_up_after
+        self.scale_down_after = scale_down_after
+        self.cooldown = cooldown
+        self.time = time_func
+        self.decisions = deque(maxlen=100)
+        self.utilization = 0.0
+        self._busy_seconds = 0.0
+        self._window_started = self.time()
+        self._last_change = None
+        self._pressure = 0  # consecutive evaluations wanting up (+) / down (-)
+        self._metrics = None
+        self._resize(self._clamp(agent.concurrency))
+
+    @property
+    def size(self):
+        """The agent's current concurrency."""
+        return self.agent.concurrency
+
+    def _clamp(self, size):
+        return max(self.min_workers, min(self.max_workers, size))
+
+    def on_queue_stats(self, agent, stats):
+        """:class:`~pikachewie.monitor.QueueMonitor` callback.
+
+        Evaluates once per poll, after the last of the agent's queues has
+        been polled.
+
+        """
+        queues = agent.queue_monitor.queues
+        if not queues or stats.queue == queues[-1]:
+            self.evaluate([agent.queue_monitor.stats[queue]
+                           for queue in queues
+                           if queue in agent.queue_monitor.stats])
+
+    def evaluate(self, stats):
+        """Decide whether to scale, given the latest stats for each queue.
+
+        :param stats: the latest stats for the agent's queues
+        :type stats: sequence of :class:`pikachewie.monitor.QueueStats`
+        :returns: the decision made, if any
+        :rtype: :class:`ScalingDecision` or `NoneType`
+
+        """
+        now = self.time()
+        elapsed = now - self._window_started
+        if elapsed > 0:
+            self.utilization = min(
+                1.0, self._busy_seconds / (self.size * elapsed))
+        self._busy_seconds = 0.0
+        self._window_started = now
+
+        backlog = sum(s.message_count for s in stats)
+        drain_seconds = max([s.drain_seconds for s in stats] or [0.0])
+        ages = [s.oldest_message_age for s in stats
+                if s.oldest_message_age is not None]
+        oldest_message_age = max(ages) if ages else None
+
+        behind = drain_seconds > self.target_drain_seconds or (
+            self.max_message_age is not None and oldest_message_age is not None
+            and oldest_message_age > self.max_message_age)
+        if backlog and behind and self.utilization >= self.high_utilization:
+            self._pressure = max(self._pressure, 0) + 1
+        elif not behind and self.utilization <= self.low_utilization:
+            self._pressure = min(self._pressure, 0) - 1
+        else:
+            self._pressure = 0
+        self._export()
+
+        if self._pressure >= self.scale_up_after:
+            new_size = self._clamp(self.size + self.step)
+            reason = 'saturated and behind'
+        elif -self._pressure >= self.scale_down_after:
+            new_size = self._clamp(self.size - self.step)
+            reason = 'underutilized'
+        else:
+            return None
+        if new_size == self.size:
+            return None
+        if self._last_change is not None and \
+                now - self._last_change < self.cooldown:
+            log.debug('Not scaling to %d workers during cooldown', new_size)
+            return None
+
+        decision = ScalingDecision(self.size, new_size, reason,
+                                   self.utilization, backlog, drain_seconds,
+                                   oldest_message_age)
+        log.info('Scaling from %d to %d workers (%s): utilization=%.2f, '
+                 'backlog=%d, drain_seconds=%.1f, oldest_message_age=%s',
+                 decision.old_size, decision.new_size, reason,
+                 self.utilization, backlog, drain_seconds,
+                 oldest_message_age)
+        self._resize(new_size)
+        self._last_change = now
+        self._pressure = 0
+        self.decisions.append(decision)
+        if self._metrics is not None:
+            direction = 'up' if new_size > decision.old_size else 'down'
+            self._metrics[2].labels(direction).inc()
+        self._export()
+        return decision
+
+    def _resize(self, size):
+        self.agent.set_concurrency(size)
+        if self.prefetch_per_worker:
+            self.agent.set_prefetch_count(size * self.prefetch_per_worker)
+
+    def _export(self):
+        metrics = self.agent.metrics
+        if metrics is None:
+            return
+        if self._metrics is None:
+            registry = metrics.registry
+            self._metrics = (
+                registry.gauge('pikachewie_workers',
+                               'Messages the agent processes at once.'),
+                registry.gauge('pikachewie_worker_utilization',
+                               'Fraction of worker time spent processing.'),
+                registry.counter('pikachewie_scaling_decisions_total',
+                                 'Changes made to the number of workers.',
+                                 ('direction',)),
+            )
+        workers, utilization, _ = self._metrics
+        workers.labels().set(self.size)
+        utilization.labels().set(self.utilization)
+
+    # lifecycle hooks
+
+    def message_processed(self, agent, message, outcome, seconds):
+        self._busy_seconds += seconds
@@ -0,0 +1,425 @@
+"""
+==========================================================
+pikachewie.bench -- Load generator and latency measurement
+==========================================================
+
+``pikachewie-bench`` publishes synthetic messages through a
+:class:`~pikachewie.publisher.BlockingPublisher` (or
+:class:`~pikachewie.publisher.BlockingJSONPublisher`) and consumes them with
+a :class:`~pikachewie.agent.ConsumerAgent`, measuring each message's round
+trip from just before it is published until its consumer has processed it.
+The message size, publish rate, content type, compression, and number of
+routing keys are configurable, as are the consumer's simulated work, its
+concurrency, and its prefetch count::
+
+    $ pikachewie-bench --count 100000 --rate 5000 --size 4096 \\
+          --compression gzip --routing-keys 16 --sleep 0.001 --concurrency 8
+
+By default, the benchmark runs against an in-process
+:class:`~pikachewie.testing.FakeBroker`, which measures the client side
+alone; pass ``--url amqp://...`` to measure a real RabbitMQ node or cluster.
+
+Messages are published from a separate thread while the agent consumes on
+its IOLoop, so that publishing and consuming overlap as they would in
+production.
+
+"""
+from __future__ import print_function
+
+import argparse
+import bz2
+import copy
+import json
+import logging
+import sys
+import threading
+import time
+import zlib
+from timeit import default_timer
+
+import pika
+import simplejson
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.broker import Broker
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.publisher import BlockingJSONPublisher, BlockingPublisher
+from pikachewie.testing import FakeBroker
+from pikachewie.utils import percentile
+
+__all__ = ['BenchConsumer', 'LoadGenerator', 'broker_from_url', 'declare',
+           'main', 'make_payload']
+
+log = logging.getLogger(__name__)
+
+EXCHANGE = 'pikachewie.bench'
+QUEUE = 'pikachewie.bench'
+# publish time in integer microseconds, since AMQP tables cannot hold floats
+SENT_AT_HEADER = 'x-pikachewie-bench-sent-at'
+
+CONTENT_TYPES = ('application/json', 'text/plain',
+                 'application/octet-stream')
+COMPRESSORS = {
+    'gzip': zlib.compress,
+    'bzip2': bz2.compress,
+}
+PERCENTILES = (('p50', 0.50), ('p99', 0.99), ('p999', 0.999))
+
+
+def broker_from_url(url=None):
+    """Return a broker for the given AMQP `url`.
+
+    If `url` is not given, return a new
+    :class:`~pikachewie.testing.FakeBroker`.
+
+    """
+    if not url:
+        return FakeBroker()
+    parameters = pika.URLParameters(url)
+    nodes = {'bench': {'host': parameters.host, 'port': parameters.port}}
+    options = {'virtual_host': parameters.virtual_host,
+               'credentials': parameters.credentials}
+    return Broker(nodes, options)
+
+
+def make_payload(size):
+    """Return a JSON-serializable payload that encodes to about `size` bytes.
+
+    """
+    record = {'id': 12345, 'name': 'Chewbacca', 'species': 'Wookiee',
+              'score': 3.14159, 'tags': ['co-pilot', 'mechanic']}
+    count = max(1, size // len(simplejson.dumps(record)))
+    return {'records': [record] * count}
+
+
+def declare(broker, config, bindings):
+    """Declare the exchanges and queues in `config`, bind them as given by
+    `bindings`, and purge the queues.
+
+    :param dict config: exchange and queue config, as given to a
+        :class:`~pikachewie.agent.ConsumerAgent`
+    :param list bindings: queue bindings, as given to a
+        :class:`~pikachewie.agent.ConsumerAgent`
+
+    """
+    channel = broker.connect(blocking=True).channel()
+    for exchange, options in sorted(config['exchanges'].items()):
+        channel.exchange_declare(exchange=exchange, **options)
+    for queue, options in sorted(config['queues'].items()):
+        channel.queue_declare(queue=queue, **options)
+    for binding in bindings:
+        channel.queue_bind(queue=binding['queue'],
+                           exchange=binding['exchange'],
+                           routing_key=binding['routing_key'])
+    for queue in sorted(config['queues']):
+        channel.queue_purge(queue=queue)
+    channel.connection.close()
+
+
+class BenchConsumer(Consumer):
+    """Records the round trip time of each message.
+
+    If `sleep` is set, processing each message takes that many seconds, to
+    simulate I/O-bound work.  If `decode` is set, each message's payload is
+    decoded (decompressed and deserialized).  `on_complete` is called once
+    `count` messages have been processed.
+
+    """
+
+    def __init__(self, count, sleep=0.0, decode=False, on_complete=None):
+        self.count = count
+        self.sleep = sleep
+        self.decode = decode
+        self.on_complete = on_complete
+        self.latencies = []
+        self.finished_at = None
+
+    def process_message(self):
+        if self.decode:
+            self.message.payload
+        if self.sleep:
+            time.sleep(self.sleep)
+        sent_at = (self.message.headers or {}).get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self.latencies.append(time.time() - sent_at / 1e6)
+        if len(self.latencies) >= self.count and self.finished_at is None:
+            self.finished_at = default_timer()
+            if self.on_complete:
+                self.on_complete()
+
+
+class LoadGenerator(object):
+    """Publishes and consumes synthetic messages, measuring round trips.
+
+    :param broker: the broker to benchmark
+    :type broker: :class:`pikachewie.broker.Broker`
+    :param int count: number of messages to publish
+    :param float rate: messages per second to publish (unlimited if `None`)
+    :param int size: approximate uncompressed message body size, in bytes
+    :param str content_type: one of :data:`CONTENT_TYPES`
+    :param str compression: ``'gzip'``, ``'bzip2'``, or `None`
+    :param int routing_keys: number of distinct routing keys to publish with
+    :param float sleep: seconds the consumer spends on each message
+    :param bool decode: whether the consumer decodes each payload
+    :param int concurrency: messages the agent processes at once
+    :param int prefetch_count: the agent's QoS prefetch count
+    :param float timeout: seconds to wait for every message to be consumed
+
+    """
+
+    def __init__(self, broker, count=10000, rate=None, size=1024,
+                 content_type='application/json', compression=None,
+                 routing_keys=1, sleep=0.0, decode=False, concurrency=1,
+                 prefetch_count=100, timeout=300.0, exchange=EXCHANGE,
+                 queue=QUEUE):
+        if content_type not in CONTENT_TYPES:
+            raise ValueError('Unsupported content type: %r' % content_type)
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError('Unsupported compression: %r' % compression)
+        self.broker = broker
+        self.count = count
+        self.rate = rate
+        self.size = size
+        self.content_type = content_type
+        self.compression = compression
+        self.routing_keys = max(1, routing_keys)
+        self.sleep = sleep
+        self.decode = decode
+        self.concurrency = concurrency
+        self.prefetch_count = prefetch_count
+        self.timeout = timeout
+        self.exchange = exchange
+        self.queue = queue
+        self.published = 0
+        self.publish_seconds = None
+        self.agent = None
+        self.consumer = None
+        self._timed_out = False
+
+    @property
+    def config(self):
+        """The agent's exchange and queue config."""
+        return {
+            'exchanges': {self.exchange: {'exchange_type': 'topic',
+                                          'durable': False,
+                                          'auto_delete': False}},
+            'queues': {self.queue: {'durable': False,
+                                    'auto_delete': False}},
+        }
+
+    @property
+    def bindings(self):
+        return [{'queue': self.queue, 'exchange': self.exchange,
+                 'routing_key': 'bench.#'}]
+
+    def routing_key(self, index):
+        """Return the routing key for the `index`-th message."""
+        return 'bench.%d' % (index % self.routing_keys)
+
+    def declare(self):
+        """Declare and purge the benchmark exchange and queue."""
+        declare(self.broker, self.config, self.bindings)
+
+    def make_message(self):
+        """Return the publisher, body, and properties to publish with."""
+        properties = Properties()
+        properties.content_type = self.content_type
+        properties.delivery_mode = 1
+        if self.content_type == 'application/json':
+            body = make_payload(self.size)
+            if not self.compression:
+                return BlockingJSONPublisher(self.broker), body, properties
+            body = simplejson.dumps(body).encode('utf-8')
+        else:
+            body = (b'Chewie, we are home. ' * (self.size // 21 + 1))[
+                :self.size]
+        if self.compression:
+            body = COMPRESSORS[self.compression](body)
+            properties.content_encoding = self.compression
+        return BlockingPublisher(self.broker), body, properties
+
+    def publish(self, send=None):
+        """Publish :attr:`count` messages at :attr:`rate`.
+
+        `send(func, *args)` is used to call the publisher; by default the
+        publisher is called directly.
+
+        """
+        publisher, body, properties = self.make_message()
+        send = send or (lambda func, *args: func(*args))
+        start = default_timer()
+        for index in range(self.count):
+            if self.rate:
+                delay = start + index / float(self.rate) - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+            # a copy per message, since `send` may publish it later
+            message_properties = copy.copy(properties)
+            message_properties.headers = {
+                SENT_AT_HEADER: int(time.time() * 1e6)}
+            send(publisher.publish, self.exchange, self.routing_key(index),
+                 body, message_properties)
+            self.published += 1
+        self.publish_seconds = default_timer() - start
+
+    def run(self):
+        """Run the benchmark.
+
+        :returns: the benchmark's results (see :meth:`results`)
+        :rtype: dict
+
+        """
+        self.declare()
+        self.consumer = BenchConsumer(self.count, self.sleep, self.decode,
+                                      on_complete=self._stop)
+        self.agent = ConsumerAgent(self.consumer, self.broker, self.bindings,
+                                   config=self.config,
+                                   concurrency=self.concurrency,
+                                   prefetch_count=self.prefetch_count)
+        self.agent.connect()
+        ioloop = self.agent.connection.ioloop
+        send = None
+        if isinstance(self.broker, FakeBroker):
+            # the fake server is not thread-safe, so publish on its IOLoop
+            def send(func, *args):
+                ioloop.add_callback(func, *args)
+        publisher = threading.Thread(target=self.publish, args=(send,),
+                                     name='pikachewie-bench-publisher')
+        publisher.daemon = True
+        if hasattr(ioloop, 'add_busy_check'):
+            ioloop.add_busy_check(publisher.is_alive)
+            ioloop.add_busy_check(lambda: self.agent.workers is not None and
+                                  self.agent.workers.busy)
+        self.agent.connection.add_timeout(self.timeout, self._time_out)
+
+        start = default_timer()
+        publisher.start()
+        ioloop.start()
+        publisher.join()
+        elapsed = (self.consumer.finished_at or default_timer()) - start
+        if self.agent.workers is not None:
+            self.agent.workers.stop()
+        self.agent.disconnect()
+        return self.results(elapsed)
+
+    def _stop(self):
+        self.agent.connection.ioloop.add_callback(
+            self.agent.connection.ioloop.stop)
+
+    def _time_out(self):
+        if self.consumer.finished_at is None:
+            log.warning('Timed out after %s seconds with %d of %d messages '
+                        'consumed', self.timeout,
+                        len(self.consumer.latencies), self.count)
+            self._timed_out = True
+            self.agent.connection.ioloop.stop()
+
+    def results(self, elapsed):
+        """Summarize a run that took `elapsed` seconds.
+
+        Latencies are in milliseconds and rates in messages per second.
+
+        :rtype: dict
+
+        """
+        latencies = sorted(self.consumer.latencies)
+        consumed = len(latencies)
+        results = {
+            'published': self.published,
+            'consumed': consumed,
+            'timed_out': self._timed_out,
+            'seconds': round(elapsed, 6),
+            'publish_rate': round(self.published / self.publish_seconds, 3)
+            if self.publish_seconds else None,
+            'consume_rate': round(consumed / elapsed, 3) if elapsed else None,
+        }
+        for name, fraction in PERCENTILES + (('max', 1.0),):
+            value = percentile(latencies, fraction)
+            results['latency_%s_ms' % name] = \
+                None if value is None else round(value * 1000, 3)
+        return results
+
+
+def format_results(results):
+    """Format the output of :meth:`LoadGenerator.run` as text."""
+    def number(value, format_='%.3f'):
+        return 'n/a' if value is None else format_ % value
+
+    lines = [
+        'messages: %d published, %d consumed%s' % (
+            results['published'], results['consumed'],
+            ' (timed out)' if results['timed_out'] else ''),
+        'elapsed:  %s s' % number(results['seconds']),
+        'publish:  %s msg/s' % number(results['publish_rate'], '%.1f'),
+        'consume:  %s msg/s' % number(results['consume_rate'], '%.1f'),
+        'latency:  ' + '  '.join(
+            '%s=%s ms' % (name, number(results['latency_%s_ms' % name]))
+            for name in ('p50', 'p99', 'p999', 'max')),
+    ]
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pikachewie-bench',
+        description='Measure PikaChewie publish/consume throughput and '
+                    'round-trip latency.')
+    parser.add_argument('--url', help='AMQP URL of a RabbitMQ node to '
+                        'benchmark (default: in-process fake broker)')
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='messages to publish (default: 10000)')
+    parser.add_argument('-r', '--rate', type=float,
+                        help='messages per second to publish '
+                        '(default: unlimited)')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+                        help='approximate message body size in bytes, '
+                        'before compression (default: 1024)')
+    parser.add_argument('-t', '--content-type', default='application/json',
+                        choices=CONTENT_TYPES,
+                        help='message content type (default: %(default)s)')
+    parser.add_argument('-z', '--compression', choices=sorted(COMPRESSORS),
+                        help='compress message bodies')
+    parser.add_argument('-k', '--routing-keys', type=int, default=1,
+                        help='distinct routing keys to publish with '
+                        '(default: 1)')
+    parser.add_argument('--sleep', type=float, default=0.0,
+                        help='seconds the consumer spends on each message, '
+                        'simulating work (default: 0, a no-op consumer)')
+    parser.add_argument('--decode', action='store_true',
+                        help='decode each payload in the consumer')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='messages the agent processes at once '
+                        '(default: 1)')
+    parser.add_argument('-p', '--prefetch-count', type=int, default=100,
+                        help='consumer prefetch count (default: 100)')
+    parser.add_argument('--timeout', type=float, default=300.0,
+                        help='seconds to wait for every message '
+                        '(default: 300)')
+    parser.add_argument('--json', action='store_true',
+                        help='write results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('pikachewie').setLevel(logging.ERROR)
+
+    generator = LoadGenerator(
+        broker_from_url(args.url), count=args.count, rate=args.rate,
+        size=args.size, content_type=args.content_type,
+        compression=args.compression, routing_keys=args.routing_keys,
+        sleep=args.sleep, decode=args.decode, concurrency=args.concurrency,
+        prefetch_count=args.prefetch_count, timeout=args.timeout)
+    results = generator.run()
+    results['broker'] = args.url or 'fake'
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_results(results))
+    return 1 if results['timed_out'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,12 +4,12 @@ pikachewie.broker -- A RabbitMQ broker
 ======================================
 
 """
+import copy
 import logging
 import random
 import time
 
 from pika import BlockingConnection, ConnectionParameters, PlainCredentials
-from pika.adapters.tornado_connection import TornadoConnection
 from pika.exceptions import AMQPConnectionError
 
 from pikachewie.utils import Missing
@@ -18,6 +18,17 @@ __all__ = ['Broker']
 
 log = logging.getLogger(__name__)
 
+# imported by _tornado_connection() on first use, since it imports Tornado
+TornadoConnection = None
+
+
+def _tornado_connection():
+    """Return pika's TornadoConnection class, importing it if needed."""
+    global TornadoConnection
+    if TornadoConnection is None:
+        from pika.adapters.tornado_connection import TornadoConnection
+    return TornadoConnection
+
 
 class BrokerConnectionError(AMQPConnectionError):
     """Raised when a new connection cannot be opened to a ``Broker``."""
@@ -59,6 +70,7 @@ class Broker(object):
     _attempts = None
     _max_attempts = None
     _abort_on_error = False
+    _pinned = False
 
     def __init__(self, nodes=None, connect_options=None):
         if nodes is None:
@@ -142,14 +154,10 @@ class Broker(object):
                 log.debug('Opening connection with %r', parameters)
 
                 try:
-                    if blocking:
-                        return BlockingConnection(parameters)
-                    else:
-                        return TornadoConnection(
-                            parameters,
-                            on_open_callback=on_open_callback,
-                            stop_ioloop_on_close=stop_ioloop_on_close,
-                        )
+                    return self._open_connection(parameters,
+                                                 on_open_callback,
+                                                 stop_ioloop_on_close,
+                                                 blocking)
                 except AMQPConnectionError as exc:
                     log.warn('Cannot connect to node %s: %s: %s', nodename,
                              type(exc).__name__, exc)
@@ -162,9 +170,49 @@ class Broker(object):
                          '' if str(cycle_delay) == '1' else 's')
                 time.sleep(cycle_delay)
 
+    def _open_connection(self, parameters, on_open_callback,
+                         stop_ioloop_on_close, blocking):
+        """Open a new connection to a RabbitMQ node.
+
+        Subclasses may override this method to connect via other adapters
+        (see :class:`pikachewie.testing.FakeBroker`).
+
+        :param parameters: parameters for connecting to the node
+        :type parameters: :class:`pika.connection.ConnectionParameters`
+
+        """
+        if blocking:
+            return BlockingConnection(parameters)
+        return _tornado_connection()(
+            parameters,
+            on_open_callback=on_open_callback,
+            stop_ioloop_on_close=stop_ioloop_on_close,
+        )
+
+    def pinned(self, index):
+        """Return a copy of this broker that prefers one of its nodes.
+
+        The copy tries node number `index` (modulo the number of nodes, in
+        order of node name) first, then the following nodes in turn, rather
+        than trying the nodes in random order; so copies pinned to
+        consecutive indexes spread their connections evenly across the
+        nodes.
+
+        :param int index: the index of the preferred node
+        :rtype: :class:`Broker`
+
+        """
+        broker = copy.copy(self)
+        nodes = sorted(self._nodes, key=lambda node: node[0])
+        index %= len(nodes)
+        broker._nodes = nodes[index:] + nodes[:index]
+        broker._pinned = True
+        return broker
+
     def _initialize_connection_attempt(self, max_attempts):
         """Prepare this broker for a connection attempt."""
-        random.shuffle(self._nodes)
+        if not self._pinned:
+            random.shuffle(self._nodes)
         if max_attempts is Missing:
             max_attempts = len(self._nodes)
         self._max_attempts = max_attempts
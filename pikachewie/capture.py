@@ -0,0 +1,358 @@
+"""
+========================================================
+pikachewie.capture -- Record and replay consumed traffic
+========================================================
+
+:class:`CaptureWriter` is an :class:`~pikachewie.metrics.AgentHooks` that
+records a sample of the messages delivered to a
+:class:`~pikachewie.agent.ConsumerAgent` to a capture file, and
+:func:`replay` passes the captured messages to any
+:class:`~pikachewie.consumer.Consumer` as fast as it can process them, with
+no broker involved.  This makes it possible to profile a consumer against
+real payloads, or to reproduce an incident involving slow messages::
+
+    agent = ConsumerAgent(consumer, broker, bindings,
+                          capture={'path': 'orders.pcap', 'sample_rate': 0.01,
+                                   'max_bytes': 100 * 1024 ** 2})
+
+    $ pikachewie-replay orders.pcap my.consumers.OrderConsumer
+
+A capture file starts with :data:`MAGIC` and is followed by one record per
+message: a fixed-size header (capture time, method class, and the lengths of
+the three sections that follow), then the AMQP-encoded delivery method (with
+its consumer tag, delivery tag, exchange, redelivered flag, and routing
+key), the AMQP-encoded ``Basic.Properties`` (including headers), and the raw
+body.  Because the method and properties use pika's own wire encoding,
+records are compact and decode exactly as they did off the wire.  A message
+whose properties cannot be re-encoded by pika is not captured.
+
+:class:`CaptureReader` memory-maps a capture file, so replaying a large
+capture does not read it all into memory.
+
+"""
+from __future__ import print_function
+
+import argparse
+import heapq
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from collections import namedtuple
+from timeit import default_timer
+
+from pika import spec
+from pika.exceptions import UnsupportedAMQPFieldException
+
+from pikachewie import exceptions
+from pikachewie.message import Message
+from pikachewie.metrics import AgentHooks
+from pikachewie.utils import import_namespaced_class, percentile
+
+__all__ = ['CaptureReader', 'CaptureWriter', 'CapturedDelivery',
+           'ReplayResult', 'replay']
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'PKCWCAP1'
+
+# capture time, method INDEX, method, properties, and body lengths
+_RECORD_HEADER = struct.Struct('!dIIII')
+
+CapturedDelivery = namedtuple('CapturedDelivery', [
+    'captured_at',      # POSIX time the message was captured
+    'method',           # e.g., pika.spec.Basic.Deliver
+    'properties',       # pika.spec.BasicProperties
+    'body',             # raw (undecoded) body
+])
+
+ReplayResult = namedtuple('ReplayResult', [
+    'messages',         # messages replayed
+    'errors',           # messages that raised Consumer/MessageException
+    'seconds',          # total time spent in Consumer.process
+    'timings',          # seconds spent on each message, in replay order
+    'slowest',          # (seconds, record index, routing key), slowest first
+])
+
+
+class CaptureWriter(AgentHooks):
+    """Appends a sample of an agent's messages to a capture file.
+
+    Each delivered message is captured with probability `sample_rate`, until
+    the file would grow beyond `max_bytes` (if set).
+
+    :param str path: the capture file; created if it does not exist
+    :param float sample_rate: fraction of messages to capture
+    :param int max_bytes: maximum size of the capture file
+
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=None,
+                 random=random.random):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('Invalid sample rate: %r' % sample_rate)
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.random = random
+        self.captured = 0
+        self.skipped = 0    # not sampled
+        self.dropped = 0    # sampled, but over the size cap or unencodable
+        self._file = None
+        self.size = 0
+
+    @property
+    def full(self):
+        """Whether the capture file has reached `max_bytes`."""
+        return self.max_bytes is not None and self.size >= self.max_bytes
+
+    def open(self):
+        """Open the capture file for appending."""
+        self._file = open(self.path, 'ab')
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+        if not self.size:
+            self._file.write(MAGIC)
+            self.size = len(MAGIC)
+        log.info('Capturing %.1f%% of messages to %s', 100 * self.sample_rate,
+                 self.path)
+
+    def close(self):
+        """Flush and close the capture file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, message):
+        """Capture the given message, subject to sampling and the size cap.
+
+        :param message: the message to capture
+        :type message: :class:`pikachewie.message.Message`
+        :returns: whether the message was captured
+        :rtype: `bool`
+
+        """
+        if self.sample_rate < 1 and self.random() >= self.sample_rate:
+            self.skipped += 1
+            return False
+        if self._file is None:
+            self.open()
+        if self.full:
+            self.dropped += 1
+            return False
+        try:
+            method = b''.join(message.method.encode())
+            properties = b''.join(
+                message.properties.to_basic_properties().encode())
+        except (UnsupportedAMQPFieldException, TypeError) as exc:
+            log.debug('Cannot capture message #%s: %r', message.delivery_tag,
+                      exc)
+            self.dropped += 1
+            return False
+
+        body = message.raw_body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        size = _RECORD_HEADER.size + len(method) + len(properties) + len(body)
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            log.info('Capture file %s is full', self.path)
+            self.size = self.max_bytes
+            self.dropped += 1
+            return False
+        self._file.write(_RECORD_HEADER.pack(
+            time.time(), message.method.INDEX, len(method), len(properties),
+            len(body)))
+        self._file.write(method)
+        self._file.write(properties)
+        self._file.write(body)
+        self.size += size
+        self.captured += 1
+        return True
+
+    # lifecycle hooks
+
+    def message_received(self, agent, message):
+        self.record(message)
+
+
+class CaptureReader(object):
+    """Reads the records of a capture file via a memory map.
+
+    Iterating over a reader yields a :class:`CapturedDelivery` per record.
+    A truncated final record (e.g., from a crash mid-write) is ignored.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file, e.g., from a writer that crashed before MAGIC
+            self._file.close()
+            raise ValueError('Not a PikaChewie capture file: %s' % path)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('Not a PikaChewie capture file: %s' % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __iter__(self):
+        data = self._map
+        offset = len(MAGIC)
+        end = len(data)
+        while offset + _RECORD_HEADER.size <= end:
+            captured_at, index, method_size, properties_size, body_size = \
+                _RECORD_HEADER.unpack_from(data, offset)
+            offset += _RECORD_HEADER.size
+            if offset + method_size + properties_size + body_size > end:
+                break
+            method = spec.methods[index]()
+            method.decode(data[offset:offset + method_size])
+            offset += method_size
+            properties = spec.BasicProperties()
+            properties.decode(data, offset)
+            offset += properties_size
+            body = data[offset:offset + body_size]
+            offset += body_size
+            yield CapturedDelivery(captured_at, method, properties, body)
+        if offset < end:
+            log.warning('Ignoring truncated record at the end of %s',
+                        self.path)
+
+    def messages(self, channel=None):
+        """Yield a :class:`pikachewie.message.Message` per record."""
+        for delivery in self:
+            yield Message(channel, delivery.method, delivery.properties,
+                          delivery.body)
+
+
+def replay(consumer, path, repeat=1, limit=None, slowest=5):
+    """Pass each message captured in `path` to `consumer`.
+
+    Messages are replayed back to back, with no broker.  As in
+    :class:`~pikachewie.agent.ConsumerAgent`, a
+    :class:`~pikachewie.exceptions.ConsumerException` or
+    :class:`~pikachewie.exceptions.MessageException` is counted as an error
+    and replay continues; any other exception is raised.
+
+    :param consumer: the consumer to replay messages through
+    :type consumer: :class:`pikachewie.consumer.Consumer`
+    :param str path: the capture file
+    :param int repeat: number of times to replay the capture
+    :param int limit: maximum number of messages to replay per repetition
+    :param int slowest: number of slowest messages to report
+    :rtype: :class:`ReplayResult`
+
+    """
+    errors = 0
+    timings = []
+    slow = []
+    with CaptureReader(path) as reader:
+        for _ in range(repeat):
+            for index, message in enumerate(reader.messages()):
+                if limit is not None and index >= limit:
+                    break
+                start = default_timer()
+                try:
+                    consumer.process(message)
+                except (exceptions.ConsumerException,
+                        exceptions.MessageException) as exc:
+                    log.debug('Replayed message raised %r', exc)
+                    errors += 1
+                seconds = default_timer() - start
+                timings.append(seconds)
+                if slowest:
+                    entry = (seconds, index, message.routing_key)
+                    if len(slow) < slowest:
+                        heapq.heappush(slow, entry)
+                    elif entry > slow[0]:
+                        heapq.heapreplace(slow, entry)
+    return ReplayResult(len(timings), errors, sum(timings), timings,
+                        sorted(slow, reverse=True))
+
+
+def summarize(result):
+    """Summarize a :class:`ReplayResult` as a dict.
+
+    Latencies are in milliseconds.  ``slowest`` lists the record index,
+    routing key, and time of the slowest messages, so that they can be
+    replayed on their own (see :meth:`CaptureReader.messages`).
+
+    :rtype: dict
+
+    """
+    samples = sorted(result.timings)
+    summary = {
+        'messages': result.messages,
+        'errors': result.errors,
+        'seconds': round(result.seconds, 6),
+        'messages_per_second': round(result.messages / result.seconds, 3)
+        if result.seconds else None,
+        'slowest': [{'index': index, 'routing_key': routing_key,
+                     'ms': round(seconds * 1000, 3)}
+                    for seconds, index, routing_key in result.slowest],
+    }
+    for name, fraction in (('p50', 0.50), ('p99', 0.99), ('p999', 0.999),
+                           ('max', 1.0)):
+        value = percentile(samples, fraction)
+        summary['latency_%s_ms' % name] = \
+            None if value is None else round(value * 1000, 3)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pikachewie-replay',
+        description='Replay a PikaChewie capture file through a consumer.')
+    parser.add_argument('path', help='capture file to replay')
+    parser.add_argument('consumer', help='consumer class, e.g., '
+                        'my.consumers.OrderConsumer')
+    parser.add_argument('-a', '--arguments', type=json.loads, default={},
+                        help='consumer keyword arguments, as a JSON object')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='times to replay the capture (default: 1)')
+    parser.add_argument('-n', '--limit', type=int,
+                        help='messages to replay per repetition '
+                        '(default: all)')
+    parser.add_argument('--json', action='store_true',
+                        help='write results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    consumer = import_namespaced_class(args.consumer)(**args.arguments)
+    result = replay(consumer, args.path, args.repeat, args.limit)
+    summary = summarize(result)
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print('%d messages (%d errors) in %.3f s: %s msg/s' % (
+            summary['messages'], summary['errors'], summary['seconds'],
+            summary['messages_per_second']))
+        print('latency: ' + '  '.join(
+            '%s=%s ms' % (name, summary['latency_%s_ms' % name])
+            for name in ('p50', 'p99', 'p999', 'max')))
+        for slow in summary['slowest']:
+            print('slow: #%(index)d %(routing_key)s %(ms).3f ms' % slow)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
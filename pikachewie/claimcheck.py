@@ -0,0 +1,300 @@
+"""
+=================================================
+pikachewie.claimcheck -- Large message offloading
+=================================================
+
+Every message body is held in RabbitMQ's memory (and, for durable queues,
+written to disk) and copied to every consumer that receives it, so bodies
+of several megabytes are expensive to route, and hold up the messages
+behind them.  With a `claim check`_, a publisher writes such a body to a
+:class:`BlobStore` shared with its consumers, and publishes only a
+reference to it in the :data:`CLAIM_CHECK_HEADER` header, with an empty
+body::
+
+    store = FileBlobStore('/mnt/shared/blobs')
+    publisher = BlockingPublisher(broker, blob_store=store)
+    publisher.publish('reports', 'report.daily', report)  # > 1 MB
+
+Publishers set with a ``blob_store`` do so for every body longer than their
+``claim_check_threshold`` (1 MB, by default).  On the consumer side, set
+:attr:`pikachewie.message.Message.blob_store` to the same store, and
+:attr:`~pikachewie.message.Message.body` and
+:attr:`~pikachewie.message.Message.payload` load a claim-checked body from
+the store, through a memory map, the first time they are read::
+
+    Message.blob_store = FileBlobStore('/mnt/shared/blobs')
+
+Since a body may be delivered to any number of queues, the store cannot
+tell when it has been read for the last time.  Instead, blobs are
+collected once they are older than any message that may refer to them (for
+instance, older than the queues' message TTL); a :class:`BlobCollector`
+does so periodically::
+
+    BlobCollector(store, max_age=24 * 3600).start()
+
+.. _claim check:
+    https://www.enterpriseintegrationpatterns.com/StoreInLibrary.html
+
+"""
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+
+__all__ = ['BlobCollector', 'BlobStore', 'CLAIM_CHECK_HEADER',
+           'DEFAULT_CLAIM_CHECK_THRESHOLD', 'FileBlobStore']
+
+log = logging.getLogger(__name__)
+
+#: The header holding the key of a claim-checked message body.
+CLAIM_CHECK_HEADER = 'x-claim-check'
+
+#: The default size, in bytes, above which message bodies are claim-checked.
+DEFAULT_CLAIM_CHECK_THRESHOLD = 1024 * 1024
+
+
+class BlobStore(object):
+    """Base class for stores of message bodies, by key."""
+
+    def put(self, body):
+        """Store `body`, and return its key.
+
+        :param bytes body: the message body
+        :rtype: str
+
+        """
+        raise NotImplementedError
+
+    def open(self, key):
+        """Return the body stored under `key`.
+
+        :param str key: the key returned by :meth:`put`
+        :returns: the body, or a read-only buffer over it
+        :raises: :class:`KeyError` if no body is stored under `key`
+
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete the body stored under `key`, if any.
+
+        :param str key: the key returned by :meth:`put`
+
+        """
+        raise NotImplementedError
+
+    def collect(self, max_age, now=None):
+        """Delete the bodies stored more than `max_age` seconds ago.
+
+        :param float max_age: the age of the oldest body to keep
+        :param float now: the current POSIX timestamp (default:
+            ``time.time()``)
+        :returns: the number of bodies deleted
+        :rtype: int
+
+        """
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """Stores message bodies as files in a (local or shared) directory.
+
+    Bodies are content-addressed: each is stored once, under the SHA-256
+    digest of its contents, so a body published many times takes up space
+    only once, and concurrent writers of the same body do not conflict.
+    Files are written to a temporary name and then renamed into place, so
+    readers never see a partly written body.  Storing a body again resets
+    its age.
+
+    :param str path: the directory to store bodies in (created if missing)
+
+    """
+    _KEY = re.compile(r'^[0-9a-f]{64}$')
+    _TEMPORARY_PREFIX = '.tmp-'
+
+    def __init__(self, path):
+        self.path = path
+        _make_directory(path)
+
+    def put(self, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        key = hashlib.sha256(body).hexdigest()
+        path = self._path(key)
+        if os.path.exists(path):
+            try:
+                os.utime(path, None)
+                return key
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                # collected in the meantime; store it again
+        directory = os.path.dirname(path)
+        _make_directory(directory)
+        descriptor, temporary = tempfile.mkstemp(
+            prefix=self._TEMPORARY_PREFIX, dir=directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as fp:
+                fp.write(body)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.chmod(temporary, 0o644)
+            os.rename(temporary, path)
+        except BaseException:
+            _remove(temporary)
+            raise
+        log.debug('Stored %d-byte body as %s', len(body), key)
+        return key
+
+    def open(self, key):
+        """Return a read-only memory map of the body stored under `key`.
+
+        The map remains readable even if the body is collected.
+
+        :rtype: :class:`mmap.mmap` (or empty `bytes`)
+
+        """
+        if not self._is_key(key):
+            raise KeyError(key)
+        try:
+            fp = open(self._path(key), 'rb')
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+        with fp:
+            if not os.fstat(fp.fileno()).st_size:
+                return b''  # empty files cannot be mapped
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, key):
+        if self._is_key(key):
+            _remove(self._path(key))
+
+    def keys(self):
+        """Return the keys of every stored body.
+
+        :rtype: `list` of `str`
+
+        """
+        return [prefix + name for prefix, name, _ in self._files()
+                if self._is_key(prefix + name)]
+
+    def collect(self, max_age, now=None):
+        if now is None:
+            now = time.time()
+        cutoff = now - max_age
+        collected = 0
+        for prefix, name, path in self._files():
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+            except OSError:
+                continue
+            if _remove(path) and not name.startswith(
+                    self._TEMPORARY_PREFIX):
+                collected += 1
+        if collected:
+            log.info('Collected %d bodies from %s', collected, self.path)
+        return collected
+
+    def _is_key(self, key):
+        try:
+            return bool(self._KEY.match(key))
+        except TypeError:
+            return False
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _files(self):
+        """Yield the ``(prefix, name, path)`` of every stored file."""
+        for prefix in sorted(_list_directory(self.path)):
+            directory = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in _list_directory(directory):
+                yield prefix, name, os.path.join(directory, name)
+
+
+class BlobCollector(object):
+    """Periodically collects old bodies from a blob store, on a thread.
+
+    :param store: the store to collect from
+    :type store: :class:`BlobStore`
+    :param float max_age: the age, in seconds, of the oldest body to keep;
+        this must exceed the time any message referring to a body may spend
+        in its queues
+    :param float interval: seconds between collections (default: a tenth
+        of `max_age`)
+
+    """
+
+    def __init__(self, store, max_age, interval=None):
+        self.store = store
+        self.max_age = max_age
+        self.interval = interval or max_age / 10.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start collecting, after the first interval."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='pikachewie-blob-collector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop collecting, waiting for a collection under way to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collect(self):
+        """Collect old bodies now.
+
+        :returns: the number of bodies deleted
+        :rtype: int
+
+        """
+        return self.store.collect(self.max_age)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.collect()
+            except Exception:
+                log.exception('Cannot collect bodies from %r', self.store)
+
+
+def _make_directory(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _list_directory(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _remove(path):
+    """Remove `path`, and return whether it existed."""
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return False
+    return True
@@ -0,0 +1,216 @@
+"""
+==================================================
+pikachewie.columnar -- Batch decoding into columns
+==================================================
+
+Decoding thousands of small JSON messages one :attr:`payload
+<pikachewie.message.Message.payload>` at a time builds a dict per message,
+only for most of it to be thrown away once the fields of interest are
+copied into arrays.  :func:`decode_columns` decodes a batch of JSON
+messages that share a schema together, straight into one array per
+selected field::
+
+    batch = decode_columns(messages, [('price', 'd'), ('quantity', 'q'),
+                                      'sku', 'customer.region'])
+    prices, missing = batch['price']
+    revenue = sum(price * quantity for price, quantity, null in
+                  zip(prices, batch['quantity'].values, missing)
+                  if not null)
+
+Each selected field is a top-level property name or a dotted path into
+nested objects.  Its column is an array of the given typecode (one of the
+:mod:`array` module's numeric typecodes), or a :class:`list` for fields
+with no typecode (such as strings), together with a null mask that is true
+where the field is ``null`` or missing.  Null entries of numeric columns
+are ``0`` (or ``nan``, for floating-point columns).  Columns are NumPy
+arrays (with boolean masks) if NumPy is installed, unless ``use_numpy`` is
+false.
+
+The bodies are decompressed (and loaded, if claim-checked) one by one, then
+joined into a single JSON array and parsed in one call; only the selected
+properties of each object are kept, in a small list, rather than building a
+dict per object.  Selected fields should hold numbers, strings, booleans,
+or ``null``.  Payload validators (see :mod:`pikachewie.validation`) are not
+applied.
+
+"""
+from array import array
+from collections import OrderedDict, namedtuple
+
+import simplejson
+
+from pikachewie.exceptions import MessageException
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['Column', 'ColumnBatch', 'decode_columns']
+
+#: A decoded column: its values, and whether each value is null or missing.
+Column = namedtuple('Column', 'values mask')
+
+_FLOAT_TYPECODES = frozenset('fd')
+_MISSING = object()
+
+
+class _Record(list):
+    """The selected properties of a decoded JSON object."""
+    __slots__ = ()
+
+
+class ColumnBatch(object):
+    """Columns decoded from a batch of messages, by field.
+
+    :attr:`invalid` lists the indexes of the messages whose bodies could
+    not be loaded or were not JSON objects; all their fields are null.
+
+    """
+
+    def __init__(self, columns, size, invalid=()):
+        self.columns = columns
+        self.size = size
+        self.invalid = list(invalid)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __repr__(self):
+        return '<%s %d rows: %s>' % (self.__class__.__name__, self.size,
+                                     ', '.join(self.columns))
+
+
+def decode_columns(messages, fields, use_numpy=None):
+    """Decode the JSON bodies of `messages` into columns.
+
+    :param messages: the messages to decode
+    :type messages: sequence of :class:`pikachewie.message.Message`
+    :param fields: the fields to decode, each a name (or dotted path), or a
+        ``(name, typecode)`` pair
+    :param bool use_numpy: whether to return NumPy arrays (default: if
+        NumPy is installed)
+    :rtype: :class:`ColumnBatch`
+    :raises: :class:`ValueError` if a value does not fit its column
+
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError('NumPy is not installed')
+    names, typecodes = _parse_fields(fields)
+    index = {}
+    paths = []
+    for name in names:
+        paths.append([index.setdefault(word, len(index))
+                      for word in name.split('.')])
+    records, invalid = _decode_records(messages, index)
+
+    columns = OrderedDict()
+    for name, typecode, path in zip(names, typecodes, paths):
+        values, mask = _extract(records, name, path)
+        columns[name] = _column(name, values, mask, typecode, use_numpy)
+    return ColumnBatch(columns, len(records), invalid)
+
+
+def _parse_fields(fields):
+    names, typecodes = [], []
+    for field in fields:
+        if isinstance(field, tuple):
+            name, typecode = field
+        else:
+            name, typecode = field, None
+        names.append(name)
+        typecodes.append(typecode)
+    return names, typecodes
+
+
+def _decode_records(messages, index):
+    """Return the selected properties of every message, and the indexes of
+    those that could not be decoded.
+
+    """
+    blank = [_MISSING] * len(index)
+    lookup = index.get
+
+    def select(pairs):
+        record = _Record(blank)
+        for key, value in pairs:
+            position = lookup(key)
+            if position is not None:
+                record[position] = value
+        return record
+
+    bodies = []
+    for message in messages:
+        try:
+            body = message._decoded_body
+        except MessageException:
+            body = u'null'  # e.g. a missing claim-checked body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        bodies.append(body)
+    try:
+        records = simplejson.loads(u'[%s]' % u','.join(bodies),
+                                   object_pairs_hook=select)
+        if len(records) != len(bodies):
+            raise ValueError('Message bodies are not single JSON values')
+    except ValueError:
+        # decode each message on its own, to find the ones at fault
+        records = []
+        for body in bodies:
+            try:
+                records.append(simplejson.loads(body,
+                                                object_pairs_hook=select))
+            except ValueError:
+                records.append(None)
+    invalid = []
+    for position, record in enumerate(records):
+        if not isinstance(record, _Record):
+            invalid.append(position)
+            records[position] = blank
+    return records, invalid
+
+
+def _extract(records, name, path):
+    """Return the values of the field at `path`, and its null mask."""
+    values = []
+    mask = []
+    for record in records:
+        value = record
+        for position in path:
+            if not isinstance(value, _Record):
+                value = _MISSING
+                break
+            value = value[position]
+        if isinstance(value, _Record):
+            raise ValueError('Field %r is an object, not a value' % name)
+        if value is None or value is _MISSING:
+            values.append(None)
+            mask.append(True)
+        else:
+            values.append(value)
+            mask.append(False)
+    return values, mask
+
+
+def _column(name, values, mask, typecode, use_numpy):
+    if typecode is not None:
+        null = float('nan') if typecode in _FLOAT_TYPECODES else 0
+        values = [null if value is None else value for value in values]
+    try:
+        if use_numpy:
+            dtype = object if typecode is None else typecode
+            return Column(numpy.array(values, dtype=dtype),
+                          numpy.array(mask, dtype=bool))
+        if typecode is not None:
+            values = array(typecode, values)
+        return Column(values, array('b', mask))
+    except (OverflowError, TypeError, ValueError) as exc:
+        raise ValueError('Cannot decode column %r: %s' % (name, exc))
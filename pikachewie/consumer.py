@@ -4,14 +4,27 @@ pikachewie.consumer -- PikaChewie base consumer class
 =====================================================
 
 """
+import copy
 import logging
 
+from pika.spec import BasicProperties
+
+from pikachewie.exceptions import MessageException
+
 log = logging.getLogger(__name__)
 
 
 class Consumer(object):
-    """Base class for RabbitMQ consumers."""
+    """Base class for RabbitMQ consumers.
+
+    If :attr:`schemas` is set, the payloads of the messages processed are
+    validated by it (see :mod:`pikachewie.validation`).
+
+    """
     message = None
+    #: the :class:`pikachewie.validation.SchemaRegistry` to validate
+    #: payloads by
+    schemas = None
 
     def process(self, message):
         """Process the given RabbitMQ `message`.
@@ -25,9 +38,69 @@ class Consumer(object):
         """
         log.debug('Received: %r', message)
         self.message = message
+        if self.schemas is not None:
+            message.validator = self.schemas
         log.debug('Calling %r', self.process_message)
         self.process_message()
 
     def process_message(self):
         """Subclasses must override this method to implement consumer logic."""
         raise NotImplementedError
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Publish a message once the current message has been processed.
+
+        When run by a :class:`~pikachewie.agent.ConsumerAgent`, the message
+        is published on the agent's own connection, and the current message
+        is acknowledged only once the broker has confirmed it (see
+        :mod:`pikachewie.outbox`).  It is not published if processing the
+        current message fails.
+
+        :param str exchange: the exchange to publish to
+        :param str routing_key: the routing key to publish with
+        :param str body: the message body
+        :param properties: the message properties
+        :type properties: :class:`pikachewie.data.Properties` or
+            :class:`pika.spec.BasicProperties`
+
+        """
+        self.message.outputs.append((exchange, routing_key, body, properties))
+
+    def pause(self, seconds=None):
+        """Ask the agent to stop delivering messages, once the current
+        message has been processed.
+
+        Use this when a downstream system pushes back.  Consumption resumes
+        after `seconds`, or when :meth:`resume` is called while processing
+        a later message (e.g., one delivered before the pause took effect).
+        See :meth:`pikachewie.agent.ConsumerAgent.pause`.
+
+        :param float seconds: how long to pause for (default: until resumed)
+
+        """
+        self.message.flow_request = ('pause', seconds)
+
+    def resume(self):
+        """Ask the agent to resume delivering messages paused by
+        :meth:`pause`, once the current message has been processed.
+
+        """
+        self.message.flow_request = ('resume', None)
+
+    def reply(self, body, properties=None):
+        """Reply to the current message, an RPC request.
+
+        The reply is published like :meth:`publish`, to the request's
+        ``reply_to`` queue, with its ``correlation_id``.
+
+        :raises: :class:`pikachewie.exceptions.MessageException` if the
+            current message has no ``reply_to``
+
+        """
+        if not self.message.reply_to:
+            raise MessageException('Cannot reply to message #%s: no reply_to'
+                                   % self.message.delivery_tag)
+        properties = copy.copy(properties) if properties is not None \
+            else BasicProperties()
+        properties.correlation_id = self.message.correlation_id
+        self.publish('', self.message.reply_to, body, properties)
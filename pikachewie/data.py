@@ -63,3 +63,15 @@ class Properties(DataObject):
         for attr in self.attrs:
             setattr(self, attr, getattr(header, attr))
         self.headers = copy.deepcopy(header.headers) or {}
+
+    def to_basic_properties(self):
+        """Convert these properties back into pika's.
+
+        :rtype: :class:`pika.spec.BasicProperties`
+
+        """
+        basic_properties = BasicProperties(
+            headers=copy.deepcopy(self.headers))
+        for attr in self.attrs:
+            setattr(basic_properties, attr, getattr(self, attr))
+        return basic_properties
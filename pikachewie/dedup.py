@@ -0,0 +1,210 @@
+"""
+====================================================
+pikachewie.dedup -- Skipping of duplicate deliveries
+====================================================
+
+RabbitMQ delivers each message at least once: deliveries left unacknowledged
+when a connection drops are redelivered, and a publisher that retries after
+an uncertain send may publish the same message twice.  A
+:class:`Deduplicator` remembers the keys of the messages an agent has
+processed successfully (by default, their ``message_id``), so that the
+agent can acknowledge later copies without passing them to the consumer::
+
+    agent = ConsumerAgent(consumer, broker, bindings,
+                          deduplicate={'ttl': 3600,
+                                       'path': '/var/run/orders.dedup'})
+
+Keys are kept in a :class:`MemoryStore`, a bounded LRU cache whose entries
+expire after `ttl` seconds.  If a `path` is given, they are also kept in a
+:class:`DiskStore`, an SQLite database that every worker process on the
+host can share, so that a copy redelivered to a different process is also
+recognized.
+
+A message's key is remembered only once the message has been acknowledged,
+that is, once every message its consumer published has been confirmed (see
+:mod:`pikachewie.outbox`); a message requeued because its outputs could not
+be published is processed again when redelivered.  Only messages that have
+already been acknowledged are recognized: if two copies of a message are
+delivered concurrently, both are processed.  Messages without a key are
+never considered duplicates.
+
+"""
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+from pikachewie.metrics import AgentHooks
+from pikachewie.utils import import_namespaced_class
+
+__all__ = ['Deduplicator', 'DiskStore', 'MemoryStore']
+
+log = logging.getLogger(__name__)
+
+
+def message_id(message):
+    """Return the deduplication key of `message`: its ``message_id``."""
+    return message.id
+
+
+class MemoryStore(object):
+    """An LRU set of keys, whose entries expire after `ttl` seconds.
+
+    :param int max_size: maximum number of keys to remember
+    :param float ttl: seconds to remember each key for
+
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, time_func=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.time = time_func
+        self._expiries = OrderedDict()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def __contains__(self, key):
+        expires_at = self._expiries.get(key)
+        if expires_at is None:
+            return False
+        del self._expiries[key]
+        if expires_at <= self.time():
+            return False
+        self._expiries[key] = expires_at  # most recently used
+        return True
+
+    def add(self, key):
+        """Remember `key`, evicting the least recently used if full."""
+        self._expiries.pop(key, None)
+        self._expiries[key] = self.time() + self.ttl
+        while len(self._expiries) > self.max_size:
+            self._expiries.popitem(last=False)
+
+
+class DiskStore(object):
+    """A set of keys in an SQLite database, shared between processes.
+
+    Expired keys are purged every `purge_every` additions.
+
+    :param str path: the database file; created if it does not exist
+    :param float ttl: seconds to remember each key for
+
+    """
+    _TIMEOUT = 5  # seconds to wait for another process's lock
+    purge_every = 1000
+
+    def __init__(self, path, ttl=3600, time_func=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.time = time_func
+        self._additions = 0
+        self._db = sqlite3.connect(path, timeout=self._TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen '
+                         '(key TEXT PRIMARY KEY, expires_at REAL)')
+
+    def __contains__(self, key):
+        row = self._db.execute('SELECT expires_at FROM seen WHERE key = ?',
+                               (key,)).fetchone()
+        return row is not None and row[0] > self.time()
+
+    def add(self, key):
+        """Remember `key`."""
+        self._db.execute('INSERT OR REPLACE INTO seen VALUES (?, ?)',
+                         (key, self.time() + self.ttl))
+        self._additions += 1
+        if self._additions % self.purge_every == 0:
+            self.purge()
+
+    def purge(self):
+        """Forget expired keys."""
+        self._db.execute('DELETE FROM seen WHERE expires_at <= ?',
+                         (self.time(),))
+
+    def close(self):
+        self._db.close()
+
+
+class Deduplicator(AgentHooks):
+    """Recognizes messages that an agent has already processed.
+
+    :param key: returns a message's deduplication key (default: its
+        ``message_id``); may also be given as a namespaced function name,
+        e.g., ``'my.module.order_key'``
+    :type key: callable or :class:`str`
+    :param int max_size: maximum number of keys to remember in memory
+    :param float ttl: seconds to remember each key for
+    :param str path: SQLite database in which to share keys between
+        processes
+
+    """
+
+    def __init__(self, key=None, max_size=10000, ttl=3600, path=None,
+                 time_func=time.time):
+        if isinstance(key, str):
+            key = import_namespaced_class(key)
+        self.key = key or message_id
+        self.memory = MemoryStore(max_size, ttl, time_func)
+        self.disk = None
+        if path is not None:
+            self.disk = DiskStore(path, ttl, time_func)
+        self.duplicates = 0
+        self._processed = {}    # delivery tag -> message awaiting its ack
+
+    def _key(self, message):
+        key = self.key(message)
+        return None if key is None else str(key)
+
+    def is_duplicate(self, message):
+        """Whether a message with the same key has already been processed.
+
+        :rtype: `bool`
+
+        """
+        key = self._key(message)
+        if key is None:
+            return False
+        if key in self.memory:
+            return True
+        if self.disk is not None and key in self.disk:
+            self.memory.add(key)
+            return True
+        return False
+
+    def add(self, message):
+        """Remember that `message` has been processed."""
+        key = self._key(message)
+        if key is None:
+            return
+        self.memory.add(key)
+        if self.disk is not None:
+            self.disk.add(key)
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    # lifecycle hooks
+
+    def message_dropped(self, agent, message, reason):
+        if reason == 'duplicate':
+            self.duplicates += 1
+
+    def message_processed(self, agent, message, outcome, seconds):
+        if outcome != 'ok':
+            return
+        if agent._ack:
+            self._processed[message.delivery_tag] = message
+        else:
+            self.add(message)
+
+    def message_acknowledged(self, agent, message, seconds):
+        if self._processed.pop(message.delivery_tag, None) is message:
+            self.add(message)
+
+    def message_rejected(self, agent, delivery_tag, requeue):
+        self._processed.pop(delivery_tag, None)
@@ -24,3 +24,8 @@ class MessageException(Exception):
 
     """
     pass
+
+
+class ValidationException(MessageException):
+    """Raised when a message payload does not match its schema."""
+    pass
@@ -0,0 +1,120 @@
+"""
+==================================================
+pikachewie.flow -- Backpressure by in-flight bytes
+==================================================
+
+A channel's prefetch count bounds the number of messages a
+:class:`~pikachewie.agent.ConsumerAgent` holds at once, but not their size:
+a prefetch count of 100 holds 100 KB of 1 KB messages, or 1 GB of 10 MB
+ones.  A :class:`FlowController` bounds the bytes instead.  It counts the
+body bytes of every message the agent holds, from delivery (while it waits
+for a worker, undecoded) until it is acknowledged or rejected.  When they
+exceed `max_bytes`, it pauses the agent's consumption (see
+:meth:`~pikachewie.agent.ConsumerAgent.pause`), and resumes it once they
+fall to `resume_bytes`::
+
+    agent = ConsumerAgent(consumer, broker, bindings, concurrency=8,
+                          prefetch_count=100,
+                          backpressure={'max_bytes': 256 * 1024 * 1024})
+
+The agent pauses by cancelling its consumers (``pause_method='cancel'``,
+the default), or by lowering its channel's prefetch count to 1
+(``pause_method='qos'``); a prefetch count of 0 would mean no limit at all.
+Cancelling takes effect at once: messages already received are still
+processed, and those still in transit are requeued by pika.  Lowering the
+prefetch count only throttles: it stops deliveries until every message held
+has been settled, and keeps the consumers (and their place in the queues'
+round-robin) in the meantime, but once the held messages are settled the
+broker delivers another.  If a message arrives while paused that way, the
+agent cancels its consumers, so that the throttle lets at most one more
+message per consumer through.
+
+Consumers may also pause the agent themselves, e.g., when a downstream
+system pushes back (see :meth:`pikachewie.consumer.Consumer.pause`).  The
+agent consumes again only once every reason to pause has been lifted.
+
+Claim-checked bodies (see :mod:`pikachewie.claimcheck`) are counted by their
+size on the wire, since they are only loaded when read.
+
+"""
+import logging
+
+from pikachewie.metrics import AgentHooks
+
+__all__ = ['FlowController']
+
+log = logging.getLogger(__name__)
+
+
+class FlowController(AgentHooks):
+    """Pauses an agent while it holds more than `max_bytes` of messages.
+
+    :param agent: the agent to pause
+    :type agent: :class:`pikachewie.agent.ConsumerAgent`
+    :param int max_bytes: the number of body bytes held above which to
+        pause
+    :param int resume_bytes: the number of body bytes held at or below
+        which to resume (default: half of `max_bytes`)
+
+    """
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    REASON = 'backpressure'
+
+    def __init__(self, agent, max_bytes=DEFAULT_MAX_BYTES, resume_bytes=None):
+        if resume_bytes is None:
+            resume_bytes = max_bytes // 2
+        if not 0 <= resume_bytes < max_bytes:
+            raise ValueError('Invalid byte watermarks: %r to %r'
+                             % (resume_bytes, max_bytes))
+        self.agent = agent
+        self.max_bytes = max_bytes
+        self.resume_bytes = resume_bytes
+        self.held_bytes = 0
+        self.paused = False
+        self._held = {}     # delivery tag -> body bytes
+
+    def reset(self):
+        """Forget the messages held on a lost channel."""
+        self._held.clear()
+        self.held_bytes = 0
+        self._check()
+
+    def message_received(self, agent, message):
+        size = len(message.raw_body or b'')
+        self._held[message.delivery_tag] = size
+        self.held_bytes += size
+        self._check()
+
+    def message_dropped(self, agent, message, reason):
+        if not agent._ack:
+            self._release(message.delivery_tag)
+
+    def message_processed(self, agent, message, outcome, seconds):
+        # successfully processed messages are held until acknowledged, but
+        # every other outcome settles the message at once
+        if outcome != 'ok' or not agent._ack:
+            self._release(message.delivery_tag)
+
+    def message_acknowledged(self, agent, message, seconds):
+        self._release(message.delivery_tag)
+
+    def message_rejected(self, agent, delivery_tag, requeue):
+        self._release(delivery_tag)
+
+    def _release(self, delivery_tag):
+        size = self._held.pop(delivery_tag, None)
+        if size is not None:
+            self.held_bytes -= size
+            self._check()
+
+    def _check(self):
+        if not self.paused and self.held_bytes > self.max_bytes:
+            log.info('Holding %d bytes of messages (limit: %d); pausing',
+                     self.held_bytes, self.max_bytes)
+            self.paused = True
+            self.agent.pause(self.REASON)
+        elif self.paused and self.held_bytes <= self.resume_bytes:
+            log.info('Holding %d bytes of messages; resuming',
+                     self.held_bytes)
+            self.paused = False
+            self.agent.resume(self.REASON)
@@ -6,8 +6,28 @@ pikachewie.helpers -- Helpers for creating brokers and agents
 """
 from pikachewie.agent import ConsumerAgent
 from pikachewie.broker import Broker
+from pikachewie.host import ConsumerHost
+from pikachewie.pipeline import Pipeline, Stage
 from pikachewie.utils import import_namespaced_class
 
+# optional ConsumerAgent keyword arguments read from a consumer's config
+AGENT_OPTIONS = (
+    'drop_expired',
+    'metrics_port',
+    'profile_dir',
+    'queue_poll_interval',
+    'concurrency',
+    'prefetch_count',
+    'autoscale',
+    'capture',
+    'drain_timeout',
+    'retry',
+    'deduplicate',
+    'schedule',
+    'backpressure',
+    'pause_method',
+)
+
 
 def consumer_from_config(config):
     """
@@ -89,11 +109,74 @@ def consumer_agent_from_config(config, name, broker='default',
             },
         }
 
+    Besides `no_ack`, a consumer's config may set any of the optional
+    :class:`~pikachewie.agent.ConsumerAgent` keyword arguments listed in
+    :data:`AGENT_OPTIONS` (e.g., ``drop_expired: reject``), and may list
+    the consumers that follow it in an in-process ``pipeline`` (see
+    :mod:`pikachewie.pipeline`).
+
     """
     consumer_config = config[section]['consumers'][name]
-    consumer = consumer_from_config(consumer_config)
     broker = broker_from_config(config[section]['brokers'][broker])
+    return _consumer_agent(consumer_config, broker, config['rabbitmq'])
+
+
+def consumer_host_from_config(config, names=None, broker='default',
+                              section='rabbitmq', drain_timeout=None):
+    """
+    Create a :class:`pikachewie.host.ConsumerHost` from the given `config`.
+
+    The host runs an agent for each of the consumers named in `names`
+    (default: every consumer in the config), all over one connection to
+    `broker`.  The `config` has the structure described in
+    :func:`consumer_agent_from_config`; each consumer may set its own
+    ``prefetch_count`` and other agent options.  If `drain_timeout` is set,
+    the host drains on ``SIGTERM`` (see
+    :meth:`pikachewie.host.ConsumerHost.drain`).
+
+    """
+    consumers = config[section]['consumers']
+    if names is None:
+        names = sorted(consumers)
+    broker = broker_from_config(config[section]['brokers'][broker])
+    host = ConsumerHost(broker, drain_timeout=drain_timeout)
+    for name in names:
+        host.add(name, _consumer_agent(consumers[name], broker,
+                                       config['rabbitmq']))
+    return host
+
+
+def _consumer_agent(consumer_config, broker, config):
+    """Create a :class:`pikachewie.agent.ConsumerAgent` for a consumer."""
+    consumer = consumer_from_config(consumer_config)
+    if consumer_config.get('pipeline'):
+        consumer = _pipeline(consumer, consumer_config['pipeline'], config)
     no_ack = consumer_config.get('no_ack', False)
+    options = dict((key, consumer_config[key]) for key in AGENT_OPTIONS
+                   if key in consumer_config)
 
     return ConsumerAgent(consumer, broker, consumer_config['bindings'], no_ack,
-                         config['rabbitmq'])
+                         config, **options)
+
+
+def _pipeline(consumer, names, config):
+    """Create a :class:`pikachewie.pipeline.Pipeline` from `consumer` and
+    the consumers named in `names`.
+
+    """
+    consumers = config['consumers']
+    stages = []
+    for name in names:
+        if name not in consumers:
+            raise ValueError('Unknown pipeline stage: %r' % name)
+        stages.append(Stage(name, consumer_from_config(consumers[name]),
+                            consumers[name]['bindings']))
+    exchange_types = dict(
+        (name, options.get('exchange_type', 'direct'))
+        for name, options in (config.get('exchanges') or {}).items())
+    stage_queues = set(binding['queue'] for stage in stages
+                       for binding in stage.bindings)
+    other_bindings = [binding for options in consumers.values()
+                      for binding in options.get('bindings') or []
+                      if binding['queue'] not in stage_queues]
+    return Pipeline(consumer, stages, exchange_types, other_bindings)
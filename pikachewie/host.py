@@ -0,0 +1,249 @@
+"""
+=========================================================
+pikachewie.host -- Many consumer agents on one connection
+=========================================================
+
+A :class:`ConsumerHost` runs several
+:class:`~pikachewie.agent.ConsumerAgent` objects over a single connection and
+IOLoop, instead of one connection (with its own heartbeats and reconnects)
+per agent.  Each agent still consumes on its own channel, with its own QoS
+prefetch count, queue monitor, worker pool, and hooks::
+
+    host = consumer_host_from_config(config)
+    host.run()
+
+Recovery is coordinated by the host:
+
+* When the connection is lost, every agent forgets its channel, and the host
+  reconnects once, after :attr:`ConsumerHost._RECONNECT_DELAY` seconds,
+  reattaching every agent to the new connection.
+* When one agent's channel is closed (e.g., by a protocol error) or its
+  consumer is cancelled, only that agent's channel is reopened, after the
+  same delay; the other agents are not disturbed.
+* Stopping any agent (e.g., on ``KeyboardInterrupt``) stops the whole host.
+
+:meth:`ConsumerHost.drain` drains every agent (see
+:meth:`pikachewie.agent.ConsumerAgent.drain`) and closes the connection once
+they have all finished.  An agent drained on its own closes its channel and
+leaves the host.
+
+"""
+import logging
+import signal
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+
+__all__ = ['ConsumerHost']
+
+log = logging.getLogger(__name__)
+
+
+class ConsumerHost(object):
+    """Runs several consumer agents over one connection to a broker.
+
+    :param broker: the broker to connect to
+    :type broker: :class:`pikachewie.broker.Broker`
+    :param agents: the agents to run, by name
+    :type agents: :class:`dict` of :class:`pikachewie.agent.ConsumerAgent`
+    :param float drain_timeout: if set, drain for up to this many seconds
+        when the process receives ``SIGTERM``
+
+    """
+    _RECONNECT_DELAY = 5  # seconds
+
+    def __init__(self, broker, agents=None, drain_timeout=None):
+        self.broker = broker
+        self.agents = OrderedDict()
+        self.connection = None
+        self.drain_timeout = drain_timeout
+        self._recovering = set()
+        self._stopping = False
+        self._draining = False
+        for name, agent in sorted((agents or {}).items()):
+            self.add(name, agent)
+
+    def add(self, name, agent):
+        """Run the given agent on this host's connection.
+
+        If the connection is already open, the agent starts consuming
+        immediately.
+
+        """
+        if name in self.agents:
+            raise ValueError('Duplicate agent name: %r' % name)
+        self.agents[name] = agent
+        agent.host = self
+        if self.connection is not None and self.connection.is_open:
+            agent.attach(self, self.connection)
+
+    def connect(self):
+        """Open this host's connection to RabbitMQ."""
+        log.info('Connecting %d agent%s to RabbitMQ via %r', len(self.agents),
+                 '' if len(self.agents) == 1 else 's', self.broker)
+        self.connection = self.broker.connect(
+            self.on_connection_open,
+            on_failure_callback=self.on_connection_failure
+        )
+
+    def on_connection_failure(self, exc):
+        """Callback invoked when a RabbitMQ connection cannot be established.
+
+        :param exception exc: the exception raised
+
+        """
+        log.warning('Host cannot connect: %s: %s', exc.__class__.__name__, exc)
+        time.sleep(self._RECONNECT_DELAY)
+        sys.exit()
+
+    def on_connection_open(self, connection):
+        """Callback invoked when the connection to RabbitMQ is established.
+
+        Each agent opens its channel on the new connection.
+
+        """
+        log.info('Connection opened to %s', connection)
+        self.connection = connection
+        connection.add_on_close_callback(self.on_connection_close)
+        self._recovering.clear()
+        for name, agent in self.agents.items():
+            log.debug('Attaching agent %s', name)
+            agent.attach(self, connection)
+
+    def on_connection_close(self, connection, reply_code, reply_text):
+        """Callback invoked when the connection to RabbitMQ is closed.
+
+        Unless the host is stopping, every agent is detached, and the host
+        reconnects after a delay.
+
+        """
+        if connection is not self.connection:
+            return
+        for agent in self.agents.values():
+            agent.detach()
+        self._recovering.clear()
+        if self._draining:
+            self.stop()
+        if self._stopping:
+            log.info('Connection closed: (%s) %s', reply_code, reply_text)
+            connection.ioloop.stop()
+            return
+        log.warning('Server closed connection: (%s) %s', reply_code,
+                    reply_text)
+        log.info('Reconnecting in %i seconds', self._RECONNECT_DELAY)
+        connection.add_timeout(self._RECONNECT_DELAY, self.connect)
+
+    def on_agent_channel_close(self, agent, channel):
+        """Callback invoked when one agent's channel is closed.
+
+        Channels closed along with the connection, or replaced by a
+        previous recovery, are left to :meth:`on_connection_close`.
+
+        """
+        if channel is not agent.channel or self._stopping or \
+                self.connection is None or not self.connection.is_open:
+            return
+        self.recover(agent)
+
+    def recover(self, agent):
+        """Reopen the given agent's channel after a delay.
+
+        The agent's current channel, if still open, is closed first, so
+        that the broker requeues its unacknowledged messages.
+
+        """
+        if self._stopping or agent in self._recovering:
+            return
+        channel = agent.channel
+        agent.detach()
+        if channel is not None and channel.is_open:
+            channel.close()
+        connection = self.connection
+        if connection is None or not connection.is_open:
+            # the whole connection is being recovered
+            return
+        log.info('Reopening channel for %r in %i seconds', agent.consumer,
+                 self._RECONNECT_DELAY)
+        self._recovering.add(agent)
+        connection.add_timeout(self._RECONNECT_DELAY,
+                               partial(self._reattach, agent, connection))
+
+    def _reattach(self, agent, connection):
+        if agent not in self._recovering or connection is not self.connection:
+            return
+        self._recovering.discard(agent)
+        if connection.is_open and not self._stopping:
+            agent.attach(self, connection)
+
+    def drain(self, timeout=None):
+        """Drain every agent, then close the connection.
+
+        :param float timeout: seconds to wait for in-flight messages
+
+        """
+        if self._draining:
+            return
+        log.info('Draining %d agent%s', len(self.agents),
+                 '' if len(self.agents) == 1 else 's')
+        self._draining = True
+        if not self.agents:
+            self.stop()
+        for agent in list(self.agents.values()):
+            agent.drain(timeout)
+
+    def on_agent_drained(self, agent):
+        """Callback invoked when a hosted agent has drained.
+
+        The agent's channel is closed and the agent leaves the host; once no
+        agents remain, the host stops.
+
+        """
+        for name, hosted in list(self.agents.items()):
+            if hosted is agent:
+                log.info('Agent %s drained', name)
+                del self.agents[name]
+        self._recovering.discard(agent)
+        channel = agent.channel
+        agent.detach()
+        agent.release()
+        if channel is not None and channel.is_open:
+            channel.close()
+        if not self.agents:
+            self.stop()
+
+    def run(self):
+        """Connect to RabbitMQ and start the connection's IOLoop."""
+        self.connect()
+        for agent in self.agents.values():
+            agent.start_services()
+        if self.drain_timeout is not None:
+            self._install_drain_signal_handler()
+        self.connection.ioloop.start()
+
+    def _install_drain_signal_handler(self):
+        """Drain when this process receives SIGTERM."""
+        try:
+            signal.signal(signal.SIGTERM, self._on_drain_signal)
+        except ValueError as exc:
+            # not running in the main thread
+            log.warning('Cannot install drain signal handler: %s', exc)
+
+    def _on_drain_signal(self, signum, frame):
+        ioloop = self.connection.ioloop
+        add_callback = getattr(ioloop, 'add_callback_from_signal',
+                               ioloop.add_callback)
+        add_callback(self.drain, self.drain_timeout)
+
+    def stop(self):
+        """Stop every agent and close the connection to RabbitMQ."""
+        if self._stopping:
+            return
+        log.info('Stopping...')
+        self._stopping = True
+        for agent in self.agents.values():
+            agent.release()
+        if self.connection is not None and self.connection.is_open:
+            log.info('Closing connection to %s', self.connection)
+            self.connection.close()
+        log.info('Exiting...')
@@ -6,17 +6,29 @@ pikachewie.message -- A RabbitMQ message
 """
 import bz2
 import copy
+import time
 import zlib
 from datetime import datetime, timedelta
+from timeit import default_timer
 
 import simplejson
 
+from pikachewie.claimcheck import CLAIM_CHECK_HEADER
 from pikachewie.data import DataObject, Properties
+from pikachewie.exceptions import MessageException
 from pikachewie.utils import cached_property, delegate
 
 
 class Message(DataObject):
     """A RabbitMQ message."""
+    # seconds spent decoding the payload (None until it has been decoded)
+    decode_seconds = None
+    #: the :class:`pikachewie.claimcheck.BlobStore` that claim-checked
+    #: bodies are loaded from
+    blob_store = None
+    #: the :class:`pikachewie.validation.SchemaRegistry` that payloads are
+    #: validated by
+    validator = None
 
     def __init__(self, channel, method, header, body):
         """
@@ -38,7 +50,12 @@ class Message(DataObject):
         self.channel = channel
         self.method = method
         self.properties = Properties(header)
-        self.body = copy.copy(body)
+        # the body as received, which is empty if it is claim-checked
+        self.raw_body = copy.copy(body)
+        # messages published by the consumer while processing this one
+        self.outputs = []
+        # the consumer's request to pause or resume consumption, if any
+        self.flow_request = None
 
     # AMQP method delegates
     consumer_tag = delegate('method', 'consumer_tag')
@@ -57,6 +74,42 @@ class Message(DataObject):
     type = delegate('properties', 'type')
     user_id = delegate('properties', 'user_id')
 
+    @cached_property
+    def claim_check(self):
+        """Return the key of the claim-checked body, if any.
+
+        :rtype: :class:`str` or `NoneType`
+
+        """
+        headers = getattr(self.properties, 'headers', None)
+        if not isinstance(headers, dict):
+            return None
+        key = headers.get(CLAIM_CHECK_HEADER)
+        if isinstance(key, bytes) and not isinstance(key, str):
+            key = key.decode('ascii')
+        return key
+
+    @cached_property
+    def body(self):
+        """Return the message body.
+
+        A claim-checked body is loaded from :attr:`blob_store`, and returned
+        as a read-only :class:`memoryview` of its memory map, so that it is
+        not copied unless the consumer does so (e.g., with ``bytes(body)``).
+
+        :rtype: :class:`str` or :class:`memoryview`
+        :raises: :class:`pikachewie.exceptions.MessageException` if a
+            claim-checked body cannot be loaded
+
+        """
+        body = self._body_buffer
+        if body is self.raw_body:
+            return body
+        try:
+            return memoryview(body)
+        except TypeError:  # Python 2's mmap has no memoryview support
+            return buffer(body)
+
     @cached_property
     def content_encoding(self):
         """Return the content encoding as a lowercase string.
@@ -98,6 +151,39 @@ class Message(DataObject):
         ttl = timedelta(milliseconds=int(self.properties.expiration))
         return self.created_at + ttl
 
+    @cached_property
+    def expiration_timestamp(self):
+        """Return the message expiration time as a POSIX timestamp.
+
+        Unlike :attr:`expires_at`, this is computed with plain numeric
+        arithmetic, so it is cheap enough to check for every delivery.
+
+        :rtype: :class:`float` or `NoneType`
+
+        """
+        if not (self.properties.timestamp and self.properties.expiration):
+            return None
+        return (float(self.properties.timestamp) +
+                int(self.properties.expiration) / 1000.0)
+
+    def time_remaining(self, now=None):
+        """Return the number of seconds remaining before this message expires.
+
+        The result is negative if the message has already expired, and `None`
+        if the message has no expiration.
+
+        :param now: the current POSIX timestamp (default: ``time.time()``)
+        :type now: :class:`float`
+
+        :rtype: :class:`float` or `NoneType`
+
+        """
+        if self.expiration_timestamp is None:
+            return None
+        if now is None:
+            now = time.time()
+        return self.expiration_timestamp - now
+
     @property
     def is_expired(self):
         """Whether this message has expired.
@@ -112,15 +198,24 @@ class Message(DataObject):
     def payload(self):
         """Return the decoded, deserialized contents of the message body.
 
+        The payload is validated by :attr:`validator`, if set.
+
         :rtype: any
+        :raises: :class:`pikachewie.exceptions.ValidationException` if the
+            payload is invalid
 
         """
+        start = default_timer()
         payload = self._decoded_body
 
         # Deserialize JSON message bodies
         if self.content_type == 'application/json':
             payload = simplejson.loads(payload, use_decimal=True)
 
+        if self.validator is not None:
+            self.validator.validate(self, payload)
+
+        self.decode_seconds = default_timer() - start
         return payload
 
     @cached_property
@@ -129,13 +224,32 @@ class Message(DataObject):
 
         :rtype: :class:`str`
         """
-        result = self.body
+        # Compressed bodies are decompressed straight from the memory map of
+        # a claim-checked body, without copying it first.
 
         # Handle bzip2 compressed content
         if self.content_encoding == 'bzip2':
-            result = bz2.decompress(result)
+            return bz2.decompress(self._body_buffer)
         # Handle zlib compressed content
         elif self.content_encoding == 'gzip':
-            result = zlib.decompress(result)
+            return zlib.decompress(self._body_buffer)
+
+        body = self.body
+        if body is not self.raw_body:
+            # decoders need the body itself, not a view of it
+            return bytes(body)
+        return body
 
-        return result
+    @cached_property
+    def _body_buffer(self):
+        """Return the message body, memory-mapped if it is claim-checked."""
+        key = self.claim_check
+        if key is None:
+            return self.raw_body
+        if self.blob_store is None:
+            raise MessageException('Cannot load claim-checked body %s: no '
+                                   'blob store configured' % key)
+        try:
+            return self.blob_store.open(key)
+        except KeyError:
+            raise MessageException('Claim-checked body %s not found' % key)
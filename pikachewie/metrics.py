@@ -0,0 +1,347 @@
+"""
+==================================================================
+pikachewie.metrics -- Agent lifecycle hooks and Prometheus metrics
+==================================================================
+
+A :class:`~pikachewie.agent.ConsumerAgent` calls the methods of each of its
+:class:`AgentHooks` as messages pass through it.  :class:`AgentMetrics` is a
+hook that aggregates per-queue and per-routing-key counters and latency
+histograms in a :class:`MetricsRegistry`, which :class:`MetricsServer` serves
+in the Prometheus text exposition format.
+
+"""
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+__all__ = ['AgentHooks', 'AgentMetrics', 'MetricsRegistry', 'MetricsServer']
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class AgentHooks(object):
+    """Base class for ConsumerAgent lifecycle hooks.
+
+    Every method is a no-op; subclasses override the ones they need.  All
+    durations are in seconds.
+
+    """
+
+    def message_received(self, agent, message):
+        """Called when a message is delivered, before it is processed."""
+
+    def message_dropped(self, agent, message, reason):
+        """Called when a message is discarded without being processed."""
+
+    def message_processed(self, agent, message, outcome, seconds):
+        """Called after the consumer has processed a message.
+
+        `outcome` is one of ``'ok'``, ``'requeued'``, ``'rejected'``,
+        ``'retried'``, ``'parked'``, or ``'error'``.
+
+        """
+
+    def message_acknowledged(self, agent, message, seconds):
+        """Called after a message is acknowledged.
+
+        `seconds` is the time since the message was received.
+
+        """
+
+    def message_rejected(self, agent, delivery_tag, requeue):
+        """Called after a message is rejected."""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%.1f' % value
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+
+class _Metric(object):
+    """A family of metrics sharing a name and label names."""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        """Return the child metric for the given label values."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def clear(self):
+        self._children.clear()
+
+    def samples(self):
+        """Yield ``(suffix, labelnames, labelvalues, value)`` tuples."""
+        for values, child in sorted(self._children.items()):
+            for sample in self._child_samples(values, child):
+                yield sample
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(names, values),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+    _new_child = _Value
+
+    def _child_samples(self, values, child):
+        yield '', self.labelnames, values, child.value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _child_samples(self, values, child):
+        names = self.labelnames + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            yield '_bucket', names, values + (_format_value(bound),), \
+                cumulative
+        yield '_sum', self.labelnames, values, child.sum
+        yield '_count', self.labelnames, values, child.count
+
+
+class MetricsRegistry(object):
+    """A collection of metrics that can be rendered for Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('Metric %s is already registered as a %s'
+                             % (name, metric.type))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Return the named :class:`Counter`, registering it if needed."""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Return the named :class:`Gauge`, registering it if needed."""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Return the named :class:`Histogram`, registering it if needed."""
+        return self._register(Histogram, name, documentation, labelnames,
+                              buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        return ''.join(metric.render() + '\n'
+                       for _, metric in sorted(self._metrics.items()))
+
+
+class AgentMetrics(AgentHooks):
+    """Aggregates ConsumerAgent lifecycle events into a registry.
+
+    Counters and histograms are labelled by queue and routing key.  If
+    `label_routing_keys` is false, the routing key label is omitted, which
+    bounds the number of series for agents that see many distinct keys.
+
+    :param registry: where to record metrics (default: a new registry)
+    :type registry: :class:`MetricsRegistry`
+
+    """
+    prefix = 'pikachewie_'
+
+    def __init__(self, registry=None, label_routing_keys=True,
+                 buckets=DEFAULT_BUCKETS):
+        self.registry = registry or MetricsRegistry()
+        self.label_routing_keys = label_routing_keys
+        labels = ('queue', 'routing_key') if label_routing_keys \
+            else ('queue',)
+        self.received = self.registry.counter(
+            self.prefix + 'messages_received_total',
+            'Messages delivered to the agent.', labels)
+        self.dropped = self.registry.counter(
+            self.prefix + 'messages_dropped_total',
+            'Messages discarded without being processed.',
+            labels + ('reason',))
+        self.processed = self.registry.counter(
+            self.prefix + 'messages_processed_total',
+            'Messages processed by the consumer.', labels + ('outcome',))
+        self.acknowledged = self.registry.counter(
+            self.prefix + 'messages_acknowledged_total',
+            'Messages acknowledged.', labels)
+        self.rejected = self.registry.counter(
+            self.prefix + 'messages_rejected_total',
+            'Messages rejected.', ('requeue',))
+        self.queued_seconds = self.registry.histogram(
+            self.prefix + 'message_queued_seconds',
+            'Time from message timestamp to delivery.', labels, buckets)
+        self.decode_seconds = self.registry.histogram(
+            self.prefix + 'message_decode_seconds',
+            'Time spent decoding message payloads.', labels, buckets)
+        self.process_seconds = self.registry.histogram(
+            self.prefix + 'message_process_seconds',
+            'Time spent in Consumer.process.', labels, buckets)
+        self.ack_seconds = self.registry.histogram(
+            self.prefix + 'message_ack_seconds',
+            'Time from delivery to acknowledgement.', labels, buckets)
+
+    def _labels(self, agent, message):
+        queue = agent.queue_for(message.consumer_tag) or ''
+        if self.label_routing_keys:
+            return (queue, message.routing_key)
+        return (queue,)
+
+    def message_received(self, agent, message):
+        labels = self._labels(agent, message)
+        self.received.labels(*labels).inc()
+        timestamp = message.properties.timestamp
+        if timestamp:
+            self.queued_seconds.labels(*labels).observe(
+                max(0.0, time.time() - float(timestamp)))
+
+    def message_dropped(self, agent, message, reason):
+        self.dropped.labels(*self._labels(agent, message) + (reason,)).inc()
+
+    def message_processed(self, agent, message, outcome, seconds):
+        labels = self._labels(agent, message)
+        self.processed.labels(*labels + (outcome,)).inc()
+        self.process_seconds.labels(*labels).observe(seconds)
+        if message.decode_seconds is not None:
+            self.decode_seconds.labels(*labels).observe(
+                message.decode_seconds)
+
+    def message_acknowledged(self, agent, message, seconds):
+        labels = self._labels(agent, message)
+        self.acknowledged.labels(*labels).inc()
+        self.ack_seconds.labels(*labels).observe(seconds)
+
+    def message_rejected(self, agent, delivery_tag, requeue):
+        self.rejected.labels(str(requeue).lower()).inc()
+
+
+class MetricsServer(object):
+    """Serves a registry's metrics over HTTP at ``/metrics``.
+
+    The server runs on the Tornado IOLoop that is current when
+    :meth:`start` is called, i.e., the agent's own IOLoop.
+
+    `routes` maps additional URL paths to callables that take a dict of
+    query arguments and return a plain-text response body.
+
+    """
+
+    def __init__(self, registry, port, address='', routes=None):
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self.routes = dict(routes or {})
+        self._server = None
+
+    def start(self):
+        """Start listening for HTTP requests."""
+        # tornado.web is only needed when metrics are served
+        from tornado.httpserver import HTTPServer
+        from tornado.web import Application, RequestHandler
+
+        class TextHandler(RequestHandler):
+            def initialize(self, render):
+                self.render_text = render
+
+            def get(self):
+                arguments = dict((name, self.get_argument(name))
+                                 for name in self.request.arguments)
+                self.set_header('Content-Type',
+                                'text/plain; version=0.0.4; charset=utf-8')
+                self.write(self.render_text(arguments))
+
+        handlers = [(r'/metrics', TextHandler,
+                     {'render': lambda arguments: self.registry.render()})]
+        for path, render in sorted(self.routes.items()):
+            handlers.append((path, TextHandler, {'render': render}))
+
+        self._server = HTTPServer(Application(handlers))
+        self._server.listen(self.port, self.address)
+        log.info('Serving metrics on %s:%s/metrics', self.address or '*',
+                 self.port)
+
+    def stop(self):
+        """Stop listening for HTTP requests."""
+        if self._server:
+            self._server.stop()
+            self._server = None
@@ -0,0 +1,204 @@
+"""
+===========================================================
+pikachewie.monitor -- Queue depth polling for ConsumerAgent
+===========================================================
+
+:class:`QueueMonitor` periodically issues a passive ``Queue.Declare`` for each
+of an agent's queues on a side channel, so that a missing queue cannot close
+the agent's consuming channel.  The ``Queue.DeclareOk`` reply carries the
+queue's depth and consumer count, from which the monitor derives:
+
+* the net drain rate (messages per second the queue is shrinking by);
+* the estimated time to drain the queue at that rate;
+* the approximate age of the oldest queued message, i.e., the age (from its
+  ``timestamp`` property) of the message most recently delivered from the
+  queue, which was at the head of the queue when it was delivered.
+
+Each poll produces a :class:`QueueStats` per queue, which is passed to every
+registered callback and, if the agent has metrics enabled, exported as
+gauges.
+
+"""
+import logging
+import time
+from collections import namedtuple
+from functools import partial
+
+from pikachewie.metrics import AgentHooks
+
+__all__ = ['QueueMonitor', 'QueueStats']
+
+log = logging.getLogger(__name__)
+
+INFINITY = float('inf')
+
+QueueStats = namedtuple('QueueStats', [
+    'queue',                # queue name
+    'message_count',        # messages ready for delivery
+    'consumer_count',       # consumers on the queue
+    'drain_rate',           # messages/second the queue is shrinking by
+    'drain_seconds',        # estimated seconds to empty (inf if growing)
+    'oldest_message_age',   # approximate age of the oldest message (or None)
+    'polled_at',            # POSIX time of the poll
+])
+
+
+class QueueMonitor(AgentHooks):
+    """Polls the depth of an agent's queues.
+
+    :param agent: the agent whose queues to poll
+    :type agent: :class:`pikachewie.agent.ConsumerAgent`
+    :param float interval: seconds between polls
+
+    """
+
+    def __init__(self, agent, interval):
+        self.agent = agent
+        self.interval = interval
+        self.stats = {}
+        self.channel = None
+        self._callbacks = []
+        self._timeout = None
+        self._connection = None
+        self._opening = None    # the side channel being opened, if any
+        self._pending = 0       # passive declares awaiting their reply
+        self._last_timestamps = {}
+        self._gauges = None
+
+    def add_callback(self, callback):
+        """Call `callback(agent, stats)` with each new :class:`QueueStats`."""
+        self._callbacks.append(callback)
+
+    @property
+    def queues(self):
+        """The names of the queues to poll."""
+        return sorted(set(binding['queue'] for binding in self.agent.bindings))
+
+    def start(self, connection):
+        """Start polling on the given connection."""
+        self.stop()
+        self._connection = connection
+        self._schedule()
+
+    def stop(self):
+        """Stop polling."""
+        if self._timeout is not None and self._connection is not None:
+            self._connection.remove_timeout(self._timeout)
+        if self.channel is not None and self.channel.is_open:
+            self.channel.close()
+        self._timeout = None
+        self._connection = None
+        self._opening = None
+        self._pending = 0
+        self.channel = None
+
+    def _schedule(self):
+        self._timeout = self._connection.add_timeout(self.interval, self.poll)
+
+    def poll(self):
+        """Passively declare each queue, then schedule the next poll.
+
+        The poll is skipped if the previous one has not finished yet.
+
+        """
+        self._timeout = None
+        connection = self._connection
+        if connection is None or not connection.is_open:
+            return
+        if self._opening is not None or self._pending:
+            log.debug('Skipping queue poll; the previous one is unfinished')
+        elif self.channel is None or not self.channel.is_open:
+            log.debug('Opening queue monitor channel')
+            self._opening = connection.channel(
+                on_open_callback=self._on_channel_open)
+            self._opening.add_on_close_callback(self._on_channel_close)
+        else:
+            self._declare_queues()
+        self._schedule()
+
+    def _on_channel_open(self, channel):
+        if channel is not self._opening:
+            channel.close()  # opened for a monitor since stopped
+            return
+        self._opening = None
+        self.channel = channel
+        self._declare_queues()
+
+    def _on_channel_close(self, channel, reply_code, reply_text):
+        log.warning('Queue monitor channel closed: (%s) %s', reply_code,
+                    reply_text)
+        if channel is self._opening:
+            self._opening = None
+        elif channel is self.channel:
+            self.channel = None
+            self._pending = 0
+
+    def _declare_queues(self):
+        queues = self.queues
+        self._pending = len(queues)
+        for queue in queues:
+            self.channel.queue_declare(partial(self._on_declare_ok, queue),
+                                       queue, passive=True)
+
+    def _on_declare_ok(self, queue, method_frame):
+        self._pending = max(0, self._pending - 1)
+        now = time.time()
+        message_count = method_frame.method.message_count
+        previous = self.stats.get(queue)
+        drain_rate = None
+        if previous is not None and now > previous.polled_at:
+            drain_rate = ((previous.message_count - message_count) /
+                          (now - previous.polled_at))
+
+        if not message_count:
+            drain_seconds = 0.0
+        elif drain_rate is not None and drain_rate > 0:
+            drain_seconds = message_count / drain_rate
+        else:
+            drain_seconds = INFINITY
+
+        oldest_message_age = None
+        timestamp = self._last_timestamps.get(queue)
+        if message_count and timestamp:
+            oldest_message_age = max(0.0, now - timestamp)
+
+        stats = QueueStats(queue, message_count,
+                           method_frame.method.consumer_count, drain_rate,
+                           drain_seconds, oldest_message_age, now)
+        self.stats[queue] = stats
+        log.debug('Queue stats: %r', stats)
+        self._export(stats)
+        for callback in self._callbacks:
+            callback(self.agent, stats)
+
+    def _export(self, stats):
+        metrics = self.agent.metrics
+        if metrics is None:
+            return
+        if self._gauges is None:
+            registry = metrics.registry
+            self._gauges = (
+                registry.gauge('pikachewie_queue_messages',
+                               'Messages ready in the queue.', ('queue',)),
+                registry.gauge('pikachewie_queue_consumers',
+                               'Consumers on the queue.', ('queue',)),
+                registry.gauge('pikachewie_queue_drain_seconds',
+                               'Estimated seconds to drain the queue.',
+                               ('queue',)),
+                registry.gauge('pikachewie_queue_oldest_message_age_seconds',
+                               'Approximate age of the oldest queued '
+                               'message.', ('queue',)),
+            )
+        messages, consumers, drain, age = self._gauges
+        messages.labels(stats.queue).set(stats.message_count)
+        consumers.labels(stats.queue).set(stats.consumer_count)
+        drain.labels(stats.queue).set(stats.drain_seconds)
+        age.labels(stats.queue).set(stats.oldest_message_age or 0.0)
+
+    # lifecycle hooks
+
+    def message_received(self, agent, message):
+        timestamp = message.properties.timestamp
+        if timestamp:
+            queue = agent.queue_for(message.consumer_tag)
+            self._last_timestamps[queue] = float(timestamp)
@@ -0,0 +1,186 @@
+"""
+==================================================
+pikachewie.outbox -- Publishing from inside agents
+==================================================
+
+A consumer run by a :class:`~pikachewie.agent.ConsumerAgent` publishes
+follow-up messages and RPC replies with
+:meth:`~pikachewie.consumer.Consumer.publish` and
+:meth:`~pikachewie.consumer.Consumer.reply`::
+
+    class PriceConsumer(Consumer):
+
+        def process_message(self):
+            price = lookup(self.message.body)
+            self.publish('prices', 'price.updated', price)
+            self.reply(price)
+
+Rather than opening a blocking connection of its own, which would stall the
+agent's IOLoop, each message published is recorded on the message being
+processed.  Once processing succeeds, the agent's :class:`Outbox` publishes
+the outputs, back to back, on a dedicated channel in confirm mode on the
+agent's own connection, and the agent acknowledges the input message only
+once the broker has confirmed every one of its outputs.  If the broker
+rejects an output, or the channel is lost first, the input is requeued, so
+that its outputs are published at least once.
+
+Outputs of a message whose processing fails (e.g., that is rejected or
+retried) are discarded.
+
+"""
+import logging
+from collections import OrderedDict
+
+from pika.spec import Basic
+
+from pikachewie.data import Properties
+
+__all__ = ['Outbox']
+
+log = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    """The outputs of one input message awaiting confirmation."""
+    __slots__ = ('remaining', 'on_confirmed', 'on_failed')
+
+    def __init__(self, remaining, on_confirmed, on_failed):
+        self.remaining = remaining
+        self.on_confirmed = on_confirmed
+        self.on_failed = on_failed
+
+
+class Outbox(object):
+    """Publishes messages on a confirm channel on an existing connection.
+
+    The channel is opened on first use.
+
+    :param connection: the connection to publish over
+    :type connection:
+        :class:`pika.adapters.tornado_connection.TornadoConnection`
+
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = None
+        self.pending = 0
+        self._opening = False
+        self._closed = False
+        self._backlog = []
+        self._unconfirmed = OrderedDict()
+        self._publish_tag = 0
+
+    def publish(self, outputs, on_confirmed=None, on_failed=None):
+        """Publish `outputs`, and report when the broker confirms them.
+
+        Exactly one of `on_confirmed` and `on_failed` is called, with no
+        arguments, on the IOLoop.
+
+        :param outputs: ``(exchange, routing_key, body, properties)`` tuples
+        :param on_confirmed: called once every output has been confirmed
+        :param on_failed: called if any output is rejected or lost
+
+        """
+        entry = _Entry(len(outputs), on_confirmed, on_failed)
+        self.pending += 1
+        if self.channel is not None and self.channel.is_open:
+            self._publish(outputs, entry)
+            return
+        self._backlog.append((outputs, entry))
+        if not self._opening:
+            self._open_channel()
+
+    def close(self):
+        """Close the channel, forgetting any unconfirmed outputs."""
+        self._closed = True
+        self._backlog = []
+        self._unconfirmed.clear()
+        self.pending = 0
+        if self.channel is not None and self.channel.is_open:
+            self.channel.close()
+
+    def _open_channel(self):
+        log.info('Opening publishing channel')
+        self._opening = True
+        self.connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self._opening = False
+        if self._closed:
+            channel.close()
+            return
+        self.channel = channel
+        self._publish_tag = 0
+        channel.add_on_close_callback(self._on_channel_close)
+        channel.confirm_delivery(self._on_confirm)
+        backlog, self._backlog = self._backlog, []
+        for outputs, entry in backlog:
+            self._publish(outputs, entry)
+
+    def _on_channel_close(self, channel, reply_code, reply_text):
+        if channel is not self.channel:
+            return
+        self.channel = None
+        if self._closed:
+            return
+        log.warning('Publishing channel closed: (%s) %s', reply_code,
+                    reply_text)
+        entries = []
+        for entry in self._unconfirmed.values():
+            if entry not in entries:
+                entries.append(entry)
+        self._unconfirmed.clear()
+        for entry in entries:
+            self._fail(entry)
+        if self._backlog and not self._opening:
+            self._open_channel()
+
+    def _publish(self, outputs, entry):
+        if not outputs:
+            self._confirm(entry)
+            return
+        for exchange, routing_key, body, properties in outputs:
+            if isinstance(properties, Properties):
+                properties = properties.to_basic_properties()
+            self.channel.basic_publish(exchange=exchange,
+                                       routing_key=routing_key, body=body,
+                                       properties=properties)
+            self._publish_tag += 1
+            self._unconfirmed[self._publish_tag] = entry
+
+    def _on_confirm(self, method_frame):
+        method = method_frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed
+                    if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            entry = self._unconfirmed.pop(tag, None)
+            if entry is None:
+                continue
+            if isinstance(method, Basic.Nack):
+                log.warning('Broker rejected published message #%s', tag)
+                self._fail(entry)
+            else:
+                entry.remaining -= 1
+                if entry.remaining == 0:
+                    self._confirm(entry)
+
+    def _confirm(self, entry):
+        entry.remaining = 0
+        self.pending -= 1
+        if entry.on_confirmed is not None:
+            entry.on_confirmed()
+
+    def _fail(self, entry):
+        if entry.remaining <= 0:
+            return  # already failed
+        entry.remaining = -1
+        self.pending -= 1
+        for tag in [tag for tag, other in self._unconfirmed.items()
+                    if other is entry]:
+            del self._unconfirmed[tag]
+        if entry.on_failed is not None:
+            entry.on_failed()
@@ -0,0 +1,182 @@
+"""
+=================================================
+pikachewie.pipeline -- In-process consumer chains
+=================================================
+
+When one consumer's output is another's input, each hop through RabbitMQ
+costs a publish, a round-trip, and (for durable queues) a disk write.  A
+:class:`Pipeline` runs such a chain of consumers in one process, passing
+each output that the next stages would receive straight to them in memory;
+only outputs that no later stage binds to are published to RabbitMQ.
+
+Stages are declared with a consumer's ``pipeline`` option, which lists the
+consumers (by name, from the same ``consumers`` config) that follow it::
+
+    consumers:
+      parse:
+        class: my.consumers.Parser
+        bindings: [{exchange: raw, queue: raw, routing_key: '#'}]
+        pipeline: [enrich, store]
+      enrich:
+        class: my.consumers.Enricher
+        bindings: [{exchange: parsed, queue: enrich, routing_key: 'order.*'}]
+      store:
+        class: my.consumers.Store
+        bindings: [{exchange: enriched, queue: store, routing_key: '#'}]
+
+An output published by a stage (see
+:meth:`pikachewie.consumer.Consumer.publish`) is passed to a later stage
+with a binding that the output would be routed by, as declared in the
+``exchanges`` config: by routing key for direct and topic exchanges, to
+every binding for fanout exchanges, and by queue name for the default
+exchange.  Outputs to headers exchanges always go through RabbitMQ.
+
+An output is only passed in memory if that stage's queue is the only one
+it would be routed to.  If it would also reach another stage, or a queue
+bound by any other consumer in the ``consumers`` config, it is published
+to RabbitMQ instead, so that every queue receives it.  Queues bound
+outside the config are not known to the pipeline; bind them in the config
+(e.g., with a consumer that is not run) or keep them off the routing keys
+that stages bind to.
+
+The whole chain processes the original delivery: it is acknowledged only
+once every stage has succeeded and every output published to RabbitMQ has
+been confirmed, and if any stage raises, the delivery is rejected or
+requeued as if the first stage had raised, and no outputs are published.
+
+The later stages' own consumers may still run in their own agents, to
+process messages published by other processes.
+
+"""
+import copy
+import logging
+from collections import namedtuple
+
+from pika.spec import Basic
+
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.message import Message
+from pikachewie.routing import TopicTrie
+
+__all__ = ['Pipeline', 'Stage']
+
+log = logging.getLogger(__name__)
+
+#: A consumer in a pipeline, with the bindings it receives messages by.
+Stage = namedtuple('Stage', 'name consumer bindings')
+
+
+class _BindingMatcher(object):
+    """Whether an output would be routed to any of a stage's bindings."""
+
+    def __init__(self, bindings, exchange_types):
+        self._queues = set()
+        self._keys = {}
+        self._tries = {}
+        self._fanouts = set()
+        for binding in bindings:
+            exchange = binding['exchange']
+            self._queues.add(binding['queue'])
+            exchange_type = exchange_types.get(exchange, 'direct')
+            routing_key = binding.get('routing_key') or ''
+            if exchange_type == 'fanout':
+                self._fanouts.add(exchange)
+            elif exchange_type == 'topic':
+                self._tries.setdefault(exchange, TopicTrie()).add(
+                    routing_key, True)
+            elif exchange_type == 'direct':
+                self._keys.setdefault(exchange, set()).add(routing_key)
+
+    def __call__(self, exchange, routing_key):
+        if exchange == '':
+            return routing_key in self._queues
+        if exchange in self._fanouts:
+            return True
+        if routing_key in self._keys.get(exchange, ()):
+            return True
+        trie = self._tries.get(exchange)
+        return trie is not None and bool(trie.match(routing_key))
+
+
+class Pipeline(Consumer):
+    """A consumer that runs a chain of consumers in memory.
+
+    :param consumer: the first stage
+    :type consumer: :class:`pikachewie.consumer.Consumer`
+    :param stages: the later stages, in order
+    :type stages: sequence of :class:`Stage`
+    :param dict exchange_types: the type of each exchange, by name (default:
+        ``'direct'``)
+    :param list other_bindings: the bindings of every other queue that
+        outputs may be routed to
+
+    """
+
+    def __init__(self, consumer, stages, exchange_types=None,
+                 other_bindings=None):
+        self.consumer = consumer
+        self.stages = list(stages)
+        exchange_types = exchange_types or {}
+        self._matchers = [_BindingMatcher(stage.bindings, exchange_types)
+                          for stage in self.stages]
+        self._others = _BindingMatcher(other_bindings or [], exchange_types)
+
+    def __copy__(self):
+        # give each worker thread its own copy of every stage's consumer
+        pipeline = object.__new__(self.__class__)
+        pipeline.__dict__.update(self.__dict__)
+        pipeline.consumer = copy.copy(self.consumer)
+        pipeline.stages = [stage._replace(consumer=copy.copy(stage.consumer))
+                           for stage in self.stages]
+        return pipeline
+
+    def process(self, message):
+        """Process `message` through every stage it reaches.
+
+        On return, the message's ``outputs`` are those to be published to
+        RabbitMQ.
+
+        """
+        self.message = message
+        message.outputs[:] = self._run(self.consumer, message, 0)
+
+    def _run(self, consumer, message, first_stage):
+        """Process `message`, and return its outputs bound for RabbitMQ."""
+        consumer.process(message)
+        published = []
+        for output in message.outputs:
+            index = self._stage_for(output, first_stage)
+            if index is None:
+                published.append(output)
+                continue
+            stage = self.stages[index]
+            log.debug('Passing output of message #%s to stage %s',
+                      message.delivery_tag, stage.name)
+            published.extend(self._run(stage.consumer,
+                                       self._deliver(message, output),
+                                       index + 1))
+        return published
+
+    def _stage_for(self, output, first_stage):
+        """Return the index of the stage that is the only one `output` would
+        be routed to, or `None` if it must be published.
+
+        """
+        exchange, routing_key = output[0], output[1]
+        if self._others(exchange, routing_key):
+            return None
+        indexes = [index for index, matcher in enumerate(self._matchers)
+                   if matcher(exchange, routing_key)]
+        if len(indexes) == 1 and indexes[0] >= first_stage:
+            return indexes[0]
+        return None
+
+    def _deliver(self, message, output):
+        """Return `output` of `message` as a message for the next stage."""
+        exchange, routing_key, body, properties = output
+        if isinstance(properties, Properties):
+            properties = properties.to_basic_properties()
+        method = Basic.Deliver(message.consumer_tag, message.delivery_tag,
+                               message.redelivered, exchange, routing_key)
+        return Message(message.channel, method, properties, body)
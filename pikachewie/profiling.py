@@ -0,0 +1,221 @@
+"""
+==========================================================
+pikachewie.profiling -- On-demand profiling of live agents
+==========================================================
+
+:class:`AgentProfiler` profiles a running
+:class:`~pikachewie.agent.ConsumerAgent` for a limited time when asked to,
+either by a signal (``SIGUSR2`` by default) or via the agent's metrics
+endpoint (``/profile?seconds=30``).  While a profile runs:
+
+* a background thread samples the call stack of every thread (the agent's
+  IOLoop thread, and its worker threads, if any) at a fixed interval,
+  attributing each sample to the message that thread is processing (by
+  message type, or routing key if the message has no type);
+* the CPU time (:func:`time.thread_time`) spent processing each message,
+  on the thread processing it, is accumulated per message type or routing
+  key;
+* on Python 3, :mod:`tracemalloc` traces memory allocations.
+
+Sampling happens on a separate thread and the agent keeps consuming, so no
+restart is needed and no messages are lost.  When the profile finishes,
+three files are written to the profiler's output directory:
+
+``<prefix>.collapsed``
+    stack samples in the collapsed format read by ``flamegraph.pl`` and
+    speedscope, one ``frame;frame;... count`` line per distinct stack
+``<prefix>.cpu.txt``
+    per-message-type message counts and CPU time
+``<prefix>.memory.txt``
+    the top allocation sites (only if :mod:`tracemalloc` is available)
+
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+__all__ = ['AgentProfiler']
+
+log = logging.getLogger(__name__)
+
+thread_time = getattr(time, 'thread_time', None) or \
+    getattr(time, 'process_time', None) or time.clock
+
+IDLE = '(idle)'
+
+
+def _frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class AgentProfiler(object):
+    """Profiles a ConsumerAgent on demand.
+
+    The agent (or its :class:`~pikachewie.workers.WorkerPool`) calls
+    :meth:`begin` and :meth:`end` around the processing of each message, on
+    the thread processing it.
+
+    :param str output_dir: directory to write profiles to
+    :param float interval: seconds between stack samples
+    :param int memory_frames: number of frames tracemalloc keeps per
+        allocation
+    :param int memory_top: number of allocation sites to report
+
+    """
+    default_seconds = 30
+
+    def __init__(self, output_dir='.', interval=0.005, memory_frames=10,
+                 memory_top=50):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.memory_frames = memory_frames
+        self.memory_top = memory_top
+        self.active = False
+        self._current = {}  # thread ident -> (label, CPU time at start)
+        self._stacks = defaultdict(int)
+        self._cpu = defaultdict(float)
+        self._messages = defaultdict(int)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # profiling control
+
+    def start(self, seconds=None):
+        """Profile every thread of this process for `seconds` seconds.
+
+        Does nothing if a profile is already running.
+
+        :returns: the path prefix of the files that will be written, or
+            `None` if a profile is already running
+        :rtype: :class:`str` or `NoneType`
+        :raises: :class:`ValueError` if `seconds` is not a positive number
+
+        """
+        seconds = float(seconds or self.default_seconds)
+        if not seconds > 0:
+            raise ValueError('Invalid profile duration: %r' % seconds)
+        with self._lock:
+            if self.active:
+                log.warning('A profile is already running')
+                return None
+            self.active = True
+
+        prefix = os.path.join(self.output_dir, 'pikachewie-%d-%d' % (
+            os.getpid(), int(time.time())))
+        self._stacks.clear()
+        self._cpu.clear()
+        self._messages.clear()
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(self.memory_frames)
+
+        self._thread = threading.Thread(
+            target=self._run, args=(seconds, prefix, tracing),
+            name='pikachewie-profiler')
+        self._thread.daemon = True
+        log.info('Profiling for %s seconds; writing to %s.*', seconds, prefix)
+        self._thread.start()
+        return prefix
+
+    def install_signal_handler(self, ioloop, signum=None):
+        """Start a profile whenever this process receives `signum`.
+
+        The profile is started on `ioloop`, not in the signal handler, which
+        may have interrupted a thread holding the profiler's lock.  `signum`
+        defaults to ``SIGUSR2``.
+
+        """
+        if signum is None:
+            signum = signal.SIGUSR2
+        add_callback = getattr(ioloop, 'add_callback_from_signal',
+                               ioloop.add_callback)
+        signal.signal(signum, lambda signum, frame: add_callback(self.start))
+
+    def handle_request(self, arguments):
+        """Start a profile from a ``/profile`` HTTP request.
+
+        :param dict arguments: query arguments; ``seconds`` sets the duration
+
+        """
+        seconds = arguments.get('seconds')
+        try:
+            prefix = self.start(seconds)
+        except ValueError:
+            return 'Invalid seconds: %r\n' % seconds
+        if prefix is None:
+            return 'A profile is already running.\n'
+        return 'Profiling; results will be written to %s.*\n' % prefix
+
+    def _run(self, seconds, prefix, tracing):
+        deadline = time.time() + seconds
+        sampler = threading.current_thread().ident
+        try:
+            while time.time() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident != sampler:
+                        self._sample(ident, frame)
+                time.sleep(self.interval)
+            snapshot = tracemalloc.take_snapshot() if tracing else None
+            # still active, so that start() cannot clear the results yet
+            self._write(prefix, snapshot)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            self.active = False
+
+    def _sample(self, ident, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        stack.append(self._current.get(ident, (IDLE,))[0])
+        self._stacks[';'.join(reversed(stack))] += 1
+
+    def _write(self, prefix, snapshot):
+        with open(prefix + '.collapsed', 'w') as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+        with open(prefix + '.cpu.txt', 'w') as f:
+            f.write('%-40s %10s %14s %14s\n' % ('message', 'count',
+                                                'cpu seconds', 'cpu ms/msg'))
+            for label, cpu in sorted(self._cpu.items(), key=lambda i: -i[1]):
+                count = self._messages[label]
+                f.write('%-40s %10d %14.6f %14.3f\n' % (
+                    label, count, cpu, 1000 * cpu / count if count else 0))
+
+        if snapshot is not None:
+            with open(prefix + '.memory.txt', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:self.memory_top]:
+                    f.write('%s\n' % stat)
+
+        log.info('Wrote profile to %s.*', prefix)
+
+    # message processing
+
+    def begin(self, message):
+        """Note that the calling thread has started processing `message`."""
+        if self.active:
+            label = message.type or message.routing_key or IDLE
+            self._current[threading.current_thread().ident] = (
+                label, thread_time())
+
+    def end(self, message):
+        """Note that the calling thread has finished processing `message`."""
+        current = self._current.pop(threading.current_thread().ident, None)
+        if current is not None:
+            label, cpu_started = current
+            cpu = thread_time() - cpu_started
+            with self._lock:
+                self._cpu[label] += cpu
+                self._messages[label] += 1
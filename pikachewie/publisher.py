@@ -4,20 +4,37 @@ pikachewie.publisher -- PikaChewie base publisher class
 =======================================================
 
 """
+import copy
 import logging
+import threading
 import time
+import weakref
 
 import simplejson
-from pika.exceptions import ConnectionClosed, ChannelClosed
+from pika.exceptions import (AMQPConnectionError, ConnectionClosed,
+                             ChannelClosed)
 from pika.spec import BasicProperties
 
+from pikachewie.claimcheck import (CLAIM_CHECK_HEADER,
+                                   DEFAULT_CLAIM_CHECK_THRESHOLD)
+from pikachewie.data import Properties
+
 log = logging.getLogger(__name__)
 
 
 class PublisherMixin(object):
-    """Mixin for publishing messages to RabbitMQ."""
+    """Mixin for publishing messages to RabbitMQ.
+
+    If :attr:`blob_store` is set, bodies longer than
+    :attr:`claim_check_threshold` bytes are written to it, and published as
+    claim checks (see :mod:`pikachewie.claimcheck`).
+
+    """
 
     retry_on_exceptions = (ConnectionClosed, ChannelClosed)
+    #: the :class:`pikachewie.claimcheck.BlobStore` to store large bodies in
+    blob_store = None
+    claim_check_threshold = DEFAULT_CLAIM_CHECK_THRESHOLD
 
     def publish(self, exchange, routing_key, body, properties=None):
         """Publish a message to RabbitMQ.
@@ -29,12 +46,21 @@ class PublisherMixin(object):
         :param str routing_key: the routing key to publish with
         :param str|unicode body: the message body to publish
         :param pikachewie.data.Properties properties: the message properties
+        :returns: `False` if the channel confirms deliveries and the broker
+            nacked or returned the message, `True` otherwise
+        :rtype: bool
 
         """
+        if self.blob_store is not None:
+            if not isinstance(body, bytes):
+                # the threshold is in bytes, not characters
+                body = body.encode('utf-8')
+            if len(body) > self.claim_check_threshold:
+                body, properties = self._claim_check(body, properties)
         if properties:
             properties = self._build_basic_properties(properties)
         try:
-            self.channel.basic_publish(
+            return self.channel.basic_publish(
                 exchange=exchange,
                 routing_key=routing_key,
                 properties=properties,
@@ -44,7 +70,7 @@ class PublisherMixin(object):
             log.warn('Cannot publish on existing channel')
             log.info('Attempting to republish on new channel')
             self._channel = None
-            self.channel.basic_publish(
+            return self.channel.basic_publish(
                 exchange=exchange,
                 routing_key=routing_key,
                 properties=properties,
@@ -65,6 +91,18 @@ class PublisherMixin(object):
                 # it on demand.
                 self._channel = None
 
+    def _claim_check(self, body, properties):
+        """Store `body`, and return the empty body and properties to publish
+        in its place.
+
+        """
+        key = self.blob_store.put(body)
+        properties = copy.copy(properties) if properties else Properties()
+        properties.headers = dict(properties.headers or {})
+        properties.headers[CLAIM_CHECK_HEADER] = key
+        log.debug('Publishing %d-byte body as claim check %s', len(body), key)
+        return b'', properties
+
     def _build_basic_properties(self, properties):
         """
         Get the pika.BasicProperties from a pikachewie.data.Properties object.
@@ -102,11 +140,64 @@ class PublisherMixin(object):
 
 
 class BlockingPublisher(PublisherMixin, object):
-    """Base class for synchronous RabbitMQ publishers."""
+    """Base class for synchronous RabbitMQ publishers.
+
+    A blocking connection only answers the broker's heartbeats while it is
+    in use, so an idle publisher's connection is eventually dropped, and the
+    next publish fails and reconnects.  If `keepalive` is set, a background
+    thread services the connection every `keepalive` seconds (or every
+    :attr:`DEFAULT_KEEPALIVE_INTERVAL` seconds, if `keepalive` is `True`)
+    once it has been opened, and reopens it as soon as it is lost.  The
+    thread never uses the connection at the same time as :meth:`publish`.
+    Call :meth:`close` to stop it.
+
+    `keepalive` should be well under the connection's heartbeat interval.
+
+    :param broker: the broker to publish to
+    :type broker: :class:`pikachewie.broker.Broker`
+    :param keepalive: seconds between services of an idle connection
+    :type keepalive: :class:`float` or :class:`bool`
+    :param blob_store: the store to claim-check large bodies in
+    :type blob_store: :class:`pikachewie.claimcheck.BlobStore`
+    :param int claim_check_threshold: the size, in bytes, above which
+        bodies are claim-checked
+
+    """
+    DEFAULT_KEEPALIVE_INTERVAL = 10  # seconds
     _channel = None
+    _opened = False
+    _stopped = None
+    _keepalive_thread = None
 
-    def __init__(self, broker):
+    def __init__(self, broker, keepalive=None, blob_store=None,
+                 claim_check_threshold=None):
         self.broker = broker
+        if blob_store is not None:
+            self.blob_store = blob_store
+        if claim_check_threshold is not None:
+            self.claim_check_threshold = claim_check_threshold
+        self._opened = False
+        self._stopped = threading.Event()
+        self._keepalive_thread = None
+        if keepalive is True:
+            keepalive = self.DEFAULT_KEEPALIVE_INTERVAL
+        self.keepalive = keepalive or None
+        if self.keepalive:
+            self._keepalive_thread = threading.Thread(
+                target=_keep_alive,
+                args=(weakref.ref(self), self.keepalive, self._stopped),
+                name='pikachewie-publisher-keepalive')
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    @property
+    def _lock(self):
+        # created on first use, so subclasses need not call __init__
+        lock = self.__dict__.get('_publisher_lock')
+        if lock is None:
+            lock = self.__dict__.setdefault('_publisher_lock',
+                                            threading.RLock())
+        return lock
 
     @property
     def channel(self):
@@ -115,15 +206,75 @@ class BlockingPublisher(PublisherMixin, object):
         If necessary, create and cache a new channel.
 
         """
-        if not self._channel or not self._channel.is_open:
-            self._channel = self.broker.connect(blocking=True).channel()
-            self._channel.confirm_delivery()
-        return self._channel
+        with self._lock:
+            if not self._channel or not self._channel.is_open:
+                self._channel = self.broker.connect(blocking=True).channel()
+                self._channel.confirm_delivery()
+                self._opened = True
+            return self._channel
 
     @channel.deleter
     def channel(self):
         self._channel = None
 
+    def publish(self, *args, **kwargs):
+        with self._lock:
+            return super(BlockingPublisher, self).publish(*args, **kwargs)
+
+    def process_data_events(self, time_limit=0):
+        with self._lock:
+            super(BlockingPublisher, self).process_data_events(time_limit)
+
+    def keep_alive(self):
+        """Service the connection, reopening it if it has been lost.
+
+        Called periodically by the keepalive thread.
+
+        """
+        with self._lock:
+            if not self._opened:
+                return
+            if self._channel and self._channel.is_open:
+                try:
+                    self._channel.connection.process_data_events(
+                        time_limit=0)
+                    return
+                except self.retry_on_exceptions as exc:
+                    log.warning('Publisher connection lost: %r', exc)
+            self._channel = None
+            try:
+                self.channel
+            except AMQPConnectionError as exc:
+                log.warning('Cannot reconnect publisher: %r', exc)
+            else:
+                log.info('Reconnected publisher')
+
+    def close(self):
+        """Stop the keepalive thread, and close the connection."""
+        if self._stopped is not None:
+            self._stopped.set()
+        thread = self._keepalive_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self._lock:
+            if self._channel and self._channel.connection.is_open:
+                self._channel.connection.close()
+            self._channel = None
+            self._opened = False
+
+
+def _keep_alive(publisher_ref, interval, stopped):
+    """Run a publisher's keepalive until it is closed or garbage-collected."""
+    while not stopped.wait(interval):
+        publisher = publisher_ref()
+        if publisher is None:
+            return
+        try:
+            publisher.keep_alive()
+        except Exception:
+            log.exception('Publisher keepalive failed')
+        del publisher
+
 
 class JSONPublisherMixin(PublisherMixin):
     """Publisher Mixin that JSON-serializes the message payload."""
@@ -149,7 +300,7 @@ class JSONPublisherMixin(PublisherMixin):
         if not properties:
             properties = BasicProperties()
         properties.content_type = 'application/json'
-        super(JSONPublisherMixin, self).publish(
+        return super(JSONPublisherMixin, self).publish(
             exchange,
             routing_key,
             self._serialize(payload),
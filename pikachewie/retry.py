@@ -0,0 +1,176 @@
+"""
+====================================================
+pikachewie.retry -- Delayed retry of failed messages
+====================================================
+
+By default, a :class:`~pikachewie.agent.ConsumerAgent` rejects a message
+whose processing raises a :class:`~pikachewie.exceptions.ConsumerException`
+with requeue, so the broker redelivers it at once; while a dependency is
+down, the agent and broker spin in a tight reject/redeliver loop.  With a
+:class:`RetryPolicy`, the agent instead republishes the message to a retry
+queue, where it waits out an exponentially increasing delay before being
+dead-lettered back to its original queue, and acknowledges the original
+once the broker has confirmed the copy (see :mod:`pikachewie.outbox`); if
+the copy cannot be published, the original is requeued instead.  After
+`max_attempts` retries, the message is parked in a queue of its own for
+inspection.
+
+For each queue ``q`` it consumes from, the agent declares:
+
+``q.retry`` (a headers exchange)
+    routes each retried message to the retry queue for its delay, by its
+    ``retry-delay`` header (headers exchanges ignore ``x-`` headers);
+``q.retry.<milliseconds>`` (one queue per delay)
+    holds retried messages for that many milliseconds (``x-message-ttl``),
+    then dead-letters them to ``q.retry.return``;
+``q.retry.return`` (a fanout exchange bound only to ``q``)
+    returns retried messages to ``q``, with their original routing keys;
+``q.parked``
+    holds messages that failed on every attempt.
+
+Retried messages carry the number of retries so far in their
+``x-retry-count`` header, and their original exchange and routing key in
+``x-original-exchange`` and ``x-original-routing-key``.
+
+"""
+import logging
+
+__all__ = ['RetryPolicy']
+
+log = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+    """Retries failed messages with exponential backoff.
+
+    The delay before retry ``n`` (counting from 1) is
+    ``initial_delay * multiplier ** (n - 1)`` seconds, up to `max_delay`.
+
+    :param float initial_delay: seconds before the first retry
+    :param float multiplier: factor by which each delay grows
+    :param float max_delay: maximum seconds before a retry
+    :param int max_attempts: retries before a message is parked
+
+    """
+    count_header = 'x-retry-count'
+    delay_header = 'retry-delay'
+
+    def __init__(self, initial_delay=1.0, multiplier=2.0, max_delay=300.0,
+                 max_attempts=5):
+        if initial_delay <= 0 or multiplier < 1 or max_delay < initial_delay:
+            raise ValueError('Invalid retry delays: %r * %r ** n, up to %r'
+                             % (initial_delay, multiplier, max_delay))
+        if max_attempts < 0:
+            raise ValueError('Invalid max_attempts: %r' % max_attempts)
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        """Return the delay before the given retry, in milliseconds.
+
+        :param int attempt: the retry number, counting from 1
+        :rtype: int
+
+        """
+        seconds = min(self.initial_delay * self.multiplier ** (attempt - 1),
+                      self.max_delay)
+        return int(round(seconds * 1000))
+
+    @property
+    def delays(self):
+        """The distinct retry delays, in milliseconds, in increasing order."""
+        return sorted(set(self.delay(attempt)
+                          for attempt in range(1, self.max_attempts + 1)))
+
+    def retry_exchange(self, queue):
+        return '%s.retry' % queue
+
+    def retry_queue(self, queue, delay):
+        return '%s.retry.%d' % (queue, delay)
+
+    def return_exchange(self, queue):
+        return '%s.retry.return' % queue
+
+    def parking_queue(self, queue):
+        return '%s.parked' % queue
+
+    def topology(self, queue, durable=False):
+        """Return the declarations needed to retry messages from `queue`.
+
+        :param str queue: the queue whose messages to retry
+        :param bool durable: whether to declare durable exchanges and queues
+        :returns: (channel method name, keyword arguments) pairs, in order
+        :rtype: `list`
+
+        """
+        retry_exchange = self.retry_exchange(queue)
+        return_exchange = self.return_exchange(queue)
+        declarations = [
+            ('exchange_declare', {'exchange': retry_exchange,
+                                  'exchange_type': 'headers',
+                                  'durable': durable}),
+            ('exchange_declare', {'exchange': return_exchange,
+                                  'exchange_type': 'fanout',
+                                  'durable': durable}),
+            ('queue_bind', {'queue': queue, 'exchange': return_exchange,
+                            'routing_key': ''}),
+        ]
+        for delay in self.delays:
+            retry_queue = self.retry_queue(queue, delay)
+            declarations.extend([
+                ('queue_declare', {'queue': retry_queue, 'durable': durable,
+                                   'arguments': {
+                                       'x-message-ttl': delay,
+                                       'x-dead-letter-exchange':
+                                           return_exchange,
+                                   }}),
+                ('queue_bind', {'queue': retry_queue,
+                                'exchange': retry_exchange,
+                                'routing_key': '',
+                                'arguments': {'x-match': 'all',
+                                              self.delay_header: delay}}),
+            ])
+        declarations.append(
+            ('queue_declare', {'queue': self.parking_queue(queue),
+                               'durable': durable}))
+        return declarations
+
+    def retry_count(self, message):
+        """Return the number of times `message` has already been retried.
+
+        :rtype: int
+
+        """
+        return int((message.headers or {}).get(self.count_header, 0))
+
+    def output_for(self, queue, message):
+        """Return the message to publish to retry or park `message`.
+
+        :param str queue: the queue `message` was consumed from
+        :param message: the message that failed
+        :type message: :class:`pikachewie.message.Message`
+        :returns: ``'retried'`` or ``'parked'``, and an ``(exchange,
+            routing_key, body, properties)`` tuple
+        :rtype: tuple
+
+        """
+        attempt = self.retry_count(message) + 1
+        properties = message.properties.to_basic_properties()
+        headers = properties.headers = properties.headers or {}
+        headers.setdefault('x-original-exchange', message.exchange)
+        headers.setdefault('x-original-routing-key', message.routing_key)
+        if attempt > self.max_attempts:
+            log.warning('Parking message #%s after %d attempts',
+                        message.delivery_tag, attempt)
+            headers.pop(self.delay_header, None)
+            return 'parked', ('', self.parking_queue(queue), message.raw_body,
+                              properties)
+        delay = self.delay(attempt)
+        log.info('Retrying message #%s in %d ms (attempt %d of %d)',
+                 message.delivery_tag, delay, attempt, self.max_attempts)
+        headers[self.count_header] = attempt
+        headers[self.delay_header] = delay
+        return 'retried', (self.retry_exchange(queue), message.routing_key,
+                           message.raw_body, properties)
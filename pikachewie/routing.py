@@ -0,0 +1,179 @@
+"""
+===================================================
+pikachewie.routing -- Dispatch of messages by topic
+===================================================
+
+A :class:`RoutedConsumer` dispatches each message to a handler method chosen
+by the message's routing key, matched against AMQP topic patterns, in which
+``*`` matches exactly one word and ``#`` matches zero or more words::
+
+    class OrderConsumer(RoutedConsumer):
+
+        @route('orders.*.created')
+        def process_new_order(self):
+            ...
+
+        @route('orders.#')
+        def process_other_order(self):
+            ...
+
+If several patterns match a routing key, the handler registered first wins.
+If none does, :meth:`RoutedConsumer.process_unrouted` is called, which
+rejects the message by raising a
+:class:`~pikachewie.exceptions.MessageException` unless overridden.
+
+The patterns are compiled into a :class:`TopicTrie`, which matches a routing
+key in time proportional to its number of words rather than the number of
+patterns, and the handler chosen for each routing key is cached.
+
+"""
+import itertools
+
+from pikachewie.consumer import Consumer
+from pikachewie.exceptions import MessageException
+
+__all__ = ['RoutedConsumer', 'TopicTrie', 'route']
+
+_registrations = itertools.count()
+
+
+class _Node(object):
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie(object):
+    """A trie of AMQP topic patterns, each associated with a value."""
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, value):
+        """Associate `value` with the topic `pattern`."""
+        node = self._root
+        for word in pattern.split('.'):
+            node = node.children.setdefault(word, _Node())
+        node.values.append((self._count, value))
+        self._count += 1
+
+    def match(self, routing_key):
+        """Return the values of every pattern matching `routing_key`.
+
+        Values are returned in the order in which their patterns were added.
+
+        :rtype: `list`
+
+        """
+        words = routing_key.split('.')
+        matches = {}
+        visited = set()
+        stack = [(self._root, 0)]
+        while stack:
+            node, position = stack.pop()
+            if (id(node), position) in visited:
+                continue
+            visited.add((id(node), position))
+            children = node.children
+            hash_node = children.get('#')
+            if hash_node is not None:
+                # '#' consumes zero or more of the remaining words
+                for end in range(position, len(words) + 1):
+                    stack.append((hash_node, end))
+            if position == len(words):
+                for index, value in node.values:
+                    matches[index] = value
+                continue
+            word = words[position]
+            for key in (word, '*'):
+                child = children.get(key)
+                if child is not None:
+                    stack.append((child, position + 1))
+        return [matches[index] for index in sorted(matches)]
+
+
+def route(*patterns):
+    """Register the decorated method as the handler for topic `patterns`.
+
+    Handlers take no arguments, like
+    :meth:`~pikachewie.consumer.Consumer.process_message`.
+
+    """
+    def decorator(method):
+        registered = list(getattr(method, '_routes', ()))
+        for pattern in patterns:
+            registered.append((next(_registrations), pattern))
+        method._routes = registered
+        return method
+    return decorator
+
+
+class RoutedConsumer(Consumer):
+    """A consumer that dispatches messages to handlers by routing key.
+
+    Handlers are registered with the :func:`route` decorator, or listed in
+    :attr:`routes` as ``(pattern, method name)`` pairs, which take
+    precedence over decorated methods.
+
+    """
+    #: ``(pattern, method name)`` pairs, in order of precedence
+    routes = ()
+
+    _CACHE_SIZE = 10000  # routing keys
+
+    @classmethod
+    def _routing_table(cls):
+        table = cls.__dict__.get('_table')
+        if table is None:
+            table = cls._table = (cls._compile_routes(), {})
+        return table
+
+    @classmethod
+    def _compile_routes(cls):
+        registrations = []
+        for name in dir(cls):
+            for order, pattern in getattr(getattr(cls, name, None),
+                                          '_routes', ()):
+                registrations.append((order, pattern, name))
+        trie = TopicTrie()
+        for pattern, name in cls.routes:
+            trie.add(pattern, name)
+        for _, pattern, name in sorted(registrations):
+            trie.add(pattern, name)
+        return trie
+
+    @classmethod
+    def handler_name(cls, routing_key):
+        """Return the name of the handler for `routing_key`, or `None`."""
+        trie, cache = cls._routing_table()
+        try:
+            return cache[routing_key]
+        except KeyError:
+            pass
+        names = trie.match(routing_key)
+        name = names[0] if names else None
+        if len(cache) >= cls._CACHE_SIZE:
+            cache.clear()
+        cache[routing_key] = name
+        return name
+
+    def process_message(self):
+        name = self.handler_name(self.message.routing_key)
+        if name is None:
+            return self.process_unrouted()
+        return getattr(self, name)()
+
+    def process_unrouted(self):
+        """Handle a message whose routing key matches no route.
+
+        Override this method to provide a default handler.
+
+        """
+        raise MessageException('No route for routing key %r'
+                               % self.message.routing_key)
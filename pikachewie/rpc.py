@@ -0,0 +1,336 @@
+"""
+================================================
+pikachewie.rpc -- Request/response over RabbitMQ
+================================================
+
+A :class:`BlockingRpcClient` sends requests and waits for their replies
+using RabbitMQ's `direct reply-to`_: replies are consumed from the
+``amq.rabbitmq.reply-to`` pseudo-queue on one long-lived channel, so no
+reply queue is declared or deleted per call.  Each request carries a unique
+``correlation_id``, which maps its reply back to the :class:`RpcFuture`
+returned for it, so any number of calls can be outstanding at once::
+
+    client = BlockingRpcClient(broker, timeout=5)
+    reply = client.call('rpc', 'inventory.lookup', 'sku-1234')
+
+    futures = [client.call_async('rpc', 'price.' + region, 'sku-1234')
+               for region in ('eu', 'us', 'ap')]
+    replies = client.gather(futures, quorum=2)
+
+The server replies by publishing to the default exchange with the request's
+``reply_to`` as the routing key and its ``correlation_id`` unchanged.
+
+Like :class:`~pikachewie.publisher.BlockingPublisher`, the client is not
+thread-safe.  Replies are only received while the client is waiting for
+one (in :meth:`RpcFuture.result`, :meth:`BlockingRpcClient.call`, or
+:meth:`BlockingRpcClient.gather`).
+
+.. _direct reply-to: https://www.rabbitmq.com/direct-reply-to.html
+
+"""
+import copy
+import heapq
+import itertools
+import logging
+import time
+import uuid
+
+from pikachewie.data import Properties
+from pikachewie.message import Message
+from pikachewie.publisher import JSONPublisherMixin, PublisherMixin
+
+__all__ = ['BlockingJSONRpcClient', 'BlockingRpcClient', 'RpcError',
+           'RpcFuture', 'RpcTimeout']
+
+log = logging.getLogger(__name__)
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class RpcError(Exception):
+    """Raised when a remote procedure call cannot be completed."""
+    pass
+
+
+class RpcTimeout(RpcError):
+    """Raised when no reply arrives before a call's deadline."""
+    pass
+
+
+class RpcFuture(object):
+    """The pending reply to a remote procedure call."""
+
+    def __init__(self, client, correlation_id, deadline=None):
+        self.client = client
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self._reply = None
+        self._exception = None
+        self._done = False
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.correlation_id,
+                               'done' if self._done else 'pending')
+
+    def done(self):
+        """Whether the call has completed, successfully or not."""
+        return self._done
+
+    def result(self, timeout=None):
+        """Wait for and return the reply.
+
+        :param float timeout: maximum seconds to wait (default: until the
+            call's own deadline)
+        :rtype: :class:`pikachewie.message.Message`
+        :raises: :class:`RpcTimeout`, or :class:`RpcError` if the call
+            failed or was cancelled
+
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._reply
+
+    def exception(self, timeout=None):
+        """Wait for the call to complete, and return its exception, if any.
+
+        :param float timeout: maximum seconds to wait (default: until the
+            call's own deadline)
+        :raises: :class:`RpcTimeout` if `timeout` elapses first
+
+        """
+        if not self._done:
+            self.client.wait([self], timeout=timeout)
+            if not self._done:
+                raise RpcTimeout('No reply to %s within %s seconds'
+                                 % (self.correlation_id, timeout))
+        return self._exception
+
+    def cancel(self):
+        """Stop waiting for the reply.
+
+        :returns: whether the call was still pending
+        :rtype: bool
+
+        """
+        if self._done:
+            return False
+        self.client._pending.pop(self.correlation_id, None)
+        self._set_exception(RpcError('Call %s cancelled'
+                                     % self.correlation_id))
+        return True
+
+    def _set_reply(self, reply):
+        self._reply = reply
+        self._done = True
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+
+class BlockingRpcClient(PublisherMixin, object):
+    """Synchronous RPC client using direct reply-to.
+
+    :param broker: the broker to connect to
+    :type broker: :class:`pikachewie.broker.Broker`
+    :param float timeout: default seconds to wait for each reply (default:
+        forever)
+
+    """
+    _channel = None
+
+    def __init__(self, broker, timeout=None, time_func=time.time):
+        self.broker = broker
+        self.timeout = timeout
+        self.time = time_func
+        self._pending = {}
+        self._deadlines = []
+        self._prefix = uuid.uuid4().hex
+        self._sequence = itertools.count(1)
+
+    @property
+    def channel(self):
+        """Return an open channel consuming from direct reply-to.
+
+        If necessary, create and cache a new channel.  Calls pending on a
+        previous channel fail, since their replies cannot be received.
+
+        """
+        if not self._channel or not self._channel.is_open:
+            self._fail_pending(RpcError('Reply channel closed'))
+            channel = self.broker.connect(blocking=True).channel()
+            channel.basic_consume(self._on_reply, DIRECT_REPLY_TO,
+                                  no_ack=True)
+            self._channel = channel
+        return self._channel
+
+    @channel.deleter
+    def channel(self):
+        self._channel = None
+
+    @property
+    def pending(self):
+        """The number of calls awaiting a reply."""
+        return len(self._pending)
+
+    def call_async(self, exchange, routing_key, body, properties=None,
+                   timeout=None):
+        """Send a request, and return the future of its reply.
+
+        If the call has a timeout and `properties` specify no expiration,
+        the request expires with the call, so that a server does not
+        process a request whose caller has given up.
+
+        :param str exchange: the exchange to publish the request to
+        :param str routing_key: the routing key to publish with
+        :param body: the request body
+        :param pikachewie.data.Properties properties: the request properties
+        :param float timeout: seconds to wait for the reply (default: the
+            client's `timeout`)
+        :rtype: :class:`RpcFuture`
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        properties = copy.copy(properties) if properties else Properties()
+        correlation_id = '%s.%d' % (self._prefix, next(self._sequence))
+        properties.correlation_id = correlation_id
+        properties.reply_to = DIRECT_REPLY_TO
+        deadline = None
+        if timeout is not None:
+            deadline = self.time() + timeout
+            if properties.expiration is None:
+                properties.expiration = max(int(timeout * 1000), 1)
+        self.publish(exchange, routing_key, body, properties)
+        future = RpcFuture(self, correlation_id, deadline)
+        self._pending[correlation_id] = future
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, correlation_id))
+        return future
+
+    def call(self, exchange, routing_key, body, properties=None,
+             timeout=None):
+        """Send a request, and wait for and return its reply.
+
+        Takes the same arguments as :meth:`call_async`.
+
+        :rtype: :class:`pikachewie.message.Message`
+        :raises: :class:`RpcTimeout` if no reply arrives in time
+
+        """
+        return self.call_async(exchange, routing_key, body, properties,
+                               timeout).result()
+
+    def scatter(self, requests, quorum=None, timeout=None):
+        """Send several requests, and gather their replies.
+
+        :param requests: ``(exchange, routing_key, body)`` or ``(exchange,
+            routing_key, body, properties)`` tuples
+        :returns: see :meth:`gather`
+
+        """
+        futures = [self.call_async(*request, timeout=timeout)
+                   for request in requests]
+        return self.gather(futures, quorum, timeout)
+
+    def gather(self, futures, quorum=None, timeout=None):
+        """Wait for the replies to several calls.
+
+        Waits until `quorum` calls have succeeded, every call has completed,
+        or `timeout` seconds have passed, whichever comes first; calls still
+        pending then are cancelled.
+
+        :param futures: the calls to wait for
+        :param int quorum: the number of replies needed (default: all)
+        :param float timeout: maximum seconds to wait (default: until every
+            call's own deadline)
+        :returns: the replies received, in order of arrival
+        :rtype: `list` of :class:`pikachewie.message.Message`
+
+        """
+        futures = list(futures)
+        if quorum is None:
+            quorum = len(futures)
+        replies = []
+        collected = set()
+
+        def collect():
+            for future in futures:
+                if future.done() and future not in collected:
+                    collected.add(future)
+                    if future._exception is None:
+                        replies.append(future._reply)
+            return (len(replies) >= quorum
+                    or len(collected) == len(futures))
+
+        self.wait(futures, timeout=timeout, until=collect)
+        for future in futures:
+            future.cancel()
+        return replies
+
+    def wait(self, futures, timeout=None, until=None):
+        """Receive replies until every one of `futures` is done.
+
+        :param float timeout: maximum seconds to wait (default: until every
+            call's own deadline)
+        :param until: a callable returning whether to stop waiting early
+
+        """
+        deadline = None if timeout is None else self.time() + timeout
+        while True:
+            now = self.time()
+            self._expire(now)
+            if until is not None and until():
+                return
+            if all(future.done() for future in futures):
+                return
+            if deadline is not None and now >= deadline:
+                return
+            self._process_data_events(self._time_limit(deadline, now))
+
+    def _time_limit(self, deadline, now):
+        """Return the seconds until `deadline` or the next call's deadline."""
+        if self._deadlines:
+            if deadline is None or self._deadlines[0][0] < deadline:
+                deadline = self._deadlines[0][0]
+        if deadline is None:
+            return None
+        return deadline - now
+
+    def _process_data_events(self, time_limit):
+        channel = self.channel
+        try:
+            channel.connection.process_data_events(time_limit=time_limit)
+        except self.retry_on_exceptions as exc:
+            log.warning('Lost reply channel: %r', exc)
+            self._channel = None
+            self._fail_pending(RpcError('Reply channel closed: %r' % exc))
+
+    def _expire(self, now):
+        """Time out the calls whose deadlines have passed."""
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, correlation_id = heapq.heappop(self._deadlines)
+            future = self._pending.pop(correlation_id, None)
+            if future is not None:
+                future._set_exception(RpcTimeout(
+                    'No reply to %s by its deadline' % correlation_id))
+
+    def _fail_pending(self, exception):
+        pending, self._pending = self._pending, {}
+        self._deadlines = []
+        for future in pending.values():
+            future._set_exception(exception)
+
+    def _on_reply(self, channel, method, properties, body):
+        future = self._pending.pop(properties.correlation_id, None)
+        if future is None:
+            log.debug('Discarding reply to unknown or expired call %s',
+                      properties.correlation_id)
+            return
+        future._set_reply(Message(channel, method, properties, body))
+
+
+class BlockingJSONRpcClient(JSONPublisherMixin, BlockingRpcClient):
+    """RPC client that JSON-serializes request payloads."""
+    pass
@@ -0,0 +1,83 @@
+"""
+========================================================
+pikachewie.scheduling -- Ordering of buffered deliveries
+========================================================
+
+When a :class:`~pikachewie.agent.ConsumerAgent` prefetches more messages
+than its workers can process at once, the surplus waits in its
+:class:`~pikachewie.workers.WorkerPool`.  A :class:`DeliveryScheduler`
+hands the waiting messages to workers in order of:
+
+1. ``priority``, highest first;
+2. deadline (the message's expiration time), earliest first, with messages
+   that never expire last;
+3. fairness between routing keys: within the same priority and deadline,
+   routing keys take turns, so a burst of bulk messages with one routing
+   key does not hold up the others;
+4. arrival.
+
+An agent processing one message at a time has no buffer to order, so its
+behaviour is unaffected.
+
+"""
+import heapq
+import itertools
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+__all__ = ['DeliveryScheduler']
+
+INFINITY = float('inf')
+
+
+class DeliveryScheduler(Queue):
+    """A thread-safe queue of deliveries, ordered by priority and deadline.
+
+    Items are ``(message, ...)`` tuples; any other item (e.g., a worker
+    pool's stop token) is a control item, and is served before any message,
+    so that shrinking a pool sheds load at once.
+
+    """
+    _PRUNE_THRESHOLD = 1024  # routing keys
+
+    def _init(self, maxsize):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._round = 0
+        self._last_rounds = {}
+
+    def _qsize(self):
+        return len(self._heap)
+
+    def _put(self, item):
+        if isinstance(item, tuple):
+            key = self._message_key(item[0])
+        else:
+            key = (0,)
+        heapq.heappush(self._heap, (key, next(self._sequence), item))
+
+    def _get(self):
+        key, _, item = heapq.heappop(self._heap)
+        if len(key) > 1:
+            self._round = max(self._round, key[3])
+        return item
+
+    def _message_key(self, message):
+        routing_key = message.routing_key
+        turn = max(self._round, self._last_rounds.get(routing_key, 0)) + 1
+        self._last_rounds[routing_key] = turn
+        if len(self._last_rounds) > self._PRUNE_THRESHOLD:
+            self._prune()
+        deadline = message.expiration_timestamp
+        return (1, -(message.priority or 0),
+                INFINITY if deadline is None else deadline, turn)
+
+    def _prune(self):
+        """Forget routing keys with no messages waiting."""
+        self._last_rounds = dict(
+            (routing_key, turn)
+            for routing_key, turn in self._last_rounds.items()
+            if turn > self._round)
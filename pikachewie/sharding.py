@@ -0,0 +1,207 @@
+"""
+==================================================
+pikachewie.sharding -- Multi-connection publishing
+==================================================
+
+A single connection, served by a single channel process on the broker and
+a single socket in the client, caps a publisher's throughput at about one
+core's worth.  A :class:`ShardedPublisher` spreads its messages over
+several :class:`~pikachewie.publisher.BlockingPublisher` shards, each with
+its own connection (spread across the broker's nodes, see
+:meth:`pikachewie.broker.Broker.pinned`), its own publisher confirms, and
+its own reconnects, published to by its own thread::
+
+    publisher = ShardedPublisher(broker, shards=4)
+    for order in orders:
+        publisher.publish('orders', order.customer_id, order.to_json())
+    publisher.flush()   # wait for every message to be confirmed
+
+Messages are assigned to shards by a hash of their routing key, so that
+messages with the same routing key are published, in order, by the same
+shard.  Messages whose order does not matter (``ordered=False``) are
+assigned round-robin instead.
+
+A message the broker nacks or returns is reported by the next
+:meth:`~ShardedPublisher.flush`, as is every later message with the same
+routing key: once a message fails, later ordered messages with its routing
+key are not published until the failure has been reported, so that they are
+never published out of order.
+
+"""
+import itertools
+import logging
+import threading
+import time
+import zlib
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+from pika.exceptions import NackError
+
+from pikachewie.publisher import BlockingPublisher
+
+__all__ = ['PublishError', 'ShardedPublisher']
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PublishError(Exception):
+    """Raised when messages could not be published.
+
+    :attr:`failures` lists the ``((exchange, routing_key, body,
+    properties), exception)`` pairs of the messages that failed.  A message
+    that was not published because an earlier message with the same routing
+    key failed is paired with a :class:`PublishError` for that message.
+
+    """
+
+    def __init__(self, failures):
+        super(PublishError, self).__init__(
+            '%d message%s could not be published' %
+            (len(failures), '' if len(failures) == 1 else 's'))
+        self.failures = failures
+
+
+class ShardedPublisher(object):
+    """Publishes over several connections at once.
+
+    :param broker: the broker to publish to
+    :type broker: :class:`pikachewie.broker.Broker`
+    :param int shards: the number of connections
+    :param int max_pending: maximum number of messages waiting to be
+        published by each shard, beyond which :meth:`publish` blocks
+    :param publisher_class: the class of each shard (default:
+        :class:`~pikachewie.publisher.BlockingPublisher`)
+    :param dict publisher_options: keyword arguments for each shard, e.g.
+        ``{'keepalive': True}``
+
+    """
+
+    def __init__(self, broker, shards=4, max_pending=1000,
+                 publisher_class=BlockingPublisher, publisher_options=None):
+        if shards < 1:
+            raise ValueError('Invalid number of shards: %r' % shards)
+        options = publisher_options or {}
+        self.shards = [publisher_class(broker.pinned(index), **options)
+                       for index in range(shards)]
+        self.pending = 0
+        self._failures = []
+        self._failed_keys = {}
+        self._condition = threading.Condition()
+        self._rotation = itertools.count()
+        self._queues = []
+        self._threads = []
+        for index, shard in enumerate(self.shards):
+            queue = Queue(max_pending)
+            thread = threading.Thread(
+                target=self._publish_from, args=(shard, queue),
+                name='pikachewie-shard-%d' % (index + 1))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    def shard_for(self, routing_key):
+        """Return the index of the shard that publishes `routing_key`.
+
+        :rtype: int
+
+        """
+        if not isinstance(routing_key, bytes):
+            routing_key = routing_key.encode('utf-8')
+        return (zlib.crc32(routing_key) & 0xffffffff) % len(self.shards)
+
+    def publish(self, exchange, routing_key, body, properties=None,
+                ordered=True):
+        """Queue a message for publishing.
+
+        Takes the same arguments as
+        :meth:`pikachewie.publisher.PublisherMixin.publish`.  Returns once
+        the message is queued; call :meth:`flush` to wait for it to be
+        confirmed.
+
+        :param bool ordered: whether the message must be published after
+            the messages previously published with the same routing key
+
+        """
+        if ordered:
+            index = self.shard_for(routing_key)
+        else:
+            index = next(self._rotation) % len(self.shards)
+        with self._condition:
+            self.pending += 1
+        self._queues[index].put(
+            ((exchange, routing_key, body, properties), ordered))
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been published and confirmed.
+
+        :param float timeout: maximum seconds to wait
+        :returns: whether every message was published in time
+        :rtype: bool
+        :raises: :class:`PublishError` if any message could not be
+            published since the last flush
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self._condition.wait(remaining)
+            failures, self._failures = self._failures, []
+            flushed = not self.pending
+            if flushed:
+                self._failed_keys.clear()
+        if failures:
+            raise PublishError(failures)
+        return flushed
+
+    def close(self):
+        """Publish the queued messages, then close every connection."""
+        for queue in self._queues:
+            queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        for shard in self.shards:
+            if hasattr(shard, 'close'):
+                shard.close()
+
+    def _publish_from(self, shard, queue):
+        while True:
+            entry = queue.get()
+            if entry is _STOP:
+                return
+            item, ordered = entry
+            routing_key = item[1]
+            with self._condition:
+                failure = self._failed_keys.get(routing_key) if ordered \
+                    else None
+            exc = None
+            if failure is not None:
+                exc = PublishError([failure])
+            else:
+                try:
+                    if shard.publish(*item) is False:
+                        exc = NackError([item])
+                except Exception as caught:
+                    exc = caught
+                if exc is not None:
+                    log.warning('Shard failed to publish to %s/%s: %r',
+                                item[0], routing_key, exc)
+            with self._condition:
+                if exc is not None:
+                    self._failures.append((item, exc))
+                    if ordered and failure is None:
+                        self._failed_keys[routing_key] = (item, exc)
+                self.pending -= 1
+                if not self.pending:
+                    self._condition.notify_all()
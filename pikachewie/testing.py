@@ -0,0 +1,1066 @@
+"""
+====================================================================
+pikachewie.testing -- An in-process RabbitMQ stand-in for PikaChewie
+====================================================================
+
+:class:`FakeBroker` is a drop-in replacement for
+:class:`pikachewie.broker.Broker` whose connections talk to an in-memory
+:class:`FakeServer` instead of a RabbitMQ node.  It implements the subset of
+AMQP 0-9-1 channel semantics used by :class:`pikachewie.agent.ConsumerAgent`
+and the publishers in :mod:`pikachewie.publisher`:
+
+* direct, topic, fanout, and headers exchanges;
+* queue declare (including passive declare), bind, purge, and delete;
+* ``basic_consume``, ``basic_cancel``, ``basic_qos``, ``basic_get``,
+  ``basic_ack``, ``basic_nack``, and ``basic_reject``;
+* publisher confirms;
+* direct reply-to (``amq.rabbitmq.reply-to``);
+* per-queue (``x-message-ttl``) and per-message (``expiration``) TTLs;
+* dead-lettering via ``x-dead-letter-exchange`` and
+  ``x-dead-letter-routing-key``.
+
+All connections opened via the same :class:`FakeBroker` share one
+:class:`FakeServer` and one :class:`FakeIOLoop`, so publishers and consumers
+in the same process can be run against each other without a network::
+
+    broker = FakeBroker()
+    agent = ConsumerAgent(consumer, broker, bindings, config=config)
+    agent.connect()
+    broker.server.ioloop.run_until_idle()
+
+    publisher = BlockingPublisher(broker)
+    publisher.publish('my.exchange', 'my.routing.key', 'Chewie, we are home.')
+    broker.server.ioloop.run_until_idle()
+
+"""
+import copy
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from pika import amqp_object, frame, spec
+from pika.exceptions import ChannelClosed, ConnectionClosed
+from pika.spec import BasicProperties
+
+from pikachewie.broker import Broker
+
+__all__ = ['FakeBroker', 'FakeServer', 'FakeIOLoop', 'topic_matches']
+
+log = logging.getLogger(__name__)
+
+NOT_FOUND = 404
+PRECONDITION_FAILED = 406
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+def topic_matches(pattern, routing_key):
+    """Whether the AMQP topic `pattern` matches the given `routing_key`.
+
+    In a topic pattern, ``*`` matches exactly one word and ``#`` matches zero
+    or more words.
+
+    :rtype: `bool`
+
+    """
+    return _match_words(tuple(pattern.split('.')),
+                        tuple(routing_key.split('.')))
+
+
+def _match_words(pattern, words):
+    """Match a tuple of topic pattern words against a tuple of key words."""
+    if not pattern:
+        return not words
+    head = pattern[0]
+    if head == '#':
+        rest = pattern[1:]
+        return any(_match_words(rest, words[i:])
+                   for i in range(len(words) + 1))
+    if not words:
+        return False
+    if head == '*' or head == words[0]:
+        return _match_words(pattern[1:], words[1:])
+    return False
+
+
+class _ServerError(Exception):
+    """Raised internally when the fake server closes a channel."""
+
+    def __init__(self, reply_code, reply_text):
+        super(_ServerError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
+
+class FakeIOLoop(object):
+    """A minimal stand-in for the Tornado IOLoop.
+
+    Unlike a real IOLoop, :meth:`start` returns as soon as there is no more
+    work to do (no pending callbacks, no pending timeouts, and no busy
+    checks returning true), since nothing outside the loop can wake it up.
+
+    As with Tornado, :meth:`add_callback` may be called from other threads;
+    register a busy check (see :meth:`add_busy_check`) for each source of
+    such callbacks so that the loop waits for them.
+
+    """
+    _BUSY_WAIT = 0.05  # seconds
+
+    def __init__(self, time_func=time.time):
+        self.time = time_func
+        self._callbacks = deque()
+        self._timeouts = []
+        self._sequence = itertools.count()
+        self._running = False
+        self._busy_checks = []
+        self._wakeup = threading.Condition()
+
+    def add_callback(self, callback, *args, **kwargs):
+        """Call `callback` on the next iteration of the loop."""
+        with self._wakeup:
+            self._callbacks.append((callback, args, kwargs))
+            self._wakeup.notify()
+
+    def add_busy_check(self, check):
+        """Keep the loop running while `check()` returns true.
+
+        Use this when work started by the loop (e.g., on a worker thread)
+        will later call :meth:`add_callback`.
+
+        """
+        self._busy_checks.append(check)
+
+    def add_timeout(self, deadline, callback, *args, **kwargs):
+        """Call `callback` at the POSIX time `deadline`.
+
+        :returns: an opaque handle that may be passed to
+            :meth:`remove_timeout`
+
+        """
+        timeout = [deadline, next(self._sequence), callback, args, kwargs]
+        heapq.heappush(self._timeouts, timeout)
+        return timeout
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Call `callback` after `delay` seconds."""
+        return self.add_timeout(self.time() + delay, callback, *args,
+                                **kwargs)
+
+    def remove_timeout(self, timeout):
+        """Cancel a pending timeout."""
+        timeout[2] = None
+
+    def start(self):
+        """Run the loop until :meth:`stop` is called or it runs out of work."""
+        self._running = True
+        while self._running:
+            if not self._run_once(block=True):
+                break
+        self._running = False
+
+    def stop(self):
+        """Stop the loop after the current callback returns."""
+        self._running = False
+
+    def run_until_idle(self):
+        """Run every callback and every timeout that is already due.
+
+        Also waits for callbacks from any busy check that returns true.
+
+        """
+        while self._run_once(block=False):
+            pass
+
+    def _busy(self):
+        return any(check() for check in self._busy_checks)
+
+    def _run_once(self, block):
+        """Run one batch of callbacks.
+
+        :returns: whether there may be more work to do
+        :rtype: `bool`
+
+        """
+        while self._timeouts and self._timeouts[0][2] is None:
+            heapq.heappop(self._timeouts)
+
+        now = self.time()
+        while self._timeouts and self._timeouts[0][0] <= now:
+            _, _, callback, args, kwargs = heapq.heappop(self._timeouts)
+            if callback is not None:
+                self.add_callback(callback, *args, **kwargs)
+
+        with self._wakeup:
+            if not self._callbacks:
+                delay = None
+                if self._timeouts and block:
+                    delay = max(0, self._timeouts[0][0] - now)
+                if self._busy():
+                    delay = min(delay if delay is not None else
+                                self._BUSY_WAIT, self._BUSY_WAIT)
+                if delay is None:
+                    return False
+                self._wakeup.wait(delay)
+                return True
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+        return True
+
+
+class _Envelope(object):
+    """A message held in a fake queue."""
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body',
+                 'redelivered', 'expires_at')
+
+    def __init__(self, exchange, routing_key, properties, body,
+                 expires_at=None):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+        self.expires_at = expires_at
+
+
+class _Exchange(object):
+    """A fake AMQP exchange."""
+
+    def __init__(self, name, exchange_type='direct', durable=False,
+                 auto_delete=False, internal=False, arguments=None):
+        self.name = name
+        self.type = exchange_type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.internal = internal
+        self.arguments = arguments or {}
+        self.bindings = []
+        self._route_cache = {}
+
+    def bind(self, queue, routing_key, arguments=None):
+        binding = (queue, routing_key or '', arguments or {})
+        if binding not in self.bindings:
+            self.bindings.append(binding)
+            self._route_cache.clear()
+
+    def unbind(self, queue, routing_key=None, arguments=None):
+        self.bindings = [binding for binding in self.bindings
+                         if binding[0] != queue or
+                         (routing_key is not None and
+                          binding[1:] != (routing_key, arguments or {}))]
+        self._route_cache.clear()
+
+    def route(self, routing_key, headers):
+        """Return the names of the queues matching the given message."""
+        if self.type == 'headers':
+            return self._route_headers(headers or {})
+        if routing_key not in self._route_cache:
+            self._route_cache[routing_key] = self._route_key(routing_key)
+        return self._route_cache[routing_key]
+
+    def _route_key(self, routing_key):
+        queues = []
+        for queue, key, _ in self.bindings:
+            if self.type == 'fanout':
+                matched = True
+            elif self.type == 'topic':
+                matched = topic_matches(key, routing_key)
+            else:
+                matched = key == routing_key
+            if matched and queue not in queues:
+                queues.append(queue)
+        return queues
+
+    def _route_headers(self, headers):
+        queues = []
+        for queue, _, arguments in self.bindings:
+            match_any = arguments.get('x-match', 'all') == 'any'
+            pairs = [(key, value) for key, value in arguments.items()
+                     if not key.startswith('x-')]
+            results = [key in headers and headers[key] == value
+                       for key, value in pairs]
+            matched = any(results) if match_any else all(results)
+            if matched and queue not in queues:
+                queues.append(queue)
+        return queues
+
+
+class _Consumer(object):
+    """A subscription to a fake queue by a channel."""
+    __slots__ = ('channel', 'tag', 'queue', 'callback', 'no_ack')
+
+    def __init__(self, channel, tag, queue, callback, no_ack):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+
+
+class _Queue(object):
+    """A fake AMQP queue."""
+
+    def __init__(self, server, name, durable=False, exclusive=False,
+                 auto_delete=False, arguments=None):
+        self.server = server
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = deque()
+        self._dispatch_scheduled = False
+
+    @property
+    def ttl(self):
+        """The queue's message TTL in seconds (or None)."""
+        ttl = self.arguments.get('x-message-ttl')
+        return None if ttl is None else int(ttl) / 1000.0
+
+    def enqueue(self, envelope):
+        expires_at = self._expiry(envelope)
+        envelope.expires_at = expires_at
+        self.messages.append(envelope)
+        if expires_at is not None:
+            self.server.ioloop.add_timeout(expires_at, self.schedule_dispatch)
+        self.schedule_dispatch()
+
+    def requeue(self, envelope):
+        envelope.redelivered = True
+        self.messages.appendleft(envelope)
+        self.schedule_dispatch()
+
+    def _expiry(self, envelope):
+        ttls = [self.ttl]
+        if envelope.properties.expiration is not None:
+            ttls.append(int(envelope.properties.expiration) / 1000.0)
+        ttls = [ttl for ttl in ttls if ttl is not None]
+        if not ttls:
+            return None
+        return self.server.ioloop.time() + min(ttls)
+
+    def schedule_dispatch(self):
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            self.server.ioloop.add_callback(self.dispatch)
+
+    def pop(self):
+        """Remove and return the next unexpired message (or None)."""
+        self.expire()
+        return self.messages.popleft() if self.messages else None
+
+    def expire(self):
+        """Dead-letter expired messages from the head of the queue."""
+        now = self.server.ioloop.time()
+        while self.messages and self.messages[0].expires_at is not None \
+                and self.messages[0].expires_at <= now:
+            self.dead_letter(self.messages.popleft(), 'expired')
+
+    def dispatch(self):
+        """Deliver queued messages to consumers with spare capacity."""
+        self._dispatch_scheduled = False
+        self.expire()
+        while self.messages:
+            consumer = self._next_consumer()
+            if consumer is None:
+                break
+            envelope = self.pop()
+            if envelope is None:
+                break
+            consumer.channel._deliver(consumer, envelope)
+
+    def _next_consumer(self):
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[0]
+            self.consumers.rotate(-1)
+            if consumer.channel._can_deliver(consumer):
+                return consumer
+        return None
+
+    def dead_letter(self, envelope, reason):
+        exchange = self.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            log.debug('Discarding %s message from queue %s', reason,
+                      self.name)
+            return
+        routing_key = self.arguments.get('x-dead-letter-routing-key',
+                                         envelope.routing_key)
+        properties = _copy_properties(envelope.properties)
+        properties.expiration = None
+        properties.headers = properties.headers or {}
+        deaths = list(properties.headers.get('x-death') or [])
+        for death in deaths:
+            if death.get('queue') == self.name and \
+                    death.get('reason') == reason:
+                death['count'] = death.get('count', 1) + 1
+                deaths.remove(death)
+                deaths.insert(0, death)
+                break
+        else:
+            deaths.insert(0, {
+                'count': 1,
+                'reason': reason,
+                'queue': self.name,
+                'time': int(self.server.ioloop.time()),
+                'exchange': envelope.exchange,
+                'routing-keys': [envelope.routing_key],
+            })
+        properties.headers['x-death'] = deaths
+        try:
+            self.server.publish(exchange, routing_key, properties,
+                                envelope.body)
+        except _ServerError as exc:
+            log.warning('Cannot dead-letter message from queue %s: %s',
+                        self.name, exc.reply_text)
+
+
+def _copy_properties(properties):
+    """Return a copy of the given BasicProperties."""
+    properties = copy.copy(properties or BasicProperties())
+    properties.headers = copy.deepcopy(properties.headers)
+    return properties
+
+
+class FakeServer(object):
+    """The in-memory state of a fake RabbitMQ broker."""
+
+    DEFAULT_EXCHANGES = (
+        ('', 'direct'),
+        ('amq.direct', 'direct'),
+        ('amq.fanout', 'fanout'),
+        ('amq.headers', 'headers'),
+        ('amq.match', 'headers'),
+        ('amq.topic', 'topic'),
+    )
+
+    def __init__(self, ioloop=None):
+        self.ioloop = ioloop or FakeIOLoop()
+        self.exchanges = {}
+        self.queues = {}
+        self._names = itertools.count(1)
+        for name, exchange_type in self.DEFAULT_EXCHANGES:
+            self.exchanges[name] = _Exchange(name, exchange_type, durable=True)
+
+    def declare_exchange(self, name, exchange_type='direct', passive=False,
+                         **kwargs):
+        exchange = self.exchanges.get(name)
+        if passive:
+            if exchange is None:
+                raise _ServerError(NOT_FOUND, "NOT_FOUND - no exchange '%s'"
+                                   % name)
+            return exchange
+        if exchange is None:
+            exchange = self.exchanges[name] = \
+                _Exchange(name, exchange_type, **kwargs)
+        elif exchange.type != exchange_type:
+            raise _ServerError(
+                PRECONDITION_FAILED, "PRECONDITION_FAILED - inequivalent arg "
+                "'type' for exchange '%s'" % name)
+        return exchange
+
+    def delete_exchange(self, name):
+        self._get_exchange(name)
+        del self.exchanges[name]
+
+    def declare_queue(self, name='', passive=False, **kwargs):
+        if not name and not passive:
+            name = 'amq.gen-%d' % next(self._names)
+        queue = self.queues.get(name)
+        if passive:
+            if queue is None:
+                raise _ServerError(NOT_FOUND, "NOT_FOUND - no queue '%s'"
+                                   % name)
+            return queue
+        if queue is None:
+            queue = self.queues[name] = _Queue(self, name, **kwargs)
+            self.exchanges[''].bind(name, name)
+        return queue
+
+    def delete_queue(self, name):
+        queue = self._get_queue(name)
+        del self.queues[name]
+        for exchange in self.exchanges.values():
+            exchange.unbind(name)
+        for consumer in list(queue.consumers):
+            consumer.channel._cancel_by_server(consumer.tag)
+        return len(queue.messages)
+
+    def bind_queue(self, queue, exchange, routing_key=None, arguments=None):
+        self._get_queue(queue)
+        self._get_exchange(exchange).bind(queue, routing_key, arguments)
+
+    def unbind_queue(self, queue, exchange, routing_key=None, arguments=None):
+        self._get_queue(queue)
+        self._get_exchange(exchange).unbind(queue, routing_key or '',
+                                            arguments)
+
+    def publish(self, exchange, routing_key, properties, body):
+        """Route a message to its queues.
+
+        :returns: the number of queues the message was routed to
+        :rtype: `int`
+
+        """
+        queues = self._get_exchange(exchange).route(
+            routing_key, properties.headers if properties else None)
+        for name in queues:
+            envelope = _Envelope(exchange, routing_key,
+                                 _copy_properties(properties), body)
+            self.queues[name].enqueue(envelope)
+        return len(queues)
+
+    def _get_exchange(self, name):
+        try:
+            return self.exchanges[name]
+        except KeyError:
+            raise _ServerError(NOT_FOUND, "NOT_FOUND - no exchange '%s'"
+                               % name)
+
+    def _get_queue(self, name):
+        try:
+            return self.queues[name]
+        except KeyError:
+            raise _ServerError(NOT_FOUND, "NOT_FOUND - no queue '%s'" % name)
+
+
+class FakeBroker(Broker):
+    """A :class:`~pikachewie.broker.Broker` backed by a :class:`FakeServer`.
+
+    :param server: the fake server to connect to (default: a new one)
+    :type server: :class:`FakeServer`
+
+    """
+
+    def __init__(self, nodes=None, connect_options=None, server=None):
+        super(FakeBroker, self).__init__(nodes, connect_options)
+        self.server = server or FakeServer()
+
+    def _open_connection(self, parameters, on_open_callback,
+                         stop_ioloop_on_close, blocking):
+        if blocking:
+            return FakeBlockingConnection(self.server, parameters)
+        return FakeConnection(self.server, parameters, on_open_callback,
+                              stop_ioloop_on_close)
+
+
+class FakeConnection(object):
+    """An asynchronous connection to a :class:`FakeServer`.
+
+    Mimics :class:`pika.adapters.tornado_connection.TornadoConnection`.
+
+    """
+
+    def __init__(self, server, parameters=None, on_open_callback=None,
+                 stop_ioloop_on_close=False):
+        self.server = server
+        self.params = parameters
+        self.ioloop = server.ioloop
+        self.is_open = True
+        self.is_closed = False
+        self._stop_ioloop_on_close = stop_ioloop_on_close
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self._on_close_callbacks = []
+        if on_open_callback:
+            self.ioloop.add_callback(on_open_callback, self)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            'open' if self.is_open else 'closed')
+
+    def add_timeout(self, deadline, callback):
+        """Call `callback` after `deadline` seconds."""
+        return self.ioloop.call_later(deadline, callback)
+
+    def remove_timeout(self, timeout_id):
+        self.ioloop.remove_timeout(timeout_id)
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def channel(self, on_open_callback=None, channel_number=None):
+        if not self.is_open:
+            raise ConnectionClosed(320, 'Connection is closed')
+        number = channel_number or next(self._channel_numbers)
+        channel = self._channels[number] = FakeChannel(self, number)
+        if on_open_callback:
+            self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self.is_open:
+            return
+        for channel in list(self._channels.values()):
+            channel._close(reply_code, reply_text)
+        self.is_open = False
+        self.is_closed = True
+        for callback in self._on_close_callbacks:
+            self.ioloop.add_callback(callback, self, reply_code, reply_text)
+        if self._stop_ioloop_on_close:
+            self.ioloop.add_callback(self.ioloop.stop)
+
+
+class FakeBlockingConnection(FakeConnection):
+    """A synchronous connection to a :class:`FakeServer`.
+
+    Mimics :class:`pika.BlockingConnection`.
+
+    """
+
+    def __init__(self, server, parameters=None):
+        super(FakeBlockingConnection, self).__init__(server, parameters)
+
+    def channel(self, channel_number=None):
+        if not self.is_open:
+            raise ConnectionClosed(320, 'Connection is closed')
+        number = channel_number or next(self._channel_numbers)
+        channel = self._channels[number] = FakeBlockingChannel(self, number)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        """Run the fake server's pending callbacks."""
+        if not self.is_open:
+            raise ConnectionClosed(320, 'Connection is closed')
+        self.ioloop.run_until_idle()
+
+    def sleep(self, duration):
+        self.process_data_events(duration)
+
+
+class _BaseFakeChannel(object):
+    """Channel semantics shared by the fake channel flavours."""
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.server = connection.server
+        self.is_open = True
+        self.is_closed = False
+        self.prefetch_count = 0
+        self._consumers = {}
+        self._consumer_tags = itertools.count(1)
+        self._unacked = {}
+        self._delivery_tags = itertools.count(1)
+        self._confirming = False
+        self._publish_tags = itertools.count(1)
+        self._reply_queue = None
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+        self._on_return_callbacks = []
+
+    def __repr__(self):
+        return '<%s number=%s %s>' % (self.__class__.__name__,
+                                      self.channel_number,
+                                      'open' if self.is_open else 'closed')
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def add_on_return_callback(self, callback):
+        self._on_return_callbacks.append(callback)
+
+    @property
+    def consumer_tags(self):
+        return list(self._consumers)
+
+    # server-side operations, raising _ServerError on protocol violations
+
+    def _exchange_declare(self, exchange, exchange_type='direct',
+                          passive=False, durable=False, auto_delete=False,
+                          internal=False, arguments=None, type=None):
+        self.server.declare_exchange(
+            exchange, type or exchange_type, passive=passive,
+            durable=durable, auto_delete=auto_delete, internal=internal,
+            arguments=arguments)
+        return spec.Exchange.DeclareOk()
+
+    def _queue_declare(self, queue='', passive=False, durable=False,
+                       exclusive=False, auto_delete=False, arguments=None):
+        if passive:
+            declared = self.server.declare_queue(queue, passive=True)
+        else:
+            declared = self.server.declare_queue(
+                queue, durable=durable, exclusive=exclusive,
+                auto_delete=auto_delete, arguments=arguments)
+        declared.expire()
+        return spec.Queue.DeclareOk(declared.name, len(declared.messages),
+                                    len(declared.consumers))
+
+    def _basic_publish(self, exchange, routing_key, body, properties=None,
+                       mandatory=False):
+        if properties is not None and properties.reply_to == DIRECT_REPLY_TO:
+            if self._reply_queue is None:
+                raise _ServerError(PRECONDITION_FAILED,
+                                   'PRECONDITION_FAILED - fast reply consumer '
+                                   'does not exist')
+            properties = _copy_properties(properties)
+            properties.reply_to = self._reply_queue
+        routed = self.server.publish(exchange, routing_key, properties, body)
+        if mandatory and not routed:
+            method = spec.Basic.Return(312, 'NO_ROUTE', exchange, routing_key)
+            for callback in self._on_return_callbacks:
+                self.server.ioloop.add_callback(callback, self, method,
+                                                properties, body)
+        return bool(routed) or not mandatory
+
+    def _basic_consume(self, consumer_callback, queue='', no_ack=False,
+                       exclusive=False, consumer_tag=None, arguments=None):
+        if queue == DIRECT_REPLY_TO:
+            queue = self._declare_reply_queue(no_ack)
+        declared = self.server._get_queue(queue)
+        if consumer_tag is None:
+            consumer_tag = 'ctag%d.%d' % (self.channel_number,
+                                          next(self._consumer_tags))
+        consumer = _Consumer(self, consumer_tag, declared, consumer_callback,
+                             no_ack)
+        self._consumers[consumer_tag] = consumer
+        declared.consumers.append(consumer)
+        declared.schedule_dispatch()
+        return consumer_tag
+
+    def _declare_reply_queue(self, no_ack):
+        """Declare the pseudo-queue behind this channel's direct reply-to."""
+        if not no_ack:
+            raise _ServerError(PRECONDITION_FAILED,
+                               'PRECONDITION_FAILED - reply consumer cannot '
+                               'acknowledge')
+        if self._reply_queue is None:
+            self._reply_queue = self.server.declare_queue(
+                '%s.%d.%d' % (DIRECT_REPLY_TO, id(self.connection),
+                              self.channel_number), exclusive=True).name
+        return self._reply_queue
+
+    def _basic_cancel(self, consumer_tag):
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None and consumer in consumer.queue.consumers:
+            consumer.queue.consumers.remove(consumer)
+        return spec.Basic.CancelOk(consumer_tag)
+
+    def _basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+        for consumer in self._consumers.values():
+            consumer.queue.schedule_dispatch()
+        return spec.Basic.QosOk()
+
+    def _basic_get(self, queue, no_ack=False):
+        declared = self.server._get_queue(queue)
+        envelope = declared.pop()
+        if envelope is None:
+            return None, None, None
+        delivery_tag = next(self._delivery_tags)
+        if not no_ack:
+            self._unacked[delivery_tag] = (envelope, declared, None)
+        method = spec.Basic.GetOk(delivery_tag, envelope.redelivered,
+                                  envelope.exchange, envelope.routing_key,
+                                  len(declared.messages))
+        return method, envelope.properties, envelope.body
+
+    def _settle(self, delivery_tag, multiple):
+        """Remove and return the unacked deliveries for `delivery_tag`."""
+        if multiple:
+            tags = sorted(tag for tag in self._unacked
+                          if not delivery_tag or tag <= delivery_tag)
+        elif delivery_tag in self._unacked:
+            tags = [delivery_tag]
+        else:
+            raise _ServerError(PRECONDITION_FAILED,
+                               'PRECONDITION_FAILED - unknown delivery tag %s'
+                               % delivery_tag)
+        settled = [self._unacked.pop(tag) for tag in tags]
+        for _, queue, _ in settled:
+            queue.schedule_dispatch()
+        return settled
+
+    def _basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple)
+
+    def _basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        for envelope, queue, _ in reversed(self._settle(delivery_tag,
+                                                        multiple)):
+            if requeue and queue.name in self.server.queues:
+                queue.requeue(envelope)
+            else:
+                queue.dead_letter(envelope, 'rejected')
+
+    def _queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self.server.bind_queue(queue, exchange, routing_key, arguments)
+        return spec.Queue.BindOk()
+
+    def _queue_unbind(self, queue, exchange, routing_key=None,
+                      arguments=None):
+        self.server.unbind_queue(queue, exchange, routing_key, arguments)
+        return spec.Queue.UnbindOk()
+
+    def _queue_purge(self, queue):
+        declared = self.server._get_queue(queue)
+        count = len(declared.messages)
+        declared.messages.clear()
+        return spec.Queue.PurgeOk(count)
+
+    def _queue_delete(self, queue):
+        return spec.Queue.DeleteOk(self.server.delete_queue(queue))
+
+    def _exchange_delete(self, exchange):
+        self.server.delete_exchange(exchange)
+        return spec.Exchange.DeleteOk()
+
+    # delivery
+
+    def _can_deliver(self, consumer):
+        if not self.is_open:
+            return False
+        if consumer.no_ack or not self.prefetch_count:
+            return True
+        return len(self._unacked) < self.prefetch_count
+
+    def _deliver(self, consumer, envelope):
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.no_ack:
+            self._unacked[delivery_tag] = (envelope, consumer.queue,
+                                           consumer.tag)
+        method = spec.Basic.Deliver(consumer.tag, delivery_tag,
+                                    envelope.redelivered, envelope.exchange,
+                                    envelope.routing_key)
+        self.server.ioloop.add_callback(self._invoke_consumer, consumer,
+                                        method, envelope)
+
+    def _invoke_consumer(self, consumer, method, envelope):
+        if not self.is_open:
+            return
+        if consumer.tag in self._consumers:
+            consumer.callback(self, method, envelope.properties,
+                              envelope.body)
+        elif not consumer.no_ack:
+            # like pika, requeue deliveries to a cancelled consumer
+            self._basic_nack(method.delivery_tag)
+
+    def _cancel_by_server(self, consumer_tag):
+        self._basic_cancel(consumer_tag)
+        method_frame = frame.Method(self.channel_number,
+                                    spec.Basic.Cancel(consumer_tag))
+        for callback in self._on_cancel_callbacks:
+            self.server.ioloop.add_callback(callback, method_frame)
+
+    def _close(self, reply_code=200, reply_text='Normal shutdown'):
+        """Close this channel, requeueing its unacknowledged deliveries."""
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.is_closed = True
+        for consumer_tag in list(self._consumers):
+            self._basic_cancel(consumer_tag)
+        for delivery_tag in sorted(self._unacked, reverse=True):
+            envelope, queue, _ = self._unacked.pop(delivery_tag)
+            if queue.name in self.server.queues:
+                queue.requeue(envelope)
+        if self._reply_queue in self.server.queues:
+            self.server.delete_queue(self._reply_queue)
+        self.connection._channels.pop(self.channel_number, None)
+        for callback in self._on_close_callbacks:
+            self.server.ioloop.add_callback(callback, self, reply_code,
+                                            reply_text)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self._close(reply_code, reply_text)
+
+
+class FakeChannel(_BaseFakeChannel):
+    """An asynchronous channel to a :class:`FakeServer`.
+
+    Mimics :class:`pika.channel.Channel`: RPC methods take a callback, which
+    is invoked with a :class:`pika.frame.Method` on the next iteration of the
+    IOLoop.  Protocol violations close the channel.
+
+    """
+
+    def _call(self, callback, operation, *args, **kwargs):
+        """Perform a server-side operation and schedule its callback."""
+        if not self.is_open:
+            raise ChannelClosed(504, 'Channel is closed')
+        try:
+            result = operation(*args, **kwargs)
+        except _ServerError as exc:
+            log.debug('Fake server closing %r: (%s) %s', self,
+                      exc.reply_code, exc.reply_text)
+            self._close(exc.reply_code, exc.reply_text)
+            return None
+        if callback and isinstance(result, amqp_object.Method):
+            self.server.ioloop.add_callback(
+                callback, frame.Method(self.channel_number, result))
+        return result
+
+    def exchange_declare(self, callback=None, exchange=None,
+                         exchange_type='direct', passive=False,
+                         durable=False, auto_delete=False, internal=False,
+                         nowait=False, arguments=None, type=None):
+        return self._call(callback, self._exchange_declare, exchange,
+                          exchange_type, passive, durable, auto_delete,
+                          internal, arguments, type)
+
+    def exchange_delete(self, callback=None, exchange=None, if_unused=False,
+                        nowait=False):
+        return self._call(callback, self._exchange_delete, exchange)
+
+    def queue_declare(self, callback, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, nowait=False,
+                      arguments=None):
+        return self._call(callback, self._queue_declare, queue, passive,
+                          durable, exclusive, auto_delete, arguments)
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None,
+                   nowait=False, arguments=None):
+        return self._call(callback, self._queue_bind, queue, exchange,
+                          routing_key, arguments)
+
+    def queue_unbind(self, callback=None, queue='', exchange=None,
+                     routing_key=None, arguments=None):
+        return self._call(callback, self._queue_unbind, queue, exchange,
+                          routing_key, arguments)
+
+    def queue_purge(self, callback=None, queue='', nowait=False):
+        return self._call(callback, self._queue_purge, queue)
+
+    def queue_delete(self, callback=None, queue='', if_unused=False,
+                     if_empty=False, nowait=False):
+        return self._call(callback, self._queue_delete, queue)
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        return self._call(callback, self._basic_qos, prefetch_count)
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        return self._call(None, self._basic_consume, consumer_callback,
+                          queue, no_ack, exclusive, consumer_tag, arguments)
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        return self._call(callback, self._basic_cancel, consumer_tag)
+
+    def basic_get(self, callback=None, queue='', no_ack=False):
+        result = self._call(None, self._basic_get, queue, no_ack)
+        if result and result[0] is not None:
+            self.server.ioloop.add_callback(callback, self, *result)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        return self._call(None, self._basic_ack, delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        return self._call(None, self._basic_nack, delivery_tag, multiple,
+                          requeue)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        return self._call(None, self._basic_nack, delivery_tag, False,
+                          requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        self._call(None, self._basic_publish, exchange, routing_key, body,
+                   properties, mandatory)
+        if self._confirming and self.is_open:
+            method = spec.Basic.Ack(next(self._publish_tags))
+            self.server.ioloop.add_callback(
+                self._on_confirm, frame.Method(self.channel_number, method))
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._confirming = True
+        self._on_confirm = callback or (lambda method_frame: None)
+
+
+class FakeBlockingChannel(_BaseFakeChannel):
+    """A synchronous channel to a :class:`FakeServer`.
+
+    Mimics :class:`pika.adapters.blocking_connection.BlockingChannel`: RPC
+    methods return their response frame, and protocol violations raise
+    :class:`pika.exceptions.ChannelClosed`.
+
+    """
+
+    def _call(self, operation, *args, **kwargs):
+        if not self.is_open:
+            raise ChannelClosed(504, 'Channel is closed')
+        try:
+            result = operation(*args, **kwargs)
+        except _ServerError as exc:
+            self._close(exc.reply_code, exc.reply_text)
+            raise ChannelClosed(exc.reply_code, exc.reply_text)
+        if isinstance(result, amqp_object.Method):
+            return frame.Method(self.channel_number, result)
+        return result
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None, type=None):
+        return self._call(self._exchange_declare, exchange, exchange_type,
+                          passive, durable, auto_delete, internal, arguments,
+                          type)
+
+    def exchange_delete(self, exchange=None, if_unused=False):
+        return self._call(self._exchange_delete, exchange)
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        return self._call(self._queue_declare, queue, passive, durable,
+                          exclusive, auto_delete, arguments)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        return self._call(self._queue_bind, queue, exchange, routing_key,
+                          arguments)
+
+    def queue_unbind(self, queue, exchange=None, routing_key=None,
+                     arguments=None):
+        return self._call(self._queue_unbind, queue, exchange, routing_key,
+                          arguments)
+
+    def queue_purge(self, queue=''):
+        return self._call(self._queue_purge, queue)
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False):
+        return self._call(self._queue_delete, queue)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        return self._call(self._basic_qos, prefetch_count)
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        return self._call(self._basic_consume, consumer_callback, queue,
+                          no_ack, exclusive, consumer_tag, arguments)
+
+    def basic_cancel(self, consumer_tag):
+        return self._call(self._basic_cancel, consumer_tag)
+
+    def basic_get(self, queue=None, no_ack=False):
+        return self._call(self._basic_get, queue, no_ack)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        return self._call(self._basic_ack, delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        return self._call(self._basic_nack, delivery_tag, multiple, requeue)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        return self._call(self._basic_nack, delivery_tag, False, requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        return self._call(self._basic_publish, exchange, routing_key, body,
+                          properties, mandatory)
+
+    def publish(self, exchange, routing_key, body, properties=None,
+                mandatory=False, immediate=False):
+        self.basic_publish(exchange, routing_key, body, properties, mandatory)
+
+    def confirm_delivery(self):
+        self._confirming = True
+
+    def process_data_events(self, time_limit=0):
+        self.connection.process_data_events(time_limit)
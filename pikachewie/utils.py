@@ -5,7 +5,7 @@ pikachewie.utils -- Utilities used internally by PikaChewie
 
 """
 
-__all__ = ['Missing', 'cached_property', 'delegate']
+__all__ = ['Missing', 'cached_property', 'delegate', 'percentile']
 
 # singleton representing an unspecified parameter value
 Missing = object()
@@ -99,3 +99,17 @@ def import_namespaced_class(namespaced_class):
 
     # Return the class handle
     return getattr(import_handle, class_name)
+
+
+def percentile(samples, fraction):
+    """Return the given `fraction` percentile of the sorted `samples`.
+
+    Uses the nearest-rank method, so the result is always one of `samples`.
+
+    :param list samples: sorted samples
+    :param float fraction: percentile as a fraction (e.g., 0.99 for p99)
+
+    """
+    if not samples:
+        return None
+    return samples[int(round(fraction * (len(samples) - 1)))]
@@ -0,0 +1,234 @@
+"""
+===========================================
+pikachewie.validation -- Payload validation
+===========================================
+
+A :class:`SchemaRegistry` validates each message's payload against a JSON
+Schema chosen by the message's ``type`` property or, failing that, by its
+routing key (matched against AMQP topic patterns)::
+
+    registry = SchemaRegistry()
+    registry.add(ORDER_SCHEMA, type='order')
+    registry.add(PRICE_SCHEMA, routing_key='prices.#', shape_only=True)
+
+    class OrderConsumer(Consumer):
+        schemas = registry
+
+Set as a consumer's ``schemas`` (or as
+:attr:`pikachewie.message.Message.validator`, for every message), the
+registry is applied by :attr:`~pikachewie.message.Message.payload` as it is
+decoded: a payload that does not match its schema raises a
+:class:`~pikachewie.exceptions.ValidationException`, a
+:class:`~pikachewie.exceptions.MessageException`, so the agent rejects the
+message without requeueing it.  Messages with no schema are not validated.
+
+Each schema is compiled into a validator once, when it is added (compiled
+validators are also shared between registries), and the validator chosen
+for each routing key is cached.  Full validation uses the `jsonschema`_
+package, which must be installed separately.  For hot queues, a schema may
+instead be checked for shape only: only its ``type``, ``required``,
+``properties``, and ``items`` keywords are applied, by plain Python checks
+compiled from the schema, and every other keyword is ignored.
+
+.. _jsonschema: https://pypi.org/project/jsonschema/
+
+"""
+import decimal
+
+import simplejson
+
+from pikachewie.exceptions import ValidationException
+from pikachewie.routing import TopicTrie
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+__all__ = ['SchemaRegistry', 'compile_schema']
+
+try:
+    _string_types = (basestring,)
+    _integer_types = (int, long)
+except NameError:  # Python 3
+    _string_types = (str,)
+    _integer_types = (int,)
+
+_TYPES = {
+    'array': (list,),
+    'boolean': (bool,),
+    'integer': _integer_types,
+    'null': (type(None),),
+    'number': _integer_types + (float, decimal.Decimal),
+    'object': (dict,),
+    'string': _string_types,
+}
+
+# compiled validators, by (canonical schema, shape_only)
+_compiled = {}
+
+
+def compile_schema(schema, shape_only=False):
+    """Return a validator for the JSON Schema `schema`.
+
+    The validator is a callable that takes a payload, and raises
+    :class:`~pikachewie.exceptions.ValidationException` if it does not
+    match.  Validators are cached, so compiling the same schema again is
+    cheap.
+
+    :param dict schema: the JSON Schema
+    :param bool shape_only: whether to check only the payload's shape
+    :raises: :class:`ImportError` if full validation is requested, but
+        `jsonschema` is not installed
+
+    """
+    key = (simplejson.dumps(schema, sort_keys=True), shape_only)
+    validator = _compiled.get(key)
+    if validator is None:
+        if shape_only:
+            validator = _compile_shape_validator(schema)
+        else:
+            validator = _compile_full_validator(schema)
+        _compiled[key] = validator
+    return validator
+
+
+def _compile_full_validator(schema):
+    if jsonschema is None:
+        raise ImportError('jsonschema is required to validate payloads '
+                          'against a full schema; install it, or validate '
+                          'their shape only')
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    compiled = cls(schema)
+    best_match = jsonschema.exceptions.best_match
+
+    def validate(payload):
+        if compiled.is_valid(payload):
+            return
+        error = best_match(compiled.iter_errors(payload))
+        path = ''.join('[%r]' % part for part in error.absolute_path)
+        raise ValidationException('$%s: %s' % (path, error.message))
+    return validate
+
+
+def _compile_shape_validator(schema):
+    check = _compile_shape(schema)
+
+    def validate(payload):
+        check(payload, '$')
+    return validate
+
+
+def _compile_shape(schema):
+    """Return a function checking a value, at a path, against `schema`."""
+    types = schema.get('type')
+    if types is None:
+        classes = None
+    else:
+        if not isinstance(types, list):
+            types = [types]
+        try:
+            classes = sum((_TYPES[name] for name in types), ())
+        except KeyError as exc:
+            raise ValueError('Unknown JSON Schema type: %s' % exc)
+        # bool is a subclass of int, but not a JSON number
+        allow_booleans = 'boolean' in types
+    required = tuple(schema.get('required', ()))
+    properties = [(name, _compile_shape(subschema))
+                  for name, subschema in
+                  sorted(schema.get('properties', {}).items())]
+    items = schema.get('items')
+    items = _compile_shape(items) if isinstance(items, dict) else None
+
+    def check(value, path):
+        if classes is not None and (
+                not isinstance(value, classes) or
+                (isinstance(value, bool) and not allow_booleans)):
+            raise ValidationException('%s: expected %s, not %s' % (
+                path, ' or '.join(types), type(value).__name__))
+        if isinstance(value, dict):
+            for name in required:
+                if name not in value:
+                    raise ValidationException(
+                        '%s: missing required property %r' % (path, name))
+            for name, check_property in properties:
+                if name in value:
+                    check_property(value[name], '%s[%r]' % (path, name))
+        elif items is not None and isinstance(value, list):
+            for index, item in enumerate(value):
+                items(item, '%s[%d]' % (path, index))
+    return check
+
+
+class SchemaRegistry(object):
+    """Chooses the schema to validate each message's payload against.
+
+    :param bool shape_only: whether schemas are checked for shape only, by
+        default
+
+    """
+    _CACHE_SIZE = 10000
+
+    def __init__(self, shape_only=False):
+        self.shape_only = shape_only
+        self._by_type = {}
+        self._by_routing_key = TopicTrie()
+        self._cache = {}
+
+    def add(self, schema, type=None, routing_key=None, shape_only=None):
+        """Validate messages of `type`, or with `routing_key`, by `schema`.
+
+        If several routing key patterns match a message, the schema added
+        first is used.  Schemas chosen by type take precedence.
+
+        :param dict schema: the JSON Schema
+        :param str type: the message type
+        :param str routing_key: an AMQP topic pattern
+        :param bool shape_only: whether to check the payload's shape only
+            (default: the registry's `shape_only`)
+
+        """
+        if (type is None) == (routing_key is None):
+            raise ValueError('Specify exactly one of type and routing_key')
+        if shape_only is None:
+            shape_only = self.shape_only
+        validator = compile_schema(schema, shape_only)
+        if type is not None:
+            self._by_type[type] = validator
+        else:
+            self._by_routing_key.add(routing_key, validator)
+            self._cache.clear()
+
+    def validator_for(self, message):
+        """Return the validator for `message`, or `None` if it has none.
+
+        :param message: the message to validate
+        :type message: :class:`pikachewie.message.Message`
+
+        """
+        if self._by_type:
+            validator = self._by_type.get(message.type)
+            if validator is not None:
+                return validator
+        routing_key = message.routing_key
+        try:
+            return self._cache[routing_key]
+        except KeyError:
+            pass
+        matches = self._by_routing_key.match(routing_key or '')
+        validator = matches[0] if matches else None
+        if len(self._cache) >= self._CACHE_SIZE:
+            self._cache.clear()
+        self._cache[routing_key] = validator
+        return validator
+
+    def validate(self, message, payload):
+        """Validate the `payload` of `message` against its schema, if any.
+
+        :raises: :class:`~pikachewie.exceptions.ValidationException`
+
+        """
+        validator = self.validator_for(message)
+        if validator is not None:
+            validator(payload)
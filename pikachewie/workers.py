@@ -0,0 +1,150 @@
+"""
+======================================================
+pikachewie.workers -- Worker threads for ConsumerAgent
+======================================================
+
+A :class:`WorkerPool` runs ``Consumer.process`` on a resizable set of worker
+threads, so that a :class:`~pikachewie.agent.ConsumerAgent` can process
+several prefetched messages at once.  pika connections are not thread-safe,
+so workers never touch the channel: each result is handed back to the
+agent's IOLoop (via its thread-safe ``add_callback``), where the agent
+acknowledges or rejects the message.
+
+Each worker thread processes messages with its own shallow copy of the
+agent's consumer, since :meth:`pikachewie.consumer.Consumer.process` stores
+the current message on the consumer.
+
+"""
+import copy
+import itertools
+import logging
+import threading
+import traceback
+from timeit import default_timer
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # Python 2
+    from Queue import Empty, Queue
+
+__all__ = ['WorkerPool']
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WorkerPool(object):
+    """A resizable pool of threads that process messages.
+
+    :param consumer: the consumer to copy for each worker thread
+    :type consumer: :class:`pikachewie.consumer.Consumer`
+    :param ioloop: the IOLoop to deliver results on
+    :param int size: the initial number of worker threads
+    :param queue: the queue of submitted messages (default: first in, first
+        out), e.g., a :class:`pikachewie.scheduling.DeliveryScheduler`
+    :type queue: :class:`Queue.Queue`
+    :param profiler: a profiler to tell which message each worker is
+        processing
+    :type profiler: :class:`pikachewie.profiling.AgentProfiler`
+
+    """
+
+    def __init__(self, consumer, ioloop, size=1, queue=None, profiler=None):
+        self.consumer = consumer
+        self.ioloop = ioloop
+        self.profiler = profiler
+        self.size = 0
+        self.pending = 0
+        self._queue = Queue() if queue is None else queue
+        self._threads = []
+        self._names = itertools.count(1)
+        self.resize(size)
+
+    @property
+    def busy(self):
+        """Whether any submitted messages have not yet been completed."""
+        return self.pending > 0
+
+    def submit(self, message, callback):
+        """Process `message` on a worker thread.
+
+        When processing finishes, ``callback(message, exc, seconds)`` is
+        called on the IOLoop, where `exc` is the exception raised by the
+        consumer (or `None`) and `seconds` is the processing time.
+
+        """
+        self.pending += 1
+        self._queue.put((message, callback))
+
+    def resize(self, size):
+        """Grow or shrink the pool to `size` worker threads.
+
+        Shrinking takes effect as workers finish their current messages
+        (with the default first-in, first-out queue, once the messages
+        already submitted have been taken).
+
+        """
+        size = max(0, int(size))
+        self._threads = [thread for thread in self._threads
+                         if thread.is_alive()]
+        if size > self.size:
+            for _ in range(size - self.size):
+                thread = threading.Thread(
+                    target=self._work,
+                    name='pikachewie-worker-%d' % next(self._names))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        else:
+            for _ in range(self.size - size):
+                self._queue.put(_STOP)
+        if size != self.size:
+            log.info('Resized worker pool from %d to %d', self.size, size)
+        self.size = size
+
+    def stop(self):
+        """Stop every worker once it has finished its current message.
+
+        Messages still waiting for a worker are discarded, unprocessed.
+
+        """
+        self.resize(0)
+        stops = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if item is _STOP:
+                stops += 1
+            else:
+                self.pending -= 1
+        for _ in range(stops):
+            self._queue.put(_STOP)
+
+    def _work(self):
+        consumer = copy.copy(self.consumer)
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            message, callback = item
+            exc = None
+            start = default_timer()
+            if self.profiler is not None:
+                self.profiler.begin(message)
+            try:
+                consumer.process(message)
+            except BaseException as caught:
+                exc = caught
+                log.debug('Worker caught %r:\n%s', exc,
+                          traceback.format_exc())
+            if self.profiler is not None:
+                self.profiler.end(message)
+            self.ioloop.add_callback(self._done, message, callback, exc,
+                                     default_timer() - start)
+
+    def _done(self, message, callback, exc, seconds):
+        self.pending -= 1
+        callback(message, exc, seconds)
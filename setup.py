@@ -23,7 +23,7 @@ setup(
         messaging tools with bandoliers included.''',
     author='Bryan Deeney',
     author_email='rennybot@pobox.com',
-    packages=find_packages(exclude=['tests.*', 'tests']),
+    packages=find_packages(exclude=['tests.*', 'tests', 'benchmarks']),
     url=url,
     download_url='{url}/tarball/{version}'.format(url=url, version=version),
     license='BSD',
@@ -35,6 +35,16 @@ setup(
         'simplejson',
         'tornado',
     ],
+    extras_require={
+        'columnar': ['numpy'],
+        'validation': ['jsonschema'],
+    },
+    entry_points={
+        'console_scripts': [
+            'pikachewie-bench = pikachewie.bench:main',
+            'pikachewie-replay = pikachewie.capture:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -7,6 +7,7 @@ from pikachewie.broker import Broker
 from tests import _BaseTestCase
 
 mod = 'pikachewie.broker'
+tornado_mod = 'pika.adapters.tornado_connection'
 
 
 class _BrokerTestCase(_BaseTestCase):
@@ -14,7 +15,7 @@ class _BrokerTestCase(_BaseTestCase):
         ('_flush_outbound', patch(
             'pika.adapters.base_connection.BaseConnection._flush_outbound')),
         ('tornado_adapter_connect', patch(
-            mod + '.TornadoConnection._adapter_connect')),
+            tornado_mod + '.TornadoConnection._adapter_connect')),
         ('blocking_adapter_connect', patch(
             mod + '.BlockingConnection._adapter_connect')),
     )
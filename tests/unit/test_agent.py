@@ -1,8 +1,14 @@
-from mock import call, MagicMock, NonCallableMagicMock, patch, sentinel
+from threading import Event
+
+from mock import (ANY, call, MagicMock, NonCallableMagicMock, patch,
+                  sentinel)
 from pika.exceptions import ChannelClosed, ConnectionClosed
+from pika.spec import Basic, BasicProperties
 
 from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
 from pikachewie.exceptions import ConsumerException, MessageException
+from pikachewie.testing import FakeBroker, FakeIOLoop, FakeServer
 from tests import _BaseTestCase
 
 mod = 'pikachewie.agent'
@@ -107,6 +113,38 @@ class DescribeOnConnectionOpen(_BaseTestCase):
         self.agent.open_channel.assert_called_once_with()
 
 
+class WhenConnectionOpensWithQueueMonitor(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, queue_poll_interval=10)
+        self.agent.add_on_connection_close_callback = MagicMock()
+        self.agent.open_channel = MagicMock()
+        self.agent.queue_monitor = MagicMock()
+
+    def execute(self):
+        self.agent.on_connection_open(sentinel.connection)
+
+    def should_start_queue_monitor(self):
+        self.agent.queue_monitor.start.assert_called_once_with(
+            sentinel.connection)
+
+
+class WhenReconnectingWithQueueMonitor(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, queue_poll_interval=10)
+        self.agent.connection = MagicMock()
+        self.agent.queue_monitor = MagicMock()
+
+    def execute(self):
+        self.agent.reconnect()
+
+    def should_stop_queue_monitor(self):
+        self.agent.queue_monitor.stop.assert_called_once_with()
+
+
 class DescribeAddOnConnectionCloseCallback(_BaseTestCase):
 
     def configure(self):
@@ -184,6 +222,22 @@ class DescribeOnChannelOpen(_BaseTestCase):
         self.agent.create_bindings.assert_called_once_with()
 
 
+class WhenChannelOpensWithPrefetchCount(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, prefetch_count=10)
+        self.agent.add_on_channel_close_callback = MagicMock()
+        self.agent.create_bindings = MagicMock()
+        self.channel = MagicMock()
+
+    def execute(self):
+        self.agent.on_channel_open(self.channel)
+
+    def should_set_prefetch_count(self):
+        self.channel.basic_qos.assert_called_once_with(prefetch_count=10)
+
+
 class DescribeAddOnChannelCloseCallback(_BaseTestCase):
 
     def configure(self):
@@ -461,7 +515,8 @@ class DescribeProcess(_BaseTestCase):
 
     def configure(self):
         self.consumer = MagicMock()
-        self.ctx.Message.return_value = self.message = NonCallableMagicMock()
+        self.ctx.Message.return_value = self.message = \
+            NonCallableMagicMock(outputs=[])
         self.agent = ConsumerAgent(self.consumer, sentinel.broker,
                                    sentinel.bindings)
         self.agent.acknowledge = MagicMock()
@@ -482,6 +537,182 @@ class DescribeProcess(_BaseTestCase):
         self.agent.acknowledge.assert_called_once_with(self.message)
 
 
+class _BaseProcessExpiredMessageTestCase(_BaseTestCase):
+    __contexts__ = (
+        ('Message', patch(mod + '.Message')),
+    )
+    drop_expired = True
+    time_remaining = -1.0
+
+    def configure(self):
+        self.ctx.Message.return_value = self.message = \
+            NonCallableMagicMock(outputs=[])
+        self.message.time_remaining.return_value = self.time_remaining
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings,
+                                   drop_expired=self.drop_expired)
+        self.agent.acknowledge = MagicMock()
+        self.agent.reject = MagicMock()
+        self.agent._process = MagicMock()
+
+    def execute(self):
+        self.agent.process(sentinel.channel, sentinel.method, sentinel.header,
+                           sentinel.body)
+
+
+class WhenProcessingExpiredMessage(_BaseProcessExpiredMessageTestCase):
+
+    def should_not_call__process(self):
+        self.assertFalse(self.agent._process.called,
+                         'ConsumerAgent._process() was called')
+
+    def should_acknowledge_message(self):
+        self.agent.acknowledge.assert_called_once_with(self.message)
+
+    def should_count_expired_message(self):
+        self.assertEqual(self.agent.expired_count, 1)
+
+
+class WhenDeadLetteringExpiredMessage(_BaseProcessExpiredMessageTestCase):
+    drop_expired = 'reject'
+
+    def should_not_call__process(self):
+        self.assertFalse(self.agent._process.called,
+                         'ConsumerAgent._process() was called')
+
+    def should_reject_message(self):
+        self.agent.reject.assert_called_once_with(self.message.delivery_tag,
+                                                  requeue=False)
+
+    def should_not_acknowledge_message(self):
+        self.assertFalse(self.agent.acknowledge.called,
+                         'ConsumerAgent.acknowledge() was called')
+
+
+class WhenProcessingUnexpiredMessage(_BaseProcessExpiredMessageTestCase):
+    time_remaining = 1.0
+
+    def should_call__process(self):
+        self.agent._process.assert_called_once_with(self.message)
+
+    def should_not_count_expired_message(self):
+        self.assertEqual(self.agent.expired_count, 0)
+
+
+class WhenProcessingMessageWithoutExpiration(
+        _BaseProcessExpiredMessageTestCase):
+    time_remaining = None
+
+    def should_call__process(self):
+        self.agent._process.assert_called_once_with(self.message)
+
+
+class WhenCreatingAgentWithInvalidDropExpiredAction(_BaseTestCase):
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, ConsumerAgent, sentinel.consumer,
+                          sentinel.broker, sentinel.bindings,
+                          drop_expired='requeue')
+
+
+class WhenProcessingMessageWithHooks(_BaseTestCase):
+    __contexts__ = (
+        ('Message', patch(mod + '.Message')),
+    )
+
+    def configure(self):
+        self.hook = MagicMock()
+        self.consumer = MagicMock()
+        self.ctx.Message.return_value = self.message = \
+            NonCallableMagicMock(outputs=[])
+        self.agent = ConsumerAgent(self.consumer, sentinel.broker,
+                                   sentinel.bindings, hooks=[self.hook])
+        self.agent.channel = MagicMock()
+
+    def execute(self):
+        self.agent.process(sentinel.channel, sentinel.method, sentinel.header,
+                           sentinel.body)
+
+    def should_call_message_received(self):
+        self.hook.message_received.assert_called_once_with(self.agent,
+                                                           self.message)
+
+    def should_call_message_processed(self):
+        args = self.hook.message_processed.call_args[0]
+        self.assertEqual(args[:3], (self.agent, self.message, 'ok'))
+
+    def should_call_message_acknowledged(self):
+        args = self.hook.message_acknowledged.call_args[0]
+        self.assertEqual(args[:2], (self.agent, self.message))
+
+
+class WhenRejectingMessageWithHooks(_BaseTestCase):
+
+    def configure(self):
+        self.hook = MagicMock()
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, hooks=[self.hook])
+        self.agent.channel = MagicMock()
+
+    def execute(self):
+        self.agent.reject(sentinel.delivery_tag, requeue=False)
+
+    def should_call_message_rejected(self):
+        self.hook.message_rejected.assert_called_once_with(
+            self.agent, sentinel.delivery_tag, False)
+
+
+class WhenCreatingAgentWithMetricsPort(_BaseTestCase):
+
+    def execute(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, metrics_port=9100)
+
+    def should_add_metrics_hook(self):
+        self.assertEqual(self.agent.hooks, [self.agent.metrics])
+
+    def should_create_metrics_server(self):
+        self.assertEqual(self.agent._metrics_server.port, 9100)
+
+    def should_stop_metrics_server_when_released(self):
+        self.agent._metrics_server = MagicMock()
+        self.agent.release()
+        self.agent._metrics_server.stop.assert_called_once_with()
+
+
+class WhenCreatingAgentWithProfileDir(_BaseTestCase):
+
+    def execute(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, metrics_port=9100,
+                                   profile_dir=sentinel.profile_dir)
+
+    def should_not_add_profiler_hook(self):
+        self.assertNotIn(self.agent.profiler, self.agent.hooks)
+
+    def should_set_profile_dir(self):
+        self.assertIs(self.agent.profiler.output_dir, sentinel.profile_dir)
+
+    def should_add_profile_route(self):
+        self.assertEqual(self.agent._metrics_server.routes['/profile'],
+                         self.agent.profiler.handle_request)
+
+
+class DescribeQueueFor(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings)
+        self.agent._consumer_tags = {sentinel.queue: sentinel.consumer_tag}
+
+    def should_return_queue(self):
+        self.assertIs(self.agent.queue_for(sentinel.consumer_tag),
+                      sentinel.queue)
+
+    def should_return_none_for_unknown_tag(self):
+        self.assertIsNone(self.agent.queue_for(sentinel.other_tag))
+
+
 class WhenProcessingMessage(_BaseTestCase):
 
     def configure(self):
@@ -602,3 +833,596 @@ class DescribeRun(_BaseTestCase):
 
     def should_start_ioloop(self):
         self.agent.connection.ioloop.start.assert_called_once_with()
+
+
+class WhenSettingPrefetchCount(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings)
+        self.agent.channel = MagicMock()
+
+    def execute(self):
+        self.agent.set_prefetch_count(8)
+
+    def should_record_prefetch_count(self):
+        self.assertEqual(self.agent.prefetch_count, 8)
+
+    def should_send_basic_qos(self):
+        self.agent.channel.basic_qos.assert_called_once_with(prefetch_count=8)
+
+
+class WhenSettingConcurrency(_BaseTestCase):
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, concurrency=2)
+        self.agent.workers = MagicMock()
+
+    def execute(self):
+        self.agent.set_concurrency(4)
+
+    def should_record_concurrency(self):
+        self.assertEqual(self.agent.concurrency, 4)
+
+    def should_resize_workers(self):
+        self.agent.workers.resize.assert_called_once_with(4)
+
+
+class ConcurrentRecordingConsumer(Consumer):
+
+    def __init__(self):
+        self.messages = []
+
+    def process_message(self):
+        if self.message.body == b'requeue':
+            raise ConsumerException()
+        self.messages.append(self.message.body)
+
+
+class WhenProcessingConcurrently(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.consumer = ConcurrentRecordingConsumer()
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            concurrency=3, prefetch_count=6)
+        self.ioloop = self.broker.server.ioloop
+        self.ioloop.add_busy_check(
+            lambda: self.agent.workers is not None and self.agent.workers.busy)
+        self.agent.connect()
+        self.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for index in range(10):
+            channel.basic_publish('x', 'k', str(index))
+
+    def execute(self):
+        self.ioloop.run_until_idle()
+
+    def tearDown(self):
+        self.agent.workers.stop()
+
+    def should_use_worker_pool(self):
+        self.assertEqual(self.agent.workers.size, 3)
+
+    def should_process_every_message(self):
+        self.assertEqual(len(self.consumer.messages), 10)
+
+    def should_acknowledge_every_message(self):
+        self.assertEqual(len(self.broker.server.queues['q'].messages), 0)
+        self.assertEqual(self.agent.channel._unacked, {})
+
+
+class _BaseWorkerDoneTestCase(_BaseTestCase):
+    exc = None
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, concurrency=2)
+        self.agent.channel = MagicMock()
+        self.agent.acknowledge = MagicMock()
+        self.agent.reject = MagicMock()
+        self.agent._record_exception = MagicMock()
+        self.message = NonCallableMagicMock(channel=self.agent.channel,
+                                            outputs=[])
+
+    def execute(self):
+        self.agent._on_worker_done(self.message, self.exc, 0.1)
+
+
+class WhenWorkerSucceeds(_BaseWorkerDoneTestCase):
+
+    def should_acknowledge_message(self):
+        self.agent.acknowledge.assert_called_once_with(self.message)
+
+
+class WhenWorkerRaisesMessageException(_BaseWorkerDoneTestCase):
+    exc = MessageException()
+
+    def should_reject_message(self):
+        self.agent.reject.assert_called_once_with(self.message.delivery_tag,
+                                                  requeue=False)
+
+    def should_not_acknowledge_message(self):
+        self.assertFalse(self.agent.acknowledge.called)
+
+
+class WhenWorkerFinishesAfterChannelClosed(_BaseWorkerDoneTestCase):
+
+    def configure(self):
+        super(WhenWorkerFinishesAfterChannelClosed, self).configure()
+        self.message.channel = MagicMock()
+
+    def should_not_acknowledge_message(self):
+        self.assertFalse(self.agent.acknowledge.called)
+
+
+class WhenWorkerRaisesUnexpectedException(_BaseWorkerDoneTestCase):
+
+    def execute(self):
+        self.assertRaises(ValueError, self.agent._on_worker_done,
+                          self.message, ValueError(), 0.1)
+
+    def should_not_acknowledge_message(self):
+        self.assertFalse(self.agent.acknowledge.called)
+
+
+class WhenCreatingAgentWithAutoscale(_BaseTestCase):
+
+    def execute(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   [{'queue': 'q'}],
+                                   autoscale={'min_workers': 2,
+                                              'max_workers': 4})
+
+    def should_add_autoscaler_hook(self):
+        self.assertIn(self.agent.autoscaler, self.agent.hooks)
+
+    def should_poll_queues(self):
+        self.assertEqual(self.agent.queue_monitor.interval, 5)
+
+    def should_start_at_min_workers(self):
+        self.assertEqual(self.agent.concurrency, 2)
+
+    def should_set_matching_prefetch_count(self):
+        self.assertEqual(self.agent.prefetch_count, 4)
+
+
+class WhenReceivingMessageWhileDraining(_BaseTestCase):
+    __contexts__ = (
+        ('Message', patch(mod + '.Message')),
+    )
+
+    def configure(self):
+        self.ctx.Message.return_value = self.message = \
+            NonCallableMagicMock(outputs=[])
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings)
+        self.agent.reject = MagicMock()
+        self.agent._process = MagicMock()
+        self.agent.draining = True
+
+    def execute(self):
+        self.agent.process(sentinel.channel, sentinel.method, sentinel.header,
+                           sentinel.body)
+
+    def should_not_call__process(self):
+        self.assertFalse(self.agent._process.called)
+
+    def should_requeue_message(self):
+        self.agent.reject.assert_called_once_with(self.message.delivery_tag)
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class BlockingConsumer(Consumer):
+
+    def __init__(self, release):
+        self.release = release
+        self.messages = []
+
+    def process_message(self):
+        self.release.wait()
+        self.messages.append(self.message.body)
+
+
+class _BaseDrainTestCase(_BaseTestCase):
+    timeout = 10
+
+    def configure(self):
+        self.clock = Clock()
+        self.release = Event()
+        self.broker = FakeBroker(server=FakeServer(FakeIOLoop(self.clock)))
+        self.ioloop = self.broker.server.ioloop
+        self.consumer = BlockingConsumer(self.release)
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            concurrency=2, prefetch_count=4)
+        self.agent.connect()
+        self.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for index in range(6):
+            channel.basic_publish('x', 'k', str(index))
+        self.ioloop.run_until_idle()
+        self.connection = self.agent.connection
+        self.agent.drain(self.timeout)
+        self.ioloop.run_until_idle()
+
+    def tearDown(self):
+        self.release.set()
+        self.agent.workers.stop()
+
+    def finish_work(self):
+        self.release.set()
+        self.ioloop.add_busy_check(lambda: self.agent.workers.busy)
+        self.ioloop.run_until_idle()
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.ioloop.run_until_idle()
+
+    def queued(self):
+        return len(self.broker.server.queues['q'].messages)
+
+
+class WhenDraining(_BaseDrainTestCase):
+
+    def should_cancel_consumer(self):
+        self.assertEqual(len(self.broker.server.queues['q'].consumers), 0)
+
+    def should_keep_connection_open_while_in_flight(self):
+        self.assertTrue(self.connection.is_open)
+
+    def should_not_requeue_in_flight_messages(self):
+        self.assertEqual(self.queued(), 2)
+
+
+class WhenDrainingCompletes(_BaseDrainTestCase):
+
+    def execute(self):
+        self.finish_work()
+        self.advance(ConsumerAgent._DRAIN_POLL_INTERVAL)
+
+    def should_process_in_flight_messages(self):
+        self.assertEqual(sorted(self.consumer.messages),
+                         ['0', '1', '2', '3'])
+
+    def should_acknowledge_in_flight_messages(self):
+        self.assertEqual(self.queued(), 2)
+
+    def should_be_drained(self):
+        self.assertTrue(self.agent.drained)
+
+    def should_close_connection(self):
+        self.assertFalse(self.connection.is_open)
+
+
+class WhenDrainTimesOut(_BaseDrainTestCase):
+    timeout = 1
+
+    def execute(self):
+        self.advance(self.timeout)
+
+    def should_requeue_in_flight_messages(self):
+        self.assertEqual(self.queued(), 6)
+
+    def should_close_connection(self):
+        self.assertFalse(self.connection.is_open)
+
+    def should_discard_late_results(self):
+        self.finish_work()
+        self.assertEqual(self.queued(), 6)
+
+
+class WhenCreatingAgentWithInvalidPauseMethod(_BaseTestCase):
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, ConsumerAgent, sentinel.consumer,
+                          sentinel.broker, sentinel.bindings,
+                          pause_method='stop')
+
+
+class WhenCreatingAgentWithBackpressure(_BaseTestCase):
+
+    def execute(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings,
+                                   backpressure={'max_bytes': 1024})
+
+    def should_create_flow_controller(self):
+        self.assertEqual(self.agent.flow.max_bytes, 1024)
+
+    def should_add_flow_controller_hook(self):
+        self.assertIn(self.agent.flow, self.agent.hooks)
+
+
+class _BasePauseTestCase(_BaseTestCase):
+    pause_method = 'cancel'
+    no_ack = False
+
+    def configure(self):
+        self.agent = ConsumerAgent(sentinel.consumer, sentinel.broker,
+                                   sentinel.bindings, no_ack=self.no_ack,
+                                   prefetch_count=10,
+                                   pause_method=self.pause_method)
+        self.agent.connection = MagicMock()
+        self.agent.channel = MagicMock()
+        self.agent.channel.basic_consume.return_value = sentinel.new_tag
+        self.agent._consumer_tags = {'q': sentinel.consumer_tag}
+
+
+class WhenPausing(_BasePauseTestCase):
+
+    def execute(self):
+        self.agent.pause()
+
+    def should_be_paused(self):
+        self.assertTrue(self.agent.paused)
+
+    def should_cancel_consumers(self):
+        self.agent.channel.basic_cancel.assert_called_once_with(
+            self.agent._on_pause_cancel_ok,
+            consumer_tag=sentinel.consumer_tag)
+
+    def should_still_be_consuming_from_queue(self):
+        self.assertTrue(self.agent.is_consuming_from('q'))
+
+    def should_know_queue_of_cancelled_consumer(self):
+        self.assertEqual(self.agent.queue_for(sentinel.consumer_tag), 'q')
+
+    def should_defer_consuming_from_new_queues(self):
+        self.agent.start_consuming('r')
+        self.assertFalse(self.agent.channel.basic_consume.called)
+
+
+class WhenResuming(_BasePauseTestCase):
+
+    def execute(self):
+        self.agent.pause()
+        self.agent.start_consuming('r')
+        self.agent.resume()
+
+    def should_not_be_paused(self):
+        self.assertFalse(self.agent.paused)
+
+    def should_consume_from_paused_queues(self):
+        self.assertEqual(
+            self.agent.channel.basic_consume.call_args_list,
+            [call(consumer_callback=self.agent.process, queue=queue,
+                  no_ack=False) for queue in ('q', 'r')])
+
+    def should_record_new_consumer_tags(self):
+        self.assertEqual(self.agent._consumer_tags,
+                         {'q': sentinel.new_tag, 'r': sentinel.new_tag})
+
+
+class WhenPausingForSeveralReasons(_BasePauseTestCase):
+
+    def execute(self):
+        self.agent.pause('backpressure')
+        self.agent.pause()
+        self.agent.resume('backpressure')
+
+    def should_stay_paused(self):
+        self.assertTrue(self.agent.paused)
+
+    def should_cancel_consumers_once(self):
+        self.assertEqual(self.agent.channel.basic_cancel.call_count, 1)
+
+    def should_not_consume_again(self):
+        self.assertFalse(self.agent.channel.basic_consume.called)
+
+
+class WhenPausingForSomeSeconds(_BasePauseTestCase):
+
+    def execute(self):
+        self.agent.pause(seconds=30)
+
+    def should_add_timeout(self):
+        self.agent.connection.add_timeout.assert_called_once_with(
+            30, ANY)
+
+    def should_resume_on_timeout(self):
+        callback = self.agent.connection.add_timeout.call_args[0][1]
+        callback()
+        self.assertFalse(self.agent.paused)
+
+    def should_remove_timeout_when_resumed(self):
+        self.agent.resume()
+        self.agent.connection.remove_timeout.assert_called_once_with(
+            self.agent.connection.add_timeout.return_value)
+
+
+class WhenPausingByQos(_BasePauseTestCase):
+    pause_method = 'qos'
+
+    def execute(self):
+        self.agent.pause()
+
+    def should_lower_prefetch_count(self):
+        self.agent.channel.basic_qos.assert_called_once_with(
+            prefetch_count=1)
+
+    def should_keep_consumers(self):
+        self.assertFalse(self.agent.channel.basic_cancel.called)
+
+    def should_defer_prefetch_count_changes(self):
+        self.agent.set_prefetch_count(20)
+        self.assertEqual(self.agent.channel.basic_qos.call_count, 1)
+
+    def should_restore_prefetch_count_when_resumed(self):
+        self.agent.set_prefetch_count(20)
+        self.agent.resume()
+        self.agent.channel.basic_qos.assert_called_with(prefetch_count=20)
+
+
+class WhenPausingByQosWithoutAcks(_BasePauseTestCase):
+    pause_method = 'qos'
+    no_ack = True
+
+    def execute(self):
+        self.agent.pause()
+
+    def should_cancel_consumers(self):
+        self.assertFalse(self.agent.channel.basic_qos.called)
+        self.assertTrue(self.agent.channel.basic_cancel.called)
+
+
+class WhenMessageArrivesWhilePausedByQos(_BasePauseTestCase):
+    pause_method = 'qos'
+
+    def execute(self):
+        self.agent.pause()
+        self.agent._complete = MagicMock()
+        self.agent.consumer = MagicMock()
+        self.agent.process(self.agent.channel,
+                           Basic.Deliver(sentinel.consumer_tag, 1),
+                           BasicProperties(), b'body')
+
+    def should_cancel_consumers(self):
+        self.agent.channel.basic_cancel.assert_called_once_with(
+            self.agent._on_pause_cancel_ok,
+            consumer_tag=sentinel.consumer_tag)
+
+    def should_process_message(self):
+        self.assertTrue(self.agent.consumer.process.called)
+
+    def should_restore_prefetch_count_and_consume_when_resumed(self):
+        self.agent.resume()
+        self.agent.channel.basic_qos.assert_called_with(prefetch_count=10)
+        self.assertEqual(self.agent._consumer_tags, {'q': sentinel.new_tag})
+
+
+class _BaseCancelledTagTestCase(_BasePauseTestCase):
+
+    def configure(self):
+        super(_BaseCancelledTagTestCase, self).configure()
+        self.message = NonCallableMagicMock(consumer_tag=sentinel.consumer_tag,
+                                            delivery_tag=1)
+        self.cancel_ok = NonCallableMagicMock()
+        self.cancel_ok.method.consumer_tag = sentinel.consumer_tag
+
+
+class WhenPausedConsumerHasUnsettledMessages(_BaseCancelledTagTestCase):
+
+    def execute(self):
+        self.agent._hold(self.message)
+        self.agent.pause()
+        self.agent._on_pause_cancel_ok(self.cancel_ok)
+
+    def should_know_queue_until_settled(self):
+        self.assertEqual(self.agent.queue_for(sentinel.consumer_tag), 'q')
+
+    def should_forget_cancelled_consumer_when_acknowledged(self):
+        self.agent.acknowledge(self.message)
+        self.assertEqual(self.agent._cancelled_tags, {})
+        self.assertEqual(self.agent._unsettled_counts, {})
+
+    def should_forget_cancelled_consumer_when_rejected(self):
+        self.agent.reject(self.message.delivery_tag)
+        self.assertIsNone(self.agent.queue_for(sentinel.consumer_tag))
+
+
+class WhenPausedConsumerCancelIsConfirmed(_BaseCancelledTagTestCase):
+
+    def execute(self):
+        self.agent.pause()
+        self.agent._on_pause_cancel_ok(self.cancel_ok)
+
+    def should_forget_cancelled_consumer(self):
+        self.assertEqual(self.agent._cancelled_tags, {})
+        self.assertEqual(self.agent._cancels_confirmed, set())
+
+
+class WhenConsumerRequestsPause(_BasePauseTestCase):
+
+    def execute(self):
+        self.message = NonCallableMagicMock(flow_request=('pause', 5))
+        self.agent._processed(self.message, 'ok', None)
+
+    def should_pause_for_requested_seconds(self):
+        self.assertTrue(self.agent.paused)
+        self.agent.connection.add_timeout.assert_called_once_with(5, ANY)
+
+    def should_resume_when_requested(self):
+        self.message.flow_request = ('resume', None)
+        self.agent._processed(self.message, 'ok', None)
+        self.assertFalse(self.agent.paused)
+
+
+class _BaseBackpressureTestCase(_BaseDrainTestCase):
+    pause_method = 'cancel'
+
+    def configure(self):
+        self.clock = Clock()
+        self.release = Event()
+        self.broker = FakeBroker(server=FakeServer(FakeIOLoop(self.clock)))
+        self.ioloop = self.broker.server.ioloop
+        self.consumer = BlockingConsumer(self.release)
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            concurrency=2, prefetch_count=4,
+            backpressure={'max_bytes': 25}, pause_method=self.pause_method)
+        self.agent.connect()
+        self.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for index in range(6):
+            channel.basic_publish('x', 'k', 'message-%02d' % index)
+        self.ioloop.run_until_idle()
+
+
+class WhenHoldingTooManyBytes(_BaseBackpressureTestCase):
+
+    def should_pause(self):
+        self.assertTrue(self.agent.paused)
+
+    def should_cancel_consumer(self):
+        self.assertEqual(len(self.broker.server.queues['q'].consumers), 0)
+
+    def should_requeue_messages_in_transit(self):
+        self.assertEqual(self.queued(), 3)
+
+
+class WhenHoldingTooManyBytesPausedByQos(_BaseBackpressureTestCase):
+    pause_method = 'qos'
+
+    def should_pause(self):
+        self.assertTrue(self.agent.paused)
+
+    def should_cancel_consumer_once_throttle_lets_message_through(self):
+        self.assertEqual(len(self.broker.server.queues['q'].consumers), 0)
+
+    def should_process_every_message_once_released(self):
+        self.finish_work()
+        self.assertEqual(len(self.consumer.messages), 6)
+        self.assertEqual(self.queued(), 0)
+
+    def should_forget_cancelled_consumers_once_released(self):
+        self.finish_work()
+        self.assertEqual(self.agent._cancelled_tags, {})
+
+
+class WhenHeldBytesAreReleased(_BaseBackpressureTestCase):
+
+    def execute(self):
+        self.finish_work()
+
+    def should_resume(self):
+        self.assertFalse(self.agent.paused)
+
+    def should_process_every_message(self):
+        self.assertEqual(len(self.consumer.messages), 6)
+
+    def should_acknowledge_every_message(self):
+        self.assertEqual(self.queued(), 0)
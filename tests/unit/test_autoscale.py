@@ -0,0 +1,180 @@
+from mock import MagicMock, NonCallableMagicMock
+
+from pikachewie.autoscale import ConcurrencyController
+from pikachewie.metrics import AgentMetrics
+from pikachewie.monitor import QueueStats
+from tests import _BaseTestCase, unittest
+
+
+def stats(message_count=100, drain_seconds=60.0, oldest_message_age=None,
+          queue='q'):
+    return QueueStats(queue, message_count, 1, None, drain_seconds,
+                      oldest_message_age, 0.0)
+
+
+class FakeAgent(object):
+
+    def __init__(self, concurrency=1, metrics=None):
+        self.concurrency = concurrency
+        self.prefetch_count = None
+        self.metrics = metrics
+
+    def set_concurrency(self, concurrency):
+        self.concurrency = concurrency
+
+    def set_prefetch_count(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+
+class _BaseControllerTestCase(_BaseTestCase):
+    concurrency = 1
+    options = {}
+
+    def configure(self):
+        self.now = 0.0
+        self.agent = FakeAgent(self.concurrency, AgentMetrics())
+        options = dict(min_workers=1, max_workers=4, scale_up_after=2,
+                       scale_down_after=2, cooldown=15.0,
+                       time_func=lambda: self.now)
+        options.update(self.options)
+        self.controller = ConcurrencyController(self.agent, **options)
+        self.message = NonCallableMagicMock()
+
+    def poll(self, utilization, queue_stats=None, interval=10.0):
+        busy = utilization * self.agent.concurrency * interval
+        self.controller.message_processed(self.agent, self.message, 'ok',
+                                          busy)
+        self.now += interval
+        return self.controller.evaluate([queue_stats or stats()])
+
+
+class DescribeConcurrencyController(_BaseControllerTestCase):
+
+    def should_start_within_bounds(self):
+        self.assertEqual(self.agent.concurrency, 1)
+
+    def should_set_matching_prefetch_count(self):
+        self.assertEqual(self.agent.prefetch_count, 2)
+
+    def should_reject_invalid_bounds(self):
+        self.assertRaises(ValueError, ConcurrencyController, self.agent,
+                          min_workers=4, max_workers=2)
+
+    def should_reject_invalid_watermarks(self):
+        self.assertRaises(ValueError, ConcurrencyController, self.agent,
+                          low_utilization=0.9, high_utilization=0.5)
+
+
+class WhenSaturatedAndBehind(_BaseControllerTestCase):
+
+    def execute(self):
+        self.first = self.poll(1.0)
+        self.second = self.poll(1.0)
+
+    def should_wait_for_consecutive_signals(self):
+        self.assertIsNone(self.first)
+
+    def should_scale_up(self):
+        self.assertEqual((self.second.old_size, self.second.new_size), (1, 2))
+
+    def should_resize_agent(self):
+        self.assertEqual(self.agent.concurrency, 2)
+
+    def should_scale_prefetch_count(self):
+        self.assertEqual(self.agent.prefetch_count, 4)
+
+    def should_record_decision(self):
+        self.assertEqual(list(self.controller.decisions), [self.second])
+
+    def should_export_metrics(self):
+        text = self.agent.metrics.registry.render()
+        self.assertIn('pikachewie_workers 2', text)
+        self.assertIn('pikachewie_scaling_decisions_total{direction="up"} 1',
+                      text)
+
+
+class WhenInCooldown(_BaseControllerTestCase):
+
+    def execute(self):
+        self.poll(1.0)
+        self.poll(1.0)
+        self.poll(1.0)
+        self.decision = self.poll(1.0, interval=1.0)
+
+    def should_not_scale(self):
+        self.assertIsNone(self.decision)
+        self.assertEqual(self.agent.concurrency, 2)
+
+
+class WhenSaturatedButKeepingUp(_BaseControllerTestCase):
+
+    def execute(self):
+        for _ in range(3):
+            self.poll(1.0, stats(drain_seconds=5.0))
+
+    def should_not_scale(self):
+        self.assertEqual(self.agent.concurrency, 1)
+
+
+class WhenMessagesAreTooOld(_BaseControllerTestCase):
+    options = {'max_message_age': 60.0}
+
+    def execute(self):
+        for _ in range(2):
+            self.poll(1.0, stats(drain_seconds=5.0, oldest_message_age=120.0))
+
+    def should_scale_up(self):
+        self.assertEqual(self.agent.concurrency, 2)
+
+
+class WhenAtMaxWorkers(_BaseControllerTestCase):
+    options = {'min_workers': 4}
+
+    def execute(self):
+        for _ in range(3):
+            self.poll(1.0)
+
+    def should_not_exceed_max_workers(self):
+        self.assertEqual(self.agent.concurrency, 4)
+        self.assertFalse(self.controller.decisions)
+
+
+class WhenUnderutilized(_BaseControllerTestCase):
+    concurrency = 3
+    options = {'min_workers': 2}
+
+    def execute(self):
+        self.decisions = [self.poll(0.1, stats(0, 0.0)) for _ in range(6)]
+
+    def should_scale_down(self):
+        self.assertEqual(self.decisions[1].new_size, 2)
+
+    def should_not_go_below_min_workers(self):
+        self.assertEqual(self.agent.concurrency, 2)
+
+
+class WhenFlapping(_BaseControllerTestCase):
+
+    def execute(self):
+        for utilization in (1.0, 0.5, 1.0, 0.5, 1.0):
+            self.poll(utilization)
+
+    def should_not_scale(self):
+        self.assertEqual(self.agent.concurrency, 1)
+
+
+class WhenLastQueueIsPolled(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.agent.queue_monitor = MagicMock(queues=['a', 'b'])
+        self.agent.queue_monitor.stats = {'a': stats(queue='a'),
+                                          'b': stats(queue='b')}
+        self.controller = ConcurrencyController(self.agent)
+        self.controller.evaluate = MagicMock()
+
+    def should_evaluate_once_per_poll(self):
+        self.controller.on_queue_stats(self.agent, stats(queue='a'))
+        self.controller.on_queue_stats(self.agent, stats(queue='b'))
+        self.controller.evaluate.assert_called_once_with(
+            [stats(queue='a'), stats(queue='b')])
@@ -0,0 +1,33 @@
+from benchmarks.harness import compare
+from pikachewie.utils import percentile
+from tests import unittest
+
+
+class DescribePercentile(unittest.TestCase):
+    samples = list(range(1, 101))
+
+    def should_return_median(self):
+        self.assertEqual(percentile(self.samples, 0.5), 51)
+
+    def should_return_p99(self):
+        self.assertEqual(percentile(self.samples, 0.99), 99)
+
+    def should_return_none_without_samples(self):
+        self.assertIsNone(percentile([], 0.5))
+
+
+class DescribeCompare(unittest.TestCase):
+    baseline = {'benchmarks': {'a': {'ops_per_sec': 100.0},
+                               'b': {'ops_per_sec': 100.0},
+                               'c': {'ops_per_sec': 100.0}}}
+    results = {'benchmarks': {'a': {'ops_per_sec': 95.0},
+                              'b': {'ops_per_sec': 80.0}}}
+
+    def setUp(self):
+        self.comparison = compare(self.results, self.baseline, 0.10)
+
+    def should_skip_missing_benchmarks(self):
+        self.assertEqual([row[0] for row in self.comparison], ['a', 'b'])
+
+    def should_flag_regressions(self):
+        self.assertEqual([row[4] for row in self.comparison], [False, True])
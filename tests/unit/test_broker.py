@@ -450,3 +450,27 @@ class WhenAbortingConnectionAttemptWithCallback(_BaseTestCase):
 
     def should_invoke_on_failure_callback(self):
         self.on_failure_callback.assert_called_once_with(sentinel.exception)
+
+
+class WhenPinningBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker({'c': {'host': 'c'}, 'a': {'host': 'a'},
+                              'b': {'host': 'b'}})
+        self.pinned = [self.broker.pinned(index) for index in range(4)]
+
+    def should_prefer_nodes_in_turn(self):
+        self.assertEqual([broker._nodes[0][0] for broker in self.pinned],
+                         ['a', 'b', 'c', 'a'])
+
+    def should_fail_over_to_other_nodes(self):
+        self.assertEqual([name for name, _ in self.pinned[1]._nodes],
+                         ['b', 'c', 'a'])
+
+    def should_not_shuffle_nodes(self):
+        self.pinned[1]._initialize_connection_attempt(None)
+        self.assertEqual([name for name, _ in self.pinned[1]._nodes],
+                         ['b', 'c', 'a'])
+
+    def should_not_change_original(self):
+        self.assertFalse(self.broker._pinned)
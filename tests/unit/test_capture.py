@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from mock import patch
+from pika import spec
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.capture import (CaptureReader, CaptureWriter, MAGIC, main,
+                                replay, summarize)
+from pikachewie.consumer import Consumer
+from pikachewie.exceptions import MessageException
+from pikachewie.message import Message
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+
+class ReplayConsumer(Consumer):
+    """Records replayed messages; rejects those with a ``bad`` body."""
+
+    messages = []
+
+    def process_message(self):
+        self.messages.append(self.message)
+        if self.message.body == b'bad':
+            raise MessageException('bad message')
+
+
+def make_message(body=b'{"id": 1}', routing_key='orders.created',
+                 delivery_tag=1, headers=None):
+    method = spec.Basic.Deliver('ctag1.1', delivery_tag, False, 'orders',
+                                routing_key)
+    header = spec.BasicProperties(content_type='application/json',
+                                  message_id='abc', timestamp=1500000000,
+                                  headers=headers or {'x-retries': 2})
+    return Message(None, method, header, body)
+
+
+class _BaseCaptureTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with CaptureReader(self.path) as reader:
+            return list(reader)
+
+
+class WhenCapturingMessages(_BaseCaptureTestCase):
+
+    def execute(self):
+        self.writer = CaptureWriter(self.path)
+        for tag in range(1, 4):
+            self.writer.record(make_message(delivery_tag=tag))
+        self.writer.close()
+        self.deliveries = self.read()
+
+    def should_write_magic(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(len(MAGIC)), MAGIC)
+
+    def should_read_every_record(self):
+        self.assertEqual(len(self.deliveries), 3)
+        self.assertEqual(self.writer.captured, 3)
+
+    def should_preserve_method_fields(self):
+        method = self.deliveries[2].method
+        self.assertIsInstance(method, spec.Basic.Deliver)
+        self.assertEqual((method.consumer_tag, method.delivery_tag,
+                          method.exchange, method.routing_key),
+                         ('ctag1.1', 3, 'orders', 'orders.created'))
+
+    def should_preserve_properties_and_headers(self):
+        properties = self.deliveries[0].properties
+        self.assertEqual(properties.content_type, 'application/json')
+        self.assertEqual(properties.message_id, 'abc')
+        self.assertEqual(properties.headers, {'x-retries': 2})
+
+    def should_preserve_body(self):
+        self.assertEqual(self.deliveries[0].body, b'{"id": 1}')
+
+    def should_track_file_size(self):
+        self.assertEqual(self.writer.size, os.path.getsize(self.path))
+
+
+class WhenAppendingToCapture(_BaseCaptureTestCase):
+
+    def execute(self):
+        for _ in range(2):
+            writer = CaptureWriter(self.path)
+            writer.record(make_message())
+            writer.close()
+
+    def should_keep_earlier_records(self):
+        self.assertEqual(len(self.read()), 2)
+
+
+class WhenSamplingMessages(_BaseCaptureTestCase):
+
+    def execute(self):
+        samples = iter([0.05, 0.5, 0.09, 0.99])
+        self.writer = CaptureWriter(self.path, sample_rate=0.1,
+                                    random=lambda: next(samples))
+        for tag in range(1, 5):
+            self.writer.record(make_message(delivery_tag=tag))
+        self.writer.close()
+
+    def should_capture_sampled_messages(self):
+        self.assertEqual([d.method.delivery_tag for d in self.read()], [1, 3])
+
+    def should_count_skipped_messages(self):
+        self.assertEqual(self.writer.skipped, 2)
+
+
+class WhenCaptureIsFull(_BaseCaptureTestCase):
+
+    def execute(self):
+        self.writer = CaptureWriter(self.path, max_bytes=300)
+        for tag in range(1, 11):
+            self.writer.record(make_message(b'x' * 50, delivery_tag=tag))
+        self.writer.close()
+
+    def should_not_exceed_max_bytes(self):
+        self.assertLessEqual(os.path.getsize(self.path), 300)
+
+    def should_count_dropped_messages(self):
+        self.assertEqual(self.writer.captured + self.writer.dropped, 10)
+        self.assertTrue(self.writer.full)
+
+
+class WhenCapturingUnencodableHeaders(_BaseCaptureTestCase):
+
+    def execute(self):
+        self.writer = CaptureWriter(self.path)
+        self.result = self.writer.record(make_message(headers={'x': 1.5}))
+        self.writer.close()
+
+    def should_drop_message(self):
+        self.assertFalse(self.result)
+        self.assertEqual(self.writer.dropped, 1)
+
+
+class WhenReadingTruncatedCapture(_BaseCaptureTestCase):
+
+    def execute(self):
+        writer = CaptureWriter(self.path)
+        writer.record(make_message())
+        writer.record(make_message())
+        writer.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+
+    def should_ignore_truncated_record(self):
+        self.assertEqual(len(self.read()), 1)
+
+
+class WhenReadingOtherFile(_BaseCaptureTestCase):
+
+    def execute(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a capture file')
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, CaptureReader, self.path)
+
+
+class WhenReadingEmptyFile(_BaseCaptureTestCase):
+
+    def execute(self):
+        open(self.path, 'wb').close()
+
+    def should_raise_value_error(self):
+        with self.assertRaises(ValueError) as context:
+            CaptureReader(self.path)
+        self.assertIn('Not a PikaChewie capture file', str(context.exception))
+
+    def should_close_file(self):
+        with patch('pikachewie.capture.open', create=True) as mock_open:
+            mock_open.return_value.fileno.return_value = \
+                os.open(self.path, os.O_RDONLY)
+            self.addCleanup(os.close,
+                            mock_open.return_value.fileno.return_value)
+            self.assertRaises(ValueError, CaptureReader, self.path)
+        mock_open.return_value.close.assert_called_once_with()
+
+
+class WhenReplayingCapture(_BaseCaptureTestCase):
+
+    def execute(self):
+        writer = CaptureWriter(self.path)
+        for body in (b'{"id": 1}', b'bad', b'{"id": 2}'):
+            writer.record(make_message(body))
+        writer.close()
+        ReplayConsumer.messages = []
+        self.consumer = ReplayConsumer()
+        self.result = replay(self.consumer, self.path, repeat=2, slowest=2)
+
+    def should_replay_every_message(self):
+        self.assertEqual(self.result.messages, 6)
+        self.assertEqual(len(ReplayConsumer.messages), 6)
+
+    def should_decode_payloads(self):
+        self.assertEqual(ReplayConsumer.messages[2].payload, {'id': 2})
+
+    def should_count_errors(self):
+        self.assertEqual(self.result.errors, 2)
+
+    def should_report_slowest_messages(self):
+        self.assertEqual(len(self.result.slowest), 2)
+        seconds, index, routing_key = self.result.slowest[0]
+        self.assertIn(index, (0, 1, 2))
+        self.assertEqual(routing_key, 'orders.created')
+
+    def should_summarize(self):
+        summary = summarize(self.result)
+        self.assertEqual(summary['messages'], 6)
+        self.assertIsNotNone(summary['latency_p999_ms'])
+
+
+class WhenCapturingFromAgent(_BaseCaptureTestCase):
+
+    def execute(self):
+        broker = FakeBroker()
+        agent = ConsumerAgent(
+            Consumer(), broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            capture={'path': self.path})
+        agent.consumer.process_message = lambda: None
+        agent.connect()
+        broker.server.ioloop.run_until_idle()
+        channel = broker.connect(blocking=True).channel()
+        channel.basic_publish('x', 'k', b'captured',
+                              spec.BasicProperties(headers={'a': 'b'}))
+        broker.server.ioloop.run_until_idle()
+        agent.stop()
+
+    def should_capture_delivery(self):
+        deliveries = self.read()
+        self.assertEqual(len(deliveries), 1)
+        self.assertEqual(deliveries[0].body, b'captured')
+        self.assertEqual(deliveries[0].method.routing_key, 'k')
+        self.assertEqual(deliveries[0].properties.headers, {'a': 'b'})
+
+
+class WhenRunningReplayCommand(_BaseCaptureTestCase):
+    __contexts__ = (
+        ('stdout', patch.object(sys, 'stdout')),
+    )
+
+    def execute(self):
+        writer = CaptureWriter(self.path)
+        writer.record(make_message())
+        writer.close()
+        self.status = main([self.path, __name__ + '.ReplayConsumer',
+                            '--json'])
+        self.output = ''.join(call[0][0] for call in
+                              self.ctx.stdout.write.call_args_list)
+
+    def should_succeed(self):
+        self.assertEqual(self.status, 0)
+
+    def should_write_summary(self):
+        self.assertEqual(json.loads(self.output)['messages'], 1)
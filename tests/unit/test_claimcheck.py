@@ -0,0 +1,274 @@
+import bz2
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from mock import MagicMock
+from pika.spec import Basic, BasicProperties
+
+from pikachewie.claimcheck import (BlobCollector, CLAIM_CHECK_HEADER,
+                                   FileBlobStore)
+from pikachewie.exceptions import MessageException
+from pikachewie.message import Message
+from pikachewie.publisher import BlockingJSONPublisher, BlockingPublisher
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+BODY = b'x' * 4096
+KEY = hashlib.sha256(BODY).hexdigest()
+
+
+class _BaseBlobStoreTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FileBlobStore(os.path.join(self.directory, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, key, seconds):
+        path = self.store._path(key)
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+
+class WhenStoringBlob(_BaseBlobStoreTestCase):
+
+    def execute(self):
+        self.key = self.store.put(BODY)
+
+    def should_return_content_address(self):
+        self.assertEqual(self.key, KEY)
+
+    def should_store_body(self):
+        self.assertEqual(self.store.open(self.key)[:], BODY)
+
+    def should_list_key(self):
+        self.assertEqual(self.store.keys(), [KEY])
+
+    def should_store_same_body_once(self):
+        self.assertEqual(self.store.put(BODY), KEY)
+        self.assertEqual(self.store.keys(), [KEY])
+
+    def should_leave_no_temporary_files(self):
+        directory = os.path.dirname(self.store._path(KEY))
+        self.assertEqual(os.listdir(directory), [KEY[2:]])
+
+    def should_encode_text(self):
+        key = self.store.put(u'caf\xe9')
+        self.assertEqual(self.store.open(key)[:], u'caf\xe9'.encode('utf-8'))
+
+
+class WhenOpeningMissingBlob(_BaseBlobStoreTestCase):
+
+    def should_raise_key_error(self):
+        self.assertRaises(KeyError, self.store.open, KEY)
+
+    def should_reject_invalid_key(self):
+        self.assertRaises(KeyError, self.store.open, '../../etc/passwd')
+
+    def should_reject_non_string_key(self):
+        self.assertRaises(KeyError, self.store.open, 42)
+
+
+class WhenDeletingBlob(_BaseBlobStoreTestCase):
+
+    def execute(self):
+        self.store.put(BODY)
+        self.store.delete(KEY)
+
+    def should_delete_body(self):
+        self.assertRaises(KeyError, self.store.open, KEY)
+
+    def should_ignore_missing_body(self):
+        self.store.delete(KEY)
+
+
+class WhenCollectingBlobs(_BaseBlobStoreTestCase):
+
+    def execute(self):
+        self.old = self.store.put(b'old')
+        self.new = self.store.put(b'new')
+        self.reused = self.store.put(b'reused')
+        self.age(self.old, 120)
+        self.age(self.reused, 120)
+        self.store.put(b'reused')
+        self.collected = self.store.collect(60)
+
+    def should_delete_old_bodies(self):
+        self.assertRaises(KeyError, self.store.open, self.old)
+
+    def should_keep_new_bodies(self):
+        self.assertEqual(self.store.open(self.new)[:], b'new')
+
+    def should_keep_bodies_stored_again(self):
+        self.assertEqual(self.store.open(self.reused)[:], b'reused')
+
+    def should_return_number_collected(self):
+        self.assertEqual(self.collected, 1)
+
+
+class WhenRunningBlobCollector(_BaseTestCase):
+
+    def configure(self):
+        self.store = MagicMock()
+        self.collector = BlobCollector(self.store, max_age=60,
+                                       interval=0.01)
+
+    def execute(self):
+        self.collector.start()
+        deadline = time.time() + 5
+        while not self.store.collect.called and time.time() < deadline:
+            time.sleep(0.01)
+        self.collector.stop()
+
+    def should_collect_periodically(self):
+        self.store.collect.assert_called_with(60)
+
+    def should_stop(self):
+        self.assertIsNone(self.collector._thread)
+
+
+class _BaseClaimCheckedMessageTestCase(_BaseBlobStoreTestCase):
+    content_encoding = None
+
+    def configure(self):
+        super(_BaseClaimCheckedMessageTestCase, self).configure()
+        self.key = self.store.put(self.stored_body())
+        self.message = self.make_message(self.key)
+        self.message.blob_store = self.store
+
+    def stored_body(self):
+        return BODY
+
+    def make_message(self, key):
+        header = BasicProperties(content_encoding=self.content_encoding,
+                                 content_type='application/json',
+                                 headers={CLAIM_CHECK_HEADER: key})
+        return Message(None, Basic.Deliver(), header, b'')
+
+
+class WhenReadingClaimCheckedMessage(_BaseClaimCheckedMessageTestCase):
+
+    def stored_body(self):
+        return b'{"size": 3}'
+
+    def should_have_claim_check(self):
+        self.assertEqual(self.message.claim_check, self.key)
+
+    def should_keep_raw_body(self):
+        self.assertEqual(self.message.raw_body, b'')
+
+    def should_load_body(self):
+        self.assertEqual(bytes(self.message.body), b'{"size": 3}')
+
+    def should_not_copy_body(self):
+        self.assertIsInstance(self.message.body, memoryview)
+        self.assertTrue(self.message.body.readonly)
+
+    def should_load_payload(self):
+        self.assertEqual(self.message.payload, {'size': 3})
+
+
+class WhenReadingCompressedClaimCheckedMessage(
+        _BaseClaimCheckedMessageTestCase):
+    content_encoding = 'bzip2'
+
+    def stored_body(self):
+        return bz2.compress(b'[1, 2, 3]')
+
+    def should_decompress_payload(self):
+        self.assertEqual(self.message.payload, [1, 2, 3])
+
+
+class WhenClaimCheckedBodyIsMissing(_BaseClaimCheckedMessageTestCase):
+
+    def execute(self):
+        self.store.delete(self.key)
+
+    def should_raise_message_exception(self):
+        with self.assertRaises(MessageException):
+            self.message.body
+
+
+class WhenNoBlobStoreConfigured(_BaseClaimCheckedMessageTestCase):
+
+    def execute(self):
+        del self.message.blob_store
+
+    def should_raise_message_exception(self):
+        with self.assertRaises(MessageException):
+            self.message.payload
+
+
+class _BaseClaimCheckPublisherTestCase(_BaseBlobStoreTestCase):
+    publisher_class = BlockingPublisher
+
+    def configure(self):
+        super(_BaseClaimCheckPublisherTestCase, self).configure()
+        self.broker = FakeBroker()
+        self.broker.connect(blocking=True).channel().queue_declare('q')
+        self.publisher = self.publisher_class(
+            self.broker, blob_store=self.store, claim_check_threshold=1024)
+
+
+class WhenPublishingLargeMessage(_BaseClaimCheckPublisherTestCase):
+
+    def execute(self):
+        self.publisher.publish('', 'q', BODY)
+        self.publisher.publish('', 'q', b'small')
+        self.messages = [
+            Message(None, Basic.Deliver(), envelope.properties,
+                    envelope.body)
+            for envelope in self.broker.server.queues['q'].messages]
+        for message in self.messages:
+            message.blob_store = self.store
+
+    def should_store_large_body(self):
+        self.assertEqual(self.store.keys(), [KEY])
+
+    def should_publish_claim_check(self):
+        self.assertEqual(self.messages[0].raw_body, b'')
+        self.assertEqual(self.messages[0].claim_check, KEY)
+
+    def should_load_large_body(self):
+        self.assertEqual(bytes(self.messages[0].body), BODY)
+
+    def should_publish_small_body(self):
+        self.assertEqual(self.messages[1].raw_body, b'small')
+        self.assertIsNone(self.messages[1].claim_check)
+
+
+class WhenPublishingLargeTextMessage(_BaseClaimCheckPublisherTestCase):
+
+    def execute(self):
+        # 600 characters, but 1200 bytes once encoded
+        self.publisher.publish('', 'q', u'\xe9' * 600)
+        self.message = Message(
+            None, Basic.Deliver(),
+            self.broker.server.queues['q'].messages[0].properties, b'')
+        self.message.blob_store = self.store
+
+    def should_claim_check_by_encoded_size(self):
+        self.assertIsNotNone(self.message.claim_check)
+
+    def should_store_encoded_body(self):
+        self.assertEqual(bytes(self.message.body),
+                         (u'\xe9' * 600).encode('utf-8'))
+
+
+class WhenPublishingLargeJsonMessage(_BaseClaimCheckPublisherTestCase):
+    publisher_class = BlockingJSONPublisher
+
+    def execute(self):
+        self.publisher.publish('', 'q', {'data': 'x' * 2048})
+        self.message = Message(
+            None, Basic.Deliver(),
+            self.broker.server.queues['q'].messages[0].properties, b'')
+        self.message.blob_store = self.store
+
+    def should_load_payload(self):
+        self.assertEqual(self.message.payload, {'data': 'x' * 2048})
@@ -0,0 +1,139 @@
+import math
+import zlib
+from array import array
+
+from mock import call, patch
+from pika.spec import Basic, BasicProperties
+
+from pikachewie.columnar import decode_columns
+from pikachewie.message import Message
+from tests import _BaseTestCase
+
+mod = 'pikachewie.columnar'
+
+BODIES = [
+    b'{"price": 1.5, "quantity": 2, "sku": "a", "customer": {"region": "eu"}}',
+    b'{"price": null, "quantity": 1, "sku": "b", "extra": [1, {"sku": 3}]}',
+    b'{"quantity": 5, "sku": "c", "customer": {"region": "us", "id": 7}}',
+]
+FIELDS = [('price', 'd'), ('quantity', 'q'), 'sku', 'customer.region']
+
+
+def make_message(body, codec=None):
+    header = BasicProperties(content_type='application/json',
+                             content_encoding=codec)
+    return Message(None, Basic.Deliver(), header, body)
+
+
+class _BaseDecodeColumnsTestCase(_BaseTestCase):
+    bodies = BODIES
+
+    def configure(self):
+        self.messages = [make_message(body) for body in self.bodies]
+
+    def execute(self):
+        self.batch = decode_columns(self.messages, FIELDS, use_numpy=False)
+
+
+class WhenDecodingColumns(_BaseDecodeColumnsTestCase):
+
+    def should_have_one_row_per_message(self):
+        self.assertEqual(len(self.batch), 3)
+
+    def should_have_columns_in_order(self):
+        self.assertEqual(list(self.batch),
+                         ['price', 'quantity', 'sku', 'customer.region'])
+
+    def should_decode_typed_column(self):
+        self.assertEqual(self.batch['quantity'].values, array('q', [2, 1, 5]))
+
+    def should_fill_null_floats_with_nan(self):
+        values = self.batch['price'].values
+        self.assertEqual(values.typecode, 'd')
+        self.assertEqual(values[0], 1.5)
+        self.assertTrue(math.isnan(values[1]) and math.isnan(values[2]))
+
+    def should_mask_null_and_missing_values(self):
+        self.assertEqual(self.batch['price'].mask, array('b', [0, 1, 1]))
+
+    def should_decode_untyped_column_as_list(self):
+        self.assertEqual(self.batch['sku'].values, ['a', 'b', 'c'])
+
+    def should_decode_nested_fields(self):
+        self.assertEqual(self.batch['customer.region'],
+                         (['eu', None, 'us'], array('b', [0, 1, 0])))
+
+    def should_have_no_invalid_messages(self):
+        self.assertEqual(self.batch.invalid, [])
+
+
+class WhenDecodingCompressedMessages(_BaseDecodeColumnsTestCase):
+
+    def configure(self):
+        self.messages = [make_message(zlib.compress(body), 'gzip')
+                         for body in self.bodies]
+
+    def should_decompress_bodies(self):
+        self.assertEqual(self.batch['sku'].values, ['a', 'b', 'c'])
+
+
+class WhenDecodingInvalidMessages(_BaseDecodeColumnsTestCase):
+    bodies = [BODIES[0], b'not json', b'[1, 2]', BODIES[2]]
+
+    def should_report_invalid_messages(self):
+        self.assertEqual(self.batch.invalid, [1, 2])
+
+    def should_mask_invalid_rows(self):
+        self.assertEqual(self.batch['sku'],
+                         (['a', None, None, 'c'], array('b', [0, 1, 1, 0])))
+
+
+class WhenFieldIsAnObject(_BaseDecodeColumnsTestCase):
+
+    def execute(self):
+        pass
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, decode_columns, self.messages,
+                          ['customer'], use_numpy=False)
+
+
+class WhenValueDoesNotFitColumn(_BaseDecodeColumnsTestCase):
+
+    def execute(self):
+        pass
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, decode_columns, self.messages,
+                          [('sku', 'd')], use_numpy=False)
+
+
+class WhenDecodingColumnsWithNumpy(_BaseDecodeColumnsTestCase):
+    __contexts__ = (
+        ('numpy', patch(mod + '.numpy')),
+    )
+
+    def execute(self):
+        self.batch = decode_columns(self.messages, [('quantity', 'q'), 'sku'])
+
+    def should_build_numpy_arrays(self):
+        self.assertEqual(self.ctx.numpy.array.call_args_list, [
+            call([2, 1, 5], dtype='q'),
+            call([False, False, False], dtype=bool),
+            call(['a', 'b', 'c'], dtype=object),
+            call([False, False, False], dtype=bool),
+        ])
+
+
+class WhenNumpyIsMissing(_BaseDecodeColumnsTestCase):
+    __contexts__ = (
+        ('numpy', patch(mod + '.numpy', None)),
+    )
+
+    def execute(self):
+        self.batch = decode_columns(self.messages, ['sku'])
+        with self.assertRaises(ImportError):
+            decode_columns(self.messages, ['sku'], use_numpy=True)
+
+    def should_decode_into_arrays(self):
+        self.assertEqual(self.batch['sku'].mask, array('b', [0, 0, 0]))
@@ -1,6 +1,8 @@
 from mock import MagicMock, sentinel
+from pika.spec import BasicProperties
 
 from pikachewie.consumer import Consumer
+from pikachewie.exceptions import MessageException
 from tests import unittest
 
 
@@ -23,3 +25,42 @@ class WhenProcessingMessage(unittest.TestCase):
 
     def should_call_process_message(self):
         self.consumer.process_message.assert_called_once_with()
+
+
+class _BaseConsumerPublishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = Consumer()
+        self.consumer.message = MagicMock(outputs=[], reply_to='replies',
+                                          correlation_id='c1')
+
+
+class WhenConsumerPublishesMessage(_BaseConsumerPublishTestCase):
+
+    def should_record_output(self):
+        self.consumer.publish('x', 'k', 'body')
+        self.assertEqual(self.consumer.message.outputs,
+                         [('x', 'k', 'body', None)])
+
+
+class WhenConsumerRepliesToMessage(_BaseConsumerPublishTestCase):
+
+    def setUp(self):
+        super(WhenConsumerRepliesToMessage, self).setUp()
+        self.properties = BasicProperties(content_type='text/plain')
+        self.consumer.reply('body', self.properties)
+        self.output = self.consumer.message.outputs[0]
+
+    def should_publish_to_reply_to(self):
+        self.assertEqual(self.output[:3], ('', 'replies', 'body'))
+
+    def should_set_correlation_id(self):
+        self.assertEqual(self.output[3].correlation_id, 'c1')
+        self.assertEqual(self.output[3].content_type, 'text/plain')
+
+    def should_not_modify_properties(self):
+        self.assertIsNone(self.properties.correlation_id)
+
+    def should_raise_message_exception_without_reply_to(self):
+        self.consumer.message.reply_to = None
+        self.assertRaises(MessageException, self.consumer.reply, 'body')
@@ -141,3 +141,23 @@ class WhenCreatingPropertiesWithHeader(unittest.TestCase):
 
     def should_set_user_id(self):
         self.assertEqual(self.properties.user_id, self.kwargs['user_id'])
+
+
+class DescribePropertiesToBasicProperties(unittest.TestCase):
+
+    def setUp(self):
+        self.properties = Properties(BasicProperties(
+            content_type='application/json', headers={'a': 1}))
+        self.basic_properties = self.properties.to_basic_properties()
+
+    def should_return_basic_properties(self):
+        self.assertIsInstance(self.basic_properties, BasicProperties)
+
+    def should_copy_attributes(self):
+        self.assertEqual(self.basic_properties.content_type,
+                         'application/json')
+
+    def should_copy_headers(self):
+        self.assertEqual(self.basic_properties.headers, {'a': 1})
+        self.assertIsNot(self.basic_properties.headers,
+                         self.properties.headers)
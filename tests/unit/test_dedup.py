@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+
+from mock import MagicMock, NonCallableMagicMock
+from pika.spec import BasicProperties
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.dedup import Deduplicator, DiskStore, MemoryStore
+from pikachewie.outbox import Outbox
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase, unittest
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def order_key(message):
+    return message.headers.get('order')
+
+
+class DescribeMemoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.store = MemoryStore(max_size=2, ttl=10, time_func=self.clock)
+        self.store.add('a')
+        self.store.add('b')
+
+    def should_contain_added_keys(self):
+        self.assertIn('a', self.store)
+
+    def should_forget_expired_keys(self):
+        self.clock.now += 10
+        self.assertNotIn('a', self.store)
+        self.assertEqual(len(self.store), 1)
+
+    def should_evict_least_recently_used_key(self):
+        self.assertIn('a', self.store)
+        self.store.add('c')
+        self.assertNotIn('b', self.store)
+        self.assertIn('a', self.store)
+
+
+class DescribeDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'dedup.db')
+        self.store = DiskStore(path, ttl=10, time_func=self.clock)
+        self.other = DiskStore(path, ttl=10, time_func=self.clock)
+        self.store.add('a')
+
+    def tearDown(self):
+        self.store.close()
+        self.other.close()
+        shutil.rmtree(self.directory)
+
+    def should_share_keys_between_stores(self):
+        self.assertIn('a', self.other)
+
+    def should_forget_expired_keys(self):
+        self.clock.now += 10
+        self.assertNotIn('a', self.other)
+
+    def should_purge_expired_keys(self):
+        self.clock.now += 10
+        self.store.purge()
+        self.assertEqual(self.store._db.execute(
+            'SELECT COUNT(*) FROM seen').fetchone()[0], 0)
+
+
+class DescribeDeduplicator(_BaseTestCase):
+
+    def configure(self):
+        self.deduplicator = Deduplicator()
+        self.agent = MagicMock(_ack=True)
+        self.message = NonCallableMagicMock(id='m1', delivery_tag=1)
+
+    def execute(self):
+        self.deduplicator.message_processed(self.agent, self.message, 'ok',
+                                            0.1)
+        self.deduplicator.message_acknowledged(self.agent, self.message, 0.1)
+
+    def should_recognize_processed_message(self):
+        self.assertTrue(self.deduplicator.is_duplicate(
+            NonCallableMagicMock(id='m1')))
+
+    def should_not_recognize_other_messages(self):
+        self.assertFalse(self.deduplicator.is_duplicate(
+            NonCallableMagicMock(id='m2')))
+
+    def should_ignore_messages_without_key(self):
+        message = NonCallableMagicMock(id=None)
+        self.deduplicator.add(message)
+        self.assertFalse(self.deduplicator.is_duplicate(message))
+
+    def should_not_remember_failed_messages(self):
+        message = NonCallableMagicMock(id='m3', delivery_tag=3)
+        self.deduplicator.message_processed(self.agent, message, 'requeued',
+                                            0.1)
+        self.assertFalse(self.deduplicator.is_duplicate(message))
+
+    def should_not_remember_messages_until_acknowledged(self):
+        message = NonCallableMagicMock(id='m4', delivery_tag=4)
+        self.deduplicator.message_processed(self.agent, message, 'ok', 0.1)
+        self.assertFalse(self.deduplicator.is_duplicate(message))
+
+    def should_not_remember_rejected_messages(self):
+        message = NonCallableMagicMock(id='m5', delivery_tag=5)
+        self.deduplicator.message_processed(self.agent, message, 'ok', 0.1)
+        self.deduplicator.message_rejected(self.agent, 5, True)
+        self.deduplicator.message_acknowledged(self.agent, message, 0.1)
+        self.assertFalse(self.deduplicator.is_duplicate(message))
+
+
+class WhenKeyFunctionIsNamed(unittest.TestCase):
+
+    def should_import_key_function(self):
+        deduplicator = Deduplicator(key='tests.unit.test_dedup.order_key')
+        self.assertIs(deduplicator.key, order_key)
+
+
+class RecordingConsumer(Consumer):
+
+    def __init__(self):
+        self.messages = []
+
+    def process_message(self):
+        self.messages.append(self.message.body)
+
+
+class WhenAgentReceivesDuplicates(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.consumer = RecordingConsumer()
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            deduplicate=True)
+        self.agent.connect()
+        self.broker.server.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for message_id, body in (('1', 'a'), ('1', 'a'), ('2', 'b')):
+            channel.basic_publish('x', 'k', body,
+                                  BasicProperties(message_id=message_id))
+
+    def execute(self):
+        self.broker.server.ioloop.run_until_idle()
+
+    def should_process_each_message_once(self):
+        self.assertEqual(self.consumer.messages, ['a', 'b'])
+
+    def should_acknowledge_duplicates(self):
+        self.assertEqual(len(self.broker.server.queues['q'].messages), 0)
+        self.assertEqual(self.agent.channel._unacked, {})
+
+    def should_count_duplicates(self):
+        self.assertEqual(self.agent.deduplicator.duplicates, 1)
+
+
+class ForwardingConsumer(RecordingConsumer):
+
+    def process_message(self):
+        super(ForwardingConsumer, self).process_message()
+        self.publish('out', 'k', 'out: %s' % self.message.body)
+
+
+class WhenOutputConfirmFails(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.server = self.broker.server
+        self.consumer = ForwardingConsumer()
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            deduplicate=True)
+        self.agent.connect()
+        self.server.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        channel.exchange_declare('out', 'direct')
+        channel.queue_declare('out')
+        channel.queue_bind('out', 'out', 'k')
+        channel.basic_publish('x', 'k', 'a', BasicProperties(message_id='1'))
+        # hold back the confirms of the first attempt's outputs
+        self.agent.outbox = Outbox(self.agent.connection)
+        self.agent.outbox._on_confirm = MagicMock()
+        self.server.ioloop.run_until_idle()
+
+    def execute(self):
+        del self.agent.outbox._on_confirm
+        self.agent.outbox.channel._close(320, 'CONNECTION_FORCED')
+        self.server.ioloop.run_until_idle()
+
+    def should_process_redelivered_message(self):
+        self.assertEqual(self.consumer.messages, ['a', 'a'])
+        self.assertEqual(self.agent.deduplicator.duplicates, 0)
+
+    def should_publish_outputs_again(self):
+        self.assertEqual([envelope.body for envelope in
+                          self.server.queues['out'].messages],
+                         ['out: a', 'out: a'])
+
+    def should_remember_message_once_acknowledged(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+        self.assertTrue(self.agent.deduplicator.is_duplicate(
+            NonCallableMagicMock(id='1')))
@@ -0,0 +1,111 @@
+from mock import MagicMock, NonCallableMagicMock
+
+from pikachewie.flow import FlowController
+from tests import _BaseTestCase
+
+
+def make_message(delivery_tag, size):
+    return NonCallableMagicMock(delivery_tag=delivery_tag,
+                                raw_body=b'x' * size)
+
+
+class DescribeFlowController(_BaseTestCase):
+
+    def execute(self):
+        self.controller = FlowController(MagicMock(), max_bytes=100)
+
+    def should_resume_at_half_of_max_bytes(self):
+        self.assertEqual(self.controller.resume_bytes, 50)
+
+    def should_hold_no_bytes(self):
+        self.assertEqual(self.controller.held_bytes, 0)
+
+    def should_not_be_paused(self):
+        self.assertFalse(self.controller.paused)
+
+    def should_reject_invalid_watermarks(self):
+        self.assertRaises(ValueError, FlowController, MagicMock(),
+                          max_bytes=100, resume_bytes=100)
+
+
+class _BaseFlowControllerTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.agent = MagicMock(_ack=True)
+        self.controller = FlowController(self.agent, max_bytes=100,
+                                         resume_bytes=40)
+        self.messages = [make_message(tag, 30) for tag in range(1, 5)]
+        for message in self.messages:
+            self.controller.message_received(self.agent, message)
+
+
+class WhenHoldingTooManyBytes(_BaseFlowControllerTestCase):
+
+    def should_count_held_bytes(self):
+        self.assertEqual(self.controller.held_bytes, 120)
+
+    def should_pause_agent(self):
+        self.agent.pause.assert_called_once_with(FlowController.REASON)
+
+    def should_not_resume_agent(self):
+        self.assertFalse(self.agent.resume.called)
+
+
+class WhenSettlingHeldMessages(_BaseFlowControllerTestCase):
+
+    def execute(self):
+        self.controller.message_acknowledged(self.agent, self.messages[0],
+                                             0.1)
+        self.controller.message_rejected(self.agent, 2, requeue=True)
+        self.resumed_early = self.agent.resume.called
+        self.controller.message_processed(self.agent, self.messages[2],
+                                          'failed', 0.1)
+
+    def should_release_settled_bytes(self):
+        self.assertEqual(self.controller.held_bytes, 30)
+
+    def should_not_resume_above_resume_bytes(self):
+        self.assertFalse(self.resumed_early)
+
+    def should_resume_agent(self):
+        self.agent.resume.assert_called_once_with(FlowController.REASON)
+
+
+class WhenProcessingHeldMessage(_BaseFlowControllerTestCase):
+
+    def execute(self):
+        self.controller.message_processed(self.agent, self.messages[0], 'ok',
+                                          0.1)
+
+    def should_hold_bytes_until_acknowledged(self):
+        self.assertEqual(self.controller.held_bytes, 120)
+
+
+class WhenProcessingWithoutAcks(_BaseFlowControllerTestCase):
+
+    def execute(self):
+        self.agent._ack = False
+        self.controller.message_processed(self.agent, self.messages[0], 'ok',
+                                          0.1)
+        self.controller.message_dropped(self.agent, self.messages[1],
+                                        'expired')
+
+    def should_release_bytes(self):
+        self.assertEqual(self.controller.held_bytes, 60)
+
+
+class WhenChannelIsLost(_BaseFlowControllerTestCase):
+
+    def execute(self):
+        self.controller.reset()
+
+    def should_forget_held_bytes(self):
+        self.assertEqual(self.controller.held_bytes, 0)
+
+    def should_resume_agent(self):
+        self.agent.resume.assert_called_once_with(FlowController.REASON)
+
+    def should_ignore_late_settlements(self):
+        self.controller.message_acknowledged(self.agent, self.messages[0],
+                                             0.1)
+        self.assertEqual(self.controller.held_bytes, 0)
@@ -1,3 +1,4 @@
+from copy import deepcopy
 from pkg_resources import resource_filename
 
 from mock import patch, sentinel
@@ -5,7 +6,9 @@ from yaml import load
 
 from pikachewie.broker import Broker
 from pikachewie.helpers import (broker_from_config, consumer_agent_from_config,
-                                consumer_from_config)
+                                consumer_from_config,
+                                consumer_host_from_config)
+from pikachewie.pipeline import Pipeline
 from tests import _BaseTestCase, LoggingConsumer, unittest
 
 mod = 'pikachewie.helpers'
@@ -79,3 +82,92 @@ class DescribeConsumerAgentFromConfig(_BaseTestCase):
 
     def should_return_agent(self):
         self.assertIs(self.agent, sentinel.agent)
+
+
+class WhenConsumerConfigHasAgentOptions(_BaseTestCase):
+    __contexts__ = (
+        ('ConsumerAgent', patch(mod + '.ConsumerAgent',
+                                return_value=sentinel.agent)),
+        ('consumer_from_config', patch(mod + '.consumer_from_config',
+                                       return_value=sentinel.consumer)),
+        ('broker_from_config', patch(mod + '.broker_from_config',
+                                     return_value=sentinel.broker)),
+    )
+
+    def configure(self):
+        self.config = deepcopy(config)
+        self.consumer_config = \
+            self.config['rabbitmq']['consumers']['message_logger']
+        self.consumer_config['drop_expired'] = 'reject'
+
+    def execute(self):
+        self.agent = consumer_agent_from_config(self.config, 'message_logger')
+
+    def should_pass_agent_options(self):
+        self.ctx.ConsumerAgent.assert_called_once_with(
+            sentinel.consumer, sentinel.broker,
+            self.consumer_config['bindings'], True, self.config['rabbitmq'],
+            drop_expired='reject')
+
+
+class DescribeConsumerHostFromConfig(_BaseTestCase):
+
+    def configure(self):
+        self.config = deepcopy(config)
+        consumers = self.config['rabbitmq']['consumers']
+        consumers['audit_logger'] = deepcopy(consumers['message_logger'])
+        consumers['audit_logger']['prefetch_count'] = 10
+
+    def execute(self):
+        self.host = consumer_host_from_config(self.config)
+
+    def should_host_every_consumer(self):
+        self.assertEqual(list(self.host.agents),
+                         ['audit_logger', 'message_logger'])
+
+    def should_share_broker(self):
+        for agent in self.host.agents.values():
+            self.assertIs(agent.broker, self.host.broker)
+
+    def should_pass_agent_options(self):
+        self.assertEqual(self.host.agents['audit_logger'].prefetch_count, 10)
+
+
+class WhenCreatingPipelineFromConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.config = deepcopy(config)
+        consumers = self.config['rabbitmq']['consumers']
+        consumers['message_logger']['pipeline'] = ['next_logger']
+        consumers['next_logger'] = deepcopy(consumers['message_logger'])
+        del consumers['next_logger']['pipeline']
+        self.agent = consumer_agent_from_config(self.config, 'message_logger')
+
+    def should_wrap_consumer_in_pipeline(self):
+        self.assertIsInstance(self.agent.consumer, Pipeline)
+        self.assertIsInstance(self.agent.consumer.consumer, LoggingConsumer)
+
+    def should_create_stages(self):
+        stage, = self.agent.consumer.stages
+        self.assertEqual(stage.name, 'next_logger')
+        self.assertIsInstance(stage.consumer, LoggingConsumer)
+
+    def should_match_stage_bindings_by_exchange_type(self):
+        self.assertEqual(
+            self.agent.consumer._stage_for(
+                ('message', 'example.text.hello', '', None), 0), 0)
+
+    def should_publish_outputs_bound_by_other_consumers(self):
+        consumers = self.config['rabbitmq']['consumers']
+        consumers['other_logger'] = deepcopy(consumers['next_logger'])
+        for binding in consumers['other_logger']['bindings']:
+            binding['queue'] = 'other'
+        agent = consumer_agent_from_config(self.config, 'message_logger')
+        self.assertIsNone(agent.consumer._stage_for(
+            ('message', 'example.text.hello', '', None), 0))
+
+    def should_reject_unknown_stages(self):
+        self.config['rabbitmq']['consumers']['message_logger']['pipeline'] \
+            = ['nobody']
+        self.assertRaises(ValueError, consumer_agent_from_config,
+                          self.config, 'message_logger')
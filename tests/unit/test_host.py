@@ -0,0 +1,202 @@
+from mock import MagicMock
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.host import ConsumerHost
+from pikachewie.testing import FakeBroker, FakeIOLoop, FakeServer
+from tests import _BaseTestCase
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingConsumer(Consumer):
+
+    def __init__(self):
+        self.messages = []
+
+    def process_message(self):
+        self.messages.append(self.message.body)
+
+
+class _BaseHostTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.clock = Clock()
+        self.server = FakeServer(FakeIOLoop(self.clock))
+        self.broker = FakeBroker(server=self.server)
+        self.consumers = {}
+        self.host = ConsumerHost(self.broker)
+        for name, prefetch_count in (('a', 1), ('b', 5)):
+            self.consumers[name] = RecordingConsumer()
+            self.host.add(name, ConsumerAgent(
+                self.consumers[name], self.broker,
+                [{'queue': name, 'exchange': 'x', 'routing_key': name}],
+                prefetch_count=prefetch_count))
+        self.host.connect()
+        self.run_until_idle()
+        self.publisher = self.broker.connect(blocking=True).channel()
+
+    def run_until_idle(self):
+        self.server.ioloop.run_until_idle()
+
+    def wait_for_reconnect(self):
+        self.clock.now += ConsumerHost._RECONNECT_DELAY
+        self.run_until_idle()
+
+    def publish(self):
+        self.publisher.basic_publish('x', 'a', 'to a')
+        self.publisher.basic_publish('x', 'b', 'to b')
+        self.run_until_idle()
+
+
+class WhenHostingConsumers(_BaseHostTestCase):
+
+    def execute(self):
+        self.publish()
+
+    def should_share_one_connection(self):
+        agents = list(self.host.agents.values())
+        self.assertIs(agents[0].connection, self.host.connection)
+        self.assertIs(agents[1].connection, self.host.connection)
+
+    def should_open_one_channel_per_agent(self):
+        agents = list(self.host.agents.values())
+        self.assertIsNot(agents[0].channel, agents[1].channel)
+
+    def should_set_prefetch_count_per_channel(self):
+        self.assertEqual(self.host.agents['a'].channel.prefetch_count, 1)
+        self.assertEqual(self.host.agents['b'].channel.prefetch_count, 5)
+
+    def should_deliver_to_each_consumer(self):
+        self.assertEqual(self.consumers['a'].messages, ['to a'])
+        self.assertEqual(self.consumers['b'].messages, ['to b'])
+
+
+class WhenOneAgentChannelCloses(_BaseHostTestCase):
+
+    def execute(self):
+        self.channel_b = self.host.agents['b'].channel
+        self.host.agents['a'].channel._close(406, 'PRECONDITION_FAILED')
+        self.run_until_idle()
+
+    def should_detach_agent(self):
+        self.assertIsNone(self.host.agents['a'].channel)
+
+    def should_not_disturb_other_agents(self):
+        self.assertIs(self.host.agents['b'].channel, self.channel_b)
+
+    def should_keep_connection_open(self):
+        self.assertTrue(self.host.connection.is_open)
+
+    def should_reopen_channel_after_delay(self):
+        self.wait_for_reconnect()
+        self.publish()
+        self.assertTrue(self.host.agents['a'].channel.is_open)
+        self.assertEqual(self.consumers['a'].messages, ['to a'])
+
+
+class WhenHostedAgentReconnects(_BaseHostTestCase):
+
+    def execute(self):
+        self.channel = self.host.agents['a'].channel
+        self.host.agents['a'].reconnect()
+        self.host.agents['a'].reconnect()
+        self.run_until_idle()
+        self.wait_for_reconnect()
+
+    def should_close_old_channel(self):
+        self.assertFalse(self.channel.is_open)
+
+    def should_open_one_new_channel(self):
+        self.assertEqual(len(self.host.connection._channels), 2)
+
+
+class WhenHostConnectionCloses(_BaseHostTestCase):
+
+    def execute(self):
+        self.connection = self.host.connection
+        self.connection.close(320, 'CONNECTION_FORCED')
+        self.run_until_idle()
+
+    def should_detach_every_agent(self):
+        for agent in self.host.agents.values():
+            self.assertIsNone(agent.channel)
+
+    def should_reconnect_every_agent_after_delay(self):
+        self.wait_for_reconnect()
+        self.assertIsNot(self.host.connection, self.connection)
+        self.publish()
+        self.assertEqual(self.consumers['a'].messages, ['to a'])
+        self.assertEqual(self.consumers['b'].messages, ['to b'])
+
+
+class WhenHostedAgentStops(_BaseHostTestCase):
+
+    def execute(self):
+        for agent in self.host.agents.values():
+            agent.release = MagicMock()
+        self.host.agents['a'].stop()
+        self.run_until_idle()
+        self.wait_for_reconnect()
+
+    def should_release_every_agent(self):
+        for agent in self.host.agents.values():
+            agent.release.assert_called_once_with()
+
+    def should_close_connection(self):
+        self.assertFalse(self.host.connection.is_open)
+
+
+class WhenAddingDuplicateAgent(_BaseTestCase):
+
+    def configure(self):
+        self.host = ConsumerHost(MagicMock())
+        self.host.add('a', MagicMock())
+
+    def should_raise_value_error(self):
+        self.assertRaises(ValueError, self.host.add, 'a', MagicMock())
+
+
+class WhenHostDrains(_BaseHostTestCase):
+
+    def execute(self):
+        self.connection = self.host.connection
+        self.host.drain(10)
+        self.run_until_idle()
+        self.clock.now += ConsumerAgent._DRAIN_POLL_INTERVAL
+        self.run_until_idle()
+
+    def should_remove_every_agent(self):
+        self.assertEqual(len(self.host.agents), 0)
+
+    def should_close_connection(self):
+        self.assertFalse(self.connection.is_open)
+
+
+class WhenOneHostedAgentDrains(_BaseHostTestCase):
+
+    def execute(self):
+        self.agent = self.host.agents['a']
+        self.channel = self.agent.channel
+        self.agent.drain()
+        self.run_until_idle()
+        self.clock.now += ConsumerAgent._DRAIN_POLL_INTERVAL
+        self.run_until_idle()
+
+    def should_remove_agent(self):
+        self.assertEqual(list(self.host.agents), ['b'])
+
+    def should_close_agent_channel(self):
+        self.assertFalse(self.channel.is_open)
+
+    def should_keep_other_agents_consuming(self):
+        self.publish()
+        self.assertEqual(self.consumers['a'].messages, [])
+        self.assertEqual(self.consumers['b'].messages, ['to b'])
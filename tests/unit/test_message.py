@@ -394,3 +394,69 @@ class WhenGettingJsonPayload(_BaseTestCase):
 
     def should_return_deserialized_body(self):
         self.assertEqual(self.payload, sentinel.deserialized_body)
+
+
+class WhenGettingMessageExpirationTimestamp(_BaseTestCase):
+
+    def configure(self):
+        self.header = NonCallableMagicMock(timestamp=1234567890,
+                                           expiration='60000')
+        self.message = Message(sentinel.channel, sentinel.method, self.header,
+                               sentinel.body)
+
+    def execute(self):
+        self.expiration_timestamp = self.message.expiration_timestamp
+
+    def should_return_expiration_timestamp(self):
+        self.assertEqual(self.expiration_timestamp, 1234567950.0)
+
+
+class WhenMessageExpirationTimestampUndefined(_BaseTestCase):
+
+    def configure(self):
+        self.header = NonCallableMagicMock(timestamp=1234567890,
+                                           expiration=None)
+        self.message = Message(sentinel.channel, sentinel.method, self.header,
+                               sentinel.body)
+
+    def execute(self):
+        self.expiration_timestamp = self.message.expiration_timestamp
+
+    def should_return_none(self):
+        self.assertIsNone(self.expiration_timestamp)
+
+
+class WhenGettingMessageTimeRemaining(_BaseTestCase):
+    __contexts__ = (
+        ('time', patch(mod + '.time')),
+    )
+
+    def configure(self):
+        self.ctx.time.time.return_value = 1234567940.0
+        self.header = NonCallableMagicMock(timestamp=1234567890,
+                                           expiration='60000')
+        self.message = Message(sentinel.channel, sentinel.method, self.header,
+                               sentinel.body)
+
+    def execute(self):
+        self.time_remaining = self.message.time_remaining()
+
+    def should_return_seconds_remaining(self):
+        self.assertEqual(self.time_remaining, 10.0)
+
+    def should_accept_current_time(self):
+        self.assertEqual(self.message.time_remaining(1234567960.0), -10.0)
+
+
+class WhenGettingTimeRemainingWithoutExpiration(_BaseTestCase):
+
+    def configure(self):
+        self.header = NonCallableMagicMock(timestamp=None, expiration=None)
+        self.message = Message(sentinel.channel, sentinel.method, self.header,
+                               sentinel.body)
+
+    def execute(self):
+        self.time_remaining = self.message.time_remaining()
+
+    def should_return_none(self):
+        self.assertIsNone(self.time_remaining)
@@ -0,0 +1,103 @@
+from mock import MagicMock, NonCallableMagicMock, patch
+
+from pikachewie.metrics import AgentMetrics, MetricsRegistry
+from tests import _BaseTestCase
+
+mod = 'pikachewie.metrics'
+
+
+class DescribeMetricsRegistry(_BaseTestCase):
+
+    def configure(self):
+        self.registry = MetricsRegistry()
+
+    def execute(self):
+        counter = self.registry.counter('hits_total', 'Hits.', ('path',))
+        counter.labels('/a"b').inc()
+        counter.labels('/a"b').inc(2)
+        histogram = self.registry.histogram('latency_seconds', 'Latency.',
+                                            buckets=(0.1, 1.0))
+        histogram.labels().observe(0.05)
+        histogram.labels().observe(0.5)
+        histogram.labels().observe(5)
+        self.text = self.registry.render()
+
+    def should_render_counter(self):
+        self.assertIn('# TYPE hits_total counter\n'
+                      'hits_total{path="/a\\"b"} 3\n', self.text)
+
+    def should_render_cumulative_buckets(self):
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n'
+                      'latency_seconds_bucket{le="1.0"} 2\n'
+                      'latency_seconds_bucket{le="+Inf"} 3\n', self.text)
+
+    def should_render_sum_and_count(self):
+        self.assertIn('latency_seconds_sum 5.55\n'
+                      'latency_seconds_count 3\n', self.text)
+
+    def should_return_registered_metric(self):
+        self.assertIs(self.registry.counter('hits_total', 'Hits.'),
+                      self.registry.get('hits_total'))
+
+    def should_reject_conflicting_metric_type(self):
+        self.assertRaises(ValueError, self.registry.gauge, 'hits_total',
+                          'Hits.')
+
+
+class WhenAggregatingAgentEvents(_BaseTestCase):
+    __contexts__ = (
+        ('time', patch(mod + '.time')),
+    )
+
+    def configure(self):
+        self.ctx.time.time.return_value = 1002.0
+        self.agent = MagicMock()
+        self.agent.queue_for.return_value = 'q'
+        self.message = NonCallableMagicMock(routing_key='a.b',
+                                            decode_seconds=0.001)
+        self.message.properties.timestamp = 1000
+        self.metrics = AgentMetrics()
+
+    def execute(self):
+        self.metrics.message_received(self.agent, self.message)
+        self.metrics.message_processed(self.agent, self.message, 'ok', 0.5)
+        self.metrics.message_acknowledged(self.agent, self.message, 0.6)
+        self.metrics.message_rejected(self.agent, 1, False)
+
+    def should_count_received_messages(self):
+        self.assertEqual(self.metrics.received.labels('q', 'a.b').value, 1)
+
+    def should_count_processed_messages(self):
+        self.assertEqual(
+            self.metrics.processed.labels('q', 'a.b', 'ok').value, 1)
+
+    def should_observe_queued_time(self):
+        self.assertEqual(self.metrics.queued_seconds.labels('q', 'a.b').sum,
+                         2.0)
+
+    def should_observe_decode_time(self):
+        self.assertEqual(self.metrics.decode_seconds.labels('q', 'a.b').sum,
+                         0.001)
+
+    def should_observe_ack_time(self):
+        self.assertEqual(self.metrics.ack_seconds.labels('q', 'a.b').sum,
+                         0.6)
+
+    def should_count_rejections(self):
+        self.assertEqual(self.metrics.rejected.labels('false').value, 1)
+
+
+class WhenNotLabellingRoutingKeys(_BaseTestCase):
+
+    def configure(self):
+        self.agent = MagicMock()
+        self.agent.queue_for.return_value = 'q'
+        self.message = NonCallableMagicMock(routing_key='a.b')
+        self.message.properties.timestamp = None
+        self.metrics = AgentMetrics(label_routing_keys=False)
+
+    def execute(self):
+        self.metrics.message_received(self.agent, self.message)
+
+    def should_label_by_queue_only(self):
+        self.assertEqual(self.metrics.received.labels('q').value, 1)
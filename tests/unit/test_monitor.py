@@ -0,0 +1,154 @@
+from mock import MagicMock, NonCallableMagicMock, patch, sentinel
+from pika import frame, spec
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.monitor import QueueMonitor, QueueStats
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+mod = 'pikachewie.monitor'
+
+
+def declare_ok(message_count, consumer_count=1):
+    return frame.Method(1, spec.Queue.DeclareOk('q', message_count,
+                                                consumer_count))
+
+
+class _BaseMonitorTestCase(_BaseTestCase):
+    __contexts__ = (
+        ('time', patch(mod + '.time')),
+    )
+
+    def configure(self):
+        self.agent = MagicMock(bindings=[{'queue': 'q'}, {'queue': 'q'}],
+                               metrics=None)
+        self.agent.queue_for.return_value = 'q'
+        self.monitor = QueueMonitor(self.agent, 5)
+        self.callback = MagicMock()
+        self.monitor.add_callback(self.callback)
+
+
+class DescribeQueueMonitor(_BaseMonitorTestCase):
+
+    def should_poll_each_bound_queue_once(self):
+        self.assertEqual(self.monitor.queues, ['q'])
+
+
+class WhenQueueIsDraining(_BaseMonitorTestCase):
+
+    def execute(self):
+        message = NonCallableMagicMock()
+        message.properties.timestamp = 990
+        self.monitor.message_received(self.agent, message)
+        self.ctx.time.time.return_value = 1000.0
+        self.monitor._on_declare_ok('q', declare_ok(100))
+        self.ctx.time.time.return_value = 1010.0
+        self.monitor._on_declare_ok('q', declare_ok(50))
+
+    def should_compute_drain_rate(self):
+        self.assertEqual(self.monitor.stats['q'].drain_rate, 5.0)
+
+    def should_estimate_drain_time(self):
+        self.assertEqual(self.monitor.stats['q'].drain_seconds, 10.0)
+
+    def should_estimate_oldest_message_age(self):
+        self.assertEqual(self.monitor.stats['q'].oldest_message_age, 20.0)
+
+    def should_call_callbacks(self):
+        self.callback.assert_called_with(self.agent,
+                                         self.monitor.stats['q'])
+
+
+class WhenQueueIsGrowing(_BaseMonitorTestCase):
+
+    def execute(self):
+        self.ctx.time.time.return_value = 1000.0
+        self.monitor._on_declare_ok('q', declare_ok(50))
+        self.ctx.time.time.return_value = 1010.0
+        self.monitor._on_declare_ok('q', declare_ok(100))
+
+    def should_never_drain(self):
+        self.assertEqual(self.monitor.stats['q'].drain_seconds, float('inf'))
+
+
+class WhenQueueIsEmpty(_BaseMonitorTestCase):
+
+    def execute(self):
+        self.ctx.time.time.return_value = 1000.0
+        self.monitor._on_declare_ok('q', declare_ok(0))
+
+    def should_drain_immediately(self):
+        self.assertEqual(self.monitor.stats['q'].drain_seconds, 0.0)
+
+    def should_not_estimate_oldest_message_age(self):
+        self.assertIsNone(self.monitor.stats['q'].oldest_message_age)
+
+
+class WhenPollingFakeBroker(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.agent = ConsumerAgent(
+            Consumer(), self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            queue_poll_interval=60, metrics_port=0)
+        self.agent.start_consuming = MagicMock()
+        self.agent.connect()
+        self.broker.server.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for _ in range(3):
+            channel.basic_publish('x', 'k', 'body')
+
+    def execute(self):
+        self.agent.queue_monitor.poll()
+        self.broker.server.ioloop.run_until_idle()
+        self.agent.queue_monitor.stop()
+
+    def should_record_queue_depth(self):
+        self.assertEqual(self.agent.queue_monitor.stats['q'].message_count, 3)
+
+    def should_export_queue_depth(self):
+        self.assertIn('pikachewie_queue_messages{queue="q"} 3',
+                      self.agent.metrics.registry.render())
+
+    def should_use_side_channel(self):
+        self.assertIsNot(self.agent.queue_monitor.channel, self.agent.channel)
+
+
+class WhenPollsOverlap(_BaseMonitorTestCase):
+
+    def configure(self):
+        super(WhenPollsOverlap, self).configure()
+        self.connection = MagicMock()
+        self.connection.channel.side_effect = lambda **kwargs: MagicMock()
+        self.monitor.start(self.connection)
+
+    def execute(self):
+        self.monitor.poll()
+        self.monitor.poll()
+        self.opening = self.monitor._opening
+
+    def should_open_one_side_channel(self):
+        self.assertEqual(self.connection.channel.call_count, 1)
+
+    def should_skip_polls_while_declaring(self):
+        self.monitor._on_channel_open(self.opening)
+        self.monitor.poll()
+        self.assertEqual(self.opening.queue_declare.call_count, 1)
+
+    def should_poll_again_once_declared(self):
+        self.monitor._on_channel_open(self.opening)
+        self.monitor._on_declare_ok('q', declare_ok(0))
+        self.monitor.poll()
+        self.assertEqual(self.opening.queue_declare.call_count, 2)
+
+    def should_open_new_channel_if_opening_fails(self):
+        self.monitor._on_channel_close(self.opening, 404, 'NOT_FOUND')
+        self.monitor.poll()
+        self.assertEqual(self.connection.channel.call_count, 2)
+
+    def should_close_channel_opened_after_stopping(self):
+        self.monitor.stop()
+        self.monitor._on_channel_open(self.opening)
+        self.opening.close.assert_called_once_with()
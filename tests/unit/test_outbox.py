@@ -0,0 +1,211 @@
+from mock import MagicMock
+from pika import frame, spec
+from pika.spec import BasicProperties
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.outbox import Outbox
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+
+class ForwardingConsumer(Consumer):
+
+    def process_message(self):
+        if self.message.reply_to:
+            self.reply('re: %s' % self.message.body)
+        else:
+            self.publish('out', 'k', 'first: %s' % self.message.body)
+            self.publish('out', 'k', 'second: %s' % self.message.body)
+
+
+class _BaseAgentOutputTestCase(_BaseTestCase):
+    concurrency = 1
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.server = self.broker.server
+        self.agent = ConsumerAgent(
+            ForwardingConsumer(), self.broker,
+            [{'queue': 'in', 'exchange': 'x', 'routing_key': 'k'}],
+            concurrency=self.concurrency)
+        self.server.ioloop.add_busy_check(
+            lambda: self.agent.workers is not None and self.agent.workers.busy)
+        self.agent.connect()
+        self.server.ioloop.run_until_idle()
+        self.publisher = self.broker.connect(blocking=True).channel()
+        self.publisher.exchange_declare('out', 'direct')
+        self.publisher.queue_declare('out')
+        self.publisher.queue_bind('out', 'out', 'k')
+
+    def run_until_idle(self):
+        self.server.ioloop.run_until_idle()
+
+    def published(self, queue='out'):
+        return [envelope.body
+                for envelope in self.server.queues[queue].messages]
+
+
+class WhenConsumerPublishes(_BaseAgentOutputTestCase):
+
+    def execute(self):
+        self.publisher.basic_publish('x', 'k', 'a')
+        self.publisher.basic_publish('x', 'k', 'b')
+        self.run_until_idle()
+
+    def should_publish_outputs_in_order(self):
+        self.assertEqual(self.published(), ['first: a', 'second: a',
+                                            'first: b', 'second: b'])
+
+    def should_publish_on_agent_connection(self):
+        self.assertIs(self.agent.outbox.connection, self.agent.connection)
+        self.assertIsNot(self.agent.outbox.channel, self.agent.channel)
+
+    def should_acknowledge_inputs_once_confirmed(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+        self.assertEqual(self.agent.outbox.pending, 0)
+
+
+class WhenConsumerPublishesConcurrently(WhenConsumerPublishes):
+    concurrency = 2
+
+    def tearDown(self):
+        self.agent.workers.stop()
+
+    def should_publish_outputs_in_order(self):
+        self.assertEqual(sorted(self.published()),
+                         ['first: a', 'first: b', 'second: a', 'second: b'])
+
+
+class WhenConsumerReplies(_BaseAgentOutputTestCase):
+
+    def execute(self):
+        self.server.declare_queue('replies')
+        self.publisher.basic_publish(
+            'x', 'k', 'ping',
+            BasicProperties(reply_to='replies', correlation_id='c1'))
+        self.run_until_idle()
+
+    def should_reply_with_correlation_id(self):
+        envelope = self.server.queues['replies'].messages[0]
+        self.assertEqual(envelope.body, 're: ping')
+        self.assertEqual(envelope.properties.correlation_id, 'c1')
+
+    def should_acknowledge_request(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+
+
+class WhenAwaitingConfirms(_BaseAgentOutputTestCase):
+
+    def execute(self):
+        self.publisher.basic_publish('x', 'k', 'a')
+        self.agent.outbox = Outbox(self.agent.connection)
+        self.agent.outbox._on_confirm = MagicMock()
+        self.run_until_idle()
+
+    def should_not_acknowledge_input(self):
+        self.assertEqual(len(self.agent.channel._unacked), 1)
+        self.assertEqual(self.agent.outbox.pending, 1)
+
+    def should_reprocess_input_if_publishing_channel_closes(self):
+        self.agent.outbox.channel._close(320, 'CONNECTION_FORCED')
+        self.run_until_idle()
+        self.assertEqual(self.published(), ['first: a', 'second: a'] * 2)
+        self.assertTrue(self.agent.outbox.channel.is_open)
+
+
+class _BaseOutboxTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.connection = MagicMock()
+        self.outbox = Outbox(self.connection)
+        self.channel = MagicMock(is_open=True)
+        self.confirmed = MagicMock()
+        self.failed = MagicMock()
+
+    def open_channel(self):
+        self.outbox._on_channel_open(self.channel)
+
+    def confirm(self, method):
+        self.outbox._on_confirm(frame.Method(1, method))
+
+
+class WhenPublishingBeforeChannelOpens(_BaseOutboxTestCase):
+
+    def execute(self):
+        properties = Properties()
+        properties.correlation_id = 'c1'
+        self.outbox.publish([('x', 'k', 'body', properties)],
+                            self.confirmed, self.failed)
+
+    def should_open_channel_once(self):
+        self.outbox.publish([('x', 'k', 'body', None)])
+        self.assertEqual(self.connection.channel.call_count, 1)
+
+    def should_publish_once_open(self):
+        self.assertFalse(self.channel.basic_publish.called)
+        self.open_channel()
+        self.channel.confirm_delivery.assert_called_once_with(
+            self.outbox._on_confirm)
+        properties = self.channel.basic_publish.call_args[1]['properties']
+        self.assertEqual(properties.correlation_id, 'c1')
+
+
+class WhenOutputsAreConfirmed(_BaseOutboxTestCase):
+
+    def execute(self):
+        self.open_channel()
+        self.outbox.publish([('x', 'k', '1', None), ('x', 'k', '2', None)],
+                            self.confirmed, self.failed)
+        self.outbox.publish([('x', 'k', '3', None)], MagicMock(), MagicMock())
+        self.confirm(spec.Basic.Ack(2, multiple=True))
+
+    def should_call_on_confirmed(self):
+        self.confirmed.assert_called_once_with()
+        self.assertFalse(self.failed.called)
+
+    def should_track_remaining_inputs(self):
+        self.assertEqual(self.outbox.pending, 1)
+
+
+class WhenOutputIsRejected(_BaseOutboxTestCase):
+
+    def execute(self):
+        self.open_channel()
+        self.outbox.publish([('x', 'k', '1', None), ('x', 'k', '2', None)],
+                            self.confirmed, self.failed)
+        self.confirm(spec.Basic.Nack(1))
+        self.confirm(spec.Basic.Ack(2))
+
+    def should_call_on_failed_once(self):
+        self.failed.assert_called_once_with()
+        self.assertFalse(self.confirmed.called)
+        self.assertEqual(self.outbox.pending, 0)
+
+
+class WhenPublishingNoOutputs(_BaseOutboxTestCase):
+
+    def execute(self):
+        self.open_channel()
+        self.outbox.publish([], self.confirmed, self.failed)
+
+    def should_confirm_immediately(self):
+        self.confirmed.assert_called_once_with()
+
+
+class WhenOutboxCloses(_BaseOutboxTestCase):
+
+    def execute(self):
+        self.open_channel()
+        self.outbox.publish([('x', 'k', '1', None)], self.confirmed,
+                            self.failed)
+        self.outbox.close()
+        self.outbox._on_channel_close(self.channel, 200, 'Normal shutdown')
+
+    def should_close_channel(self):
+        self.channel.close.assert_called_once_with()
+
+    def should_forget_outputs(self):
+        self.assertFalse(self.failed.called)
+        self.assertEqual(self.outbox.pending, 0)
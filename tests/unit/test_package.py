@@ -0,0 +1,56 @@
+import subprocess
+import sys
+
+import pikachewie
+from pikachewie import broker
+from pikachewie.publisher import BlockingPublisher
+from tests import unittest
+
+IMPORTED_MODULES = '''
+import sys
+%s
+print(' '.join(sorted(name for name in sys.modules
+                      if name.split('.')[0] in ('pikachewie', 'tornado'))))
+'''
+
+
+def imported_modules(statement):
+    """Return the modules imported by `statement` in a fresh interpreter."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORTED_MODULES % statement])
+    return output.decode('utf-8').split()
+
+
+class DescribeLazyPackage(unittest.TestCase):
+
+    def should_resolve_public_names(self):
+        self.assertIs(pikachewie.BlockingPublisher, BlockingPublisher)
+
+    def should_list_public_names(self):
+        self.assertTrue(set(pikachewie.__all__) <= set(dir(pikachewie)))
+
+    def should_raise_attribute_error_for_unknown_names(self):
+        self.assertRaises(AttributeError, getattr, pikachewie, 'Chewbacca')
+
+    def should_import_nothing_on_package_import(self):
+        self.assertEqual(imported_modules('import pikachewie'),
+                         ['pikachewie'])
+
+    def should_not_import_agent_or_tornado_for_publishing(self):
+        modules = imported_modules(
+            'from pikachewie import Broker, BlockingPublisher')
+        self.assertNotIn('pikachewie.agent', modules)
+        self.assertFalse([name for name in modules
+                          if name.startswith('tornado')])
+
+    def should_not_import_tornado_for_agent_until_connecting(self):
+        modules = imported_modules('from pikachewie import ConsumerAgent')
+        self.assertFalse([name for name in modules
+                          if name.startswith('tornado')])
+
+
+class DescribeTornadoConnection(unittest.TestCase):
+
+    def should_import_tornado_adapter_on_demand(self):
+        from pika.adapters.tornado_connection import TornadoConnection
+        self.assertIs(broker._tornado_connection(), TornadoConnection)
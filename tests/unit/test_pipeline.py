@@ -0,0 +1,162 @@
+import copy
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.exceptions import MessageException
+from pikachewie.pipeline import Pipeline, Stage
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+
+class Stage1(Consumer):
+
+    def process_message(self):
+        body = self.message.body
+        self.publish('parsed', 'order.' + body, body.upper())
+        self.publish('audit', 'parsed', body)
+
+
+class Stage2(Consumer):
+
+    def process_message(self):
+        if self.message.body == 'BAD':
+            raise MessageException('Cannot enrich')
+        self.publish('enriched', self.message.routing_key,
+                     self.message.body + '!')
+
+
+class Stage3(Consumer):
+
+    def __init__(self):
+        self.messages = []
+
+    def process_message(self):
+        self.messages.append((self.message.exchange,
+                              self.message.routing_key, self.message.body))
+        self.publish('', 'done', self.message.body)
+
+
+EXCHANGE_TYPES = {'parsed': 'topic', 'enriched': 'fanout'}
+
+
+class _BasePipelineTestCase(_BaseTestCase):
+    other_bindings = []
+
+    def configure(self):
+        self.stage3 = Stage3()
+        self.pipeline = Pipeline(Stage1(), [
+            Stage('enrich', Stage2(), [{'exchange': 'parsed',
+                                        'queue': 'enrich',
+                                        'routing_key': 'order.*'}]),
+            Stage('store', self.stage3, [{'exchange': 'enriched',
+                                          'queue': 'store'}]),
+        ], EXCHANGE_TYPES, self.other_bindings)
+        self.broker = FakeBroker()
+        self.server = self.broker.server
+        self.agent = ConsumerAgent(
+            self.pipeline, self.broker,
+            [{'queue': 'raw', 'exchange': 'raw', 'routing_key': 'k'}])
+        self.agent.connect()
+        self.server.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        for queue, exchange in (('audit', 'audit'), ('done', '')):
+            channel.queue_declare(queue)
+            if exchange:
+                channel.exchange_declare(exchange, 'direct')
+                channel.queue_bind(queue, exchange, 'parsed')
+        self.publisher = channel
+
+    def published(self, queue):
+        return [envelope.body
+                for envelope in self.server.queues[queue].messages]
+
+
+class WhenRunningPipeline(_BasePipelineTestCase):
+
+    def execute(self):
+        self.publisher.basic_publish('raw', 'k', 'abc')
+        self.server.ioloop.run_until_idle()
+
+    def should_pass_outputs_between_stages_in_memory(self):
+        self.assertEqual(self.stage3.messages,
+                         [('enriched', 'order.abc', 'ABC!')])
+
+    def should_publish_outputs_no_stage_binds_to(self):
+        self.assertEqual(self.published('audit'), ['abc'])
+        self.assertEqual(self.published('done'), ['ABC!'])
+
+    def should_acknowledge_original_delivery(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+
+
+class WhenPipelineStageFails(_BasePipelineTestCase):
+
+    def execute(self):
+        self.publisher.basic_publish('raw', 'k', 'bad')
+        self.server.ioloop.run_until_idle()
+
+    def should_not_run_later_stages(self):
+        self.assertEqual(self.stage3.messages, [])
+
+    def should_not_publish_outputs(self):
+        self.assertEqual(self.published('audit'), [])
+        self.assertEqual(self.published('done'), [])
+
+    def should_reject_original_delivery(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+        self.assertEqual(self.published('raw'), [])
+
+
+class WhenAnotherQueueIsBoundToStageOutput(_BasePipelineTestCase):
+    other_bindings = [{'exchange': 'parsed', 'queue': 'orders',
+                       'routing_key': 'order.#'}]
+
+    def configure(self):
+        super(WhenAnotherQueueIsBoundToStageOutput, self).configure()
+        self.publisher.exchange_declare('parsed', 'topic')
+        self.publisher.queue_declare('orders')
+        self.publisher.queue_bind('orders', 'parsed', 'order.#')
+
+    def execute(self):
+        self.publisher.basic_publish('raw', 'k', 'abc')
+        self.server.ioloop.run_until_idle()
+
+    def should_publish_output_instead(self):
+        self.assertEqual(self.published('orders'), ['ABC'])
+
+    def should_not_pass_output_in_memory(self):
+        self.assertEqual(self.stage3.messages, [])
+
+
+class WhenOutputMatchesSeveralStages(_BaseTestCase):
+
+    def configure(self):
+        self.stage3 = Stage3()
+        self.pipeline = Pipeline(Stage1(), [
+            Stage('enrich', Stage2(), [{'exchange': 'parsed',
+                                        'queue': 'enrich',
+                                        'routing_key': 'order.*'}]),
+            Stage('store', self.stage3, [{'exchange': 'parsed',
+                                          'queue': 'store',
+                                          'routing_key': '#'}]),
+        ], EXCHANGE_TYPES)
+
+    def should_publish_output(self):
+        self.assertIsNone(
+            self.pipeline._stage_for(('parsed', 'order.abc', '', None), 0))
+
+    def should_pass_output_bound_by_one_stage_in_memory(self):
+        self.assertEqual(
+            self.pipeline._stage_for(('parsed', 'other', '', None), 0), 1)
+
+
+class WhenCopyingPipeline(_BasePipelineTestCase):
+
+    def execute(self):
+        self.copy = copy.copy(self.pipeline)
+
+    def should_copy_every_stage_consumer(self):
+        self.assertIsNot(self.copy.consumer, self.pipeline.consumer)
+        for stage, original in zip(self.copy.stages, self.pipeline.stages):
+            self.assertIsNot(stage.consumer, original.consumer)
+            self.assertEqual(stage.name, original.name)
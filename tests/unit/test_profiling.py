@@ -0,0 +1,172 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from mock import MagicMock, NonCallableMagicMock, patch
+
+from pikachewie.consumer import Consumer
+from pikachewie.profiling import AgentProfiler
+from pikachewie.testing import FakeIOLoop
+from pikachewie.workers import WorkerPool
+from tests import _BaseTestCase
+
+mod = 'pikachewie.profiling'
+
+
+class WhenProfilingAgent(_BaseTestCase):
+
+    def configure(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.profiler = AgentProfiler(self.output_dir, interval=0.001)
+        self.message = NonCallableMagicMock(type='greeting')
+
+    def execute(self):
+        self.prefix = self.profiler.start(0.05)
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            self.profiler.begin(self.message)
+            sum(range(1000))
+            self.profiler.end(self.message)
+        self.profiler._thread.join()
+
+    def should_finish(self):
+        self.assertFalse(self.profiler.active)
+
+    def should_stay_active_while_writing(self):
+        write = self.profiler._write
+        states = []
+        self.profiler._write = lambda *args: (
+            states.append(self.profiler.active), write(*args))
+        self.profiler.start(0.01)
+        self.profiler._thread.join()
+        self.assertEqual(states, [True])
+
+    def should_write_collapsed_stacks(self):
+        with open(self.prefix + '.collapsed') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit()
+                            for line in lines))
+
+    def should_attribute_samples_to_message_type(self):
+        with open(self.prefix + '.collapsed') as f:
+            self.assertIn('greeting;', f.read())
+
+    def should_write_cpu_time_per_message_type(self):
+        with open(self.prefix + '.cpu.txt') as f:
+            self.assertIn('greeting', f.read())
+
+    def should_write_memory_profile(self):
+        self.assertTrue(os.path.exists(self.prefix + '.memory.txt'))
+
+
+class SpinningConsumer(Consumer):
+
+    def process_message(self):
+        deadline = time.time() + 0.01
+        while time.time() < deadline:
+            pass
+
+
+class WhenProfilingWorkerThreads(_BaseTestCase):
+
+    def configure(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.profiler = AgentProfiler(self.output_dir, interval=0.001)
+        self.ioloop = FakeIOLoop()
+        self.pool = WorkerPool(SpinningConsumer(), self.ioloop, 2,
+                               profiler=self.profiler)
+        self.addCleanup(self.pool.stop)
+        self.ioloop.add_busy_check(lambda: self.pool.busy)
+
+    def execute(self):
+        self.prefix = self.profiler.start(0.5)
+        for index in range(10):
+            message = NonCallableMagicMock(type='job-%d' % (index % 2))
+            self.pool.submit(message, lambda *args: None)
+        self.ioloop.run_until_idle()
+        self.profiler._thread.join()
+
+    def should_attribute_worker_samples_to_their_messages(self):
+        with open(self.prefix + '.collapsed') as f:
+            stacks = f.read()
+        self.assertIn('job-0;', stacks)
+        self.assertIn('job-1;', stacks)
+        self.assertIn('process_message', stacks)
+
+    def should_measure_cpu_time_on_worker_threads(self):
+        self.assertEqual(self.profiler._messages, {'job-0': 5, 'job-1': 5})
+        self.assertGreater(self.profiler._cpu['job-0'], 0)
+
+
+class WhenProfileAlreadyRunning(_BaseTestCase):
+
+    def configure(self):
+        self.profiler = AgentProfiler()
+        self.profiler.active = True
+
+    def execute(self):
+        self.response = self.profiler.handle_request({'seconds': '5'})
+
+    def should_not_start_another_profile(self):
+        self.assertEqual(self.response, 'A profile is already running.\n')
+
+
+class WhenProfileDurationIsInvalid(_BaseTestCase):
+
+    def configure(self):
+        self.profiler = AgentProfiler()
+
+    def execute(self):
+        self.response = self.profiler.handle_request({'seconds': 'abc'})
+
+    def should_refuse_request(self):
+        self.assertEqual(self.response, "Invalid seconds: 'abc'\n")
+
+    def should_not_claim_profiler(self):
+        self.assertFalse(self.profiler.active)
+
+
+class WhenProfilingOnSignal(_BaseTestCase):
+    __contexts__ = (
+        ('signal', patch(mod + '.signal.signal')),
+    )
+
+    def configure(self):
+        self.profiler = AgentProfiler()
+        self.profiler.start = MagicMock()
+        self.ioloop = MagicMock()
+
+    def execute(self):
+        self.profiler.install_signal_handler(self.ioloop)
+        signum, handler = self.ctx.signal.call_args[0]
+        self.signum = signum
+        handler(signum, None)
+
+    def should_handle_sigusr2(self):
+        self.assertEqual(self.signum, signal.SIGUSR2)
+
+    def should_start_profile_on_ioloop(self):
+        self.assertFalse(self.profiler.start.called)
+        self.ioloop.add_callback_from_signal.assert_called_once_with(
+            self.profiler.start)
+
+
+class WhenNotProfiling(_BaseTestCase):
+
+    def configure(self):
+        self.profiler = AgentProfiler()
+        self.message = NonCallableMagicMock(type='greeting')
+
+    def execute(self):
+        with patch(mod + '.thread_time') as thread_time:
+            self.profiler.begin(self.message)
+            self.profiler.end(self.message)
+        self.thread_time = thread_time
+
+    def should_not_measure_cpu_time(self):
+        self.assertFalse(self.thread_time.called)
@@ -1,8 +1,12 @@
+import time
+
 from mock import call, MagicMock, patch, PropertyMock, sentinel
 from pika.exceptions import ConnectionClosed, ChannelClosed
 
+from pikachewie.broker import BrokerConnectionError
 from pikachewie.publisher import (BlockingJSONPublisher, BlockingPublisher,
                                   JSONPublisherMixin)
+from pikachewie.testing import FakeBroker
 from tests import _BaseTestCase
 
 mod = 'pikachewie.publisher'
@@ -24,6 +28,38 @@ class DescribeBlockingPublisher(_BaseTestCase):
     def should_have_channel(self):
         self.assertIs(self.publisher.channel, self.channel)
 
+    def should_not_share_lock_with_other_publishers(self):
+        self.assertIsNot(self.publisher._lock,
+                         BlockingPublisher(self.broker)._lock)
+
+
+class LegacyPublisher(BlockingPublisher):
+
+    def __init__(self, broker):
+        self.broker = broker
+
+
+class WhenSubclassSkipsInit(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.broker.connect(blocking=True).channel().queue_declare('q')
+        self.publisher = LegacyPublisher(self.broker)
+
+    def execute(self):
+        self.publisher.publish('', 'q', 'body')
+        self.publisher.process_data_events()
+
+    def should_publish(self):
+        self.assertEqual(len(self.broker.server.queues['q'].messages), 1)
+
+    def should_keep_one_lock(self):
+        self.assertIs(self.publisher._lock, self.publisher._lock)
+
+    def should_not_share_lock_with_other_publishers(self):
+        self.assertIsNot(self.publisher._lock,
+                         LegacyPublisher(self.broker)._lock)
+
 
 class WhenPublishingMessage(_BaseTestCase):
 
@@ -48,10 +84,14 @@ class WhenPublishingMessage(_BaseTestCase):
 
 
 class _BasePublishOnClosedResource(_BaseTestCase):
+    __contexts__ = (
+        ('channel', patch(mod + '.BlockingPublisher.channel',
+                          new_callable=PropertyMock)),
+    )
 
     def configure(self):
         self.publisher = BlockingPublisher(MagicMock())
-        BlockingPublisher.channel = self.channel = PropertyMock(is_open=True)
+        self.channel = self.ctx.channel
         self.channel().basic_publish = \
             MagicMock(side_effect=[self.exception_cls(), None])
         self.publisher._build_basic_properties = \
@@ -120,3 +160,94 @@ class WhenPublishingJSONMessage(_BaseTestCase):
 
     def should_set_content_type(self):
         self.assertEqual(self.properties.content_type, 'application/json')
+
+
+class _BaseKeepaliveTestCase(_BaseTestCase):
+    keepalive = None
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.publisher = BlockingPublisher(self.broker,
+                                           keepalive=self.keepalive)
+
+    def tearDown(self):
+        self.publisher.close()
+
+
+class WhenKeepingAliveUnopenedPublisher(_BaseKeepaliveTestCase):
+
+    def execute(self):
+        self.broker.connect = MagicMock(wraps=self.broker.connect)
+        self.publisher.keep_alive()
+
+    def should_not_connect(self):
+        self.assertFalse(self.broker.connect.called)
+
+
+class WhenKeepingAliveOpenPublisher(_BaseKeepaliveTestCase):
+
+    def execute(self):
+        self.channel = self.publisher.channel
+        self.channel.connection.process_data_events = MagicMock()
+        self.publisher.keep_alive()
+
+    def should_process_data_events(self):
+        self.channel.connection.process_data_events.assert_called_once_with(
+            time_limit=0)
+
+    def should_keep_channel(self):
+        self.assertIs(self.publisher.channel, self.channel)
+
+
+class WhenKeepingAlivePublisherWithLostConnection(_BaseKeepaliveTestCase):
+
+    def execute(self):
+        self.channel = self.publisher.channel
+        self.channel.connection.close(320, 'CONNECTION_FORCED')
+        self.publisher.keep_alive()
+
+    def should_reconnect(self):
+        self.assertIsNot(self.publisher._channel, self.channel)
+        self.assertTrue(self.publisher._channel.is_open)
+
+
+class WhenKeepaliveCannotReconnect(_BaseKeepaliveTestCase):
+
+    def execute(self):
+        self.publisher.channel.connection.close()
+        self.broker.connect = MagicMock(
+            side_effect=BrokerConnectionError())
+        self.publisher.keep_alive()
+
+    def should_retry_later(self):
+        self.broker.connect = MagicMock(wraps=FakeBroker().connect)
+        self.publisher.keep_alive()
+        self.assertTrue(self.publisher._channel.is_open)
+
+
+class WhenRunningKeepaliveThread(_BaseKeepaliveTestCase):
+    keepalive = 0.01
+
+    def execute(self):
+        self.channel = self.publisher.channel
+        self.channel.connection.close()
+        deadline = time.time() + 5
+        while self.publisher._channel is self.channel and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+    def should_reconnect_in_background(self):
+        self.assertIsNot(self.publisher._channel, self.channel)
+
+    def should_stop_thread_on_close(self):
+        self.publisher.close()
+        self.assertFalse(self.publisher._keepalive_thread.is_alive())
+        self.assertIsNone(self.publisher._channel)
+
+
+class WhenKeepaliveIsTrue(_BaseKeepaliveTestCase):
+    keepalive = True
+
+    def should_use_default_interval(self):
+        self.assertEqual(self.publisher.keepalive,
+                         BlockingPublisher.DEFAULT_KEEPALIVE_INTERVAL)
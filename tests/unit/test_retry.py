@@ -0,0 +1,211 @@
+from mock import ANY, MagicMock, NonCallableMagicMock
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.exceptions import ConsumerException
+from pikachewie.retry import RetryPolicy
+from pikachewie.testing import FakeBroker, FakeIOLoop, FakeServer
+from tests import _BaseTestCase, unittest
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class DescribeRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(initial_delay=1, multiplier=2, max_delay=5,
+                                  max_attempts=5)
+
+    def should_back_off_exponentially(self):
+        self.assertEqual([self.policy.delay(n) for n in range(1, 4)],
+                         [1000, 2000, 4000])
+
+    def should_cap_delay(self):
+        self.assertEqual(self.policy.delay(5), 5000)
+
+    def should_have_one_tier_per_distinct_delay(self):
+        self.assertEqual(self.policy.delays, [1000, 2000, 4000, 5000])
+
+    def should_declare_retry_queue_per_tier(self):
+        queues = [kwargs['queue'] for method, kwargs
+                  in self.policy.topology('q')
+                  if method == 'queue_declare']
+        self.assertEqual(queues, ['q.retry.1000', 'q.retry.2000',
+                                  'q.retry.4000', 'q.retry.5000',
+                                  'q.parked'])
+
+    def should_dead_letter_retry_queues_back_to_origin(self):
+        declarations = self.policy.topology('q')
+        self.assertIn(('queue_bind', {'queue': 'q',
+                                      'exchange': 'q.retry.return',
+                                      'routing_key': ''}), declarations)
+        self.assertEqual(declarations[3][1]['arguments'], {
+            'x-message-ttl': 1000,
+            'x-dead-letter-exchange': 'q.retry.return',
+        })
+
+    def should_reject_invalid_delays(self):
+        self.assertRaises(ValueError, RetryPolicy, initial_delay=10,
+                          max_delay=1)
+
+
+class _BaseOutputTestCase(_BaseTestCase):
+    headers = {}
+
+    def configure(self):
+        self.policy = RetryPolicy(max_attempts=2)
+        self.message = NonCallableMagicMock(exchange='x', routing_key='k',
+                                            body='body')
+        self.message.properties = Properties()
+        self.message.properties.headers = dict(self.headers)
+        self.message.headers = self.message.properties.headers
+
+    def execute(self):
+        self.outcome, output = self.policy.output_for('q', self.message)
+        self.kwargs = dict(zip(('exchange', 'routing_key', 'body',
+                                'properties'), output))
+
+
+class WhenRetryingFirstFailure(_BaseOutputTestCase):
+
+    def should_publish_to_retry_exchange(self):
+        self.assertEqual(self.kwargs['exchange'], 'q.retry')
+
+    def should_keep_routing_key(self):
+        self.assertEqual(self.kwargs['routing_key'], 'k')
+
+    def should_count_retry(self):
+        self.assertEqual(self.kwargs['properties'].headers['x-retry-count'], 1)
+
+    def should_record_original_exchange(self):
+        self.assertEqual(
+            self.kwargs['properties'].headers['x-original-exchange'], 'x')
+
+    def should_return_retried(self):
+        self.assertEqual(self.outcome, 'retried')
+
+
+class WhenRetryingLastFailure(_BaseOutputTestCase):
+    headers = {'x-retry-count': 2}
+
+    def should_publish_to_parking_queue(self):
+        self.assertEqual(self.kwargs['exchange'], '')
+        self.assertEqual(self.kwargs['routing_key'], 'q.parked')
+
+    def should_return_parked(self):
+        self.assertEqual(self.outcome, 'parked')
+
+
+class FailingConsumer(Consumer):
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = []
+        self.routing_keys = []
+
+    def process_message(self):
+        self.attempts.append(self.message.headers.get('x-retry-count', 0))
+        self.routing_keys.append(self.message.routing_key)
+        if len(self.attempts) <= self.failures:
+            raise ConsumerException('dependency is down')
+
+
+class _BaseRetryingAgentTestCase(_BaseTestCase):
+    failures = 1
+
+    def configure(self):
+        self.clock = Clock()
+        self.server = FakeServer(FakeIOLoop(self.clock))
+        self.broker = FakeBroker(server=self.server)
+        self.consumer = FailingConsumer(self.failures)
+        self.hook = MagicMock()
+        self.agent = self.make_agent()
+        self.agent.connect()
+        self.server.ioloop.run_until_idle()
+        self.before_publishing()
+        channel = self.broker.connect(blocking=True).channel()
+        channel.basic_publish('x', 'k', 'body')
+        self.server.ioloop.run_until_idle()
+
+    def make_agent(self):
+        return ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'k'}],
+            retry={'initial_delay': 1, 'max_attempts': 2}, hooks=[self.hook])
+
+    def before_publishing(self):
+        pass
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.server.ioloop.run_until_idle()
+
+    def depth(self, queue):
+        return len(self.server.queues[queue].messages)
+
+
+class WhenConsumerFails(_BaseRetryingAgentTestCase):
+
+    def should_not_redeliver_immediately(self):
+        self.assertEqual(self.consumer.attempts, [0])
+
+    def should_hold_message_in_retry_queue(self):
+        self.assertEqual(self.depth('q.retry.1000'), 1)
+
+    def should_acknowledge_original(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+
+    def should_acknowledge_through_hooks(self):
+        self.hook.message_acknowledged.assert_called_once_with(
+            self.agent, ANY, ANY)
+
+
+class WhenRetryDelayPasses(_BaseRetryingAgentTestCase):
+
+    def execute(self):
+        self.advance(1)
+
+    def should_redeliver_with_retry_count(self):
+        self.assertEqual(self.consumer.attempts, [0, 1])
+
+    def should_keep_original_routing_key(self):
+        self.assertEqual(self.consumer.routing_keys, ['k', 'k'])
+
+    def should_empty_retry_queue(self):
+        self.assertEqual(self.depth('q.retry.1000'), 0)
+
+
+class WhenEveryRetryFails(_BaseRetryingAgentTestCase):
+    failures = 3
+
+    def execute(self):
+        self.advance(1)
+        self.advance(2)
+
+    def should_back_off_between_attempts(self):
+        self.assertEqual(self.consumer.attempts, [0, 1, 2])
+
+    def should_park_message(self):
+        self.assertEqual(self.depth('q.parked'), 1)
+
+
+
+class WhenRetryExchangeIsMissing(_BaseRetryingAgentTestCase):
+
+    def before_publishing(self):
+        self.server.delete_exchange('q.retry')
+
+    def should_requeue_original(self):
+        self.assertEqual(self.consumer.attempts, [0, 0])
+
+    def should_acknowledge_message_once_processed(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+        self.assertEqual(self.hook.message_acknowledged.call_count, 1)
@@ -0,0 +1,149 @@
+from mock import MagicMock
+
+from pikachewie.exceptions import MessageException
+from pikachewie.routing import RoutedConsumer, TopicTrie, route
+from tests import _BaseTestCase, unittest
+
+
+class DescribeTopicTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = TopicTrie()
+        for pattern in ('a.b.c', 'a.*.c', 'a.#', '#', '#.c', 'a.#.c', '*',
+                        'a.b'):
+            self.trie.add(pattern, pattern)
+
+    def should_count_patterns(self):
+        self.assertEqual(len(self.trie), 8)
+
+    def should_match_in_order_added(self):
+        self.assertEqual(self.trie.match('a.b.c'),
+                         ['a.b.c', 'a.*.c', 'a.#', '#', '#.c', 'a.#.c'])
+
+    def should_let_hash_match_zero_words(self):
+        self.assertEqual(self.trie.match('a.c'),
+                         ['a.#', '#', '#.c', 'a.#.c'])
+
+    def should_let_hash_match_many_words(self):
+        self.assertEqual(self.trie.match('a.x.y.c'),
+                         ['a.#', '#', '#.c', 'a.#.c'])
+
+    def should_let_star_match_exactly_one_word(self):
+        self.assertEqual(self.trie.match('z'), ['#', '*'])
+
+    def should_match_nothing_else(self):
+        trie = TopicTrie()
+        trie.add('a.*', 'a')
+        self.assertEqual(trie.match('b.c'), [])
+        self.assertEqual(trie.match('a'), [])
+        self.assertEqual(trie.match('a.b.c'), [])
+
+
+class OrderConsumer(RoutedConsumer):
+    routes = (('orders.eu.created', 'process_european_order'),)
+
+    def __init__(self):
+        self.handled = []
+
+    def process_european_order(self):
+        self.handled.append('european')
+
+    @route('orders.*.created')
+    def process_new_order(self):
+        self.handled.append('new')
+
+    @route('orders.#', 'refunds.#')
+    def process_other(self):
+        self.handled.append('other')
+
+
+class _BaseRoutedConsumerTestCase(_BaseTestCase):
+    consumer_class = OrderConsumer
+    routing_key = None
+
+    def configure(self):
+        self.consumer = self.consumer_class()
+        self.message = MagicMock(routing_key=self.routing_key)
+
+    def execute(self):
+        self.consumer.process(self.message)
+
+
+class WhenRoutingToMostPreciseHandler(_BaseRoutedConsumerTestCase):
+    routing_key = 'orders.us.created'
+
+    def should_call_first_matching_handler(self):
+        self.assertEqual(self.consumer.handled, ['new'])
+
+    def should_cache_handler_name(self):
+        trie, cache = OrderConsumer._routing_table()
+        self.assertEqual(cache['orders.us.created'], 'process_new_order')
+
+
+class WhenRoutingByRoutesAttribute(_BaseRoutedConsumerTestCase):
+    routing_key = 'orders.eu.created'
+
+    def should_prefer_listed_routes(self):
+        self.assertEqual(self.consumer.handled, ['european'])
+
+
+class WhenRoutingToHandlerWithManyPatterns(_BaseRoutedConsumerTestCase):
+    routing_key = 'refunds.eu'
+
+    def should_call_handler(self):
+        self.assertEqual(self.consumer.handled, ['other'])
+
+
+class WhenNoRouteMatches(_BaseRoutedConsumerTestCase):
+    routing_key = 'invoices.eu'
+
+    def execute(self):
+        pass
+
+    def should_raise_message_exception(self):
+        self.assertRaises(MessageException, self.consumer.process,
+                          self.message)
+
+
+class DefaultingOrderConsumer(OrderConsumer):
+
+    @route('invoices.*')
+    def process_invoice(self):
+        self.handled.append('invoice')
+
+    def process_unrouted(self):
+        self.handled.append('default')
+
+
+class WhenNoRouteMatchesWithDefaultHandler(_BaseRoutedConsumerTestCase):
+    consumer_class = DefaultingOrderConsumer
+    routing_key = 'payments'
+
+    def should_call_default_handler(self):
+        self.assertEqual(self.consumer.handled, ['default'])
+
+
+class WhenSubclassAddsRoutes(_BaseRoutedConsumerTestCase):
+    consumer_class = DefaultingOrderConsumer
+    routing_key = 'invoices.eu'
+
+    def should_inherit_and_extend_routes(self):
+        self.assertEqual(self.consumer.handled, ['invoice'])
+
+    def should_not_change_base_class_routes(self):
+        self.assertIsNone(OrderConsumer.handler_name('invoices.eu'))
+
+
+class WhenRoutingCacheIsFull(_BaseTestCase):
+
+    def configure(self):
+        self.consumer_class = type('SmallCacheConsumer', (OrderConsumer,),
+                                   {'_CACHE_SIZE': 2})
+
+    def execute(self):
+        for routing_key in ('orders.a', 'orders.b', 'orders.c'):
+            self.consumer_class.handler_name(routing_key)
+
+    def should_bound_cache(self):
+        trie, cache = self.consumer_class._routing_table()
+        self.assertEqual(list(cache), ['orders.c'])
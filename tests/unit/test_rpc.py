@@ -0,0 +1,259 @@
+from mock import MagicMock
+from pika.exceptions import ChannelClosed
+from pika.spec import BasicProperties
+
+from pikachewie.data import Properties
+from pikachewie.rpc import (BlockingJSONRpcClient, BlockingRpcClient,
+                            RpcError, RpcTimeout)
+from pikachewie.testing import FakeBroker, FakeIOLoop, FakeServer
+from tests import _BaseTestCase
+
+
+class TickingClock(object):
+    """A clock that advances by `tick` seconds each time it is read."""
+
+    def __init__(self, now=1000.0, tick=0.0):
+        self.now = now
+        self.tick = tick
+
+    def __call__(self):
+        self.now += self.tick
+        return self.now
+
+
+class _BaseRpcTestCase(_BaseTestCase):
+    servers = ('a',)
+    timeout = 10
+    client_class = BlockingRpcClient
+
+    def configure(self):
+        self.clock = TickingClock()
+        self.server = FakeServer(FakeIOLoop(self.clock))
+        self.broker = FakeBroker(server=self.server)
+        self.requests = []
+        channel = self.broker.connect(blocking=True).channel()
+        channel.exchange_declare('rpc', 'topic')
+        for name in self.servers:
+            channel.queue_declare(name)
+            channel.queue_bind(name, 'rpc', name)
+            channel.basic_consume(self.responder(name), name, no_ack=True)
+        self.client = self.client_class(self.broker, timeout=self.timeout,
+                                        time_func=self.clock)
+
+    def responder(self, name):
+        def respond(channel, method, properties, body):
+            self.requests.append((name, properties, body))
+            channel.basic_publish(
+                '', properties.reply_to, '%s: %s' % (name, body),
+                BasicProperties(correlation_id=properties.correlation_id))
+        return respond
+
+
+class WhenCallingRemoteProcedure(_BaseRpcTestCase):
+
+    def execute(self):
+        self.reply = self.client.call('rpc', 'a', 'ping')
+
+    def should_return_reply(self):
+        self.assertEqual(self.reply.body, 'a: ping')
+
+    def should_reply_to_direct_reply_to(self):
+        properties = self.requests[0][1]
+        self.assertTrue(
+            properties.reply_to.startswith('amq.rabbitmq.reply-to.'))
+
+    def should_expire_request_with_call(self):
+        self.assertEqual(self.requests[0][1].expiration, '10000')
+
+    def should_forget_call(self):
+        self.assertEqual(self.client.pending, 0)
+
+    def should_reuse_channel(self):
+        channel = self.client.channel
+        self.client.call('rpc', 'a', 'pong')
+        self.assertIs(self.client.channel, channel)
+
+
+class WhenMakingConcurrentCalls(_BaseRpcTestCase):
+
+    def execute(self):
+        self.futures = [self.client.call_async('rpc', 'a', str(n))
+                        for n in range(3)]
+        self.replies = [future.result() for future in reversed(self.futures)]
+
+    def should_use_unique_correlation_ids(self):
+        self.assertEqual(
+            len(set(future.correlation_id for future in self.futures)), 3)
+
+    def should_match_replies_to_calls(self):
+        self.assertEqual([reply.body for reply in self.replies],
+                         ['a: 2', 'a: 1', 'a: 0'])
+
+
+class WhenCallingWithProperties(_BaseRpcTestCase):
+
+    def execute(self):
+        self.properties = Properties()
+        self.properties.expiration = 500
+        self.client.call('rpc', 'a', 'ping', self.properties)
+
+    def should_keep_expiration(self):
+        self.assertEqual(self.requests[0][1].expiration, '500')
+
+    def should_not_modify_properties(self):
+        self.assertIsNone(self.properties.correlation_id)
+
+
+class WhenCallTimesOut(_BaseRpcTestCase):
+    servers = ()
+    timeout = 3
+
+    def configure(self):
+        super(WhenCallTimesOut, self).configure()
+        self.clock.tick = 0.01
+
+    def execute(self):
+        self.future = self.client.call_async('rpc', 'a', 'ping')
+
+    def should_raise_rpc_timeout(self):
+        self.assertRaises(RpcTimeout, self.future.result)
+
+    def should_forget_call(self):
+        self.future.exception()
+        self.assertEqual(self.client.pending, 0)
+
+    def should_raise_rpc_timeout_when_result_times_out(self):
+        self.client.timeout = None
+        future = self.client.call_async('rpc', 'a', 'ping')
+        self.assertRaises(RpcTimeout, future.result, 2)
+        self.assertFalse(future.done())
+
+
+class WhenCallTimesOutBeforeDelivery(_BaseRpcTestCase):
+
+    def execute(self):
+        self.future = self.client.call_async('rpc', 'a', 'ping')
+        self.clock.now += self.timeout
+        self.client.wait([self.future])
+
+    def should_time_out(self):
+        self.assertIsInstance(self.future.exception(), RpcTimeout)
+
+    def should_expire_request(self):
+        self.assertEqual(self.requests, [])
+
+
+class WhenReplyArrivesAfterCancel(_BaseRpcTestCase):
+
+    def execute(self):
+        self.future = self.client.call_async('rpc', 'a', 'ping')
+        self.future.cancel()
+        self.client.wait([self.future])
+        self.client.channel.connection.process_data_events()
+
+    def should_fail_call(self):
+        self.assertIsInstance(self.future.exception(), RpcError)
+
+    def should_discard_reply(self):
+        self.assertEqual(len(self.requests), 1)
+        self.assertIsNone(self.future._reply)
+
+
+class WhenScatteringRequests(_BaseRpcTestCase):
+    servers = ('a', 'b', 'c')
+
+    def execute(self):
+        self.replies = self.client.scatter(
+            [('rpc', name, 'ping') for name in ('a', 'b', 'c')])
+
+    def should_gather_every_reply(self):
+        self.assertEqual(sorted(reply.body for reply in self.replies),
+                         ['a: ping', 'b: ping', 'c: ping'])
+
+
+class WhenGatheringQuorum(_BaseRpcTestCase):
+    servers = ('a', 'b')
+
+    def execute(self):
+        self.futures = [self.client.call_async('rpc', name, 'ping')
+                        for name in ('a', 'b', 'c')]
+        self.replies = self.client.gather(self.futures, quorum=2)
+
+    def should_return_quorum_of_replies(self):
+        self.assertEqual(len(self.replies), 2)
+
+    def should_cancel_outstanding_calls(self):
+        self.assertIsInstance(self.futures[2].exception(), RpcError)
+        self.assertEqual(self.client.pending, 0)
+
+
+class WhenGatheringUntilDeadline(_BaseRpcTestCase):
+    servers = ('a',)
+    timeout = None
+
+    def configure(self):
+        super(WhenGatheringUntilDeadline, self).configure()
+        self.clock.tick = 0.01
+
+    def execute(self):
+        properties = Properties()
+        properties.expiration = 60000
+        self.replies = self.client.scatter(
+            [('rpc', name, 'ping', properties) for name in ('a', 'b')],
+            timeout=5)
+
+    def should_return_replies_received_by_deadline(self):
+        self.assertEqual([reply.body for reply in self.replies], ['a: ping'])
+
+    def should_forget_calls(self):
+        self.assertEqual(self.client.pending, 0)
+
+
+class WhenReplyChannelCloses(_BaseRpcTestCase):
+
+    def execute(self):
+        self.server.queues['a'].consumers[0].channel._close()
+        self.future = self.client.call_async('rpc', 'a', 'ping')
+        self.client.channel._close(320, 'CONNECTION_FORCED')
+        self.client.wait([self.future])
+
+    def should_fail_pending_calls(self):
+        self.assertIsInstance(self.future.exception(), RpcError)
+
+    def should_reopen_channel_for_next_call(self):
+        future = self.client.call_async('rpc', 'a', 'ping')
+        self.assertTrue(self.client.channel.is_open)
+        self.assertFalse(future.done())
+
+
+class WhenCallingWithJSONPayload(_BaseRpcTestCase):
+    client_class = BlockingJSONRpcClient
+
+    def execute(self):
+        self.client.call('rpc', 'a', {'sku': 1234})
+
+    def should_serialize_payload(self):
+        name, properties, body = self.requests[0]
+        self.assertEqual(body, '{"sku": 1234}')
+        self.assertEqual(properties.content_type, 'application/json')
+
+
+class WhenPublishingToDirectReplyToWithoutConsuming(_BaseTestCase):
+
+    def configure(self):
+        self.channel = FakeBroker().connect(blocking=True).channel()
+
+    def should_close_channel(self):
+        self.assertRaises(
+            ChannelClosed, self.channel.basic_publish, '', 'a', 'ping',
+            BasicProperties(reply_to='amq.rabbitmq.reply-to'))
+
+
+class WhenConsumingDirectReplyToWithAcks(_BaseTestCase):
+
+    def configure(self):
+        self.channel = FakeBroker().connect(blocking=True).channel()
+
+    def should_close_channel(self):
+        self.assertRaises(ChannelClosed, self.channel.basic_consume,
+                          MagicMock(), 'amq.rabbitmq.reply-to')
@@ -0,0 +1,127 @@
+from threading import Event
+
+from mock import MagicMock, NonCallableMagicMock, sentinel
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.scheduling import DeliveryScheduler
+from pikachewie.testing import FakeBroker, FakeIOLoop
+from pikachewie.workers import WorkerPool
+from tests import _BaseTestCase, unittest
+
+
+def message(name, routing_key='k', priority=None, deadline=None):
+    return NonCallableMagicMock(name=name, routing_key=routing_key,
+                                priority=priority,
+                                expiration_timestamp=deadline)
+
+
+class _BaseSchedulerTestCase(_BaseTestCase):
+    messages = ()
+
+    def configure(self):
+        self.scheduler = DeliveryScheduler()
+
+    def execute(self):
+        for item in self.messages:
+            self.scheduler.put((item, sentinel.callback))
+        self.order = []
+        while not self.scheduler.empty():
+            self.order.append(self.scheduler.get()[0])
+
+
+class WhenSchedulingByPriority(_BaseSchedulerTestCase):
+    messages = (message('low', priority=1), message('none'),
+                message('high', priority=9))
+
+    def should_serve_highest_priority_first(self):
+        self.assertEqual(self.order, [self.messages[2], self.messages[0],
+                                      self.messages[1]])
+
+
+class WhenSchedulingByDeadline(_BaseSchedulerTestCase):
+    messages = (message('never'), message('later', deadline=2000.0),
+                message('sooner', deadline=1000.0))
+
+    def should_serve_earliest_deadline_first(self):
+        self.assertEqual(self.order, [self.messages[2], self.messages[1],
+                                      self.messages[0]])
+
+
+class WhenSchedulingAcrossRoutingKeys(_BaseSchedulerTestCase):
+    messages = (message('a1', 'bulk'), message('a2', 'bulk'),
+                message('a3', 'bulk'), message('b1', 'orders'),
+                message('b2', 'orders'))
+
+    def should_alternate_between_routing_keys(self):
+        self.assertEqual([item._mock_name for item in self.order],
+                         ['a1', 'b1', 'a2', 'b2', 'a3'])
+
+
+class WhenSchedulingStopToken(_BaseTestCase):
+
+    def configure(self):
+        self.scheduler = DeliveryScheduler()
+        self.stop = object()
+
+    def execute(self):
+        self.scheduler.put(self.stop)
+        self.scheduler.put((message('m'), sentinel.callback))
+
+    def should_serve_stop_token_before_waiting_messages(self):
+        self.assertIs(self.scheduler.get(), self.stop)
+        self.assertIsInstance(self.scheduler.get(), tuple)
+
+
+class WhenAgentProcessesConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = ConsumerAgent(MagicMock(), FakeBroker(),
+                                   sentinel.bindings, concurrency=2)
+        self.agent.connection = self.agent.broker.connect()
+
+    def tearDown(self):
+        self.agent.workers.stop()
+
+    def should_schedule_waiting_messages(self):
+        self.agent._submit(message('m'))
+        self.assertIsInstance(self.agent.workers._queue, DeliveryScheduler)
+
+    def should_not_schedule_if_disabled(self):
+        self.agent.schedule = False
+        self.agent._submit(message('m'))
+        self.assertNotIsInstance(self.agent.workers._queue,
+                                 DeliveryScheduler)
+
+
+class BlockingConsumer(Consumer):
+
+    def __init__(self, started, release):
+        self.started = started
+        self.release = release
+        self.processed = []
+
+    def process(self, message):
+        self.started.set()
+        self.release.wait(5)
+        self.processed.append(message)
+
+
+class WhenShrinkingScheduledPool(unittest.TestCase):
+
+    def setUp(self):
+        self.started, self.release = Event(), Event()
+        self.consumer = BlockingConsumer(self.started, self.release)
+        self.pool = WorkerPool(self.consumer, FakeIOLoop(), 1,
+                               DeliveryScheduler())
+        for name in ('m1', 'm2', 'm3'):
+            self.pool.submit(message(name), sentinel.callback)
+        self.started.wait(5)
+        self.pool.resize(0)
+        self.release.set()
+        for thread in self.pool._threads:
+            thread.join(5)
+
+    def should_retire_worker_before_waiting_messages(self):
+        self.assertEqual([item._mock_name for item in
+                          self.consumer.processed], ['m1'])
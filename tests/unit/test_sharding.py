@@ -0,0 +1,211 @@
+import threading
+
+from mock import MagicMock
+from pika.exceptions import NackError
+
+from pikachewie.publisher import BlockingPublisher
+from pikachewie.sharding import PublishError, ShardedPublisher
+from pikachewie.testing import FakeBroker
+from tests import _BaseTestCase
+
+
+class RecordingPublisher(object):
+    published = None
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.messages = []
+        self.closed = False
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        if body == 'fail':
+            raise ValueError('Nacked')
+        self.messages.append((routing_key, body))
+
+    def close(self):
+        self.closed = True
+
+
+class NackingChannel(object):
+    is_open = True
+
+    def __init__(self):
+        self.connection = MagicMock(is_open=False)
+        self.messages = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if body == 'nack':
+            return False
+        self.messages.append((routing_key, body))
+        return True
+
+
+class NackingPublisher(BlockingPublisher):
+
+    def __init__(self, broker):
+        super(NackingPublisher, self).__init__(broker)
+        self.nacking_channel = NackingChannel()
+
+    @property
+    def channel(self):
+        return self.nacking_channel
+
+
+class _BaseShardedPublisherTestCase(_BaseTestCase):
+
+    def configure(self):
+        self.publisher = ShardedPublisher(
+            FakeBroker({'a': {}, 'b': {}}), shards=3,
+            publisher_class=RecordingPublisher)
+
+    def tearDown(self):
+        self.publisher.close()
+
+
+class WhenPublishingByRoutingKey(_BaseShardedPublisherTestCase):
+
+    def execute(self):
+        for index in range(30):
+            self.publisher.publish('x', 'key%d' % (index % 5), str(index))
+        self.flushed = self.publisher.flush()
+
+    def should_flush(self):
+        self.assertTrue(self.flushed)
+        self.assertEqual(self.publisher.pending, 0)
+
+    def should_publish_each_key_on_one_shard_in_order(self):
+        for key in ('key%d' % index for index in range(5)):
+            shard = self.publisher.shards[self.publisher.shard_for(key)]
+            self.assertEqual(
+                [body for routing_key, body in shard.messages
+                 if routing_key == key],
+                [str(index) for index in range(30)
+                 if 'key%d' % (index % 5) == key])
+
+    def should_publish_every_message_once(self):
+        self.assertEqual(sum(len(shard.messages)
+                             for shard in self.publisher.shards), 30)
+
+    def should_spread_shards_across_nodes(self):
+        self.assertEqual([shard.broker._nodes[0][0]
+                          for shard in self.publisher.shards],
+                         ['a', 'b', 'a'])
+
+
+class WhenPublishingUnordered(_BaseShardedPublisherTestCase):
+
+    def execute(self):
+        for index in range(6):
+            self.publisher.publish('x', 'k', str(index), ordered=False)
+        self.publisher.flush()
+
+    def should_publish_round_robin(self):
+        self.assertEqual([len(shard.messages)
+                          for shard in self.publisher.shards], [2, 2, 2])
+
+
+class WhenShardFailsToPublish(_BaseShardedPublisherTestCase):
+
+    def execute(self):
+        self.publisher.publish('x', 'k', 'ok')
+        self.publisher.publish('x', 'k', 'fail')
+
+    def should_raise_publish_error_on_flush(self):
+        with self.assertRaises(PublishError) as context:
+            self.publisher.flush()
+        self.assertEqual(context.exception.failures[0][0],
+                         ('x', 'k', 'fail', None))
+
+    def should_report_failures_once(self):
+        self.assertRaises(PublishError, self.publisher.flush)
+        self.assertTrue(self.publisher.flush())
+
+
+class WhenBrokerNacksMessage(_BaseTestCase):
+
+    def configure(self):
+        self.publisher = ShardedPublisher(FakeBroker(), shards=2,
+                                          publisher_class=NackingPublisher)
+
+    def execute(self):
+        for body in ('1', 'nack', '2'):
+            self.publisher.publish('x', 'k', body)
+        self.publisher.publish('x', 'other', '3')
+        with self.assertRaises(PublishError) as context:
+            self.publisher.flush()
+        self.failures = context.exception.failures
+
+    def tearDown(self):
+        self.publisher.close()
+
+    def published(self):
+        return sorted(message for shard in self.publisher.shards
+                      for message in shard.channel.messages)
+
+    def should_report_nacked_message(self):
+        item, exc = self.failures[0]
+        self.assertEqual(item, ('x', 'k', 'nack', None))
+        self.assertIsInstance(exc, NackError)
+
+    def should_not_publish_later_messages_with_same_key(self):
+        item, exc = self.failures[1]
+        self.assertEqual(item, ('x', 'k', '2', None))
+        self.assertEqual(exc.failures, [self.failures[0]])
+        self.assertEqual(self.published(), [('k', '1'), ('other', '3')])
+
+    def should_publish_key_again_after_flush(self):
+        self.publisher.publish('x', 'k', '4')
+        self.assertTrue(self.publisher.flush())
+        self.assertIn(('k', '4'), self.published())
+
+
+class WhenFlushTimesOut(_BaseShardedPublisherTestCase):
+
+    def execute(self):
+        self.release = threading.Event()
+        shard = self.publisher.shards[self.publisher.shard_for('k')]
+        shard.publish = lambda *args: self.release.wait()
+        self.publisher.publish('x', 'k', 'slow')
+        self.flushed = self.publisher.flush(timeout=0.01)
+        self.release.set()
+
+    def should_return_false(self):
+        self.assertFalse(self.flushed)
+
+
+class WhenClosingShardedPublisher(_BaseShardedPublisherTestCase):
+
+    def execute(self):
+        self.publisher.publish('x', 'k', 'last')
+        self.publisher.close()
+
+    def tearDown(self):
+        pass
+
+    def should_publish_queued_messages(self):
+        self.assertEqual(self.publisher.pending, 0)
+
+    def should_close_every_shard(self):
+        self.assertTrue(all(shard.closed for shard in self.publisher.shards))
+
+
+class WhenPublishingToFakeBroker(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        channel = self.broker.connect(blocking=True).channel()
+        channel.queue_declare('q')
+        self.server = self.broker.server
+        self.publisher = ShardedPublisher(self.broker, shards=2)
+
+    def execute(self):
+        for index in range(20):
+            self.publisher.publish('', 'q', str(index))
+        self.publisher.flush()
+        self.publisher.close()
+
+    def should_publish_in_order(self):
+        self.assertEqual(
+            [envelope.body for envelope in self.server.queues['q'].messages],
+            [str(index) for index in range(20)])
+
@@ -0,0 +1,343 @@
+from mock import MagicMock, sentinel
+from pika.exceptions import ChannelClosed
+from pika.spec import BasicProperties
+
+from pikachewie.agent import ConsumerAgent
+from pikachewie.consumer import Consumer
+from pikachewie.data import Properties
+from pikachewie.exceptions import MessageException
+from pikachewie.publisher import BlockingJSONPublisher
+from pikachewie.testing import (FakeBlockingConnection, FakeBroker,
+                                FakeConnection, FakeIOLoop, FakeServer,
+                                topic_matches)
+from tests import _BaseTestCase, unittest
+
+
+class RecordingConsumer(Consumer):
+
+    def __init__(self, exc=None):
+        self.exc = exc
+        self.messages = []
+
+    def process_message(self):
+        self.messages.append(self.message)
+        if self.exc:
+            raise self.exc
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class DescribeTopicMatches(unittest.TestCase):
+
+    def should_match_exact_key(self):
+        self.assertTrue(topic_matches('a.b.c', 'a.b.c'))
+
+    def should_match_one_word_with_star(self):
+        self.assertTrue(topic_matches('a.*.c', 'a.b.c'))
+
+    def should_not_match_two_words_with_star(self):
+        self.assertFalse(topic_matches('a.*', 'a.b.c'))
+
+    def should_match_zero_words_with_hash(self):
+        self.assertTrue(topic_matches('a.#', 'a'))
+
+    def should_match_many_words_with_hash(self):
+        self.assertTrue(topic_matches('a.#.d', 'a.b.c.d'))
+
+    def should_not_match_different_key(self):
+        self.assertFalse(topic_matches('a.b', 'a.c'))
+
+
+class DescribeFakeIOLoop(_BaseTestCase):
+
+    def configure(self):
+        self.clock = Clock()
+        self.ioloop = FakeIOLoop(self.clock)
+        self.calls = []
+
+    def execute(self):
+        self.ioloop.add_callback(self.calls.append, 'now')
+        self.ioloop.call_later(5, self.calls.append, 'later')
+        self.cancelled = self.ioloop.call_later(1, self.calls.append, 'never')
+        self.ioloop.remove_timeout(self.cancelled)
+        self.ioloop.run_until_idle()
+
+    def should_run_callbacks(self):
+        self.assertEqual(self.calls, ['now'])
+
+    def should_run_due_timeouts(self):
+        self.clock.now += 5
+        self.ioloop.run_until_idle()
+        self.assertEqual(self.calls, ['now', 'later'])
+
+
+class DescribeFakeBroker(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+
+    def should_create_server(self):
+        self.assertIsInstance(self.broker.server, FakeServer)
+
+    def should_open_async_connection(self):
+        self.assertIsInstance(self.broker.connect(), FakeConnection)
+
+    def should_open_blocking_connection(self):
+        self.assertIsInstance(self.broker.connect(blocking=True),
+                              FakeBlockingConnection)
+
+    def should_call_on_open_callback(self):
+        callback = MagicMock()
+        connection = self.broker.connect(callback)
+        self.broker.server.ioloop.run_until_idle()
+        callback.assert_called_once_with(connection)
+
+
+class _BaseExchangeTestCase(_BaseTestCase):
+    exchange_type = 'direct'
+    bindings = ()
+    routing_key = ''
+    headers = None
+
+    def configure(self):
+        self.server = FakeServer()
+        self.channel = FakeBroker(server=self.server).connect(
+            blocking=True).channel()
+        self.channel.exchange_declare('x', self.exchange_type)
+        for queue, routing_key, arguments in self.bindings:
+            self.channel.queue_declare(queue)
+            self.channel.queue_bind(queue, 'x', routing_key, arguments)
+
+    def execute(self):
+        self.channel.basic_publish('x', self.routing_key, 'body',
+                                   BasicProperties(headers=self.headers))
+
+    def depth(self, queue):
+        return len(self.server.queues[queue].messages)
+
+
+class WhenPublishingToDirectExchange(_BaseExchangeTestCase):
+    bindings = (('q1', 'a', None), ('q2', 'b', None))
+    routing_key = 'a'
+
+    def should_route_to_matching_queue(self):
+        self.assertEqual((self.depth('q1'), self.depth('q2')), (1, 0))
+
+
+class WhenPublishingToTopicExchange(_BaseExchangeTestCase):
+    exchange_type = 'topic'
+    bindings = (('q1', 'a.*', None), ('q2', '#', None), ('q3', 'b.#', None))
+    routing_key = 'a.b'
+
+    def should_route_to_matching_queues(self):
+        self.assertEqual((self.depth('q1'), self.depth('q2'),
+                          self.depth('q3')), (1, 1, 0))
+
+
+class WhenPublishingToFanoutExchange(_BaseExchangeTestCase):
+    exchange_type = 'fanout'
+    bindings = (('q1', 'a', None), ('q2', 'b', None))
+    routing_key = 'c'
+
+    def should_route_to_all_queues(self):
+        self.assertEqual((self.depth('q1'), self.depth('q2')), (1, 1))
+
+
+class WhenPublishingToHeadersExchange(_BaseExchangeTestCase):
+    exchange_type = 'headers'
+    bindings = (
+        ('q1', '', {'x-match': 'all', 'a': 1, 'b': 2}),
+        ('q2', '', {'x-match': 'any', 'a': 1, 'b': 3}),
+        ('q3', '', {'a': 2}),
+    )
+    headers = {'a': 1, 'b': 2}
+
+    def should_route_to_matching_queues(self):
+        self.assertEqual((self.depth('q1'), self.depth('q2'),
+                          self.depth('q3')), (1, 1, 0))
+
+
+class WhenPublishingToMissingExchange(_BaseTestCase):
+
+    def configure(self):
+        self.channel = FakeBroker().connect(blocking=True).channel()
+
+    def execute(self):
+        with self.assertRaises(ChannelClosed) as context:
+            self.channel.basic_publish('nope', '', 'body')
+        self.exc = context.exception
+
+    def should_close_channel(self):
+        self.assertFalse(self.channel.is_open)
+
+    def should_raise_not_found(self):
+        self.assertEqual(self.exc.args[0], 404)
+
+
+class WhenPassivelyDeclaringQueue(_BaseTestCase):
+
+    def configure(self):
+        self.channel = FakeBroker().connect(blocking=True).channel()
+        self.channel.queue_declare('q')
+        self.channel.basic_publish('', 'q', 'body')
+
+    def execute(self):
+        self.frame = self.channel.queue_declare('q', passive=True)
+
+    def should_return_message_count(self):
+        self.assertEqual(self.frame.method.message_count, 1)
+
+    def should_return_consumer_count(self):
+        self.assertEqual(self.frame.method.consumer_count, 0)
+
+
+class _BaseAgentTestCase(_BaseTestCase):
+    exc = None
+    config = {
+        'exchanges': {'x': {'exchange_type': 'topic'}},
+        'queues': {'q': {'arguments': {'x-dead-letter-exchange': 'dlx'}}},
+    }
+
+    def configure(self):
+        self.clock = Clock()
+        self.server = FakeServer(FakeIOLoop(self.clock))
+        self.broker = FakeBroker(server=self.server)
+        self.consumer = RecordingConsumer(self.exc)
+        self.agent = ConsumerAgent(
+            self.consumer, self.broker,
+            [{'queue': 'q', 'exchange': 'x', 'routing_key': 'a.#'}],
+            config=self.config)
+        self.agent.connect()
+        self.server.ioloop.run_until_idle()
+        channel = self.broker.connect(blocking=True).channel()
+        channel.exchange_declare('dlx', 'fanout')
+        channel.queue_declare('dead')
+        channel.queue_bind('dead', 'dlx')
+        self.publisher = BlockingJSONPublisher(self.broker)
+
+    def publish(self, payload, routing_key='a.b', **kwargs):
+        properties = Properties()
+        for key, value in kwargs.items():
+            setattr(properties, key, value)
+        properties.timestamp = int(self.clock.now)
+        self.publisher.publish('x', routing_key, payload, properties)
+
+    def depth(self, queue):
+        return len(self.server.queues[queue].messages)
+
+
+class WhenConsumingFromFakeBroker(_BaseAgentTestCase):
+
+    def execute(self):
+        self.publish({'n': 1})
+        self.publish({'n': 2}, routing_key='b.a')
+        self.server.ioloop.run_until_idle()
+
+    def should_consume_matching_messages(self):
+        self.assertEqual([m.payload for m in self.consumer.messages],
+                         [{'n': 1}])
+
+    def should_acknowledge_messages(self):
+        self.assertEqual(self.agent.channel._unacked, {})
+
+    def should_empty_queue(self):
+        self.assertEqual(self.depth('q'), 0)
+
+
+class WhenConsumerRejectsMessage(_BaseAgentTestCase):
+    exc = MessageException()
+
+    def execute(self):
+        self.publish({'n': 1})
+        self.server.ioloop.run_until_idle()
+
+    def should_dead_letter_message(self):
+        self.assertEqual(self.depth('dead'), 1)
+
+    def should_record_death(self):
+        envelope = self.server.queues['dead'].messages[0]
+        death = envelope.properties.headers['x-death'][0]
+        self.assertEqual((death['reason'], death['queue'], death['count']),
+                         ('rejected', 'q', 1))
+
+
+class WhenMessageExpiresInQueue(_BaseAgentTestCase):
+
+    def execute(self):
+        self.agent.channel.basic_cancel(
+            consumer_tag=self.agent._consumer_tags['q'])
+        self.publish({'n': 1}, expiration='1000')
+        self.server.ioloop.run_until_idle()
+        self.clock.now += 1
+        self.server.ioloop.run_until_idle()
+
+    def should_dead_letter_message(self):
+        self.assertEqual((self.depth('q'), self.depth('dead')), (0, 1))
+
+    def should_record_death(self):
+        envelope = self.server.queues['dead'].messages[0]
+        death = envelope.properties.headers['x-death'][0]
+        self.assertEqual(death['reason'], 'expired')
+
+
+class WhenPrefetchLimitReached(_BaseAgentTestCase):
+
+    def execute(self):
+        self.agent.acknowledge = MagicMock()
+        self.agent.channel.basic_qos(prefetch_count=2)
+        for n in range(5):
+            self.publish({'n': n})
+        self.server.ioloop.run_until_idle()
+
+    def should_deliver_up_to_prefetch_count(self):
+        self.assertEqual(len(self.consumer.messages), 2)
+
+    def should_keep_remaining_messages_queued(self):
+        self.assertEqual(self.depth('q'), 3)
+
+    def should_requeue_unacked_messages_on_close(self):
+        self.agent.channel.close()
+        self.assertEqual(self.depth('q'), 5)
+
+
+class WhenAcknowledgingUnknownDeliveryTag(_BaseAgentTestCase):
+
+    def execute(self):
+        self.channel = self.agent.channel
+        self.on_close = MagicMock()
+        self.channel.add_on_close_callback(self.on_close)
+        self.channel.basic_ack(sentinel.delivery_tag)
+        self.server.ioloop.run_until_idle()
+
+    def should_close_channel(self):
+        self.assertFalse(self.channel.is_open)
+
+    def should_report_precondition_failed(self):
+        self.assertEqual(self.on_close.call_args[0][1], 406)
+
+
+class WhenConfirmingPublishes(_BaseTestCase):
+
+    def configure(self):
+        self.broker = FakeBroker()
+        self.connection = self.broker.connect()
+        self.channel = self.connection.channel()
+        self.on_confirm = MagicMock()
+        self.channel.confirm_delivery(self.on_confirm)
+
+    def execute(self):
+        self.channel.basic_publish('', 'nowhere', 'body')
+        self.channel.basic_publish('', 'nowhere', 'body')
+        self.broker.server.ioloop.run_until_idle()
+
+    def should_ack_each_publish(self):
+        tags = [c[0][0].method.delivery_tag
+                for c in self.on_confirm.call_args_list]
+        self.assertEqual(tags, [1, 2])
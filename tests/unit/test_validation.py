@@ -0,0 +1,215 @@
+from decimal import Decimal
+
+from mock import MagicMock, patch
+from pika.spec import Basic, BasicProperties
+
+from pikachewie.consumer import Consumer
+from pikachewie.exceptions import MessageException, ValidationException
+from pikachewie.message import Message
+from pikachewie.validation import SchemaRegistry, compile_schema
+from tests import _BaseTestCase
+
+mod = 'pikachewie.validation'
+
+ORDER = {
+    'type': 'object',
+    'required': ['id', 'lines'],
+    'properties': {
+        'id': {'type': 'integer'},
+        'note': {'type': ['string', 'null']},
+        'lines': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'required': ['sku'],
+                'properties': {'sku': {'type': 'string'},
+                               'price': {'type': 'number'}},
+            },
+        },
+    },
+}
+
+
+def make_message(body, type=None, routing_key='orders.created'):
+    header = BasicProperties(content_type='application/json', type=type)
+    method = Basic.Deliver(routing_key=routing_key)
+    return Message(None, method, header, body)
+
+
+class WhenCheckingShape(_BaseTestCase):
+
+    def configure(self):
+        self.validate = compile_schema(ORDER, shape_only=True)
+
+    def invalid(self, payload):
+        with self.assertRaises(ValidationException) as context:
+            self.validate(payload)
+        return str(context.exception)
+
+    def should_accept_valid_payload(self):
+        self.validate({'id': 1, 'note': None, 'extra': True,
+                       'lines': [{'sku': 'a', 'price': Decimal('1.5')},
+                                 {'sku': 'b', 'price': 2}]})
+
+    def should_reject_wrong_type(self):
+        self.assertEqual(self.invalid([]), '$: expected object, not list')
+
+    def should_reject_missing_property(self):
+        self.assertEqual(self.invalid({'id': 1}),
+                         "$: missing required property 'lines'")
+
+    def should_reject_nested_property(self):
+        self.assertEqual(
+            self.invalid({'id': 1, 'lines': [{'sku': 'a'}, {'sku': 2}]}),
+            "$['lines'][1]['sku']: expected string, not int")
+
+    def should_reject_boolean_as_number(self):
+        self.invalid({'id': True, 'lines': []})
+
+    def should_accept_any_of_several_types(self):
+        self.validate({'id': 1, 'lines': [], 'note': 'rush'})
+
+    def should_reject_unknown_type(self):
+        self.assertRaises(ValueError, compile_schema, {'type': 'thing'},
+                          shape_only=True)
+
+
+class WhenCompilingSchemaAgain(_BaseTestCase):
+
+    def execute(self):
+        self.first = compile_schema(dict(ORDER), shape_only=True)
+        self.second = compile_schema(dict(ORDER), shape_only=True)
+
+    def should_reuse_validator(self):
+        self.assertIs(self.first, self.second)
+
+
+class WhenCompilingFullSchema(_BaseTestCase):
+    __contexts__ = (
+        ('jsonschema', patch(mod + '.jsonschema')),
+        ('_compiled', patch.dict(mod + '._compiled', clear=True)),
+    )
+
+    def configure(self):
+        self.cls = self.ctx.jsonschema.validators.validator_for.return_value
+        self.compiled = self.cls.return_value
+        self.compiled.is_valid.side_effect = lambda payload: payload == 1
+        error = self.ctx.jsonschema.exceptions.best_match.return_value
+        error.absolute_path = ['lines', 0]
+        error.message = 'bad line'
+        self.schema = {'type': 'integer', 'minimum': 1}
+
+    def execute(self):
+        self.validate = compile_schema(self.schema)
+
+    def should_check_schema(self):
+        self.cls.check_schema.assert_called_once_with(self.schema)
+
+    def should_compile_schema(self):
+        self.cls.assert_called_once_with(self.schema)
+
+    def should_accept_valid_payload(self):
+        self.validate(1)
+
+    def should_report_best_error(self):
+        with self.assertRaises(ValidationException) as context:
+            self.validate(0)
+        self.assertEqual(str(context.exception), "$['lines'][0]: bad line")
+
+
+class WhenJsonSchemaIsMissing(_BaseTestCase):
+    __contexts__ = (
+        ('jsonschema', patch(mod + '.jsonschema', None)),
+        ('_compiled', patch.dict(mod + '._compiled', clear=True)),
+    )
+
+    def execute(self):
+        with self.assertRaises(ImportError):
+            compile_schema({'type': 'string', 'maxLength': 3})
+        self.validate = compile_schema({'type': 'string', 'maxLength': 3},
+                                       shape_only=True)
+
+    def should_check_shape_without_jsonschema(self):
+        self.validate('long string')
+
+
+class WhenChoosingSchema(_BaseTestCase):
+
+    def configure(self):
+        self.registry = SchemaRegistry(shape_only=True)
+        self.registry.add({'type': 'array'}, type='batch')
+        self.registry.add({'type': 'object'}, routing_key='orders.*')
+        self.registry.add({'type': 'string'}, routing_key='#')
+
+    def validator(self, **kwargs):
+        return self.registry.validator_for(make_message('', **kwargs))
+
+    def should_choose_by_type(self):
+        self.assertIs(self.validator(type='batch'),
+                      compile_schema({'type': 'array'}, shape_only=True))
+
+    def should_choose_first_matching_routing_key(self):
+        self.assertIs(self.validator(type='other'),
+                      compile_schema({'type': 'object'}, shape_only=True))
+
+    def should_fall_back_to_later_patterns(self):
+        self.assertIs(self.validator(routing_key='prices.eu.updated'),
+                      compile_schema({'type': 'string'}, shape_only=True))
+
+    def should_cache_validator_by_routing_key(self):
+        self.validator()
+        self.assertIn('orders.created', self.registry._cache)
+
+    def should_require_type_or_routing_key(self):
+        self.assertRaises(ValueError, self.registry.add, {})
+
+
+class WhenNoSchemaMatches(_BaseTestCase):
+
+    def configure(self):
+        self.registry = SchemaRegistry(shape_only=True)
+        self.registry.add({'type': 'object'}, routing_key='orders.*')
+
+    def should_not_validate(self):
+        message = make_message('[]', routing_key='prices.updated')
+        self.registry.validate(message, [])
+
+
+class WhenDecodingInvalidPayload(_BaseTestCase):
+
+    def configure(self):
+        self.registry = SchemaRegistry(shape_only=True)
+        self.registry.add(ORDER, routing_key='orders.#')
+        self.message = make_message('{"id": "1", "lines": []}')
+        self.message.validator = self.registry
+
+    def should_raise_message_exception(self):
+        with self.assertRaises(MessageException):
+            self.message.payload
+
+
+class WhenDecodingValidPayload(_BaseTestCase):
+
+    def configure(self):
+        self.registry = SchemaRegistry(shape_only=True)
+        self.registry.add(ORDER, routing_key='orders.#')
+        self.message = make_message('{"id": 1, "lines": []}')
+        self.message.validator = self.registry
+
+    def should_return_payload(self):
+        self.assertEqual(self.message.payload, {'id': 1, 'lines': []})
+
+
+class WhenConsumerHasSchemas(_BaseTestCase):
+
+    def configure(self):
+        self.consumer = Consumer()
+        self.consumer.schemas = SchemaRegistry()
+        self.consumer.process_message = MagicMock()
+        self.message = make_message('{}')
+
+    def execute(self):
+        self.consumer.process(self.message)
+
+    def should_validate_payloads_by_schemas(self):
+        self.assertIs(self.message.validator, self.consumer.schemas)
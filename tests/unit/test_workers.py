@@ -0,0 +1,148 @@
+import threading
+
+from mock import MagicMock, sentinel
+
+from pikachewie.consumer import Consumer
+from pikachewie.testing import FakeIOLoop
+from pikachewie.workers import WorkerPool
+from tests import _BaseTestCase
+
+
+class RecordingConsumer(Consumer):
+
+    def __init__(self, barrier=None):
+        self.barrier = barrier
+        self.threads = set()
+
+    def process(self, message):
+        self.threads.add(threading.current_thread().name)
+        if self.barrier:
+            self.barrier.wait()
+        if isinstance(message, Exception):
+            raise message
+
+
+class _BaseWorkerPoolTestCase(_BaseTestCase):
+    size = 2
+    barrier = None
+
+    def configure(self):
+        self.ioloop = FakeIOLoop()
+        self.consumer = RecordingConsumer(self.barrier)
+        self.pool = WorkerPool(self.consumer, self.ioloop, self.size)
+        self.ioloop.add_busy_check(lambda: self.pool.busy)
+        self.callback = MagicMock()
+
+    def tearDown(self):
+        self.pool.stop()
+
+
+class WhenSubmittingMessages(_BaseWorkerPoolTestCase):
+
+    def execute(self):
+        for _ in range(4):
+            self.pool.submit(sentinel.message, self.callback)
+        self.ioloop.run_until_idle()
+
+    def should_call_callback_for_each_message(self):
+        self.assertEqual(self.callback.call_count, 4)
+
+    def should_pass_message_and_no_exception(self):
+        message, exc, seconds = self.callback.call_args[0]
+        self.assertIs(message, sentinel.message)
+        self.assertIsNone(exc)
+
+    def should_not_be_busy(self):
+        self.assertFalse(self.pool.busy)
+
+    def should_process_on_worker_threads(self):
+        self.assertNotIn(threading.current_thread().name,
+                         self.consumer.threads)
+
+
+class WhenConsumerRaises(_BaseWorkerPoolTestCase):
+
+    def execute(self):
+        self.exc = ValueError('bad message')
+        self.pool.submit(self.exc, self.callback)
+        self.ioloop.run_until_idle()
+
+    def should_pass_exception_to_callback(self):
+        self.assertIs(self.callback.call_args[0][1], self.exc)
+
+
+class WhenWorkersRunConcurrently(_BaseWorkerPoolTestCase):
+    size = 3
+
+    def configure(self):
+        # every worker must be processing at once to pass the barrier
+        if hasattr(threading, 'Barrier'):
+            self.barrier = threading.Barrier(3, timeout=5)
+        super(WhenWorkersRunConcurrently, self).configure()
+
+    def execute(self):
+        for _ in range(3):
+            self.pool.submit(sentinel.message, self.callback)
+        self.ioloop.run_until_idle()
+
+    def should_process_every_message(self):
+        self.assertEqual(self.callback.call_count, 3)
+
+    def should_use_every_worker(self):
+        if self.barrier is not None:
+            self.assertEqual(len(self.consumer.threads), 3)
+
+
+class WhenResizingPool(_BaseWorkerPoolTestCase):
+
+    def execute(self):
+        self.pool.resize(4)
+        self.grown = len([t for t in self.pool._threads if t.is_alive()])
+        self.pool.resize(1)
+        self.pool.submit(sentinel.message, self.callback)
+        self.ioloop.run_until_idle()
+
+    def should_grow(self):
+        self.assertEqual(self.grown, 4)
+
+    def should_record_size(self):
+        self.assertEqual(self.pool.size, 1)
+
+    def should_keep_processing(self):
+        self.callback.assert_called_once_with(sentinel.message, None,
+                                              self.callback.call_args[0][2])
+
+
+class GatedConsumer(Consumer):
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def process(self, message):
+        self.started.set()
+        self.release.wait(5)
+
+
+class WhenStoppingWithWaitingMessages(_BaseTestCase):
+
+    def configure(self):
+        self.ioloop = FakeIOLoop()
+        self.consumer = GatedConsumer()
+        self.pool = WorkerPool(self.consumer, self.ioloop, 1)
+        self.ioloop.add_busy_check(lambda: self.pool.busy)
+        self.callback = MagicMock()
+
+    def execute(self):
+        for _ in range(3):
+            self.pool.submit(sentinel.message, self.callback)
+        self.consumer.started.wait(5)
+        self.pool.stop()
+        self.consumer.release.set()
+        self.ioloop.run_until_idle()
+
+    def should_finish_current_message(self):
+        self.assertEqual(self.callback.call_count, 1)
+
+    def should_discard_waiting_messages(self):
+        self.assertFalse(self.pool.busy)